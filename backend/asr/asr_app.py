@@ -1,14 +1,22 @@
 import asyncio
+import os
+import threading
+import time
 from collections import deque
-from typing import Optional, Deque, Tuple, List, Any, Dict
+from typing import Optional, Deque, Tuple, List, Any, Dict, Callable, Awaitable
 
 import numpy as np
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
-from faster_whisper import WhisperModel
 import uvicorn
 import json
-import aiohttp
 import hashlib, uuid
+from backend.common.startup import Startup
+from backend.common.arbiter import ArbiterClient
+from backend.common.stats import LatencyWindow
+from backend.common.text import END_PUNCTS
+from backend.common.trace import Tracer, new_trace_id
+
+STARTUP = Startup("asr")        # 进程起来就开始监听；whisper 在后台加载，/ready 之前 /ws_asr 以 1013 拒绝
 SESSION_ID = "sess-" + uuid.uuid4().hex[:8]
 
 # =========================
@@ -33,17 +41,41 @@ SHORT_PAUSE_MS = 300                    # 有结束标点时，较短静音即
 STABLE_NOCHANGE_MS = 1500               # 文本在这么久没有变化 -> 也final
 SILENCE_RMS_THRESH = 0.005              # 静音阈值（RMS），按需微调
 SILENCE_WINDOW_MS = 300                 # 静音判定看最近这段音频
-END_PUNCTS = set("。.!！？?")
-POST_TO_LLM_URL = "http://127.0.0.1:8001/receive_text"  # 指向 llm.py
+# END_PUNCTS 见 backend/common/text.py（与 LLM→TTS 分句共用）
+POST_TO_LLM_URL = os.getenv("POST_TO_LLM_URL", "http://127.0.0.1:8001/receive_text")  # 指向 llm.py
+# /ws_asr 的 final 是否推给 llm.py 落库（默认关：前端自己拿 final 调 /llm）
+ASR_PUSH_FINAL = os.getenv("ASR_PUSH_FINAL", "0") == "1"
+# 投机生成（可选）：partial 稳定这么久就下发 {"type":"stable"}，前端据此提前调 /llm/speculate
+# 0 = 关闭（默认）。需小于 STABLE_NOCHANGE_MS，否则规则3会先 final。
+SPECULATE_STABLE_MS = int(os.getenv("ASR_SPECULATE_STABLE_MS", "0"))
+# 与 TTS 同机时的算力仲裁（backend/common/arbiter.py）：每次 tick 解码前借令牌，asr 优先
+# CPU 解码固定用 ASR_CPU_THREADS 个线程（默认半数核，另一半留给 TTS）；GPU 解码借一个 GPU 槽位
+ASR_CPU_THREADS = int(os.getenv("ASR_CPU_THREADS", str(max(1, (os.cpu_count() or 2) // 2))))
 
 # =========================
-# 模型初始化（进程级别只加载一次）
+# 模型初始化（进程级别只加载一次）：faster_whisper / ctranslate2 在这里才导入，
+# 由 startup 事件放到后台线程跑（见 backend/common/startup.py），/ws_chat 共用同一个
 # =========================
-model = WhisperModel(
-    MODEL_PATH,
-    device=WHISPER_DEVICE,
-    compute_type=WHISPER_COMPUTE_TYPE,
-)
+model = None
+_MODEL_LOCK = threading.Lock()
+
+def load_model():
+    global model
+    with _MODEL_LOCK:
+        if model is None:
+            from faster_whisper import WhisperModel
+            model = WhisperModel(
+                MODEL_PATH,
+                device=WHISPER_DEVICE,
+                compute_type=WHISPER_COMPUTE_TYPE,
+                cpu_threads=ASR_CPU_THREADS,
+            )
+    return model
+
+STARTUP.background("whisper", load_model)
+ARBITER = ArbiterClient("asr", resource="gpu" if WHISPER_DEVICE == "cuda" else "cpu")
+TICK_MS = LatencyWindow()       # 每次 tick 解码耗时（含等令牌），GET /stats
+TRACER = Tracer("asr")          # 每句话一个 trace：speech_start 时生成，随消息下发（backend/common/trace.py）
 
 
 # ======= 端点器状态机（NEW） =======
@@ -54,6 +86,7 @@ class Endpointor:
         self.last_change_ts = None      # partial 最近一次变化的「时间」
         self.silence_acc_ms = 0         # 连续静音累计
         self.in_speech = False          # 是否在说话中
+        self.stable_sent = False        # 当前 partial 是否已作为 stable 下发过
 
     def reset_sentence(self):
         self.text_buffer = ""
@@ -61,6 +94,19 @@ class Endpointor:
         self.last_change_ts = None
         self.silence_acc_ms = 0
         self.in_speech = False
+        self.stable_sent = False
+
+    def stable_candidate(self, now_ms: float) -> str:
+        """
+        partial 已稳定 SPECULATE_STABLE_MS 且未上报过 → 返回该文本；否则返回 ""。
+        每个不同的 partial 最多上报一次。
+        """
+        if SPECULATE_STABLE_MS <= 0 or self.stable_sent or not self.last_text:
+            return ""
+        if self.last_change_ts is None or (now_ms - self.last_change_ts) < SPECULATE_STABLE_MS:
+            return ""
+        self.stable_sent = True
+        return self.last_text.strip()
 
     def update(
         self,
@@ -80,6 +126,7 @@ class Endpointor:
         if partial_text != self.last_text:
             self.last_text = partial_text
             self.last_change_ts = now_ms
+            self.stable_sent = False
 
         # 静音累计
         if is_silence:
@@ -145,33 +192,232 @@ class Session:
     def close(self):
         self._closed = True
 
+# =========================
+# 解码循环（/ws_asr 与 /ws_chat 共用）
+# =========================
+def _transcribe(audio_feed: np.ndarray):
+    t0 = time.perf_counter()
+    want = 1 if ARBITER.resource == "gpu" else ASR_CPU_THREADS
+    with ARBITER.lease(want, min_threads=want):
+        segments, info = model.transcribe(
+            audio_feed,
+            language=LANGUAGE,
+            beam_size=BEAM_SIZE,
+            vad_filter=USE_VAD,
+            vad_parameters=dict(min_silence_duration_ms=200),
+            condition_on_previous_text=False,
+            initial_prompt=None,
+            word_timestamps=False,
+        )
+        # segments 是惰性生成器，真正的解码发生在迭代时，所以在线程里一并取完
+        segments = list(segments)
+    TICK_MS.add((time.perf_counter() - t0) * 1000.0)
+    return segments, info
+
+
+def _drop_utterance(utter, outcome: str, ts: Optional[float]):
+    """没产出 final 的一句也要结束它的 span（outcome 说明原因），不然在 trace 里整句消失"""
+    if utter is not None:
+        utter.set(outcome=outcome)
+        utter.end(ts)
+
+
+async def run_transcriber(sess: "Session", emit: Callable[[Dict[str, Any]], Awaitable[None]]):
+    """
+    每 tick 取环形缓冲的片段跑一次 whisper，
+    通过 emit(msg) 下发 partial / stable / final 消息（msg 为 dict，由调用方决定如何发送）。
+    """
+    ep = Endpointor()                                  # NEW
+    last_voice_ts = None                               # 最近一次非静音 tick 的墙钟时间，≈ 说话结束时刻
+    voiced = False                                     # 本句是否已下发过 speech_start
+    utter = None                                       # 本句的 asr span，trace_id 随消息下发
+    try:
+        now_ms = 0.0
+        tick_ms = TICK_SECONDS * 1000.0
+        while not sess._closed:
+            await asyncio.sleep(TICK_SECONDS)
+            now_ms += tick_ms
+
+            audio = sess.snapshot()
+            ###########################防重复######################################
+
+            # 当前位置对应的全局起点（snapshot里第一帧在全局的下标）
+            current_total = sess.total_samples
+            if audio is None:
+                continue
+            snapshot_start_global = current_total - len(audio)
+
+            # 只解码 last_final_offset 之后的音频；留一点重叠避免边界截断
+            OVERLAP_S = 0.20  # 200ms
+            slice_start = max(0, int(sess.last_final_offset - snapshot_start_global))
+            slice_start = max(0, slice_start - int(OVERLAP_S * SAMPLE_RATE))
+
+            audio_feed = audio[slice_start:]
+            if len(audio_feed) < SAMPLE_RATE * 0.3:
+                continue
+
+            # 如果你还想限制窗口大小（比如8秒），在 feed 上再截一次
+            if DECODE_WINDOW_SECONDS is not None:
+                max_len = int(SAMPLE_RATE * DECODE_WINDOW_SECONDS)
+                if len(audio_feed) > max_len:
+                    audio_feed = audio_feed[-max_len:]
+                    # 若做了末尾截断，slice_start 也要相应移动到 snapshot 内的实际起点
+                    slice_start = len(audio) - len(audio_feed)
+            ############################防重复#####################################
+            if audio is None or len(audio) < SAMPLE_RATE * 0.3:   # 少于0.3秒就先不跑
+                continue
+
+            # 仅解码最近 N 秒
+            if DECODE_WINDOW_SECONDS is not None:
+                max_len = int(SAMPLE_RATE * DECODE_WINDOW_SECONDS)
+                if len(audio) > max_len:
+                    audio = audio[-max_len:]
+
+            # 计算是否静音（最近SILENCE_WINDOW_MS窗口）
+            rms = rms_recent(audio, SAMPLE_RATE, SILENCE_WINDOW_MS)   # NEW
+            is_silence = (rms < SILENCE_RMS_THRESH)                   # NEW
+            if not is_silence:
+                last_voice_ts = time.time()
+
+            # === 说话起点（打断信号）：静音 → 有声 的跳变，先于解码下发（NEW） ===
+            if not is_silence and not voiced:
+                voiced = True
+                # 上一句长静音后没出 final（或 final 为空）就被重置了：先把它的 span 结束掉
+                _drop_utterance(utter, "no_final", None)
+                utter = TRACER.span(new_trace_id(), "asr", start=last_voice_ts)
+                utter.mark("speech_start", last_voice_ts)
+                await emit({"type": "speech_start", "ts": last_voice_ts, "trace_id": utter.trace_id})
+            elif is_silence and ep.silence_acc_ms >= END_SILENCE_MS:
+                voiced = False
+
+            # whisper 解码（放到线程里，避免阻塞事件循环上的 LLM/TTS 流）
+            segments, info = await asyncio.to_thread(_transcribe, audio_feed)
+
+            seg_texts = []
+            seg_ts = []
+            for seg in segments:
+                seg_texts.append(seg.text)
+                seg_ts.append((seg.start, seg.end, seg.text))
+
+            partial_text = "".join(seg_texts).strip()
+
+            # 去抖：只在变化时下发 partial
+            if partial_text and partial_text != sess.last_partial_text:
+                sess.last_partial_text = partial_text
+                await emit({
+                    "type": "partial",
+                    "text": partial_text,
+                    "avg_logprob": getattr(info, "avg_logprob", None),
+                    "language": getattr(info, "language", None),
+                    "trace_id": utter.trace_id if utter else None,
+                })
+
+            # === 端点器决定是否最终化（NEW） ===
+            should_final, final_text = ep.update(
+                now_ms=now_ms,
+                partial_text=partial_text,
+                is_silence=is_silence,
+                tick_ms=tick_ms
+            )
+
+            # === 投机生成：partial 稳定但还没 final（NEW） ===
+            if not should_final:
+                stable_text = ep.stable_candidate(now_ms)
+                if stable_text:
+                    await emit({
+                        "type": "stable",
+                        "text": stable_text,
+                        "trace_id": utter.trace_id if utter else None,
+                    })
+
+            if should_final and final_text:
+                # 幂等保险：同一句在短时间内不重复推送
+                if final_text == sess.last_final_text:
+                    # 已经推过，忽略这次
+                    _drop_utterance(utter, "duplicate_final", last_voice_ts)
+                    utter = None
+                    continue
+                sess.last_final_text = final_text
+                # 根据最后一个 segment 的结束时间推进“全局消费”游标
+                if seg_ts:
+                    last_end_s = seg_ts[-1][1]                         # 这次 feed 内的结束秒
+                    end_in_feed = int(last_end_s * SAMPLE_RATE)        # 转帧
+                    # snapshot 的全局起点 + 本次 feed 在 snapshot 内的起点 + 结束偏移
+                    sess.last_final_offset = (
+                        snapshot_start_global + slice_start + end_in_feed
+                    )
+                if utter is None:
+                    utter = TRACER.span(new_trace_id(), "asr")
+                utter.mark("speech_end", last_voice_ts)
+                utter.mark("final")
+                utter.set(chars=len(final_text), language=getattr(info, "language", None))
+                utter.end()
+                await emit({
+                    "type": "final",
+                    "text": final_text,
+                    "segments": [{"start": s, "end": e, "text": t} for (s, e, t) in seg_ts],
+                    "speech_end_ts": last_voice_ts,
+                    "trace_id": utter.trace_id,
+                })
+                utter = None
+                sess.last_partial_text = ""  # final 后清空去抖
+                # 规则 3（文本稳定）可能在用户还在说话时就出 final：这时不重置，
+                # 否则下一个有声 tick 会再发 speech_start，把刚提交的这句的回复当打断取消掉；
+                # 等长静音分支（silence_acc_ms >= END_SILENCE_MS）再清
+                if is_silence:
+                    voiced = False
+            elif should_final:
+                # 端点到了但识别结果为空（噪声、咳嗽）：这一句到此结束
+                _drop_utterance(utter, "empty_final", last_voice_ts)
+                utter = None
+                if is_silence:
+                    voiced = False
+    except WebSocketDisconnect:
+        pass
+    finally:
+        _drop_utterance(utter, "disconnected", None)
+        sess.close()
+
+
+# =========================
+# final → llm.py 落库
+# =========================
+async def _post_final(payload: Dict[str, Any], idem: str) -> Dict[str, Any]:
+    import aiohttp
+    async with aiohttp.ClientSession() as session:
+        async with session.post(POST_TO_LLM_URL, json=payload, headers={"X-Idempotency-Key": idem}) as resp:
+            return await resp.json()
+
+# 合并部署（backend/pipeline/combined_app.py）时换成 backend.llm.llm.ingest：同进程直接调用
+FINAL_SINK: Callable[[Dict[str, Any], str], Awaitable[Dict[str, Any]]] = _post_final
+
+async def push_final(msg: Dict[str, Any]):
+    payload = {"text": msg["text"], "session_id": SESSION_ID, "segments": msg.get("segments"),
+               "trace_id": msg.get("trace_id")}
+    idem = f"{SESSION_ID}:{hashlib.sha1(msg['text'].encode('utf-8')).hexdigest()}"
+    try:
+        result = await FINAL_SINK(payload, idem)
+        print(f"[ASR 模块] 推送结果: {result}")
+    except Exception as e:
+        print(f"[ASR 模块] 推送失败: {type(e).__name__}: {e}")
+
+
+@app.get("/stats")
+def stats():
+    return {"tick_ms": TICK_MS.summary(), "cpu_threads": ASR_CPU_THREADS, "arbiter": ARBITER.summary(),
+            "trace": TRACER.summary(), "startup": STARTUP.summary()}
+
+
 # =========================
 # WebSocket 路由
 # =========================
 @app.websocket("/ws_asr")
 async def ws_asr(ws: WebSocket):
     await ws.accept()
+    if not await STARTUP.wait_ready():
+        await ws.close(code=1013, reason="asr model loading")     # 1013 = Try Again Later
+        return
     sess = Session()
-    session_id = 0 # todo
-    async def push_to_webhook(final_text: str):
-        async with aiohttp.ClientSession() as session:
-            async with session.post(POST_TO_LLM_URL, json={"text": final_text, "session_id": session_id}) as resp:
-                result = await resp.json()
-                print(f"[ASR 模块] 推送结果: {result}")
-    # async def push_to_webhook(final_text: str, language=None, avg_logprob=None, segments=None):
-    #     idem = f"{SESSION_ID}:{hashlib.sha1(final_text.encode('utf-8')).hexdigest()}"
-    #     payload = {
-    #         "text": final_text,
-    #         "session_id": SESSION_ID,
-    #         "language": language,
-    #         "avg_logprob": avg_logprob,
-    #         "segments": segments,   # 你已有的 seg_ts 可直接传
-    #     }
-    #     async with aiohttp.ClientSession() as s:
-    #         async with s.post(POST_TO_LLM_URL, json=payload,
-    #                         headers={"X-Idempotency-Key": idem}) as r:
-    #             print("[ASR] 推送结果:", await r.text())
-
     # ---- 接收端：读取 config + 连续 PCM 帧 ----
     async def receiver():
         try:
@@ -214,122 +460,14 @@ async def ws_asr(ws: WebSocket):
             sess.close()
 
     # ---- 解码端：每 tick 取环形缓冲的片段跑一次 whisper ----
-    async def transcriber():
-        ep = Endpointor()                                  # NEW
-        try:
-            now_ms = 0.0
-            tick_ms = TICK_SECONDS * 1000.0
-            while not sess._closed:
-                await asyncio.sleep(TICK_SECONDS)
-                now_ms += tick_ms
-
-                audio = sess.snapshot()
-                ###########################防重复######################################
-
-                # 当前位置对应的全局起点（snapshot里第一帧在全局的下标）
-                current_total = sess.total_samples
-                if audio is None:
-                    continue
-                snapshot_start_global = current_total - len(audio)
-
-                # 只解码 last_final_offset 之后的音频；留一点重叠避免边界截断
-                OVERLAP_S = 0.20  # 200ms
-                slice_start = max(0, int(sess.last_final_offset - snapshot_start_global))
-                slice_start = max(0, slice_start - int(OVERLAP_S * SAMPLE_RATE))
-
-                audio_feed = audio[slice_start:]
-                if len(audio_feed) < SAMPLE_RATE * 0.3:
-                    continue
-
-                # 如果你还想限制窗口大小（比如8秒），在 feed 上再截一次
-                if DECODE_WINDOW_SECONDS is not None:
-                    max_len = int(SAMPLE_RATE * DECODE_WINDOW_SECONDS)
-                    if len(audio_feed) > max_len:
-                        audio_feed = audio_feed[-max_len:]
-                        # 若做了末尾截断，slice_start 也要相应移动到 snapshot 内的实际起点
-                        slice_start = len(audio) - len(audio_feed)
-                ############################防重复#####################################
-                if audio is None or len(audio) < SAMPLE_RATE * 0.3:   # 少于0.3秒就先不跑
-                    continue
-
-                # 仅解码最近 N 秒
-                if DECODE_WINDOW_SECONDS is not None:
-                    max_len = int(SAMPLE_RATE * DECODE_WINDOW_SECONDS)
-                    if len(audio) > max_len:
-                        audio = audio[-max_len:]
-
-                # 计算是否静音（最近SILENCE_WINDOW_MS窗口）
-                rms = rms_recent(audio, SAMPLE_RATE, SILENCE_WINDOW_MS)   # NEW
-                is_silence = (rms < SILENCE_RMS_THRESH)                   # NEW
-
-                # whisper 解码
-                segments, info = model.transcribe(
-                    audio_feed,
-                    language=LANGUAGE,
-                    beam_size=BEAM_SIZE,
-                    vad_filter=USE_VAD,
-                    vad_parameters=dict(min_silence_duration_ms=200),
-                    condition_on_previous_text=False,
-                    initial_prompt=None,
-                    word_timestamps=False,
-                )
-
-                seg_texts = []
-                seg_ts = []
-                for seg in segments:
-                    seg_texts.append(seg.text)
-                    seg_ts.append((seg.start, seg.end, seg.text))
-
-                partial_text = "".join(seg_texts).strip()
-
-                # 去抖：只在变化时下发 partial
-                if partial_text and partial_text != sess.last_partial_text:
-                    sess.last_partial_text = partial_text
-                    await ws.send_text(json.dumps({
-                        "type": "partial",
-                        "text": partial_text,
-                        "avg_logprob": getattr(info, "avg_logprob", None),
-                        "language": getattr(info, "language", None),
-                    }))
-
-                # === 端点器决定是否最终化（NEW） ===
-                should_final, final_text = ep.update(
-                    now_ms=now_ms,
-                    partial_text=partial_text,
-                    is_silence=is_silence,
-                    tick_ms=tick_ms
-                )
-                
-                if should_final and final_text:
-                    # 幂等保险：同一句在短时间内不重复推送
-                    if final_text == sess.last_final_text:
-                        # 已经推过，忽略这次
-                        continue
-                    sess.last_final_text = final_text
-                    # 根据最后一个 segment 的结束时间推进“全局消费”游标
-                    if seg_ts:
-                        last_end_s = seg_ts[-1][1]                         # 这次 feed 内的结束秒
-                        end_in_feed = int(last_end_s * SAMPLE_RATE)        # 转帧
-                        # snapshot 的全局起点 + 本次 feed 在 snapshot 内的起点 + 结束偏移
-                        sess.last_final_offset = (
-                            snapshot_start_global + slice_start + end_in_feed
-                        )
-                    await ws.send_text(json.dumps({
-                        "type": "final",
-                        "text": final_text,
-                        "segments": [{"start": s, "end": e, "text": t} for (s, e, t) in seg_ts],
-                    }))
-                    # asyncio.create_task(push_to_webhook(final_text))  # 不阻塞 ASR
-                    sess.last_partial_text = ""  # final 后清空去抖
-        except WebSocketDisconnect:
-            pass
-        finally:
-            sess.close()
-
+    async def emit(msg: Dict[str, Any]):
+        await ws.send_text(json.dumps(msg))
+        if ASR_PUSH_FINAL and msg["type"] == "final":
+            asyncio.create_task(push_final(msg))  # 不阻塞 ASR
 
     # 并发跑“接收端+解码端”
     recv_task = asyncio.create_task(receiver())
-    trans_task = asyncio.create_task(transcriber())
+    trans_task = asyncio.create_task(run_transcriber(sess, emit))
     done, pending = await asyncio.wait(
         {recv_task, trans_task},
         return_when=asyncio.FIRST_COMPLETED,
@@ -337,6 +475,8 @@ async def ws_asr(ws: WebSocket):
     for t in pending:
         t.cancel()
 
+STARTUP.install(app, tracer=TRACER)
+
 if __name__ == "__main__":
     # 用命令行起更好：python app.py 或 uvicorn app:app --host 0.0.0.0 --port 8000
     uvicorn.run(app, host="0.0.0.0", port=8000)
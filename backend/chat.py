@@ -3,21 +3,23 @@ Chat 模块：调用 vLLM / HuggingFace Transformers
 生成角色化回复
 """
 
-from transformers import AutoTokenizer
-import requests
+import json
+import os
+from functools import lru_cache
+from typing import AsyncIterator
 
 # 假设你用 vLLM 起了一个服务：http://localhost:8000/v1
-VLLM_ENDPOINT = "http://localhost:8000/v1/chat/completions"
-MODEL_NAME = "Qwen/Qwen2.5-7B-Instruct"
+VLLM_ENDPOINT = os.getenv("VLLM_ENDPOINT", "http://localhost:8000/v1/chat/completions")
+MODEL_NAME = os.getenv("VLLM_MODEL", "Qwen/Qwen2.5-7B-Instruct")
 
-tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
+@lru_cache(maxsize=1)
+def get_tokenizer():
+    """只在真要数 token 时才导入 transformers 并下载/加载分词器（发 HTTP 请求用不到）"""
+    from transformers import AutoTokenizer
+    return AutoTokenizer.from_pretrained(MODEL_NAME)
 
-def chat_with_role(user_text: str, persona_prompt: str = "") -> str:
-    """
-    输入：用户文本 + 人设提示
-    输出：模型回复
-    """
-    payload = {
+def chat_payload(user_text: str, persona_prompt: str = "", stream: bool = False) -> dict:
+    return {
         "model": MODEL_NAME,
         "messages": [
             {"role": "system", "content": persona_prompt},
@@ -26,9 +28,43 @@ def chat_with_role(user_text: str, persona_prompt: str = "") -> str:
         "max_tokens": 300,
         "temperature": 0.7,
         "top_p": 0.9,
-        "stream": False
+        "stream": stream
     }
 
-    response = requests.post(VLLM_ENDPOINT, json=payload, timeout=60)
+def chat_with_role(user_text: str, persona_prompt: str = "") -> str:
+    """
+    输入：用户文本 + 人设提示
+    输出：模型回复
+    （同步版，脚本里用；异步服务里用 achat_with_role / stream_with_role）
+    """
+    import requests
+    response = requests.post(VLLM_ENDPOINT, json=chat_payload(user_text, persona_prompt), timeout=60)
     data = response.json()
     return data["choices"][0]["message"]["content"].strip()
+
+async def achat_with_role(client, user_text: str, persona_prompt: str = "") -> str:
+    """
+    异步版：client 是调用方共用的 httpx.AsyncClient（连接池），请求期间不占事件循环
+    上游非 2xx 抛 httpx.HTTPStatusError
+    """
+    r = await client.post(VLLM_ENDPOINT, json=chat_payload(user_text, persona_prompt))
+    r.raise_for_status()
+    return r.json()["choices"][0]["message"]["content"].strip()
+
+async def stream_with_role(response) -> AsyncIterator[str]:
+    """
+    逐段产出回复文本：response 是 stream=True 请求已拿到的响应（调用方先检查状态码再开始流式返回），
+    解析 OpenAI 风格 SSE（data: {...choices[0].delta.content} … data: [DONE]）
+    """
+    async for line in response.aiter_lines():
+        if not line.startswith("data: "):
+            continue
+        chunk = line[len("data: "):].strip()
+        if chunk == "[DONE]":
+            break
+        try:
+            delta = json.loads(chunk)["choices"][0]["delta"].get("content")
+        except (ValueError, KeyError, IndexError):
+            continue
+        if delta:
+            yield delta
@@ -0,0 +1,342 @@
+"""
+算力仲裁（单机部署时 ASR 与 TTS 共用一套 CPU/GPU）
+
+asr_app.py（CTranslate2，run_asr.sh 里 CTRANSLATE2_NUM_THREADS=$(nproc)）和 TTS 服务
+（Piper/ONNX Runtime 或 XTTS/torch）都默认整机的核归自己。用户在回复合成时又开口，
+两边同时超订 CPU，谁都变慢。这里起一个本机协调进程，各引擎每次推理前通过 Unix socket
+借“令牌”（CPU 线程数 / GPU 槽位），用完归还：
+
+- 优先级：asr（partial 解码，延迟敏感）= 0 永不排队，令牌不够也先给（宁可短暂超订）；
+  tts = 1 排队等令牌；asr 最近 ARBITER_HOLD_MS 内活跃过，CPU 上为它预留上次的用量（最多一半）
+  （GPU 不预留，只是 asr 在跑时 tts 不开新的块，XTTS 按块借，两次 tick 之间照常合成）；
+- 动态线程预算：授予的线程数 = min(想要的, 当前可用的)，引擎按授予值设线程数
+  （torch.set_num_threads；ONNX/CT2 会话线程数固定的，按整块申请，效果是限制同时跑几个）；
+- 竞争统计：GET /stats（各服务的 arbiter 一节）或 `python -m backend.common.arbiter stats`
+  给出各引擎的等待分位数、被压缩线程数的次数、asr 与 tts 重叠运行的次数。
+
+协调进程没起 / 连不上时，客户端退化为不做限制（直接给想要的线程数），不影响服务。
+
+启动（先于 ASR / TTS 服务）：
+  python -m backend.common.arbiter serve
+"""
+import asyncio
+import heapq
+import itertools
+import json
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+
+from backend.common.stats import LatencyWindow
+
+ARBITER_SOCKET = os.getenv("ARBITER_SOCKET", "/tmp/ai-role-chat-arbiter.sock")
+ARBITER_ENABLED = os.getenv("ARBITER", "1") != "0"
+ARBITER_CPU_TOKENS = int(os.getenv("ARBITER_CPU_TOKENS", str(os.cpu_count() or 4)))
+ARBITER_GPU_TOKENS = int(os.getenv("ARBITER_GPU_TOKENS", "1"))
+ARBITER_HOLD_MS = float(os.getenv("ARBITER_HOLD_MS", "1500"))   # asr 两次 tick 之间也替它留着（仅 CPU）
+ARBITER_RETRY_S = 5.0                                             # 连不上后多久再试
+
+PRIORITY = {"asr": 0, "tts": 1}     # 越小越优先；未列出的引擎排在最后
+
+
+# ====== 协调进程 ======
+class _Waiter:
+    def __init__(self, engine: str, resource: str, want: int, min_n: int):
+        self.engine = engine
+        self.resource = resource
+        self.want = want
+        self.min = min_n
+        self.t0 = time.perf_counter()
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+
+
+class _EngineStats:
+    def __init__(self):
+        self.wait = LatencyWindow()
+        self.grants = 0
+        self.throttled = 0      # 授予线程数少于想要的
+        self.oversub = 0        # 高优先级在令牌不足时硬给（超订）
+        self.overlap = 0        # 授予时有其它引擎正占着同一资源
+        self.threads = 0        # 当前持有
+
+    def summary(self) -> Dict[str, Any]:
+        return {"grants": self.grants, "wait_ms": self.wait.summary(), "throttled": self.throttled,
+                "oversubscribed": self.oversub, "overlap": self.overlap, "threads_now": self.threads}
+
+
+class Arbiter:
+    """令牌记账（单线程，在事件循环里调用）"""
+
+    def __init__(self, tokens: Dict[str, int], hold_ms: Optional[Dict[str, float]] = None):
+        self.total = dict(tokens)
+        self.used = {r: 0 for r in tokens}
+        self.hold_ms = hold_ms if hold_ms is not None else {"cpu": ARBITER_HOLD_MS}
+        self._seq = itertools.count()
+        self._ids = itertools.count(1)
+        self._waiters: Dict[str, list] = {r: [] for r in tokens}
+        self._leases: Dict[int, tuple] = {}                  # id -> (resource, engine, n)
+        self._reserve: Dict[tuple, tuple] = {}               # (resource, engine) -> (n, until)
+        self.stats: Dict[str, _EngineStats] = {}
+
+    def _prio(self, engine: str) -> int:
+        return PRIORITY.get(engine, len(PRIORITY))
+
+    def _reserved_above(self, resource: str, prio: int) -> int:
+        """更高优先级引擎最近用过、当前没持有的预留量"""
+        now = time.monotonic()
+        held = {e for r, e, _ in self._leases.values() if r == resource}
+        n = 0
+        for (r, e), (k, until) in list(self._reserve.items()):
+            if until < now:
+                self._reserve.pop((r, e), None)
+            elif r == resource and self._prio(e) < prio and e not in held:
+                n += k
+        # 预留最多一半，低优先级的不至于在 asr 会话期间一直借不到
+        return min(n, self.total[resource] // 2)
+
+    def acquire(self, engine: str, resource: str, want: int, min_n: int) -> asyncio.Future:
+        if resource not in self.total:
+            raise ValueError(f"unknown resource {resource!r}")
+        want = max(1, min(want, self.total[resource]))
+        w = _Waiter(engine, resource, want, max(1, min(min_n, want)))
+        heapq.heappush(self._waiters[resource], (self._prio(engine), next(self._seq), w))
+        self._pump(resource)
+        return w.future
+
+    def withdraw(self, resource: str, fut: asyncio.Future):
+        """排队中的客户端断开：作废它的等待，排在后面的不再被它挡住"""
+        if not fut.done():
+            fut.cancel()
+        self._pump(resource)
+
+    def _pump(self, resource: str):
+        q = self._waiters[resource]
+        while q:
+            prio, _, w = q[0]
+            if w.future.done():             # 客户端已断开（withdraw）
+                heapq.heappop(q)
+                continue
+            reserved = self._reserved_above(resource, prio)
+            free = self.total[resource] - self.used[resource] - reserved
+            # 整块申请大于预留后剩下的量时按剩下的给，否则 asr 活跃期间永远借不到
+            need = min(w.min, max(1, self.total[resource] - reserved))
+            st = self.stats.setdefault(w.engine, _EngineStats())
+            if free >= need:
+                n = min(w.want, free)
+            elif prio == 0:
+                n = w.min       # 延迟敏感的不排队
+                st.oversub += 1
+            else:
+                break           # 同优先级按先来后到，不插队
+            heapq.heappop(q)
+            lid = next(self._ids)
+            if any(r == resource and e != w.engine for r, e, _ in self._leases.values()):
+                st.overlap += 1
+            self._leases[lid] = (resource, w.engine, n)
+            self.used[resource] += n
+            st.grants += 1
+            st.threads += n
+            st.throttled += n < w.want
+            st.wait.add((time.perf_counter() - w.t0) * 1000.0)
+            if prio == 0:
+                self._reserve[(resource, w.engine)] = (w.want, float("inf"))
+            w.future.set_result((lid, n))
+
+    def release(self, lid: int):
+        lease = self._leases.pop(lid, None)
+        if lease is None:
+            return
+        resource, engine, n = lease
+        self.used[resource] -= n
+        self.stats[engine].threads -= n
+        if (resource, engine) in self._reserve:
+            k, _ = self._reserve[(resource, engine)]
+            hold = self.hold_ms.get(resource, 0.0)
+            if hold > 0:
+                self._reserve[(resource, engine)] = (k, time.monotonic() + hold / 1000.0)
+                # 预留到期后没有别的事件也要放排队的 tts 进来
+                asyncio.get_running_loop().call_later(hold / 1000.0 + 0.001, self._pump, resource)
+            else:
+                del self._reserve[(resource, engine)]
+        self._pump(resource)
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "tokens": self.total,
+            "used": dict(self.used),
+            "waiting": {r: len(q) for r, q in self._waiters.items()},
+            "engines": {e: s.summary() for e, s in self.stats.items()},
+        }
+
+
+async def serve(path: str = ARBITER_SOCKET, tokens: Optional[Dict[str, int]] = None):
+    arb = Arbiter(tokens or {"cpu": ARBITER_CPU_TOKENS, "gpu": ARBITER_GPU_TOKENS})
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        mine = set()        # 本连接持有的租约，断开时全部归还
+        ahead: Optional[asyncio.Task] = None      # 排队期间就开始读的下一行
+        try:
+            while True:
+                line = await (ahead if ahead is not None else reader.readline())
+                ahead = None
+                if not line:
+                    break
+                msg = json.loads(line)
+                op = msg.get("op")
+                if op == "acquire":
+                    resource = msg.get("resource", "cpu")
+                    fut = arb.acquire(msg["engine"], resource, int(msg.get("want", 1)), int(msg.get("min", 1)))
+                    # 排队时客户端不会再发东西，但断开要能发现：边等令牌边读 socket，读到 EOF 就退出队列，
+                    # 否则死掉的 tts 一直占着先来后到的位置，后面的都被它挡住
+                    ahead = asyncio.ensure_future(reader.readline())
+                    try:
+                        while not fut.done():
+                            if ahead.done():
+                                if ahead.exception() is not None or not ahead.result():
+                                    arb.withdraw(resource, fut)
+                                    return
+                                await fut       # 提前发来了下一条（协议上不会），照常等完再处理
+                                break
+                            await asyncio.wait({fut, ahead}, return_when=asyncio.FIRST_COMPLETED)
+                    except asyncio.CancelledError:
+                        arb.withdraw(resource, fut)
+                        raise
+                    lid, n = fut.result()
+                    mine.add(lid)
+                    out = {"id": lid, "threads": n}
+                elif op == "release":
+                    mine.discard(msg["id"])
+                    arb.release(msg["id"])
+                    continue
+                elif op == "stats":
+                    out = arb.summary()
+                else:
+                    out = {"error": f"unknown op {op!r}"}
+                writer.write((json.dumps(out) + "\n").encode("utf-8"))
+                await writer.drain()
+        except (ConnectionError, ValueError, KeyError):
+            pass
+        finally:
+            if ahead is not None and not ahead.done():
+                ahead.cancel()
+            for lid in mine:
+                arb.release(lid)
+            writer.close()
+
+    if os.path.exists(path):
+        os.unlink(path)
+    server = await asyncio.start_unix_server(handle, path=path)
+    print(f"[arbiter] {path} tokens={arb.total}")
+    async with server:
+        await server.serve_forever()
+
+
+# ====== 客户端（各服务在推理线程里同步调用）======
+class ArbiterClient:
+    """
+    每个线程一条连接，租约期间阻塞在该线程上（推理本来就在工作线程里跑）。
+    协调进程不可用时 lease() 直接给出 want，不等待。
+    """
+
+    def __init__(self, engine: str, resource: str = "cpu", path: str = ARBITER_SOCKET,
+                 enabled: bool = ARBITER_ENABLED):
+        self.engine = engine
+        self.resource = resource
+        self.path = path
+        self.enabled = enabled
+        self._local = threading.local()
+        self._down_until = 0.0
+        self.wait = LatencyWindow()
+        self.counters = {"leases": 0, "throttled": 0, "fallback": 0}
+
+    def _conn(self):
+        f = getattr(self._local, "f", None)
+        if f is None:
+            s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            s.connect(self.path)
+            f = self._local.f = s.makefile("rwb")
+        return f
+
+    def _drop_conn(self):
+        f = getattr(self._local, "f", None)
+        self._local.f = None
+        if f is not None:
+            try:
+                f.close()
+            except OSError:
+                pass
+
+    def _call(self, msg: Dict[str, Any], reply: bool = True) -> Optional[Dict[str, Any]]:
+        f = self._conn()
+        f.write((json.dumps(msg) + "\n").encode("utf-8"))
+        f.flush()
+        if not reply:
+            return None
+        line = f.readline()
+        if not line:
+            raise ConnectionError("arbiter closed")
+        return json.loads(line)
+
+    @contextmanager
+    def lease(self, want: int, min_threads: int = 1) -> Iterator[int]:
+        """借 want 个令牌（至少 min_threads 才开始），yield 实际授予数"""
+        if not self.enabled or time.monotonic() < self._down_until:
+            self.counters["fallback"] += 1
+            yield want
+            return
+        t0 = time.perf_counter()
+        try:
+            r = self._call({"op": "acquire", "engine": self.engine, "resource": self.resource,
+                            "want": want, "min": min_threads})
+        except (OSError, ValueError):
+            self._drop_conn()
+            self._down_until = time.monotonic() + ARBITER_RETRY_S
+            self.counters["fallback"] += 1
+            yield want
+            return
+        self.wait.add((time.perf_counter() - t0) * 1000.0)
+        self.counters["leases"] += 1
+        self.counters["throttled"] += r["threads"] < want
+        try:
+            yield r["threads"]
+        finally:
+            try:
+                self._call({"op": "release", "id": r["id"]}, reply=False)
+            except OSError:
+                self._drop_conn()   # 连接断了，协调进程那边会随之归还
+
+    def remote_stats(self) -> Optional[Dict[str, Any]]:
+        try:
+            return self._call({"op": "stats"})
+        except (OSError, ValueError):
+            self._drop_conn()
+            return None
+
+    def summary(self) -> Dict[str, Any]:
+        return {"engine": self.engine, "resource": self.resource, "socket": self.path,
+                **self.counters, "wait_ms": self.wait.summary()}
+
+
+def main():
+    import argparse
+
+    ap = argparse.ArgumentParser(description="ASR / TTS 算力仲裁")
+    ap.add_argument("cmd", choices=["serve", "stats"])
+    ap.add_argument("--socket", default=ARBITER_SOCKET)
+    ap.add_argument("--cpu", type=int, default=ARBITER_CPU_TOKENS, help="CPU 线程令牌数")
+    ap.add_argument("--gpu", type=int, default=ARBITER_GPU_TOKENS, help="GPU 并发槽位")
+    args = ap.parse_args()
+    if args.cmd == "serve":
+        try:
+            asyncio.run(serve(args.socket, {"cpu": args.cpu, "gpu": args.gpu}))
+        except KeyboardInterrupt:
+            pass
+    else:
+        print(json.dumps(ArbiterClient("cli", path=args.socket).remote_stats(), ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+打断（barge-in）用的会话级取消工具
+
+- InflightRegistry：asyncio 侧，session_id → 正在进行的任务（取消回调 + 完成信号），
+  cancel() 会等到任务真正结束，返回取消耗时；
+- CancelBoard：线程侧（同步 handler / 线程池），只记录“某会话最近一次被打断的时间”，
+  任务在开始前 / 结束后比对提交时间即可判断是否作废；
+- CancelStats：取消延迟分位数与回收的算力时间。
+"""
+import asyncio
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from backend.common.stats import LatencyWindow
+
+
+class _Job:
+    def __init__(self, cancel: Callable[[], Any], done: "asyncio.Future"):
+        self.cancel = cancel
+        self.done = done
+
+
+class InflightRegistry:
+    def __init__(self):
+        self._jobs: Dict[str, List[_Job]] = {}
+
+    def track(self, session_id: Optional[str], cancel: Callable[[], Any], done: "asyncio.Future") -> Optional[_Job]:
+        if not session_id:
+            return None
+        job = _Job(cancel, done)
+        self._jobs.setdefault(session_id, []).append(job)
+        done.add_done_callback(lambda _f: self._forget(session_id, job))
+        return job
+
+    def _forget(self, session_id: str, job: _Job):
+        jobs = self._jobs.get(session_id)
+        if jobs and job in jobs:
+            jobs.remove(job)
+            if not jobs:
+                self._jobs.pop(session_id, None)
+
+    def active(self) -> int:
+        """当前进行中的任务数（后台低优先级工作据此让路）"""
+        return sum(len(j) for j in self._jobs.values())
+
+    async def cancel(self, session_id: str, timeout: float = 2.0) -> Dict[str, Any]:
+        """取消该会话所有进行中的任务，并等待它们结束（最多 timeout 秒）。"""
+        jobs = list(self._jobs.get(session_id, []))
+        t0 = time.perf_counter()
+        for job in jobs:
+            job.cancel()
+        if jobs:
+            await asyncio.wait([j.done for j in jobs], timeout=timeout)
+        return {
+            "cancelled": len(jobs),
+            "cancel_ms": round((time.perf_counter() - t0) * 1000.0, 1),
+        }
+
+
+class CancelBoard:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._at: Dict[str, float] = {}
+
+    def cancel(self, session_id: str) -> float:
+        now = time.time()
+        with self._lock:
+            self._at[session_id] = now
+        return now
+
+    def is_cancelled(self, session_id: Optional[str], since: float) -> bool:
+        """提交时间早于最近一次打断 → 作废"""
+        if not session_id:
+            return False
+        with self._lock:
+            return self._at.get(session_id, 0.0) >= since
+
+
+class CancelStats:
+    def __init__(self):
+        self.latency = LatencyWindow()
+        self.reclaimed_ms = 0.0
+
+    def record(self, cancel_ms: Optional[float] = None, reclaimed_ms: float = 0.0):
+        """cancel_ms 为 None 时只累计回收时间（如流水线自己上报的估算值）"""
+        if cancel_ms is not None:
+            self.latency.add(cancel_ms)
+        self.reclaimed_ms += max(0.0, reclaimed_ms)
+
+    def summary(self) -> Dict[str, Any]:
+        out = {"cancel_ms": self.latency.summary()}
+        out["reclaimed_ms"] = round(self.reclaimed_ms, 1)
+        return out
@@ -0,0 +1,174 @@
+"""
+启动分阶段计时与就绪门控（各服务共用）
+
+原来 asr_app 在 import 时把 faster-whisper 加载到 CUDA、tts_xtts_server 在 import 时建 XTTS，
+uvicorn 要等模块导入完（几十秒）才开始监听：这期间健康检查连不上，编排系统会当成起不来反复重启，
+扩容也慢。这里把“进程活着”和“能接活了”分开：
+
+- 各服务 import 时只导入轻量依赖，重的库（torch / TTS / faster_whisper / transformers …）挪到加载函数里；
+- STARTUP.background(name, fn)：登记一个加载任务，startup 事件里放到后台（同步函数走线程），
+  事件循环立刻开始监听；required=False 的任务（记忆索引、语音预热）不影响就绪；
+- GET /health：存活，只要进程在处理请求就 200；GET /ready：必需的加载任务都完成才 200，否则 503
+  （加载失败时 body 里带错误）；GET /startup：各阶段耗时；
+- 需要模型的接口在就绪前等最多 STARTUP_WAIT_S 秒，还没好就 503（WebSocket 用 1013 关闭），客户端重试即可。
+
+阶段（相对进程创建时刻，毫秒）：imported（模块导入完）/ serving（startup 事件跑完，开始监听）/
+ready（必需加载完成），加上每个加载任务自己的耗时。ready 时打一行日志，并以 name="startup" 的 span
+经服务自己的 Tracer 写进 trace JSONL / OTLP，import → ready 的时间就能和每轮延迟一样长期跟踪。
+"""
+import asyncio
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Union
+
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse
+
+STARTUP_WAIT_S = float(os.getenv("STARTUP_WAIT_S", "0"))     # 就绪前到达的请求最多等多久
+
+
+def _process_start() -> float:
+    """进程创建时刻（墙钟秒）：/proc/self/stat 的 starttime + 开机时间；取不到就用本模块导入时刻"""
+    try:
+        with open("/proc/self/stat") as f:
+            ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/stat") as f:
+            btime = next(int(line.split()[1]) for line in f if line.startswith("btime"))
+        return btime + ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError, StopIteration):
+        return time.time()
+
+
+PROCESS_START = _process_start()
+# 各服务模块都把本模块放在第一个 backend 导入，它的导入时刻就是服务模块开始导入的时刻
+# （STARTUP 对象本身在导入区之后才建）
+IMPORT_START = time.time()
+
+
+class _Loader:
+    def __init__(self, name: str, fn: Callable[[], Union[Any, Awaitable[Any]]], required: bool):
+        self.name = name
+        self.fn = fn
+        self.required = required
+        self.state = "pending"          # pending / loading / ready / failed
+        self.ms: Optional[float] = None
+        self.error: Optional[str] = None
+
+
+class Startup:
+    def __init__(self, service: str):
+        self.service = service
+        self.marks: Dict[str, float] = {"process_start": PROCESS_START, "import_start": IMPORT_START}
+        self.loaders: Dict[str, _Loader] = {}
+        self.tracer = None
+        self._ready: Optional[asyncio.Event] = None
+        self._tasks = []
+
+    # ------------------ 登记 ------------------
+    def background(self, name: str, fn: Callable[[], Union[Any, Awaitable[Any]]], required: bool = True):
+        """fn 为同步函数时在线程里跑，协程函数直接 await"""
+        self.loaders[name] = _Loader(name, fn, required)
+
+    def install(self, app: FastAPI, tracer=None):
+        """模块末尾调用：记 imported，挂 /health（已有则保留）、/ready、/startup 和 startup 事件"""
+        self.mark("imported")
+        self.tracer = tracer
+        paths = {getattr(r, "path", None) for r in app.router.routes}
+        if "/health" not in paths:
+            app.add_api_route("/health", self.health, methods=["GET"])
+        app.add_api_route("/ready", self.ready_endpoint, methods=["GET"])
+        app.add_api_route("/startup", self.summary, methods=["GET"])
+        app.router.on_startup.append(self._on_startup)
+        app.router.on_shutdown.insert(0, self._on_shutdown)    # 先停加载任务，再走服务自己的清理
+
+    def mark(self, stage: str, ts: Optional[float] = None):
+        self.marks.setdefault(stage, ts if ts is not None else time.time())
+
+    # ------------------ 生命周期 ------------------
+    async def _on_startup(self):
+        self._ready = asyncio.Event()
+        for ld in self.loaders.values():
+            self._tasks.append(asyncio.create_task(self._run(ld), name=f"load-{self.service}-{ld.name}"))
+        self.mark("serving")
+        self._check()
+
+    async def _on_shutdown(self):
+        for t in self._tasks:
+            t.cancel()
+
+    async def _run(self, ld: _Loader):
+        ld.state = "loading"
+        t0 = time.perf_counter()
+        try:
+            if asyncio.iscoroutinefunction(ld.fn):
+                await ld.fn()
+            else:
+                await asyncio.to_thread(ld.fn)
+            ld.state = "ready"
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            ld.state = "failed"
+            ld.error = f"{type(e).__name__}: {e}"
+            print(f"[startup] {self.service} {ld.name} 加载失败: {ld.error}")
+        finally:
+            ld.ms = round((time.perf_counter() - t0) * 1000.0, 1)
+        self._check()
+
+    def _check(self):
+        if self._ready is None or self._ready.is_set():
+            return
+        if all(ld.state == "ready" for ld in self.loaders.values() if ld.required):
+            self.mark("ready")
+            self._ready.set()
+            s = self.summary()
+            print(f"[startup] {self.service} ready: {s['phases_ms']} loaders={s['loaders']}")
+            if self.tracer is not None:
+                span = self.tracer.span(None, "startup", start=PROCESS_START, pid=os.getpid())
+                for k, v in self.marks.items():
+                    span.mark(k, v)
+                span.set(**{f"{n}_ms": ld.ms for n, ld in self.loaders.items()})
+                span.end(self.marks["ready"])
+
+    # ------------------ 就绪 ------------------
+    @property
+    def ready(self) -> bool:
+        return self._ready is not None and self._ready.is_set()
+
+    async def wait_ready(self, timeout: float = STARTUP_WAIT_S) -> bool:
+        if self.ready:
+            return True
+        if self._ready is None or timeout <= 0:
+            return False
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    async def require(self, timeout: float = STARTUP_WAIT_S):
+        """需要模型的 HTTP 接口开头调用；未就绪抛 503（带 Retry-After）"""
+        if not await self.wait_ready(timeout):
+            raise HTTPException(status_code=503, detail=f"{self.service} not ready: {self._pending()}",
+                                headers={"Retry-After": "1"})
+
+    def _pending(self) -> Dict[str, str]:
+        return {n: ld.error or ld.state for n, ld in self.loaders.items() if ld.required and ld.state != "ready"}
+
+    # ------------------ 接口 ------------------
+    async def health(self):
+        return {"status": "ok", "service": self.service, "ready": self.ready}
+
+    async def ready_endpoint(self):
+        body = {"ready": self.ready, "service": self.service, "pending": self._pending()}
+        return JSONResponse(body, status_code=200 if self.ready else 503)
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "service": self.service,
+            "ready": self.ready,
+            "phases_ms": {k: round((v - PROCESS_START) * 1000.0, 1) for k, v in self.marks.items()
+                          if k != "process_start"},
+            "loaders": {n: {"state": ld.state, "ms": ld.ms, "required": ld.required,
+                            **({"error": ld.error} if ld.error else {})} for n, ld in self.loaders.items()},
+        }
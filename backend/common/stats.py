@@ -0,0 +1,46 @@
+"""
+轻量统计工具（纯 Python，不依赖 numpy，便于各服务直接用）
+"""
+from collections import deque
+from typing import Dict, Iterable, Sequence
+
+
+def percentiles(values: Iterable[float], qs: Sequence[float] = (50, 95, 99)) -> Dict[str, float]:
+    """最近邻法分位数；空输入返回 {}。"""
+    v = sorted(values)
+    if not v:
+        return {}
+    out = {}
+    for q in qs:
+        k = min(len(v) - 1, max(0, int(round(q / 100.0 * (len(v) - 1)))))
+        out[f"p{int(q)}"] = round(v[k], 1)
+    return out
+
+
+class Ewma:
+    """指数滑动平均；首个样本直接作为初值。"""
+
+    def __init__(self, alpha: float = 0.2, initial: float = None):
+        self.alpha = alpha
+        self.value = initial
+
+    def update(self, x: float) -> float:
+        self.value = x if self.value is None else (1 - self.alpha) * self.value + self.alpha * x
+        return self.value
+
+
+class LatencyWindow:
+    """保留最近 N 个样本，输出计数与分位数。"""
+
+    def __init__(self, maxlen: int = 1000):
+        self.samples = deque(maxlen=maxlen)
+        self.count = 0
+
+    def add(self, ms: float):
+        self.samples.append(ms)
+        self.count += 1
+
+    def summary(self) -> Dict[str, float]:
+        out = {"count": self.count}
+        out.update(percentiles(self.samples))
+        return out
@@ -0,0 +1,97 @@
+"""
+文本工具：ASR / LLM / TTS 共用的标点集合与归一化
+（保持轻量，不依赖任何模型，便于各服务直接 import）
+"""
+import re
+import unicodedata
+
+# 句末标点（ASR 端点器、LLM→TTS 分句共用）
+END_PUNCTS = set("。.!！？?")
+
+_PUNCT_RE = re.compile(r"[\s\W_]+", re.UNICODE)
+
+
+def normalize_text(text: str) -> str:
+    """
+    用于“是否同一句话”的比较：全半角统一、小写、去掉空白与标点。
+    例：" 你好，世界！" 与 "你好世界" 归一化后相同。
+    """
+    if not text:
+        return ""
+    t = unicodedata.normalize("NFKC", text).lower()
+    return _PUNCT_RE.sub("", t)
+
+
+# ====== 流式分句（LLM token → 句子 → TTS） ======
+# 长分句时也可在逗号类标点处切开，让首段音频更早出来
+CLAUSE_PUNCTS = set("，,、；;：:")
+# 句末标点后面紧跟的收尾符号，归入同一句
+_CLOSING = set("”’）)」』】…~～")
+# ASCII 引号不分开合：本句里是奇数个（还没配对）时才算收尾，否则是下一句的开引号
+_QUOTES = set("\"'")
+
+
+def _clean(s: str) -> str:
+    """去掉句首的标点与收尾符号（ASCII 引号不动：留在句首的只可能是开引号）"""
+    s = s.strip()
+    while s and (s[0] in _CLOSING or s[0] in END_PUNCTS or s[0] in CLAUSE_PUNCTS):
+        s = s[1:].lstrip()
+    return s
+
+
+class SentenceSplitter:
+    """
+    增量分句器：不断 feed() 流式 token，返回已完整的句子列表；最后 flush() 取余下部分。
+
+    - 遇到 END_PUNCTS 切句（ASCII "." 需后跟空白才算，避免把 3.14 切开）；
+    - 当前分句已 >= clause_min_chars 时，遇到 CLAUSE_PUNCTS 也切；
+    - 句末标点后的引号/括号/省略号并入本句；切点正好落在缓冲末尾时先不出句，
+      等下一个 token 看后面是不是还有收尾符号（流式时引号常常单独成一个 token）。
+    """
+
+    def __init__(self, clause_min_chars: int = 24):
+        self.clause_min_chars = clause_min_chars
+        self._buf = ""
+
+    def feed(self, token: str) -> list:
+        self._buf += token or ""
+        out = []
+        start = 0
+        i = 0
+        n = len(self._buf)
+        while i < n:
+            ch = self._buf[i]
+            cut = False
+            if ch in END_PUNCTS:
+                if ch == ".":
+                    if i + 1 >= n:
+                        break               # 还不知道后面是什么，等下一个 token
+                    cut = self._buf[i + 1].isspace()
+                else:
+                    cut = True
+            elif ch in CLAUSE_PUNCTS and (i + 1 - start) >= self.clause_min_chars:
+                cut = True
+            if cut:
+                j = i + 1
+                while j < n:
+                    c = self._buf[j]
+                    if not (c in END_PUNCTS or c in _CLOSING
+                            or (c in _QUOTES and self._buf[start:j].count(c) % 2)):
+                        break
+                    j += 1
+                if j >= n:
+                    break                   # 收尾符号可能在下一个 token 里，等它来了再切
+                sent = _clean(self._buf[start:j])
+                if sent:
+                    out.append(sent)
+                start = j
+                i = j
+                continue
+            i += 1
+        self._buf = self._buf[start:]
+        return out
+
+    def flush(self) -> list:
+        rest = _clean(self._buf)
+        self._buf = ""
+        return [rest] if rest else []
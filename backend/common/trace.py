@@ -0,0 +1,347 @@
+"""
+端到端逐轮追踪（ASR → LLM → TTS）
+
+一轮慢了，到底慢在哪一段：各服务只 print 看不出来。这里给每一轮一个 trace_id，
+各阶段把墙钟时间戳记成 span，写到本地 JSONL（可选推给 OpenTelemetry collector），再用 report 汇总。
+
+- trace_id：ASR 检测到说话起点（speech_start）时生成（32 位 hex，与 OpenTelemetry trace id 同格式），
+  随 speech_start / partial / stable / final 下发；前端调 /llm、/llm_tts 时放在 X-Trace-Id 头里，
+  llm_app 调 TTS 时同样带上；/ws_chat 与合并部署在进程内直接传。没带的请求自己生成一个。
+- span：{"trace_id","span_id","service","name","start","end","marks":{阶段: 墙钟秒},"attrs":{...}}
+  - asr：speech_start / speech_end（最后一个有声 tick）/ final（下发时刻）
+  - llm：request / first_token / llm_done / first_audio（/llm_tts、/ws_chat）/ done
+  - tts：request / first_byte / done（每句一个 span；缓冲模式 first_byte = 整段合成完）
+- 导出：后台线程批量追加到 TRACE_DIR/<service>-YYYYMMDD.jsonl，不阻塞事件循环；队列满了丢弃并计数。
+  设 TRACE_OTLP_URL（如 http://127.0.0.1:4318/v1/traces）时另外按 OTLP/HTTP JSON 推送，marks 转成 span events。
+
+报告（首音频时间 TTFA 拆分与分位数）：
+  python -m backend.common.trace report [--dir traces] [--since-hours 24]
+collector 替身（接收 OTLP/HTTP JSON，写成同样的 JSONL，供 report 读）：
+  python -m backend.common.trace collect --port 4318 --dir traces
+"""
+import atexit
+import glob
+import json
+import os
+import queue
+import re
+import threading
+import time
+import uuid
+from typing import Any, Dict, Iterable, List, Optional
+
+from backend.common.stats import percentiles
+
+TRACE_ENABLED = os.getenv("TRACE_ENABLED", "1") == "1"
+TRACE_DIR = os.getenv("TRACE_DIR", "traces")
+TRACE_OTLP_URL = os.getenv("TRACE_OTLP_URL", "")
+TRACE_FLUSH_MS = float(os.getenv("TRACE_FLUSH_MS", "500"))
+TRACE_QUEUE = int(os.getenv("TRACE_QUEUE", "10000"))
+TRACE_HEADER = "X-Trace-Id"
+
+_TRACE_ID = re.compile(r"^[0-9a-f]{32}$")
+
+
+def new_trace_id() -> str:
+    return uuid.uuid4().hex
+
+
+def valid_trace_id(value: Optional[str]) -> Optional[str]:
+    """请求头里的 trace_id 只接受 32 位小写 hex，其它一律当没带"""
+    if value and _TRACE_ID.match(value.strip().lower()):
+        return value.strip().lower()
+    return None
+
+
+class Span:
+    def __init__(self, tracer: "Tracer", trace_id: Optional[str], name: str, start: Optional[float] = None,
+                 **attrs):
+        self.tracer = tracer
+        self.trace_id = valid_trace_id(trace_id) or new_trace_id()
+        self.span_id = os.urandom(8).hex()
+        self.name = name
+        self.start = start if start is not None else time.time()
+        self.marks: Dict[str, float] = {"request": self.start}
+        self.attrs = {k: v for k, v in attrs.items() if v is not None}
+        self.ended = False
+
+    def mark(self, stage: str, ts: Optional[float] = None):
+        """记一个阶段时间戳；同一阶段只记第一次"""
+        if stage not in self.marks:
+            self.marks[stage] = ts if ts is not None else time.time()
+
+    def set(self, **attrs):
+        self.attrs.update({k: v for k, v in attrs.items() if v is not None})
+
+    def end(self, ts: Optional[float] = None):
+        if self.ended:
+            return
+        self.ended = True
+        end = ts if ts is not None else time.time()
+        self.marks.setdefault("done", end)
+        self.tracer.export({
+            "trace_id": self.trace_id, "span_id": self.span_id, "service": self.tracer.service,
+            "name": self.name, "start": self.start, "end": end, "marks": self.marks, "attrs": self.attrs,
+        })
+
+
+class Tracer:
+    """每个服务一个；span 结束时入队，后台线程每 TRACE_FLUSH_MS 批量写文件 / 推 collector"""
+
+    def __init__(self, service: str, directory: str = TRACE_DIR, otlp_url: str = TRACE_OTLP_URL,
+                 enabled: bool = TRACE_ENABLED):
+        self.service = service
+        self.dir = directory
+        self.otlp_url = otlp_url
+        self.enabled = enabled
+        self._q: "queue.Queue[Optional[dict]]" = queue.Queue(maxsize=TRACE_QUEUE)
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self.counters = {"exported": 0, "dropped": 0, "write_errors": 0, "otlp_errors": 0}
+
+    def span(self, trace_id: Optional[str], name: str, start: Optional[float] = None, **attrs) -> Span:
+        return Span(self, trace_id, name, start, **attrs)
+
+    def export(self, record: dict):
+        if not self.enabled:
+            return
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name=f"trace-{self.service}", daemon=True)
+                    self._thread.start()
+                    atexit.register(self.close)
+        try:
+            self._q.put_nowait(record)
+        except queue.Full:
+            self.counters["dropped"] += 1
+
+    def _run(self):
+        stop = False
+        while not stop:
+            batch = []
+            try:
+                item = self._q.get(timeout=TRACE_FLUSH_MS / 1000.0)
+                while True:
+                    if item is None:
+                        stop = True
+                        break
+                    batch.append(item)
+                    item = self._q.get_nowait()
+            except queue.Empty:
+                pass
+            if batch:
+                self._write(batch)
+
+    def _write(self, batch: List[dict]):
+        try:
+            os.makedirs(self.dir, exist_ok=True)
+            path = os.path.join(self.dir, f"{self.service}-{time.strftime('%Y%m%d')}.jsonl")
+            with open(path, "a", encoding="utf-8") as f:
+                f.write("".join(json.dumps(r, ensure_ascii=False) + "\n" for r in batch))   # 一次 write，多进程追加不交错
+            self.counters["exported"] += len(batch)
+        except OSError as e:
+            self.counters["write_errors"] += 1
+            print(f"[trace] write failed: {e}")
+        if self.otlp_url:
+            try:
+                import httpx
+                httpx.post(self.otlp_url, json=to_otlp(self.service, batch), timeout=2.0).raise_for_status()
+            except Exception as e:
+                self.counters["otlp_errors"] += 1
+                print(f"[trace] otlp export failed: {type(e).__name__}: {e}")
+
+    def close(self):
+        """进程退出时把队列里剩下的写完"""
+        if self._thread is not None and self._thread.is_alive():
+            self._q.put(None)
+            self._thread.join(timeout=2.0)
+
+    def summary(self) -> Dict[str, Any]:
+        return {"enabled": self.enabled, "dir": self.dir, "otlp": self.otlp_url or None,
+                "queued": self._q.qsize(), **self.counters}
+
+
+def trace_response(resp, span: Span):
+    """流式响应：第一块发出时记 first_byte、发完记 done；普通响应立即结束"""
+    iterator = getattr(resp, "body_iterator", None)
+    if iterator is None:
+        span.mark("first_byte")
+        span.end()
+        return resp
+
+    async def gen():
+        try:
+            async for chunk in iterator:
+                span.mark("first_byte")
+                yield chunk
+        finally:
+            span.end()
+    resp.body_iterator = gen()
+    return resp
+
+
+# ====== OpenTelemetry（OTLP/HTTP JSON）互转 ======
+def _ns(ts: float) -> str:
+    return str(int(ts * 1e9))
+
+
+def _attr(k: str, v: Any) -> dict:
+    if isinstance(v, bool):
+        return {"key": k, "value": {"boolValue": v}}
+    if isinstance(v, int):
+        return {"key": k, "value": {"intValue": str(v)}}
+    if isinstance(v, float):
+        return {"key": k, "value": {"doubleValue": v}}
+    return {"key": k, "value": {"stringValue": str(v)}}
+
+
+def to_otlp(service: str, records: List[dict]) -> dict:
+    spans = [{
+        "traceId": r["trace_id"], "spanId": r["span_id"], "name": r["name"], "kind": 2,
+        "startTimeUnixNano": _ns(r["start"]), "endTimeUnixNano": _ns(r["end"]),
+        "attributes": [_attr(k, v) for k, v in r["attrs"].items()],
+        "events": [{"timeUnixNano": _ns(ts), "name": stage} for stage, ts in r["marks"].items()],
+    } for r in records]
+    return {"resourceSpans": [{
+        "resource": {"attributes": [_attr("service.name", service)]},
+        "scopeSpans": [{"scope": {"name": "ai-role-chat"}, "spans": spans}],
+    }]}
+
+
+def _value(v: dict) -> Any:
+    for k in ("stringValue", "boolValue", "doubleValue"):
+        if k in v:
+            return v[k]
+    if "intValue" in v:
+        return int(v["intValue"])
+    return None
+
+
+def from_otlp(body: dict) -> List[dict]:
+    out = []
+    for rs in body.get("resourceSpans", []):
+        res = {a["key"]: _value(a["value"]) for a in rs.get("resource", {}).get("attributes", [])}
+        service = res.get("service.name", "unknown")
+        for ss in rs.get("scopeSpans", []):
+            for s in ss.get("spans", []):
+                out.append({
+                    "trace_id": s["traceId"], "span_id": s["spanId"], "service": service, "name": s["name"],
+                    "start": int(s["startTimeUnixNano"]) / 1e9, "end": int(s["endTimeUnixNano"]) / 1e9,
+                    "marks": {e["name"]: int(e["timeUnixNano"]) / 1e9 for e in s.get("events", [])},
+                    "attrs": {a["key"]: _value(a["value"]) for a in s.get("attributes", [])},
+                })
+    return out
+
+
+# ====== 报告 ======
+# (名称, 起点, 终点)；键为 "<span 名>.<阶段>"，同一 trace 里同名阶段取最早的（tts 即首句）
+STAGES = [
+    ("端点判定 speech_end→final", "asr.speech_end", "asr.final"),
+    ("上行 final→LLM 收到", "asr.final", "llm.request"),
+    ("LLM 首 token", "llm.request", "llm.first_token"),
+    ("凑首句 首 token→TTS 请求", "llm.first_token", "tts.request"),
+    ("TTS 首句首字节", "tts.request", "tts.first_byte"),
+    ("回传 TTS→首音频发出", "tts.first_byte", "llm.first_audio"),
+    ("LLM 生成完", "llm.request", "llm.llm_done"),
+    ("TTFA final→首音频", "asr.final", "llm.first_audio"),
+    ("TTFA speech_end→首音频", "asr.speech_end", "llm.first_audio"),
+]
+
+
+def load(paths: Iterable[str], since: Optional[float] = None) -> List[dict]:
+    out = []
+    for p in paths:
+        with open(p, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    r = json.loads(line)
+                except ValueError:
+                    continue
+                if since is None or r.get("start", 0) >= since:
+                    out.append(r)
+    return out
+
+
+def merge(spans: Iterable[dict]) -> Dict[str, Dict[str, float]]:
+    turns: Dict[str, Dict[str, float]] = {}
+    for s in spans:
+        if (s.get("attrs") or {}).get("status", 0) >= 400:     # 失败的合成（503 赶不上 / 409 被打断）不算
+            continue
+        if s.get("name") == "startup":      # 进程启动记录（backend/common/startup.py），不属于任何一轮
+            continue
+        t = turns.setdefault(s["trace_id"], {})
+        for stage, ts in s.get("marks", {}).items():
+            key = f"{s['name']}.{stage}"
+            if ts is not None and (key not in t or ts < t[key]):
+                t[key] = ts
+    return turns
+
+
+def report(spans: List[dict], qs=(50, 90, 99)) -> List[Dict[str, Any]]:
+    turns = merge(spans)
+    rows = []
+    for label, a, b in STAGES:
+        ms = [(t[b] - t[a]) * 1000.0 for t in turns.values() if a in t and b in t and t[b] >= t[a]]
+        rows.append({"stage": label, "n": len(ms), **percentiles(ms, qs)})
+    # 各服务冷启动：进程创建 → 模块导入完 / 就绪（每次启动一条 startup span）
+    boots = [s for s in spans if s.get("name") == "startup"]
+    for service in sorted({s["service"] for s in boots}):
+        for label, stage in (("导入完", "imported"), ("就绪", "ready")):
+            ms = [(s["marks"][stage] - s["marks"]["process_start"]) * 1000.0 for s in boots
+                  if s["service"] == service and stage in s["marks"] and "process_start" in s["marks"]]
+            rows.append({"stage": f"启动 {service} 进程→{label}", "n": len(ms), **percentiles(ms, qs)})
+    return rows
+
+
+def collect_app(directory: str):
+    """OTLP/HTTP JSON collector 替身：POST /v1/traces → <service>-YYYYMMDD.jsonl"""
+    from fastapi import FastAPI, Request
+
+    app = FastAPI(title="trace collector")
+    tracers: Dict[str, Tracer] = {}
+
+    @app.post("/v1/traces")
+    async def traces(req: Request):
+        for r in from_otlp(await req.json()):
+            tr = tracers.setdefault(r["service"], Tracer(r["service"], directory, otlp_url="", enabled=True))
+            tr.export(r)
+        return {}
+
+    return app
+
+
+def main():
+    import argparse
+
+    ap = argparse.ArgumentParser(description="逐轮延迟追踪")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    rp = sub.add_parser("report", help="TTFA 拆分与分位数")
+    rp.add_argument("--dir", default=TRACE_DIR)
+    rp.add_argument("--since-hours", type=float, default=None)
+    rp.add_argument("--json", action="store_true")
+    cp = sub.add_parser("collect", help="OTLP/HTTP JSON collector 替身")
+    cp.add_argument("--dir", default=TRACE_DIR)
+    cp.add_argument("--host", default="127.0.0.1")
+    cp.add_argument("--port", type=int, default=4318)
+    args = ap.parse_args()
+
+    if args.cmd == "collect":
+        import uvicorn
+        uvicorn.run(collect_app(args.dir), host=args.host, port=args.port, log_level="warning")
+        return
+
+    since = time.time() - args.since_hours * 3600 if args.since_hours else None
+    spans = load(sorted(glob.glob(os.path.join(args.dir, "*.jsonl"))), since)
+    rows = report(spans)
+    if args.json:
+        print(json.dumps(rows, ensure_ascii=False, indent=2))
+        return
+    print(f"{len(spans)} spans / {len(merge(spans))} traces（{args.dir}）")
+    print(f"{'阶段':<28}{'n':>6}{'p50':>9}{'p90':>9}{'p99':>9}  (ms)")
+    for r in rows:
+        print(f"{r['stage']:<28}{r['n']:>6}{r.get('p50', '-'):>9}{r.get('p90', '-'):>9}{r.get('p99', '-'):>9}")
+
+
+if __name__ == "__main__":
+    main()
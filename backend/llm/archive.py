@@ -0,0 +1,303 @@
+"""
+冷数据归档：空闲超过 ARCHIVE_IDLE_DAYS 的会话从 conversations.db 挪到按天分区的压缩 JSONL 段文件
+
+- 段文件：ARCHIVE_DIR/<YYYY-MM-DD>.jsonl.gz（装了 zstandard 且 ARCHIVE_CODEC=zstd 时为 .jsonl.zst），
+  按消息的 created_at（UTC）分天；只追加：每批在对应的天文件末尾追加一个独立的压缩帧
+  （gzip member / zstd frame，整文件仍可直接 zcat / zstdcat），写完 fsync；
+- 索引：conversations.db 里的 archive_index 表，一行 = (会话, 段文件, 帧偏移, 帧长度, 条数, 时间范围)，
+  按会话读历史时只解压命中的帧；
+- 增量：每批最多 ARCHIVE_BATCH_ROWS 行，按会话内时间从旧到新搬；先写段文件，再在一个短事务里
+  登记索引并删除原行（持写锁的时间只有这一步）。中途崩溃最多在段文件里留下未登记的帧，
+  下次会把同一批行重新归档，不会丢也不会重复可见；
+- 归档后的消息不再参与 idem 去重与全文检索；/history 透明合并（归档部分带 "archived": true）。
+"""
+import asyncio
+import gzip
+import json
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from backend.common.stats import LatencyWindow
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# 默认关：归档后的会话不再能被 /search 搜到，也不再参与 idem 去重，需要时显式打开
+ARCHIVE_ENABLED = os.getenv("ARCHIVE_ENABLED", "0") == "1"
+ARCHIVE_DB_PATH = os.getenv("CONV_DB_PATH", "conversations.db")
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "")        # 空 = <CONV_DB_PATH>.archive
+ARCHIVE_IDLE_DAYS = float(os.getenv("ARCHIVE_IDLE_DAYS", "30"))
+ARCHIVE_BATCH_ROWS = int(os.getenv("ARCHIVE_BATCH_ROWS", "500"))
+ARCHIVE_PAUSE_MS = float(os.getenv("ARCHIVE_PAUSE_MS", "50"))          # 批与批之间让出写锁
+ARCHIVE_INTERVAL_S = float(os.getenv("ARCHIVE_INTERVAL_S", "600"))
+ARCHIVE_CODEC = os.getenv("ARCHIVE_CODEC", "zstd" if zstandard is not None else "gzip")
+ARCHIVE_CACHE_FRAMES = int(os.getenv("ARCHIVE_CACHE_FRAMES", "32"))
+
+INDEX_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS archive_index (
+      session_id TEXT,
+      segment TEXT,
+      offset INTEGER,
+      length INTEGER,
+      messages INTEGER,
+      first_at REAL,
+      last_at REAL,
+      archived_at REAL
+    );""",
+    "CREATE INDEX IF NOT EXISTS idx_archive_session ON archive_index(session_id, last_at)",
+]
+
+_ROW_COLUMNS = "seq, id, session_id, role, text, created_at, idem, meta"
+
+
+def archive_dir_for(db_path: str) -> str:
+    return ARCHIVE_DIR or db_path + ".archive"
+
+
+# ====== 压缩帧 ======
+def _codec(name: str) -> str:
+    if name == "zstd" and zstandard is None:
+        print("[archive] 未安装 zstandard，改用 gzip")
+        return "gzip"
+    return name
+
+
+def _suffix(codec: str) -> str:
+    return ".jsonl.zst" if codec == "zstd" else ".jsonl.gz"
+
+
+def compress(data: bytes, codec: str) -> bytes:
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=6).compress(data)
+    return gzip.compress(data, compresslevel=6, mtime=0)
+
+
+def decompress(frame: bytes, segment: str) -> bytes:
+    if segment.endswith(".zst"):
+        return zstandard.ZstdDecompressor().decompress(frame)
+    return gzip.decompress(frame)
+
+
+def _day(ts: float) -> str:
+    return datetime.fromtimestamp(ts, tz=timezone.utc).strftime("%Y-%m-%d")
+
+
+def _encode(row: tuple) -> Dict[str, Any]:
+    """段文件里字段名仍叫 rowid（老段文件兼容），值是 messages.seq"""
+    rowid, mid, session_id, role, text, created_at, idem, meta = row
+    try:
+        meta = json.loads(meta) if meta else {}
+    except ValueError:
+        pass
+    return {"rowid": rowid, "id": mid, "session_id": session_id, "role": role, "text": text,
+            "created_at": created_at, "idem": idem, "meta": meta}
+
+
+def _decode(obj: Dict[str, Any]) -> tuple:
+    """还原成与 store._COLUMNS 相同形状的元组"""
+    return (obj["rowid"], obj["id"], obj["session_id"], obj["role"], obj["text"], obj["created_at"],
+            json.dumps(obj.get("meta") or {}, ensure_ascii=False))
+
+
+# ====== 读 ======
+class ArchiveReader:
+    """按索引读帧；最近读过的帧解码结果放在小 LRU 里（翻页时同一帧会连着读好几次）"""
+
+    def __init__(self, directory: str, cache_frames: int = ARCHIVE_CACHE_FRAMES):
+        self.dir = directory
+        self.cache_frames = cache_frames
+        self._cache: "OrderedDict[Tuple[str, int], List[tuple]]" = OrderedDict()
+        self.read_ms = LatencyWindow()
+
+    def frame(self, segment: str, offset: int, length: int) -> List[tuple]:
+        key = (segment, offset)
+        rows = self._cache.get(key)
+        if rows is not None:
+            self._cache.move_to_end(key)
+            return rows
+        t0 = time.perf_counter()
+        with open(os.path.join(self.dir, segment), "rb") as f:
+            f.seek(offset)
+            data = decompress(f.read(length), segment)
+        rows = [_decode(json.loads(line)) for line in data.splitlines() if line]
+        self.read_ms.add((time.perf_counter() - t0) * 1000.0)
+        self._cache[key] = rows
+        while len(self._cache) > self.cache_frames:
+            self._cache.popitem(last=False)
+        return rows
+
+    def page(self, session_id: str, entries: Iterable[tuple], need: int,
+             before: Optional[Tuple[float, int]] = None) -> List[tuple]:
+        """
+        entries：该会话的 (segment, offset, length, first_at)，按 last_at 降序；同一会话的帧时间上互不重叠，
+        凑够 need 条即可停。返回按 (created_at, seq) 降序的行。
+        """
+        out: List[tuple] = []
+        for segment, offset, length, first_at in entries:
+            if before is not None and first_at > before[0]:
+                continue
+            rows = [r for r in self.frame(segment, offset, length)
+                    if r[2] == session_id and (before is None or (r[5], r[0]) < before)]
+            out.extend(rows)
+            if len(out) >= need:
+                break
+        out.sort(key=lambda r: (r[5], r[0]), reverse=True)
+        return out[:need]
+
+
+# ====== 写 ======
+class Archiver:
+    def __init__(
+        self,
+        db_path: str = ARCHIVE_DB_PATH,
+        directory: Optional[str] = None,
+        idle_days: float = ARCHIVE_IDLE_DAYS,
+        batch_rows: int = ARCHIVE_BATCH_ROWS,
+        pause_ms: float = ARCHIVE_PAUSE_MS,
+        codec: str = ARCHIVE_CODEC,
+    ):
+        self.db_path = db_path
+        self.dir = directory or archive_dir_for(db_path)
+        self.idle_days = idle_days
+        self.batch_rows = max(1, batch_rows)
+        self.pause_ms = pause_ms
+        self.codec = _codec(codec)
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+        self.lock_ms = LatencyWindow()      # 每批持写锁（登记 + 删除）的时间
+        self.counters = {"runs": 0, "batches": 0, "sessions": 0, "messages": 0, "bytes_raw": 0, "bytes_stored": 0}
+
+    def _connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA busy_timeout=30000")
+        for ddl in INDEX_SCHEMA:
+            db.execute(ddl)
+        return db
+
+    def idle_sessions(self, db: sqlite3.Connection, now: Optional[float] = None) -> List[str]:
+        """最后一条消息早于截止时间的会话（走 (session_id, created_at) 覆盖索引，只读）"""
+        cutoff = (now or time.time()) - self.idle_days * 86400.0
+        return [r[0] for r in db.execute(
+            "SELECT session_id FROM messages GROUP BY session_id HAVING max(created_at) < ?", (cutoff,))]
+
+    def run_once(self, now: Optional[float] = None, max_batches: Optional[int] = None) -> Dict[str, Any]:
+        """归档一轮；按批提交，每批之间睡 pause_ms 让 llm.py 的写入插进来"""
+        os.makedirs(self.dir, exist_ok=True)
+        cutoff = (now or time.time()) - self.idle_days * 86400.0
+        db = self._connect()
+        done = {"sessions": 0, "messages": 0, "batches": 0}
+        try:
+            pending = self.idle_sessions(db, now)
+            while pending and not self._stopping and (max_batches is None or done["batches"] < max_batches):
+                rows: List[tuple] = []
+                sessions = 0
+                while pending and len(rows) < self.batch_rows:
+                    room = self.batch_rows - len(rows)
+                    # 只搬截止时间之前的行：挑出来之后会话又活跃了，新消息留在库里
+                    got = db.execute(
+                        f"SELECT {_ROW_COLUMNS} FROM messages WHERE session_id = ? AND created_at < ? "
+                        "ORDER BY created_at, seq LIMIT ?", (pending[0], cutoff, room)).fetchall()
+                    rows.extend(got)
+                    if len(got) < room:
+                        pending.pop(0)          # 这个会话搬完了
+                        sessions += 1
+                    else:
+                        break                   # 批满了；会话剩下的部分下一批接着搬
+                if not rows:
+                    done["sessions"] += sessions    # 上一批正好搬完最后几行的会话，到这里才确认
+                    continue
+                self._archive_batch(db, rows)
+                done["batches"] += 1
+                done["sessions"] += sessions
+                done["messages"] += len(rows)
+                if self.pause_ms > 0:
+                    time.sleep(self.pause_ms / 1000.0)
+        finally:
+            db.close()
+        self.counters["runs"] += 1
+        self.counters["batches"] += done["batches"]
+        self.counters["sessions"] += done["sessions"]
+        self.counters["messages"] += done["messages"]
+        return done
+
+    def _archive_batch(self, db: sqlite3.Connection, rows: List[tuple]):
+        # 1) 按天分组，各自追加一个压缩帧并 fsync（不持数据库锁）
+        by_day: Dict[str, List[tuple]] = {}
+        for r in rows:
+            by_day.setdefault(_day(r[5]), []).append(r)
+        index = []
+        now = time.time()
+        for day, day_rows in sorted(by_day.items()):
+            segment = day + _suffix(self.codec)
+            raw = "".join(json.dumps(_encode(r), ensure_ascii=False) + "\n" for r in day_rows).encode("utf-8")
+            frame = compress(raw, self.codec)
+            path = os.path.join(self.dir, segment)
+            with open(path, "ab") as f:
+                offset = f.seek(0, os.SEEK_END)
+                f.write(frame)
+                f.flush()
+                os.fsync(f.fileno())
+            self.counters["bytes_raw"] += len(raw)
+            self.counters["bytes_stored"] += len(frame)
+            per_session: Dict[str, List[float]] = {}
+            for r in day_rows:
+                per_session.setdefault(r[2], []).append(r[5])
+            for sid, ts in per_session.items():
+                index.append((sid, segment, offset, len(frame), len(ts), min(ts), max(ts), now))
+        # 2) 短事务：登记索引 + 删除原行
+        t0 = time.perf_counter()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.executemany("""INSERT INTO archive_index
+                (session_id, segment, offset, length, messages, first_at, last_at, archived_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)""", index)
+            # seq 是 AUTOINCREMENT：删掉的编号不会再分给新消息，记忆索引里残留的向量也对不到别的会话上
+            db.executemany("DELETE FROM messages WHERE seq = ?", [(r[0],) for r in rows])
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        self.lock_ms.add((time.perf_counter() - t0) * 1000.0)
+
+    # ------------------ 后台任务 ------------------
+    async def start(self):
+        self._task = asyncio.create_task(self._run(), name="archiver")
+
+    async def _run(self):
+        while True:
+            try:
+                done = await asyncio.to_thread(self.run_once)
+                if done["messages"]:
+                    print(f"[archive] 归档 {done['sessions']} 个会话 / {done['messages']} 条消息")
+            except Exception as e:
+                print(f"[archive] 归档失败: {type(e).__name__}: {e}")
+            await asyncio.sleep(ARCHIVE_INTERVAL_S)
+
+    async def stop(self):
+        self._stopping = True       # 线程里正在跑的一轮在当前批结束后退出
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def summary(self) -> Dict[str, Any]:
+        raw, stored = self.counters["bytes_raw"], self.counters["bytes_stored"]
+        return {
+            "dir": self.dir,
+            "codec": self.codec,
+            "idle_days": self.idle_days,
+            **self.counters,
+            "ratio": round(raw / stored, 2) if stored else None,
+            "lock_ms": self.lock_ms.summary(),
+        }
@@ -0,0 +1,281 @@
+"""
+对话压缩：长会话的旧轮次滚动合并成摘要，prompt = system（人设 + 摘要）+ 最近几轮原文
+
+- 请求路径上只做两件事：observe() 记下该会话最新的完整历史、apply() 用缓存里的摘要替换已覆盖的前缀，
+  都是内存操作，不碰数据库、不调模型；
+- 后台 worker 挑估算 token 数超过 COMPACT_TRIGGER_TOKENS 的会话，在 llm_app 空闲（没有进行中的
+  /llm、/llm_tts 且距最近一次请求超过 COMPACT_IDLE_MS）时让 llama-server 把“旧摘要 + 最老的若干轮”
+  压成新摘要；生成途中来了用户请求就立即取消（断开连接，llama-server 释放槽位），稍后重试；
+- 摘要存进 conversations.db 的 summaries 表（covered = 覆盖了历史里前多少条非 system 消息，
+  anchor = 这整段前缀的指纹），启动时把每个会话最新的一条读进缓存；请求带来的历史前 covered 条
+  指纹对得上才去掉，对不上（客户端自己截断 / 改写了历史）就保留原文、只加摘要，宁可重复不丢轮次。
+  只比最后一条的话，“好的”“嗯”这种重复短句会对到后面的消息上，把没进摘要的轮次删掉。
+"""
+import asyncio
+import hashlib
+import os
+import sqlite3
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from backend.common.stats import LatencyWindow
+from backend.llm.store import CONV_DB_PATH, SCHEMA
+
+COMPACT_ENABLED = os.getenv("COMPACT_ENABLED", "1") == "1"
+COMPACT_TRIGGER_TOKENS = int(os.getenv("COMPACT_TRIGGER_TOKENS", "1500"))   # 未压缩部分超过就压
+COMPACT_KEEP_MESSAGES = int(os.getenv("COMPACT_KEEP_MESSAGES", "6"))        # 最近几条保持原文
+COMPACT_MIN_FOLD = int(os.getenv("COMPACT_MIN_FOLD", "4"))                  # 一次至少并入几条，免得每轮都压
+COMPACT_SUMMARY_CHARS = int(os.getenv("COMPACT_SUMMARY_CHARS", "300"))
+COMPACT_IDLE_MS = float(os.getenv("COMPACT_IDLE_MS", "800"))
+COMPACT_CHECK_S = float(os.getenv("COMPACT_CHECK_S", "1"))
+COMPACT_FORGET_S = float(os.getenv("COMPACT_FORGET_S", "3600"))
+
+SUMMARY_PREFIX = "此前对话摘要："
+
+SUMMARIZE_INSTRUCTION = (
+    "你是对话记录员。把下面这段角色扮演对话压缩成一段简洁的中文摘要，供角色之后继续对话时参考。"
+    "保留：角色的身份、语气和与用户的关系；用户透露的事实、偏好和情绪；未完成的话题和双方的约定。"
+    "省略寒暄和重复内容，不要编造，不超过 {chars} 字，只输出摘要本身。"
+)
+
+
+def estimate_tokens(text: str) -> int:
+    """不依赖分词器的估算：中日韩字符约 1 token / 字，其余约 4 字符 / token"""
+    cjk = (len(text.encode("utf-8")) - len(text)) // 2     # 汉字 UTF-8 占 3 字节；不逐字循环，长历史也便宜
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def messages_tokens(messages: List[Dict[str, str]]) -> int:
+    return sum(estimate_tokens(m["content"]) + 4 for m in messages)     # +4 ≈ 角色与模板标记
+
+
+def fingerprint(m: Dict[str, str]) -> str:
+    return hashlib.sha1(f"{m['role']}\x00{m['content']}".encode("utf-8")).hexdigest()
+
+
+def prefix_fingerprint(messages: List[Dict[str, str]]) -> str:
+    """整段消息的指纹（逐条指纹串起来再哈希）"""
+    h = hashlib.sha1()
+    for m in messages:
+        h.update(fingerprint(m).encode("ascii"))
+    return h.hexdigest()
+
+
+def _covered(rest: List[Dict[str, str]], s: Dict[str, Any]) -> int:
+    """rest 里被摘要覆盖的前缀长度；前缀对不上返回 0"""
+    n = int(s.get("covered") or 0)
+    if 0 < n <= len(rest) and prefix_fingerprint(rest[:n]) == s["anchor"]:
+        return n
+    return 0
+
+
+def _compose(s: Dict[str, Any], messages: List[Dict[str, str]]) -> List[Dict[str, str]]:
+    system = [m for m in messages if m["role"] == "system"]
+    rest = [m for m in messages if m["role"] != "system"]
+    tail = rest[_covered(rest, s):]
+    note = f"{SUMMARY_PREFIX}\n{s['text']}"
+    if system:
+        head = [{"role": "system", "content": system[0]["content"] + "\n\n" + note}] + system[1:]
+    else:
+        head = [{"role": "system", "content": note}]
+    return head + tail
+
+
+class Compactor:
+    def __init__(
+        self,
+        summarize: Callable[[List[Dict[str, str]], int], Awaitable[str]],
+        busy: Callable[[], bool] = lambda: False,
+        db_path: str = CONV_DB_PATH,
+        trigger_tokens: int = COMPACT_TRIGGER_TOKENS,
+        keep_messages: int = COMPACT_KEEP_MESSAGES,
+        idle_ms: float = COMPACT_IDLE_MS,
+    ):
+        self.summarize = summarize          # (prompt messages, max_tokens) -> 摘要文本
+        self.busy = busy
+        self.db_path = db_path
+        self.trigger_tokens = trigger_tokens
+        self.keep = max(1, keep_messages)
+        self.idle_ms = idle_ms
+        self._latest: Dict[str, Dict[str, Any]] = {}        # session → 最近一次请求带来的历史
+        self._summaries: Dict[str, Dict[str, Any]] = {}     # session → 最新摘要
+        self._last_request = 0.0
+        self._task: Optional[asyncio.Task] = None
+        self.tokens_before = LatencyWindow()
+        self.tokens_after = LatencyWindow()
+        self.compact_ms = LatencyWindow()
+        self.counters = {"compactions": 0, "preempted": 0, "failed": 0, "applied": 0}
+
+    # ------------------ 请求路径（纯内存） ------------------
+    def observe(self, session_id: Optional[str], persona: Optional[str], messages: List[Dict[str, str]]):
+        self._last_request = time.monotonic()
+        # 没 start() 的进程（如独立跑的 chat_app 复用 llm_app 的请求路径）没有后台 worker 来消费、清理
+        if session_id and self._task is not None:
+            self._latest[session_id] = {"persona": persona, "messages": messages, "at": self._last_request}
+
+    def apply(self, session_id: Optional[str], messages: List[Dict[str, str]]) -> List[Dict[str, str]]:
+        """有摘要就把它并进 system，去掉已覆盖的前缀；记录前后的 prompt token 数"""
+        before = messages_tokens(messages)
+        s = self._summaries.get(session_id) if session_id else None
+        out = _compose(s, messages) if s is not None else messages
+        self.tokens_before.add(before)
+        self.tokens_after.add(messages_tokens(out) if s is not None else before)
+        if s is not None:
+            self.counters["applied"] += 1
+        return out
+
+    # ------------------ 后台压缩 ------------------
+    def _candidate(self) -> Optional[str]:
+        best, best_tokens = None, self.trigger_tokens
+        stale = time.monotonic() - COMPACT_FORGET_S
+        for sid in [sid for sid, seen in self._latest.items() if seen["at"] < stale]:
+            del self._latest[sid]       # 长时间没动静的会话不再跟踪（摘要仍在库里）
+        for sid, seen in self._latest.items():
+            rest = [m for m in seen["messages"] if m["role"] != "system"]
+            s = self._summaries.get(sid)
+            tail = rest[_covered(rest, s):] if s else rest
+            if len(tail) < self.keep + COMPACT_MIN_FOLD:
+                continue
+            tokens = messages_tokens(tail) + (estimate_tokens(s["text"]) if s else 0)
+            if tokens > best_tokens:
+                best, best_tokens = sid, tokens
+        return best
+
+    def _prompt(self, seen: Dict[str, Any], fold: List[Dict[str, str]], prev: Optional[str]) -> List[Dict[str, str]]:
+        persona_prompt = next((m["content"] for m in seen["messages"] if m["role"] == "system"), "")
+        lines = []
+        if persona_prompt:
+            lines.append(f"角色设定：{persona_prompt}")
+        if seen.get("persona"):
+            lines.append(f"角色：{seen['persona']}")
+        if prev:
+            lines.append(f"已有摘要：{prev}")
+        lines.append("需要并入摘要的对话：")
+        lines += [f"{'用户' if m['role'] == 'user' else '角色'}：{m['content']}" for m in fold]
+        return [
+            {"role": "system", "content": SUMMARIZE_INSTRUCTION.format(chars=COMPACT_SUMMARY_CHARS)},
+            {"role": "user", "content": "\n".join(lines)},
+        ]
+
+    async def compact(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """把该会话“旧摘要 + 最老的若干轮”压成新摘要；被抢占 / 失败返回 None"""
+        seen = self._latest.get(session_id)
+        if seen is None:
+            return None
+        rest = [m for m in seen["messages"] if m["role"] != "system"]
+        prev = self._summaries.get(session_id)
+        start = _covered(rest, prev) if prev else 0
+        fold = rest[start:len(rest) - self.keep]
+        if not fold:
+            return None
+        t0 = time.perf_counter()
+        started = time.monotonic()
+        task = asyncio.create_task(self.summarize(self._prompt(seen, fold, prev and prev["text"]),
+                                                  COMPACT_SUMMARY_CHARS * 2))
+        try:
+            while not task.done():
+                await asyncio.wait({task}, timeout=0.05)
+                # 低优先级：有进行中的请求或压缩开始后来了新请求，就让出 llama-server
+                if not task.done() and (self.busy() or self._last_request > started):
+                    task.cancel()
+                    await asyncio.wait({task})
+                    self.counters["preempted"] += 1
+                    return None
+        finally:
+            task.cancel()       # 自己被取消（stop）时也不留孤儿请求
+        try:
+            text = task.result().strip()
+        except Exception as e:
+            self.counters["failed"] += 1
+            print(f"[compaction] {session_id} 摘要失败: {type(e).__name__}: {e}")
+            return None
+        if not text:
+            self.counters["failed"] += 1
+            return None
+        row = {
+            "session_id": session_id,
+            "persona": seen.get("persona"),
+            "anchor": prefix_fingerprint(rest[:start + len(fold)]),
+            "text": text,
+            "covered": start + len(fold),       # 摘要覆盖了前多少条非 system 消息
+            "tokens_before": messages_tokens(seen["messages"]),
+            "created_at": time.time(),
+        }
+        row["tokens_after"] = messages_tokens(_compose(row, seen["messages"]))
+        await asyncio.to_thread(self._insert, row)
+        self._summaries[session_id] = row
+        self.compact_ms.add((time.perf_counter() - t0) * 1000.0)
+        self.counters["compactions"] += 1
+        return row
+
+    def _idle(self) -> bool:
+        return not self.busy() and (time.monotonic() - self._last_request) * 1000.0 >= self.idle_ms
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(COMPACT_CHECK_S)
+            try:
+                sid = self._candidate() if self._idle() else None
+                if sid is not None:
+                    await self.compact(sid)
+            except Exception as e:
+                print(f"[compaction] 后台压缩出错: {type(e).__name__}: {e}")
+
+    # ------------------ 存储 ------------------
+    def _connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(self.db_path, timeout=5)
+        db.execute("PRAGMA journal_mode=WAL")
+        return db
+
+    def _load(self):
+        db = self._connect()
+        try:
+            for ddl in SCHEMA:
+                db.execute(ddl)
+            db.commit()
+            rows = db.execute("""
+                SELECT session_id, persona, anchor, text, covered, tokens_before, tokens_after, created_at
+                FROM summaries s WHERE created_at = (
+                  SELECT max(created_at) FROM summaries WHERE session_id = s.session_id)""").fetchall()
+        finally:
+            db.close()
+        keys = ("session_id", "persona", "anchor", "text", "covered", "tokens_before", "tokens_after", "created_at")
+        self._summaries = {r[0]: dict(zip(keys, r)) for r in rows}
+
+    def _insert(self, row: Dict[str, Any]):
+        db = self._connect()
+        try:
+            db.execute("""INSERT INTO summaries
+                (session_id, persona, anchor, text, covered, tokens_before, tokens_after, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                (row["session_id"], row["persona"], row["anchor"], row["text"], row["covered"],
+                 row["tokens_before"], row["tokens_after"], row["created_at"]))
+            db.commit()
+        finally:
+            db.close()
+
+    # ------------------ 生命周期 ------------------
+    async def start(self):
+        await asyncio.to_thread(self._load)
+        self._task = asyncio.create_task(self._run(), name="compaction")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "trigger_tokens": self.trigger_tokens,
+            "keep_messages": self.keep,
+            "sessions_seen": len(self._latest),
+            "sessions_summarized": len(self._summaries),
+            **self.counters,
+            "prompt_tokens_before": self.tokens_before.summary(),
+            "prompt_tokens_after": self.tokens_after.summary(),
+            "compact_ms": self.compact_ms.summary(),
+        }
@@ -1,69 +1,84 @@
 # pip install aiosqlite
-import aiosqlite, time, uuid, json
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, HTTPException, Query, Request
 import uvicorn
 
-DB_PATH = "conversations.db"
+from backend.common.startup import Startup
+from backend.llm.archive import ARCHIVE_ENABLED, Archiver
+from backend.llm.store import CONV_DB_PATH, ConversationStore
+
+DB_PATH = CONV_DB_PATH
 app = FastAPI()
+STARTUP = Startup("store")      # 没有后台模型；开库在 startup 里完成，/ready 即 startup 跑完
 
-async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
-        CREATE TABLE IF NOT EXISTS sessions (
-          id TEXT PRIMARY KEY,
-          created_at REAL
-        );""")
-        await db.execute("""
-        CREATE TABLE IF NOT EXISTS messages (
-          id TEXT PRIMARY KEY,
-          session_id TEXT,
-          role TEXT CHECK(role IN ('user','assistant','system')),
-          text TEXT,
-          created_at REAL,
-          idem TEXT UNIQUE,
-          meta TEXT
-        );""")
-        await db.commit()
+# 常驻连接 + 写后台化批量提交（见 store.py）
+STORE = ConversationStore(DB_PATH)
+# 空闲会话定期挪到压缩段文件（见 archive.py），/history 照常能翻到
+ARCHIVER = Archiver(DB_PATH) if ARCHIVE_ENABLED else None
 
 @app.on_event("startup")
 async def _startup():
-    await init_db()
+    await STORE.open()
+    if ARCHIVER is not None:
+        await ARCHIVER.start()
+
+@app.on_event("shutdown")
+async def _shutdown():
+    if ARCHIVER is not None:
+        await ARCHIVER.stop()
+    await STORE.close()     # 把队列里还没提交的写完
 
 async def save_message(session_id: str, role: str, text: str, idem: str|None, meta: dict|None=None):
-    async with aiosqlite.connect(DB_PATH) as db:
-        # 确保 session 存在
-        await db.execute("INSERT OR IGNORE INTO sessions (id, created_at) VALUES (?,?)",
-                         (session_id, time.time()))
-        try:
-            await db.execute("""INSERT INTO messages
-                (id, session_id, role, text, created_at, idem, meta)
-                VALUES (?, ?, ?, ?, ?, ?, ?)""",
-                (str(uuid.uuid4()), session_id, role, text, time.time(),
-                 idem, json.dumps(meta or {})))
-            await db.commit()
-            return True
-        except aiosqlite.IntegrityError:
-            # idem 冲突 → 认为是重复，忽略
-            return False
+    # True = 写入；False = idem 冲突（重复，忽略）；None = CONV_ASYNC_ACK=1 时已入队未落盘
+    return await STORE.save_message(session_id, role, text, idem, meta)
 
 @app.post("/receive_text")
 async def receive_text(req: Request):
-    data = await req.json()
+    idem = req.headers.get("X-Idempotency-Key")  # 可选幂等键
+    return await ingest(await req.json(), idem)
+
+async def ingest(data: dict, idem: str|None = None) -> dict:
+    """/receive_text 的实现；合并部署时 ASR 的 final 直接调这里（asr_app.FINAL_SINK），不走 HTTP"""
     text = (data.get("text") or "").strip()
     session_id = data.get("session_id") or "default"
-    idem = req.headers.get("X-Idempotency-Key")  # 可选幂等键
     meta = {
         "source": "asr",
         "language": data.get("language"),
         "avg_logprob": data.get("avg_logprob"),
         "segments": data.get("segments"),
+        "persona": data.get("persona"),     # MEMORY_SCOPE=persona 时按人设分区召回
+        "trace_id": data.get("trace_id"),   # 与 ASR / LLM / TTS 的 span 对得上（backend/common/trace.py）
     }
     if not text:
         return {"status": "empty"}
 
     stored = await save_message(session_id, "user", text, idem, meta)
     print(f"[LLM] 收到文本: {text}  存储: {stored}")
-    return {"status": "ok", "stored": stored}
-    
+    return {"status": "ok", "stored": stored, "durable": stored is not None}
+
+@app.get("/history")
+async def history(session_id: str = "default", limit: int = Query(50, ge=1, le=200), cursor: str | None = None):
+    # 新的在前；把返回的 next_cursor 原样带回来取更早的一页
+    try:
+        return await STORE.history(session_id, limit, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/search")
+async def search(q: str, session_id: str | None = None, limit: int = Query(20, ge=1, le=200),
+                 cursor: str | None = None):
+    try:
+        return await STORE.search(q, session_id, limit, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/store/stats")
+async def store_stats():
+    out = STORE.summary()
+    if ARCHIVER is not None:
+        out["archive"] = ARCHIVER.summary()
+    return out
+
+STARTUP.install(app)
+
 if __name__ == "__main__":
     uvicorn.run(app, host="127.0.0.1", port=8001, reload=False, workers=1)
@@ -2,14 +2,30 @@ from __future__ import annotations
 import os
 import time
 import json
-from typing import List, Dict, Optional, Tuple
+import base64
+import asyncio
+from typing import AsyncIterator, List, Dict, Optional, Tuple
 
 from fastapi import FastAPI, Request, Header
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field
 import uvicorn
 import httpx
 
+from backend.common.startup import Startup
+from backend.common.inflight import CancelStats, InflightRegistry
+from backend.common.stats import Ewma
+from backend.common.trace import TRACE_HEADER, Tracer
+from backend.llm.compaction import COMPACT_ENABLED, Compactor
+from backend.llm.memory import MEMORY_ENABLED, MEMORY_TOP_K, MemoryIndex
+from backend.llm.speculative import SpeculativeManager
+from backend.pipeline.sentence_pipeline import SentencePipeline
+from backend.tts.filler import FillerPolicy
+from backend.tts.tts_client import TTSClient
+
+STARTUP = Startup("llm")
+
 # ================== llama.cpp 服务配置 ==================
 # 你的启动脚本：
 # ./llama-server -m Qwen2.5-3B-Instruct-Q4_K_M.gguf --host 0.0.0.0 --port 8080 ...
@@ -17,6 +33,22 @@ import httpx
 LLAMA_BASE = os.getenv("LLAMA_BASE", "http://127.0.0.1:8080")
 LLAMA_MODEL = os.getenv("LLAMA_MODEL", "qwen2.5-3b-instruct")  # 仅用于标识；llama-server会忽略或覆盖
 LLAMA_TIMEOUT = float(os.getenv("LLAMA_TIMEOUT", "30"))
+# 句级流水线：同时在合成中的句子数
+TTS_PIPELINE_INFLIGHT = int(os.getenv("TTS_PIPELINE_INFLIGHT", "2"))
+
+# 进程内共用一个到 llama-server 的连接池（keep-alive），省掉每轮的建连
+LLAMA_MAX_CONNECTIONS = int(os.getenv("LLAMA_MAX_CONNECTIONS", "16"))
+_HTTP: Optional[httpx.AsyncClient] = None
+
+def _http() -> httpx.AsyncClient:
+    global _HTTP
+    if _HTTP is None:
+        _HTTP = httpx.AsyncClient(
+            timeout=LLAMA_TIMEOUT,
+            limits=httpx.Limits(max_connections=LLAMA_MAX_CONNECTIONS,
+                                max_keepalive_connections=LLAMA_MAX_CONNECTIONS),
+        )
+    return _HTTP
 
 # ================== 简易幂等缓存（内存） ==================
 _IDEM: Dict[str, Tuple[float, Dict]] = {}
@@ -38,11 +70,20 @@ class ChatReq(BaseModel):
     session_id: Optional[str] = None
     temperature: Optional[float] = 0.7
     max_tokens: Optional[int] = 512
+    # 投机生成：/llm/speculate 与随后的 /llm 用同一个 key 关联（如 "wukong:12"）
+    speculation_key: Optional[str] = None
+
+class SpeakReq(ChatReq):
+    persona: Optional[str] = None   # TTS 人设（wukong/harry/ironman）
 
 class ChatResp(BaseModel):
     text: str
     model: str
     cached: bool = False
+    cancelled: bool = False   # 被 /llm/cancel 打断
+
+class CancelReq(BaseModel):
+    session_id: str
 
 # ================== FastAPI 应用 ==================
 app = FastAPI(title="LLM Module (llama.cpp client)", version="0.2.0")
@@ -68,15 +109,15 @@ async def _chat_via_openai_compat(req: ChatReq) -> Tuple[str, str]:
         "max_tokens": req.max_tokens or 512,
         "stream": False,
     }
-    async with httpx.AsyncClient(timeout=LLAMA_TIMEOUT) as client:
-        r = await client.post(url, json=payload)
-        if r.status_code == 404:
-            raise FileNotFoundError("/v1/chat/completions not found")
-        r.raise_for_status()
-        data = r.json()
-        text = (data.get("choices", [{}])[0].get("message", {}).get("content") or "").strip()
-        used_model = data.get("model", LLAMA_MODEL)
-        return text, used_model
+    client = _http()
+    r = await client.post(url, json=payload)
+    if r.status_code == 404:
+        raise FileNotFoundError("/v1/chat/completions not found")
+    r.raise_for_status()
+    data = r.json()
+    text = (data.get("choices", [{}])[0].get("message", {}).get("content") or "").strip()
+    used_model = data.get("model", LLAMA_MODEL)
+    return text, used_model
 
 
 def _to_legacy_prompt(messages: List[Msg]) -> str:
@@ -102,42 +143,375 @@ async def _chat_via_legacy_completion(req: ChatReq) -> Tuple[str, str]:
         "temperature": req.temperature or 0.7,
         "cache_prompt": True,
     }
-    async with httpx.AsyncClient(timeout=LLAMA_TIMEOUT) as client:
-        r = await client.post(url, json=payload)
-        r.raise_for_status()
-        data = r.json()
-        text = data.get("content") or data.get("generated_text") or data.get("text") or ""
-        if isinstance(text, list):
-            text = "".join(text)
-        return (text or "").strip(), "llama.cpp:completion"
+    client = _http()
+    r = await client.post(url, json=payload)
+    r.raise_for_status()
+    data = r.json()
+    text = data.get("content") or data.get("generated_text") or data.get("text") or ""
+    if isinstance(text, list):
+        text = "".join(text)
+    return (text or "").strip(), "llama.cpp:completion"
 
-async def _chat_via_llama(req: ChatReq) -> Tuple[str, str]:
+# ------------------ 长期记忆 ------------------
+# 更早的内容从 conversations.db 的向量索引里按相关度召回。
+# 索引里只有 ASR 落库的用户原话（助手的回复不入库），截断客户端历史会把旧的助手轮次整个丢掉、
+# 也召回不回来，所以默认不截断；设 MEMORY_KEEP_MESSAGES=N 只保留最近 N 条，换更短的 prompt
+MEMORY_KEEP_MESSAGES = int(os.getenv("MEMORY_KEEP_MESSAGES", "0"))
+# 索引（及可选的向量模型）在后台加载好再接上，之前的请求不带召回（见文件末尾 STARTUP.background）
+MEMORY: Optional[MemoryIndex] = None
+
+async def _load_memory():
+    global MEMORY
+    mem = await asyncio.to_thread(MemoryIndex)
+    await mem.start()
+    MEMORY = mem
+
+async def _with_memory(req: ChatReq) -> ChatReq:
+    key = MEMORY.key_of(req.session_id, {"persona": getattr(req, "persona", None)}) if MEMORY else None
+    query = _last_user_text(req)
+    if not key or not query:
+        return req
+    try:
+        hits = await MEMORY.recall(key, query, MEMORY_TOP_K)
+    except Exception as e:
+        print(f"[memory] 召回失败: {type(e).__name__}: {e}")
+        return req
+    if hits is None:            # 这个会话还没有任何记忆：原样用客户端带来的历史
+        return req
+    system = [m for m in req.messages if m.role == "system"]
+    recent = [m for m in req.messages if m.role != "system"]
+    if 0 < MEMORY_KEEP_MESSAGES < len(recent):
+        recent = recent[-MEMORY_KEEP_MESSAGES:]
+        while len(recent) > 1 and recent[0].role != "user":     # 截断后从用户的话开始
+            recent = recent[1:]
+    seen = {m.content.strip() for m in recent}
+    lines = [f"- {'用户' if h['role'] == 'user' else '你'}说过：{h['text']}" for h in hits if h["text"].strip() not in seen]
+    if lines:
+        system.append(Msg(role="system", content="与当前话题相关的过往对话（供参考）：\n" + "\n".join(lines)))
+    # 多个 system 合成一条，兼容只认第一条 system 的模板
+    head = [Msg(role="system", content="\n\n".join(m.content for m in system))] if system else []
+    return req.model_copy(update={"messages": head + recent})
+
+# ------------------ 对话压缩 ------------------
+# 旧轮次由后台 worker 滚动合并成摘要（见 compaction.py），这里只在请求路径上套用缓存里的摘要
+def _with_summary(req: ChatReq) -> ChatReq:
+    if COMPACTOR is None:
+        return req
+    msgs = [m.model_dump() for m in req.messages]
+    COMPACTOR.observe(req.session_id, getattr(req, "persona", None), msgs)
+    out = COMPACTOR.apply(req.session_id, msgs)
+    if out is msgs:
+        return req
+    return req.model_copy(update={"messages": [Msg(**m) for m in out]})
+
+async def _prepare(req: ChatReq) -> ChatReq:
+    return await _with_memory(_with_summary(req))
+
+async def _llama_chat(req: ChatReq) -> Tuple[str, str]:
     try:
         return await _chat_via_openai_compat(req)
     except FileNotFoundError:
         return await _chat_via_legacy_completion(req)
 
+async def _chat_via_llama(req: ChatReq) -> Tuple[str, str]:
+    return await _llama_chat(await _prepare(req))
+
+async def _summarize(messages: List[Dict[str, str]], max_tokens: int) -> str:
+    text, _ = await _llama_chat(ChatReq(messages=[Msg(**m) for m in messages],
+                                        temperature=0.3, max_tokens=max_tokens))
+    return text
+
+# 进行中的 /llm、/llm_tts 与还没被认领的投机生成都算忙：压缩不跟它们抢 llama-server 槽位
+COMPACTOR = Compactor(_summarize, busy=lambda: INFLIGHT.active() > 0 or SPEC.running() > 0) if COMPACT_ENABLED else None
+
+# ------------------ 流式调用（token 增量） ------------------
+async def _stream_via_openai_compat(req: ChatReq) -> AsyncIterator[str]:
+    url = f"{LLAMA_BASE}/v1/chat/completions"
+    payload = {
+        "model": LLAMA_MODEL,
+        "messages": [m.model_dump() for m in req.messages],
+        "temperature": req.temperature or 0.7,
+        "max_tokens": req.max_tokens or 512,
+        "stream": True,
+    }
+    client = _http()
+    async with client.stream("POST", url, json=payload) as r:
+        if r.status_code == 404:
+            raise FileNotFoundError("/v1/chat/completions not found")
+        r.raise_for_status()
+        async for line in r.aiter_lines():
+            if not line.startswith("data: "):
+                continue
+            chunk = line[len("data: "):].strip()
+            if chunk == "[DONE]":
+                break
+            try:
+                obj = json.loads(chunk)
+            except ValueError:
+                continue
+            delta = (obj.get("choices") or [{}])[0].get("delta", {}).get("content")
+            if delta:
+                yield delta
+
+async def _stream_via_legacy_completion(req: ChatReq) -> AsyncIterator[str]:
+    url = f"{LLAMA_BASE}/completion"
+    payload = {
+        "prompt": _to_legacy_prompt(req.messages),
+        "n_predict": req.max_tokens or 512,
+        "temperature": req.temperature or 0.7,
+        "cache_prompt": True,
+        "stream": True,
+    }
+    client = _http()
+    async with client.stream("POST", url, json=payload) as r:
+        r.raise_for_status()
+        async for line in r.aiter_lines():
+            if not line.startswith("data: "):
+                continue
+            try:
+                obj = json.loads(line[len("data: "):])
+            except ValueError:
+                continue
+            if obj.get("content"):
+                yield obj["content"]
+            if obj.get("stop"):
+                break
+
+async def _stream_via_llama(req: ChatReq) -> AsyncIterator[str]:
+    # 404 只会在第一个 token 之前出现，回退是安全的
+    req = await _prepare(req)
+    try:
+        async for tok in _stream_via_openai_compat(req):
+            yield tok
+    except FileNotFoundError:
+        async for tok in _stream_via_legacy_completion(req):
+            yield tok
+
+# ================== 投机生成 ==================
+SPEC = SpeculativeManager(_chat_via_llama, ttl=float(os.getenv("LLM_SPECULATE_TTL", "30")))
+
+def _last_user_text(req: ChatReq) -> str:
+    return next((m.content for m in reversed(req.messages) if m.role == "user"), "")
+
 # ------------------ HTTP 接口 ------------------
+@app.post("/llm/speculate")
+async def llm_speculate(req: ChatReq):
+    """ASR partial 稳定时调用：后台先生成，不等结果。"""
+    if not req.speculation_key:
+        return {"started": False, "reason": "missing speculation_key"}
+    started = SPEC.start(req.speculation_key, _last_user_text(req), req)
+    return {"started": started}
+
+@app.get("/llm/speculation")
+async def llm_speculation_stats():
+    return SPEC.stats()
+
+# ================== 打断（barge-in） ==================
+# 按 session_id 登记进行中的 /llm 与 /llm_tts；/llm/cancel 一次取消该会话的全部上游请求
+INFLIGHT = InflightRegistry()
+BARGE = CancelStats()
+LLM_MS = Ewma(alpha=0.1)   # 非流式 /llm 的平均耗时，用于估算打断省下的生成时间
+# 逐轮追踪：trace_id 来自请求头 X-Trace-Id（ASR final 里带的），调 TTS 时继续往下传
+TRACER = Tracer("llm")
+
 @app.post("/llm", response_model=ChatResp)
-async def llm_endpoint(req: ChatReq, x_idempotency_key: Optional[str] = Header(None)):
+async def llm_endpoint(req: ChatReq, x_idempotency_key: Optional[str] = Header(None),
+                       x_trace_id: Optional[str] = Header(None, alias=TRACE_HEADER)):
+    span = TRACER.span(x_trace_id, "llm", session_id=req.session_id, endpoint="/llm")
+    try:
+        return await _llm(req, x_idempotency_key, span)
+    finally:
+        span.mark("llm_done")
+        span.end()
+
+async def _generate(req: ChatReq) -> Tuple[str, str, bool]:
+    """返回 (text, model, 是否投机命中)；投机未命中或没有投机时正常生成"""
+    if req.speculation_key:
+        spec = await SPEC.resolve(req.speculation_key, _last_user_text(req))
+        if spec is not None:
+            return spec[0], spec[1], True
+    text, model_used = await _chat_via_llama(req)
+    return text, model_used, False
+
+async def _llm(req: ChatReq, x_idempotency_key: Optional[str], span) -> ChatResp:
     # 幂等缓存
     if x_idempotency_key:
         _gc_idem()
         cached = _IDEM.get(x_idempotency_key)
         if cached:
+            span.set(cached=True)
             return ChatResp(text=cached[1]["text"], model=cached[1]["model"], cached=True)
 
     try:
-        text, model_used = await _chat_via_llama(req)
+        # 放进独立任务并登记到 INFLIGHT（投机命中时等的是投机任务，同样能被打断），
+        # 取消时关闭到 llama-server 的连接，槽位立即释放
+        t0 = time.perf_counter()
+        task = asyncio.create_task(_generate(req))
+        INFLIGHT.track(req.session_id, task.cancel, task)
+        await asyncio.wait({task})
+        if task.cancelled():
+            elapsed = (time.perf_counter() - t0) * 1000.0
+            # 估算省下的生成时间：平均整轮耗时减去已经花掉的，已超过平均值时记 0
+            BARGE.record(reclaimed_ms=max(0.0, (LLM_MS.value or elapsed) - elapsed))
+            span.set(cancelled=True)
+            return ChatResp(text="", model=LLAMA_MODEL, cancelled=True)
+        text, model_used, hit = task.result()
+        if hit:
+            span.set(speculation="hit")
+        else:
+            LLM_MS.update((time.perf_counter() - t0) * 1000.0)
     except Exception as e:
         # 兜底（不抛 500），避免前端体验断裂
         text = f"[本地模型暂不可用] {type(e).__name__}: {e}"
         model_used = "llama.cpp:error"
+        span.set(error=type(e).__name__)
 
     out = {"text": text, "model": model_used}
     if x_idempotency_key:
         _IDEM[x_idempotency_key] = (time.time(), out)
     return ChatResp(**out)
 
+# ================== LLM → TTS 句级流水线 ==================
+TTS = TTSClient()
+FILLER = FillerPolicy()
+
+@app.on_event("startup")
+async def _startup():
+    if COMPACTOR is not None:
+        await COMPACTOR.start()
+
+@app.on_event("shutdown")
+async def _shutdown():
+    if COMPACTOR is not None:
+        await COMPACTOR.stop()
+    if MEMORY is not None:
+        await MEMORY.stop()     # 落盘索引，下次启动不必重新向量化
+    await TTS.aclose()
+    if _HTTP is not None:
+        await _HTTP.aclose()
+
+@app.post("/llm_tts")
+async def llm_tts_endpoint(req: SpeakReq, x_trace_id: Optional[str] = Header(None, alias=TRACE_HEADER)):
+    """
+    流式返回 NDJSON，每行一个事件：
+      {"type":"filler","text":...,"audio":"<base64 wav>","duration_ms":...}  预测首句较慢时先垫一句（可选）
+      {"type":"token","text":...}                       LLM 增量
+      {"type":"sentence","idx":0,"text":...,"ms":...}   一句已切出，开始合成
+      {"type":"llm_done","ms":...}                      LLM 生成结束
+      {"type":"audio","idx":0,"text":...,"audio":"<base64 wav>","ms":...}  按句序
+      {"type":"error",...} / {"type":"done","text":全文,"ms":...}
+      {"type":"cancelled",...}                          被 /llm/cancel 打断（附估算的回收时间）
+    """
+    span = TRACER.span(x_trace_id, "llm", session_id=req.session_id, endpoint="/llm_tts", persona=req.persona)
+    pipe = SentencePipeline(
+        synth=lambda sent, idx: TTS.synthesize_sentence(sent, idx, persona=req.persona, session_id=req.session_id,
+                                                        trace_id=span.trace_id),
+        max_inflight=TTS_PIPELINE_INFLIGHT,
+    )
+    cancel = asyncio.Event()
+    finished = asyncio.get_running_loop().create_future()
+    INFLIGHT.track(req.session_id, cancel.set, finished)
+
+    persona = req.persona or "wukong"
+    filler = asyncio.create_task(TTS.filler(persona)) if FILLER.should_fill(persona) else None
+
+    async def gen():
+        nonlocal filler
+        first_audio = True
+        try:
+            async for ev in pipe.run(_stream_via_llama(req), cancel=cancel):
+                if ev["type"] in ("token", "llm_done"):
+                    span.mark("first_token" if ev["type"] == "token" else "llm_done")
+                # 垫话一到手就先发；最迟在第一句真音频之前发，保证顺序不重叠
+                if filler is not None and (filler.done() or ev["type"] == "audio"):
+                    clip = await filler
+                    filler = None
+                    if clip is not None:
+                        span.mark("filler")
+                        yield json.dumps({"type": "filler", "text": clip["text"],
+                                          "audio": base64.b64encode(clip["audio"]).decode("ascii"),
+                                          "duration_ms": clip["duration_ms"]}, ensure_ascii=False) + "\n"
+                if ev["type"] == "audio":
+                    if first_audio:
+                        first_audio = False
+                        FILLER.observe(persona, ev["ms"])
+                        span.mark("first_audio")
+                    ev = dict(ev, audio=base64.b64encode(ev["audio"]).decode("ascii"))
+                elif ev["type"] == "cancelled":
+                    BARGE.record(reclaimed_ms=ev["reclaimed_llm_ms"] + ev["reclaimed_tts_ms"])
+                    span.set(cancelled=True)
+                elif ev["type"] == "error":
+                    span.set(error=ev.get("stage"))
+                yield json.dumps(ev, ensure_ascii=False) + "\n"
+        finally:
+            span.end()
+            if filler is not None:
+                filler.cancel()
+            if not finished.done():
+                finished.set_result(None)
+
+    return StreamingResponse(gen(), media_type="application/x-ndjson", headers={TRACE_HEADER: span.trace_id})
+
+@app.post("/llm/cancel")
+async def llm_cancel(req: CancelReq):
+    """
+    打断：取消该会话进行中的 /llm、/llm_tts（关闭 llama-server 连接），
+    并通知 TTS 服务终止/作废该会话的合成任务。
+    """
+    res = await INFLIGHT.cancel(req.session_id)
+    if res["cancelled"]:
+        BARGE.record(res["cancel_ms"])
+    try:
+        res["tts"] = await TTS.cancel(req.session_id)
+        BARGE.record(reclaimed_ms=res["tts"].get("reclaimed_ms", 0.0))
+    except Exception as e:
+        res["tts"] = {"error": f"{type(e).__name__}: {e}"}
+    return res
+
+@app.get("/llm_tts/filler")
+async def llm_tts_filler_stats():
+    return FILLER.summary()
+
+@app.get("/llm/barge_in")
+async def llm_barge_in_stats():
+    return BARGE.summary()
+
+@app.get("/llm/compaction")
+async def llm_compaction_stats():
+    # prompt_tokens_before / after：每次生成前后的 prompt token 估算分位数
+    return COMPACTOR.summary() if COMPACTOR is not None else {"enabled": False}
+
+@app.get("/memory")
+async def memory_stats():
+    return MEMORY.summary() if MEMORY is not None else {"enabled": MEMORY_ENABLED, "loaded": False}
+
+@app.get("/memory/recall")
+async def memory_recall(q: str, session_id: Optional[str] = None, persona: Optional[str] = None,
+                        k: int = MEMORY_TOP_K):
+    """调试用：看某句话会召回哪些记忆"""
+    if MEMORY is None:
+        return {"enabled": False}
+    key = MEMORY.key_of(session_id, {"persona": persona})
+    return {"key": key, "hits": await MEMORY.recall(key, q, k) if key else None}
+
+# ================== 启动：llama-server 能出字才算就绪；记忆索引后台加载，不影响就绪 ==================
+LLAMA_READY_POLL_S = float(os.getenv("LLAMA_READY_POLL_S", "1"))
+
+async def _wait_llama():
+    # llama-server 加载模型期间 /health 返回 503，加载完 200
+    while True:
+        try:
+            r = await _http().get(f"{LLAMA_BASE}/health", timeout=2.0)
+            if r.status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        await asyncio.sleep(LLAMA_READY_POLL_S)
+
+STARTUP.background("llama", _wait_llama)
+if MEMORY_ENABLED:
+    STARTUP.background("memory", _load_memory, required=False)
+STARTUP.install(app, tracer=TRACER)
+
 if __name__ == "__main__":
     uvicorn.run(app, host="127.0.0.1", port=8001, reload=False, workers=1)
@@ -0,0 +1,499 @@
+"""
+长期记忆：把 conversations.db 里的消息向量化，按会话（或人设）建索引，对话时召回相关的旧消息
+
+- 向量：默认用字符 n-gram 哈希（不下载任何模型，中文直接可用）；设置 MEMORY_EMBED_MODEL 且装了
+  sentence-transformers 时改用本地 CPU 小模型（如 BAAI/bge-small-zh-v1.5）；
+- 索引：每个分区（会话 / 人设）一块 NumPy 矩阵，批量内积取 top-k；分区超过 MEMORY_IVF_MIN 条时
+  建 IVF（球面 k-means 聚类，向量按簇连续存放，查询只扫 nprobe 个簇 + 尚未入簇的尾部）；
+- 同步：后台按 messages.seq（自增、不复用）增量读（只读，不影响 llm.py 的写入），数据源始终是 conversations.db；
+  召回时再核对一遍行所属的会话 / 人设，索引里残留的已归档向量不会带出别的分区的消息；
+- 持久化：MEMORY_DIR（默认 <CONV_DB_PATH>.memory/）下一代一组 .npy，meta.json 指向当前代，
+  启动时 mmap 加载，不重新向量化；换了向量模型会自动重建。
+"""
+import asyncio
+import json
+import math
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+
+from backend.common.stats import LatencyWindow
+
+MEMORY_ENABLED = os.getenv("MEMORY_ENABLED", "1") == "1"
+MEMORY_DB_PATH = os.getenv("CONV_DB_PATH", "conversations.db")
+MEMORY_DIR = os.getenv("MEMORY_DIR", "") or MEMORY_DB_PATH + ".memory"
+MEMORY_EMBED_MODEL = os.getenv("MEMORY_EMBED_MODEL", "")       # 空 = 哈希向量
+MEMORY_DIM = int(os.getenv("MEMORY_DIM", "256"))                 # 哈希向量维度
+MEMORY_SCOPE = os.getenv("MEMORY_SCOPE", "session")             # session / persona
+MEMORY_TOP_K = int(os.getenv("MEMORY_TOP_K", "4"))
+MEMORY_MIN_SCORE = float(os.getenv("MEMORY_MIN_SCORE", "0.2"))
+MEMORY_IVF_MIN = int(os.getenv("MEMORY_IVF_MIN", "50000"))      # 分区多大才建 IVF
+MEMORY_NPROBE = int(os.getenv("MEMORY_NPROBE", "32"))
+MEMORY_SYNC_S = float(os.getenv("MEMORY_SYNC_S", "2"))
+MEMORY_SAVE_S = float(os.getenv("MEMORY_SAVE_S", "60"))
+
+SYNC_BATCH = 2000
+_IVF_FLOOR = 256    # 向量再少就不建 IVF：平铺扫描本来就快，也凑不出像样的簇
+_CHUNK = 65536      # 平铺扫描时每次参与矩阵乘的行数，限制临时内存
+
+
+# ====== 向量化 ======
+class HashEmbedder:
+    """字符 1/2/3-gram 的带符号特征哈希，L2 归一化；对短句的字面相近度足够好"""
+
+    def __init__(self, dim: int = MEMORY_DIM):
+        self.dim = dim
+        self.name = f"hash-{dim}"
+
+    @staticmethod
+    def _grams(text: str) -> List[str]:
+        s = "".join(ch for ch in text.lower() if ch.isalnum())      # 标点、空白不参与
+        return list(s) + [s[i:i + 2] for i in range(len(s) - 1)] + [s[i:i + 3] for i in range(len(s) - 2)]
+
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        hashes, counts = [], []
+        for t in texts:
+            g = [zlib.crc32(x.encode("utf-8")) for x in self._grams(t)]
+            hashes.extend(g)
+            counts.append(len(g))
+        n = len(texts)
+        h = np.asarray(hashes, dtype=np.int64)
+        rows = np.repeat(np.arange(n, dtype=np.int64), counts)
+        signs = np.where(h & 0x80000000, -1.0, 1.0)
+        v = np.bincount(rows * self.dim + h % self.dim, weights=signs, minlength=n * self.dim)
+        v = v.reshape(n, self.dim).astype(np.float32)
+        v = np.sign(v) * np.sqrt(np.abs(v))        # 次线性词频，长句里重复的字不至于主导
+        return _normalize(v)
+
+
+class ModelEmbedder:
+    def __init__(self, model: str):
+        from sentence_transformers import SentenceTransformer
+        self.model = SentenceTransformer(model, device="cpu")
+        self.dim = int(self.model.get_sentence_embedding_dimension())
+        self.name = f"st:{model}"
+
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        v = self.model.encode(list(texts), batch_size=64, normalize_embeddings=True, show_progress_bar=False)
+        return np.asarray(v, dtype=np.float32)
+
+
+def make_embedder(model: str = MEMORY_EMBED_MODEL, dim: int = MEMORY_DIM):
+    if model:
+        try:
+            return ModelEmbedder(model)
+        except Exception as e:
+            print(f"[memory] 向量模型 {model} 不可用，改用哈希向量: {type(e).__name__}: {e}")
+    return HashEmbedder(dim)
+
+
+def _normalize(v: np.ndarray) -> np.ndarray:
+    n = np.linalg.norm(v, axis=1, keepdims=True)
+    n[n == 0] = 1.0
+    return v / n
+
+
+# ====== 索引 ======
+def _topk(scores: np.ndarray, ids: np.ndarray, k: int):
+    """scores/ids 同形状 (m,)；返回按分数降序的前 k 个"""
+    if len(scores) > k:
+        part = np.argpartition(-scores, k - 1)[:k]
+        scores, ids = scores[part], ids[part]
+    order = np.argsort(-scores)
+    return scores[order], ids[order]
+
+
+def _assign(x: np.ndarray, c: np.ndarray) -> np.ndarray:
+    out = np.empty(len(x), dtype=np.int64)
+    for i in range(0, len(x), _CHUNK):
+        out[i:i + _CHUNK] = np.argmax(x[i:i + _CHUNK] @ c.T, axis=1)
+    return out
+
+
+def spherical_kmeans(x: np.ndarray, nlist: int, iters: int = 8, seed: int = 0) -> np.ndarray:
+    """在抽样上训练簇中心（单位向量）"""
+    rng = np.random.default_rng(seed)
+    sample = x[rng.choice(len(x), min(len(x), nlist * 64), replace=False)]
+    c = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+    for _ in range(iters):
+        a = _assign(sample, c)
+        order = np.argsort(a, kind="stable")
+        used, starts = np.unique(a[order], return_index=True)
+        c[used] = np.add.reduceat(sample[order], starts, axis=0)
+        empty = np.setdiff1d(np.arange(nlist), used)
+        if len(empty):      # 空簇重新播种
+            c[empty] = sample[rng.choice(len(sample), len(empty), replace=False)]
+        c = _normalize(c)
+    return c
+
+
+class Partition:
+    """
+    一个分区的向量：[0, n_ivf) 按簇连续存放（offsets[j]:offsets[j+1] 是第 j 簇），[n_ivf, n) 是
+    建 IVF 之后新增、尚未入簇的尾部，查询时平铺扫描。
+    """
+
+    def __init__(self, dim: int):
+        self.dim = dim
+        self.vecs = np.empty((0, dim), dtype=np.float32)
+        self.rowids = np.empty(0, dtype=np.int64)
+        self.n = 0
+        self.centroids: Optional[np.ndarray] = None
+        self.offsets: Optional[np.ndarray] = None
+        self.n_ivf = 0
+
+    def add(self, vecs: np.ndarray, rowids: np.ndarray):
+        need = self.n + len(vecs)
+        if need > len(self.vecs) or not self.vecs.flags.writeable:      # mmap 加载的只读视图也要先拷出来
+            cap = max(need, int(len(self.vecs) * 1.5), 64)
+            v = np.empty((cap, self.dim), dtype=np.float32)
+            r = np.empty(cap, dtype=np.int64)
+            v[:self.n] = self.vecs[:self.n]
+            r[:self.n] = self.rowids[:self.n]
+            self.vecs, self.rowids = v, r
+        self.vecs[self.n:need] = vecs
+        self.rowids[self.n:need] = rowids
+        self.n = need
+
+    def needs_ivf(self, ivf_min: int) -> bool:
+        if self.n < max(ivf_min, _IVF_FLOOR):
+            return False
+        return self.centroids is None or (self.n - self.n_ivf) > max(ivf_min, self.n_ivf // 5)
+
+    def build_ivf(self, nlist: Optional[int] = None) -> Dict[str, np.ndarray]:
+        """只读地算出新的簇布局；由调用方加锁后 apply，期间查询照常进行"""
+        n = self.n
+        x = self.vecs[:n]
+        nlist = min(nlist or max(16, int(math.sqrt(n))), n)     # 簇数不能多于向量数
+        c = spherical_kmeans(x, nlist)
+        a = _assign(x, c)
+        order = np.argsort(a, kind="stable")
+        offsets = np.zeros(nlist + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(a, minlength=nlist))
+        return {"vecs": x[order], "rowids": self.rowids[:n][order], "centroids": c, "offsets": offsets}
+
+    def apply_ivf(self, ivf: Dict[str, np.ndarray]):
+        m = len(ivf["rowids"])
+        tail_v, tail_r = self.vecs[m:self.n].copy(), self.rowids[m:self.n].copy()
+        self.vecs, self.rowids, self.n = ivf["vecs"], ivf["rowids"], m
+        self.centroids, self.offsets, self.n_ivf = ivf["centroids"], ivf["offsets"], m
+        if len(tail_r):
+            self.add(tail_v, tail_r)
+
+    def search(self, q: np.ndarray, k: int, nprobe: int = MEMORY_NPROBE):
+        """q: (B, d)；返回每个查询的 (scores, rowids)，按分数降序"""
+        q = np.asarray(q, dtype=np.float32)     # float64 的查询会让整块矩阵跟着升精度
+        out = []
+        probes = None
+        if self.centroids is not None:
+            cs = q @ self.centroids.T
+            p = min(nprobe, len(self.centroids))
+            probes = np.argpartition(-cs, p - 1, axis=1)[:, :p]
+        tail0 = self.n_ivf if probes is not None else 0
+        tail = [(self.vecs[i:min(i + _CHUNK, self.n)] @ q.T, i) for i in range(tail0, self.n, _CHUNK)]
+        for b in range(len(q)):
+            scores, ids = [], []
+            if probes is not None:
+                for j in probes[b]:
+                    lo, hi = self.offsets[j], self.offsets[j + 1]
+                    if hi > lo:
+                        scores.append(self.vecs[lo:hi] @ q[b])
+                        ids.append(np.arange(lo, hi))
+            for s, i in tail:
+                scores.append(s[:, b])
+                ids.append(np.arange(i, i + len(s)))
+            if not scores:
+                out.append((np.empty(0, np.float32), np.empty(0, np.int64)))
+                continue
+            s, pos = _topk(np.concatenate(scores), np.concatenate(ids), k)
+            out.append((s, self.rowids[pos]))
+        return out
+
+    def nbytes(self) -> int:
+        b = self.n * (self.dim * 4 + 8)
+        if self.centroids is not None:
+            b += self.centroids.nbytes + self.offsets.nbytes
+        return b
+
+
+class MemoryIndex:
+    def __init__(
+        self,
+        db_path: str = MEMORY_DB_PATH,
+        directory: str = MEMORY_DIR,
+        embedder=None,
+        scope: str = MEMORY_SCOPE,
+        ivf_min: int = MEMORY_IVF_MIN,
+        nprobe: int = MEMORY_NPROBE,
+    ):
+        self.db_path = db_path
+        self.dir = directory
+        self.embedder = embedder or make_embedder()
+        self.scope = scope
+        self.ivf_min = ivf_min
+        self.nprobe = nprobe
+        self.parts: Dict[str, Partition] = {}
+        self.last_seq = 0
+        self.generation = 0
+        self.dirty = False
+        self._lock = threading.Lock()           # 保护 parts 的结构变更；查询持锁时间只有一次矩阵乘
+        self._sync_lock = threading.Lock()      # 同一时间只有一个同步 / 保存
+        self._task: Optional[asyncio.Task] = None
+        self.recall_ms = LatencyWindow()
+        self.counters = {"indexed": 0, "skipped": 0, "ivf_builds": 0, "saves": 0, "recalls": 0, "hits": 0}
+
+    # ------------------ 分区 ------------------
+    def key_of(self, session_id: Optional[str], meta: Optional[dict]) -> Optional[str]:
+        if self.scope == "persona":
+            return (meta or {}).get("persona")
+        return session_id
+
+    # ------------------ 增量同步 ------------------
+    def _connect(self) -> Optional[sqlite3.Connection]:
+        if not os.path.exists(self.db_path):
+            return None
+        return sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True, timeout=5)
+
+    def sync(self, limit: Optional[int] = None) -> int:
+        """把 last_seq 之后的新消息向量化进索引；返回新增条数"""
+        with self._sync_lock:
+            db = self._connect()
+            if db is None:
+                return 0
+            added = 0
+            try:
+                while limit is None or added < limit:
+                    rows = db.execute(
+                        "SELECT seq, session_id, text, meta FROM messages WHERE seq > ? "
+                        "ORDER BY seq LIMIT ?", (self.last_seq, SYNC_BATCH)).fetchall()
+                    if not rows:
+                        break
+                    self._index_rows(rows)
+                    added += len(rows)
+            finally:
+                db.close()
+            self._maybe_build_ivf()
+            return added
+
+    def _index_rows(self, rows):
+        groups: Dict[str, List[int]] = {}
+        for i, (seq, session_id, text, meta) in enumerate(rows):
+            try:
+                meta = json.loads(meta) if meta else {}
+            except ValueError:
+                meta = {}
+            key = self.key_of(session_id, meta)
+            if key is None or not (text or "").strip():
+                self.counters["skipped"] += 1
+                continue
+            groups.setdefault(key, []).append(i)
+        idx = [i for g in groups.values() for i in g]
+        if idx:
+            vecs = self.embedder.embed([rows[i][2] for i in idx])
+            pos = {i: j for j, i in enumerate(idx)}
+            with self._lock:
+                for key, g in groups.items():
+                    part = self.parts.get(key)
+                    if part is None:
+                        part = self.parts[key] = Partition(vecs.shape[1])
+                    part.add(vecs[[pos[i] for i in g]], np.asarray([rows[i][0] for i in g], dtype=np.int64))
+            self.counters["indexed"] += len(idx)
+        self.last_seq = rows[-1][0]
+        self.dirty = True
+
+    def _maybe_build_ivf(self):
+        for key, part in list(self.parts.items()):
+            if part.needs_ivf(self.ivf_min):
+                ivf = part.build_ivf()
+                with self._lock:
+                    part.apply_ivf(ivf)
+                self.counters["ivf_builds"] += 1
+                self.dirty = True
+
+    # ------------------ 查询 ------------------
+    def search(self, key: str, texts: Sequence[str], k: int = MEMORY_TOP_K) -> Optional[List[List[tuple]]]:
+        """批量查询；分区不存在返回 None，否则每个查询一个 [(score, seq), ...]"""
+        q = self.embedder.embed(texts)
+        with self._lock:
+            part = self.parts.get(key)
+            if part is None:
+                return None
+            res = part.search(q, k, self.nprobe)
+        return [list(zip(s.tolist(), r.tolist())) for s, r in res]
+
+    def _fetch(self, key: str, seqs: List[int]) -> Dict[int, tuple]:
+        """按 seq 取回消息正文；只留仍属于 key 这个分区的行"""
+        db = self._connect()
+        if db is None or not seqs:
+            return {}
+        try:
+            q = (f"SELECT seq, role, text, created_at, session_id, meta FROM messages "
+                 f"WHERE seq IN ({','.join('?' * len(seqs))})")
+            out = {}
+            for seq, role, text, created_at, session_id, meta in db.execute(q, seqs).fetchall():
+                try:
+                    meta = json.loads(meta) if meta else {}
+                except ValueError:
+                    meta = {}
+                if self.key_of(session_id, meta) == key:
+                    out[seq] = (role, text, created_at)
+            return out
+        finally:
+            db.close()
+
+    def recall_sync(self, key: str, text: str, k: int = MEMORY_TOP_K,
+                    min_score: float = MEMORY_MIN_SCORE) -> Optional[List[Dict[str, Any]]]:
+        t0 = time.perf_counter()
+        res = self.search(key, [text], k + 1)      # 多取一条：刚存进去的这句话本身通常排第一
+        if res is None:
+            return None
+        hits = [(s, r) for s, r in res[0] if s >= min_score]
+        rows = self._fetch(key, [r for _, r in hits])
+        out = []
+        for s, r in hits:
+            if r not in rows:       # 已归档 / 删除
+                continue
+            role, t, created_at = rows[r]
+            if t.strip() == text.strip():
+                continue
+            out.append({"seq": r, "score": round(s, 4), "role": role, "text": t, "created_at": created_at})
+        out = out[:k]
+        self.recall_ms.add((time.perf_counter() - t0) * 1000.0)
+        self.counters["recalls"] += 1
+        self.counters["hits"] += len(out)
+        return out
+
+    async def recall(self, key: str, text: str, k: int = MEMORY_TOP_K) -> Optional[List[Dict[str, Any]]]:
+        return await asyncio.to_thread(self.recall_sync, key, text, k)
+
+    # ------------------ 持久化 ------------------
+    def save(self):
+        with self._sync_lock:
+            if not self.dirty:
+                return
+            os.makedirs(self.dir, exist_ok=True)
+            gen = self.generation + 1
+            with self._lock:
+                keys = list(self.parts)
+                parts = [self.parts[k] for k in keys]
+                vecs = [p.vecs[:p.n] for p in parts]
+                rowids = [p.rowids[:p.n] for p in parts]
+                ivf = [(k, p.centroids, p.offsets, p.n_ivf) for k, p in zip(keys, parts) if p.centroids is not None]
+                last_seq = self.last_seq
+            dim = vecs[0].shape[1] if vecs else getattr(self.embedder, "dim", MEMORY_DIM)
+            np.save(self._path("vectors", gen), np.concatenate(vecs) if vecs else np.empty((0, dim), np.float32))
+            np.save(self._path("rowids", gen), np.concatenate(rowids) if rowids else np.empty(0, np.int64))
+            centroids = [c for _, c, _, _ in ivf]
+            np.save(self._path("centroids", gen), np.concatenate(centroids) if centroids else np.empty((0, dim), np.float32))
+            np.save(self._path("offsets", gen), np.concatenate([o for _, _, o, _ in ivf]) if ivf else np.empty(0, np.int64))
+            meta = {
+                "generation": gen,
+                "embedder": self.embedder.name,
+                "dim": int(dim),
+                "scope": self.scope,
+                "last_seq": last_seq,
+                "partitions": [[k, len(r)] for k, r in zip(keys, rowids)],
+                "ivf": [[k, len(c), n_ivf] for k, c, _, n_ivf in ivf],
+            }
+            tmp = os.path.join(self.dir, "meta.json.tmp")
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(meta, f, ensure_ascii=False)
+            os.replace(tmp, os.path.join(self.dir, "meta.json"))     # 切代是原子的
+            for name in ("vectors", "rowids", "centroids", "offsets"):
+                old = self._path(name, self.generation)
+                if self.generation and os.path.exists(old):
+                    os.remove(old)
+            self.generation = gen
+            self.dirty = False
+            self.counters["saves"] += 1
+
+    def load(self) -> bool:
+        path = os.path.join(self.dir, "meta.json")
+        if not os.path.exists(path):
+            return False
+        with open(path, encoding="utf-8") as f:
+            meta = json.load(f)
+        if "last_seq" not in meta:
+            # 按可复用的 rowid 建的老索引：向量可能挂在被别的会话复用的编号上，重建
+            print("[memory] 索引按旧的 rowid 建立，重建")
+            self.generation = meta.get("generation", 0)
+            return False
+        if meta.get("embedder") != self.embedder.name or meta.get("scope") != self.scope:
+            print(f"[memory] 索引由 {meta.get('embedder')}/{meta.get('scope')} 生成，"
+                  f"当前 {self.embedder.name}/{self.scope}，重建")
+            self.generation = meta.get("generation", 0)     # 下次保存时顺带删掉旧文件
+            return False
+        gen = meta["generation"]
+        vecs = np.load(self._path("vectors", gen), mmap_mode="r")
+        rowids = np.load(self._path("rowids", gen), mmap_mode="r")
+        centroids = np.load(self._path("centroids", gen))
+        offsets = np.load(self._path("offsets", gen))
+        ivf = {k: (nlist, n_ivf) for k, nlist, n_ivf in meta["ivf"]}
+        parts, i, ci, oi = {}, 0, 0, 0
+        for key, n in meta["partitions"]:
+            p = Partition(meta["dim"])
+            p.vecs, p.rowids, p.n = vecs[i:i + n], rowids[i:i + n], n
+            i += n
+            if key in ivf:
+                nlist, p.n_ivf = ivf[key]
+                p.centroids = centroids[ci:ci + nlist]
+                p.offsets = offsets[oi:oi + nlist + 1]
+                ci += nlist
+                oi += nlist + 1
+            parts[key] = p
+        with self._lock:
+            self.parts = parts
+            self.last_seq = meta["last_seq"]
+            self.generation = gen
+        return True
+
+    def _path(self, name: str, gen: int) -> str:
+        return os.path.join(self.dir, f"{name}-{gen}.npy")
+
+    # ------------------ 后台任务 ------------------
+    async def start(self):
+        await asyncio.to_thread(self.load)
+        self._task = asyncio.create_task(self._run(), name="memory-sync")
+
+    async def _run(self):
+        last_save = time.monotonic()
+        while True:
+            try:
+                await asyncio.to_thread(self.sync)
+                if self.dirty and time.monotonic() - last_save >= MEMORY_SAVE_S:
+                    await asyncio.to_thread(self.save)
+                    last_save = time.monotonic()
+            except Exception as e:
+                print(f"[memory] 同步失败: {type(e).__name__}: {e}")
+            await asyncio.sleep(MEMORY_SYNC_S)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await asyncio.to_thread(self.save)
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            parts = list(self.parts.values())
+        return {
+            "embedder": self.embedder.name,
+            "scope": self.scope,
+            "dir": self.dir,
+            "last_seq": self.last_seq,
+            "partitions": len(parts),
+            "vectors": sum(p.n for p in parts),
+            "ivf_partitions": sum(1 for p in parts if p.centroids is not None),
+            "index_mb": round(sum(p.nbytes() for p in parts) / 2**20, 2),
+            **self.counters,
+            "recall_ms": self.recall_ms.summary(),
+        }
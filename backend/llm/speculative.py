@@ -0,0 +1,123 @@
+"""
+投机生成：ASR partial 稳定后提前调用 llama-server，final 到达时再决定用不用。
+
+流程：
+  1) 前端收到 {"type":"stable"} → POST /llm/speculate（带 speculation_key）
+     → start()：后台任务立即开始生成；
+  2) 前端收到 final → POST /llm（同一个 speculation_key）
+     → resolve()：final 与投机文本归一化后一致 → 直接复用结果；
+                  不一致 → 取消投机任务，返回 None，由调用方重新生成。
+
+统计 saved_ms（final 到达时投机已跑掉的时间，即省下的等待）与
+wasted_ms（被取消/过期的投机所消耗的生成时间），用来调 ASR_SPECULATE_STABLE_MS。
+"""
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from backend.common.text import normalize_text
+
+
+class _Spec:
+    def __init__(self, norm_text: str, task: "asyncio.Task"):
+        self.norm_text = norm_text
+        self.task = task
+        self.started = time.perf_counter()
+        self.finished: Optional[float] = None
+        task.add_done_callback(self._on_done)
+
+    def _on_done(self, t):
+        self.finished = time.perf_counter()
+        if not t.cancelled():
+            t.exception()  # 标记已取回，避免被丢弃的失败任务刷 "never retrieved" 警告
+
+    def elapsed_ms(self) -> float:
+        end = self.finished if self.finished is not None else time.perf_counter()
+        return (end - self.started) * 1000.0
+
+
+class SpeculativeManager:
+    def __init__(self, run: Callable[[Any], Awaitable[Tuple[str, str]]], ttl: float = 30.0):
+        """
+        run：真正的生成函数（如 llm_app._chat_via_llama），入参为请求对象，返回 (text, model)
+        ttl：投机结果最长保留秒数，超时未被 final 认领视为浪费
+        """
+        self._run = run
+        self.ttl = ttl
+        self._specs: Dict[str, _Spec] = {}
+        self.counters = {
+            "started": 0,
+            "hit": 0,            # final 与投机文本一致，复用
+            "miss": 0,           # 不一致，取消并重跑
+            "superseded": 0,     # 同 key 上 partial 又变了，旧投机被替换
+            "expired": 0,        # 超时无人认领
+            "cancelled": 0,      # 命中后等结果期间被打断（/llm/cancel）
+            "saved_ms": 0.0,
+            "wasted_ms": 0.0,
+        }
+
+    def _discard(self, spec: _Spec, reason: str):
+        if not spec.task.done():
+            spec.task.cancel()
+        self.counters[reason] += 1
+        self.counters["wasted_ms"] += spec.elapsed_ms()
+
+    def _gc(self):
+        now = time.perf_counter()
+        for k, spec in list(self._specs.items()):
+            if now - spec.started > self.ttl:
+                self._specs.pop(k, None)
+                self._discard(spec, "expired")
+
+    def start(self, key: str, text: str, req: Any) -> bool:
+        """对 text 发起投机生成；同一 key 上文本没变则不重复发起。"""
+        self._gc()
+        norm = normalize_text(text)
+        if not norm:
+            return False
+        old = self._specs.get(key)
+        if old is not None:
+            if old.norm_text == norm:
+                return False
+            self._specs.pop(key, None)
+            self._discard(old, "superseded")
+        self._specs[key] = _Spec(norm, asyncio.create_task(self._run(req)))
+        self.counters["started"] += 1
+        return True
+
+    async def resolve(self, key: str, final_text: str) -> Optional[Tuple[str, str]]:
+        """final 到达：命中则返回投机结果 (text, model)，否则返回 None。"""
+        spec = self._specs.pop(key, None)
+        if spec is None:
+            return None
+        if spec.norm_text != normalize_text(final_text):
+            self._discard(spec, "miss")
+            return None
+        # 命中：final 到达前已经跑掉的生成时间就是省下的延迟
+        saved_ms = spec.elapsed_ms()
+        try:
+            result = await spec.task
+        except asyncio.CancelledError:
+            # 调用方（/llm）被打断，投机任务随之取消
+            self._discard(spec, "cancelled")
+            raise
+        except Exception:
+            # 投机任务自己失败了，按未命中处理，让调用方正常重试
+            self.counters["miss"] += 1
+            return None
+        self.counters["hit"] += 1
+        self.counters["saved_ms"] += saved_ms
+        return result
+
+    def running(self) -> int:
+        """还在生成中的投机任务数（占着 llama-server 槽位）"""
+        return sum(1 for spec in self._specs.values() if not spec.task.done())
+
+    def stats(self) -> Dict[str, Any]:
+        c = dict(self.counters)
+        judged = c["hit"] + c["miss"]
+        c["hit_ratio"] = round(c["hit"] / judged, 3) if judged else None
+        c["pending"] = len(self._specs)
+        c["saved_ms"] = round(c["saved_ms"], 1)
+        c["wasted_ms"] = round(c["wasted_ms"], 1)
+        return c
@@ -0,0 +1,490 @@
+"""
+对话存储（llm.py 的 /receive_text 用）
+
+原来每条消息都新开一个 aiosqlite 连接、INSERT OR IGNORE 会话、单独 commit：
+建连在请求路径上，而且每句话一次 fsync。这里改成：
+
+- 一条常驻连接，WAL 模式 + 调过的 pragma（synchronous 由 CONV_SYNCHRONOUS 决定，默认 FULL，
+  与原来一样每次提交都落盘，只是一批一次）；
+- 写后台化：save_message 把行放进队列，写协程攒到 CONV_FLUSH_ROWS 行或等满 CONV_FLUSH_MS
+  就在一个事务里批量写入、一次提交（group commit）；
+- 幂等不变：idem 冲突的行返回 False（同一批里重复的，后到的那条返回 False），其它行返回 True；
+- 默认等提交完成才返回（HTTP 响应时已落盘）；只有显式设置 CONV_ASYNC_ACK=1 时入队即返回
+  （stored 为 None，进程崩溃可能丢最近几毫秒的消息）。
+
+读路径（/history、/search）：
+- (session_id, created_at) 复合索引，按会话倒序取历史，游标分页（不用 OFFSET，翻到多深都是一次索引定位）；
+- FTS5 外部内容表 messages_fts（trigram 分词，中文不需要分词词典），由触发器与 messages 同步；
+  trigram 要求检索词至少 3 个字符，更短的词（如两个汉字）退回 LIKE 扫描（限定会话时走会话索引）；
+- 读用单独的只读连接，WAL 下不会排在写事务后面；
+- 已归档（archive.py）的会话：库里的行读完后接着从段文件里按同一游标往下翻，返回的消息带 archived: true。
+
+messages.seq 是 INTEGER PRIMARY KEY AUTOINCREMENT（即 rowid 的别名）：归档删掉最大的几行之后新消息也不会
+复用它们的编号，记忆索引（memory.py）、全文索引、/history 与 /search 的游标都以 seq 为键。
+没有 seq 列的老库在 open() 时整表重建一次（seq 取原 rowid）。
+"""
+import base64
+import asyncio
+import json
+import os
+import time
+import uuid
+from typing import Any, Dict, List, Optional
+
+import aiosqlite
+
+from backend.common.stats import LatencyWindow
+from backend.llm.archive import INDEX_SCHEMA as ARCHIVE_INDEX_SCHEMA, ArchiveReader, archive_dir_for
+
+CONV_DB_PATH = os.getenv("CONV_DB_PATH", "conversations.db")
+CONV_FLUSH_MS = float(os.getenv("CONV_FLUSH_MS", "5"))        # 攒批最多等多久
+CONV_FLUSH_ROWS = int(os.getenv("CONV_FLUSH_ROWS", "256"))     # 攒够多少行立即提交
+CONV_SYNCHRONOUS = os.getenv("CONV_SYNCHRONOUS", "FULL").upper()   # FULL / NORMAL（WAL 下只在检查点 fsync）
+CONV_ASYNC_ACK = os.getenv("CONV_ASYNC_ACK", "0") == "1"
+
+_MESSAGES_DDL = """
+    CREATE TABLE IF NOT EXISTS messages (
+      seq INTEGER PRIMARY KEY AUTOINCREMENT,
+      id TEXT UNIQUE,
+      session_id TEXT,
+      role TEXT CHECK(role IN ('user','assistant','system')),
+      text TEXT,
+      created_at REAL,
+      idem TEXT UNIQUE,
+      meta TEXT
+    );"""
+_MESSAGES_INDEX = "CREATE INDEX IF NOT EXISTS idx_messages_session_time ON messages(session_id, created_at)"
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS sessions (
+      id TEXT PRIMARY KEY,
+      created_at REAL
+    );""",
+    _MESSAGES_DDL,
+    _MESSAGES_INDEX,
+    # 滚动摘要（llm_app 的 compaction 写入）：covered 是覆盖的前缀条数，anchor 是这段前缀的指纹
+    """
+    CREATE TABLE IF NOT EXISTS summaries (
+      session_id TEXT,
+      persona TEXT,
+      anchor TEXT,
+      text TEXT,
+      covered INTEGER,
+      tokens_before INTEGER,
+      tokens_after INTEGER,
+      created_at REAL
+    );""",
+    "CREATE INDEX IF NOT EXISTS idx_summaries_session_time ON summaries(session_id, created_at)",
+]
+
+# 全文索引：外部内容表，不重复存正文；触发器保持同步
+FTS_SCHEMA = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+      text, content='messages', content_rowid='rowid', tokenize='trigram'
+    );""",
+    """
+    CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages BEGIN
+      INSERT INTO messages_fts(rowid, text) VALUES (new.rowid, new.text);
+    END;""",
+    """
+    CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages BEGIN
+      INSERT INTO messages_fts(messages_fts, rowid, text) VALUES ('delete', old.rowid, old.text);
+    END;""",
+    """
+    CREATE TRIGGER IF NOT EXISTS messages_fts_au AFTER UPDATE OF text ON messages BEGIN
+      INSERT INTO messages_fts(messages_fts, rowid, text) VALUES ('delete', old.rowid, old.text);
+      INSERT INTO messages_fts(rowid, text) VALUES (new.rowid, new.text);
+    END;""",
+]
+
+HISTORY_MAX_LIMIT = 200
+FTS_MIN_CHARS = 3       # trigram 分词能命中的最短检索词
+
+PRAGMAS = [
+    "PRAGMA journal_mode=WAL",
+    f"PRAGMA synchronous={CONV_SYNCHRONOUS}",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16384",         # 16MB 页缓存
+    "PRAGMA mmap_size=268435456",       # 读走 mmap
+    "PRAGMA busy_timeout=5000",
+]
+
+_INSERT = """INSERT INTO messages
+    (id, session_id, role, text, created_at, idem, meta)
+    VALUES (?, ?, ?, ?, ?, ?, ?)"""
+
+_COLUMNS = "m.seq, m.id, m.session_id, m.role, m.text, m.created_at, m.meta"
+
+
+def encode_cursor(*key) -> str:
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> list:
+    """游标格式不对抛 ValueError"""
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except Exception as e:
+        raise ValueError(f"bad cursor: {cursor!r}") from e
+    if not isinstance(key, list):
+        raise ValueError(f"bad cursor: {cursor!r}")
+    return key
+
+
+def _message(row, snippet: Optional[str] = None) -> Dict[str, Any]:
+    m = {
+        "id": row[1],
+        "session_id": row[2],
+        "role": row[3],
+        "text": row[4],
+        "created_at": row[5],
+        "meta": json.loads(row[6]) if row[6] else {},
+    }
+    if snippet is not None:
+        m["snippet"] = snippet
+    return m
+
+
+def _fts_phrase(q: str) -> str:
+    """整串当一个短语查，用户输入里的 FTS 语法字符不生效"""
+    return '"' + q.replace('"', '""') + '"'
+
+
+def _like_pattern(q: str) -> str:
+    return "%" + q.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+
+class _Row:
+    __slots__ = ("params", "future")
+
+    def __init__(self, params: tuple, future: Optional[asyncio.Future]):
+        self.params = params
+        self.future = future
+
+
+class ConversationStore:
+    def __init__(
+        self,
+        path: str = CONV_DB_PATH,
+        flush_ms: float = CONV_FLUSH_MS,
+        flush_rows: int = CONV_FLUSH_ROWS,
+        async_ack: bool = CONV_ASYNC_ACK,
+    ):
+        self.path = path
+        self.flush_ms = flush_ms
+        self.flush_rows = max(1, flush_rows)
+        self.async_ack = async_ack
+        self.archive = ArchiveReader(archive_dir_for(path))
+        self.db: Optional[aiosqlite.Connection] = None
+        self.reader: Optional[aiosqlite.Connection] = None
+        self._queue: "asyncio.Queue[_Row]" = asyncio.Queue()
+        self._writer: Optional[asyncio.Task] = None
+        self.commit_ms = LatencyWindow()
+        self.batch_rows = LatencyWindow()
+        self.history_ms = LatencyWindow()
+        self.search_ms = LatencyWindow()
+        self.counters = {"rows": 0, "stored": 0, "duplicate": 0, "failed": 0, "batches": 0}
+
+    # ------------------ 生命周期 ------------------
+    async def open(self):
+        self.db = await aiosqlite.connect(self.path, isolation_level=None)   # 事务自己管
+        for p in PRAGMAS:
+            await self.db.execute(p)
+        for ddl in SCHEMA + ARCHIVE_INDEX_SCHEMA:
+            await self.db.execute(ddl)
+        await self._ensure_seq()
+        await self._ensure_fts()
+        self.reader = await aiosqlite.connect(f"file:{self.path}?mode=ro", uri=True)
+        for p in ("PRAGMA query_only=1", "PRAGMA cache_size=-16384",
+                  "PRAGMA mmap_size=268435456", "PRAGMA busy_timeout=5000"):
+            await self.reader.execute(p)
+        self._writer = asyncio.create_task(self._run(), name="conv-writer")
+
+    async def close(self):
+        """先把队列里的写完再关"""
+        if self._writer is not None:
+            await self._queue.join()
+            self._writer.cancel()
+            try:
+                await self._writer
+            except asyncio.CancelledError:
+                pass
+            self._writer = None
+        if self.reader is not None:
+            await self.reader.close()
+            self.reader = None
+        if self.db is not None:
+            await self.db.close()
+            self.db = None
+
+    async def _ensure_seq(self):
+        """老库的 messages 没有 seq 列（id 是主键，rowid 在删掉最大的行后会被复用）：整表重建一次。
+        seq 取原 rowid，全文索引和已建的向量不用重做"""
+        db = self.db
+        await db.execute("BEGIN IMMEDIATE")     # 多个进程同时升级时只有一个真的重建
+        try:
+            async with db.execute("PRAGMA table_info(messages)") as cur:
+                cols = [r[1] for r in await cur.fetchall()]
+            if "seq" not in cols:
+                for stmt in [
+                    "DROP TRIGGER IF EXISTS messages_fts_ai",
+                    "DROP TRIGGER IF EXISTS messages_fts_ad",
+                    "DROP TRIGGER IF EXISTS messages_fts_au",
+                    "DROP INDEX IF EXISTS idx_messages_session_time",
+                    "ALTER TABLE messages RENAME TO messages_legacy",
+                    _MESSAGES_DDL,
+                    _MESSAGES_INDEX,
+                    """INSERT INTO messages (seq, id, session_id, role, text, created_at, idem, meta)
+                       SELECT rowid, id, session_id, role, text, created_at, idem, meta
+                       FROM messages_legacy ORDER BY rowid""",
+                    "DROP TABLE messages_legacy",
+                ]:
+                    await db.execute(stmt)
+                print("[store] messages 表已升级：新增不复用的自增键 seq")
+            await db.commit()
+        except BaseException:
+            await db.rollback()
+            raise
+
+    async def _ensure_fts(self):
+        """老库第一次升级时建全文索引并把已有消息灌进去"""
+        async with self.db.execute(
+                "SELECT 1 FROM sqlite_master WHERE type='table' AND name='messages_fts'") as cur:
+            existed = await cur.fetchone() is not None
+        await self.db.execute("BEGIN IMMEDIATE")
+        try:
+            for ddl in FTS_SCHEMA:
+                await self.db.execute(ddl)
+            if not existed:
+                await self.db.execute("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')")
+            await self.db.commit()
+        except BaseException:
+            await self.db.rollback()
+            raise
+
+    # ------------------ 写入 ------------------
+    async def save_message(self, session_id: str, role: str, text: str, idem: Optional[str],
+                           meta: Optional[dict] = None) -> Optional[bool]:
+        """True = 写入；False = idem 重复（忽略）；None = 异步确认模式下已入队、尚未落盘"""
+        params = (str(uuid.uuid4()), session_id, role, text, time.time(), idem, json.dumps(meta or {}))
+        if self.async_ack:
+            self._queue.put_nowait(_Row(params, None))
+            return None
+        fut = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait(_Row(params, fut))
+        return await fut
+
+    async def _collect(self) -> List[_Row]:
+        rows = [await self._queue.get()]
+        deadline = time.perf_counter() + self.flush_ms / 1000.0
+        while len(rows) < self.flush_rows:
+            try:
+                rows.append(self._queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            left = deadline - time.perf_counter()
+            if left <= 0:
+                break
+            try:
+                rows.append(await asyncio.wait_for(self._queue.get(), left))
+            except asyncio.TimeoutError:
+                break
+        return rows
+
+    async def _run(self):
+        while True:
+            rows = await self._collect()
+            t0 = time.perf_counter()
+            try:
+                results = await self._write(rows)
+            except Exception as e:
+                results = [e] * len(rows)
+            self.commit_ms.add((time.perf_counter() - t0) * 1000.0)
+            self.batch_rows.add(len(rows))
+            self.counters["batches"] += 1
+            for row, res in zip(rows, results):
+                self.counters["rows"] += 1
+                if isinstance(res, Exception):
+                    self.counters["failed"] += 1
+                    if row.future is None:
+                        print(f"[store] 写入失败（异步确认，已丢弃）: {type(res).__name__}: {res}")
+                    elif not row.future.done():
+                        row.future.set_exception(res)
+                else:
+                    self.counters["stored" if res else "duplicate"] += 1
+                    if row.future is not None and not row.future.done():
+                        row.future.set_result(res)
+                self._queue.task_done()
+
+    async def _write(self, rows: List[_Row]) -> List[Any]:
+        """一个事务写一批；返回每行的结果（True / False / 异常）"""
+        db = self.db
+        await db.execute("BEGIN IMMEDIATE")     # 先拿写锁，查重与插入之间不会有别的写者
+        try:
+            # 幂等：库里已有的 idem 与本批内重复的 idem 都算重复
+            idems = list({r.params[5] for r in rows if r.params[5] is not None})
+            seen = set()
+            for i in range(0, len(idems), 500):
+                chunk = idems[i:i + 500]
+                q = f"SELECT idem FROM messages WHERE idem IN ({','.join('?' * len(chunk))})"
+                async with db.execute(q, chunk) as cur:
+                    seen.update(r[0] for r in await cur.fetchall())
+            results: List[Any] = []
+            fresh = []
+            for r in rows:
+                idem = r.params[5]
+                if idem is not None and idem in seen:
+                    results.append(False)
+                    continue
+                if idem is not None:
+                    seen.add(idem)
+                results.append(True)
+                fresh.append(r)
+
+            sessions = {}
+            for r in rows:
+                sessions.setdefault(r.params[1], r.params[4])
+            await db.executemany("INSERT OR IGNORE INTO sessions (id, created_at) VALUES (?,?)",
+                                 list(sessions.items()))
+            await db.execute("SAVEPOINT batch")
+            try:
+                await db.executemany(_INSERT, [r.params for r in fresh])
+                await db.execute("RELEASE batch")
+            except aiosqlite.Error:
+                # 有坏行（如 role 不合法）：撤掉这批，逐行重写，把错误只归到那一行
+                await db.execute("ROLLBACK TO batch")
+                await db.execute("RELEASE batch")
+                results = await self._write_rows(rows, results)
+            await db.commit()
+        except BaseException:
+            await db.rollback()
+            raise
+        return results
+
+    async def _write_rows(self, rows: List[_Row], results: List[Any]) -> List[Any]:
+        out = []
+        for r, res in zip(rows, results):
+            if res is not True:
+                out.append(res)
+                continue
+            try:
+                await self.db.execute(_INSERT, r.params)
+                out.append(True)
+            except aiosqlite.IntegrityError:
+                out.append(False)   # 与原实现一致：完整性冲突一律按重复忽略
+            except aiosqlite.Error as e:
+                out.append(e)
+        return out
+
+    # ------------------ 读取 ------------------
+    async def history(self, session_id: str, limit: int = 50,
+                      cursor: Optional[str] = None) -> Dict[str, Any]:
+        """某个会话的消息，新的在前；next_cursor 为 None 表示没有更早的了"""
+        limit = max(1, min(limit, HISTORY_MAX_LIMIT))
+        t0 = time.perf_counter()
+        before = None
+        if cursor:
+            try:
+                created_at, seq = (float(v) for v in decode_cursor(cursor))
+            except (TypeError, ValueError):
+                raise ValueError(f"bad cursor: {cursor!r}")
+            before = (created_at, int(seq))
+            q = (f"SELECT {_COLUMNS} FROM messages m WHERE m.session_id = ? "
+                 "AND (m.created_at, m.seq) < (?, ?) "
+                 "ORDER BY m.created_at DESC, m.seq DESC LIMIT ?")
+            args = (session_id, created_at, int(seq), limit + 1)
+        else:
+            q = (f"SELECT {_COLUMNS} FROM messages m WHERE m.session_id = ? "
+                 "ORDER BY m.created_at DESC, m.seq DESC LIMIT ?")
+            args = (session_id, limit + 1)
+        async with self.reader.execute(q, args) as cur:
+            rows = await cur.fetchall()
+        more = len(rows) > limit
+        rows = rows[:limit]
+        archived = []
+        if not more:
+            # 库里的翻完了：归档的行都比库里剩下的旧，接着从段文件往下翻
+            room = limit - len(rows)
+            if rows:
+                before = (rows[-1][5], rows[-1][0])
+            async with self.reader.execute(
+                    "SELECT segment, offset, length, first_at FROM archive_index WHERE session_id = ? "
+                    "ORDER BY last_at DESC", (session_id,)) as cur:
+                entries = await cur.fetchall()
+            if entries:
+                archived = await asyncio.to_thread(self.archive.page, session_id, entries, room + 1, before)
+                more = len(archived) > room
+                archived = archived[:room]
+        self.history_ms.add((time.perf_counter() - t0) * 1000.0)
+        last = (archived or rows or [None])[-1]
+        return {
+            "messages": [_message(r) for r in rows] + [dict(_message(r), archived=True) for r in archived],
+            "next_cursor": encode_cursor(last[5], last[0]) if more else None,
+        }
+
+    async def search(self, q: str, session_id: Optional[str] = None, limit: int = 20,
+                     cursor: Optional[str] = None) -> Dict[str, Any]:
+        """全文检索，新的在前；结果带 snippet（命中处用 [] 标出）"""
+        q = q.strip()
+        if not q:
+            return {"messages": [], "next_cursor": None, "mode": "empty"}
+        limit = max(1, min(limit, HISTORY_MAX_LIMIT))
+        before = None
+        if cursor:
+            try:
+                before = int(decode_cursor(cursor)[0])
+            except (IndexError, TypeError, ValueError):
+                raise ValueError(f"bad cursor: {cursor!r}")
+        t0 = time.perf_counter()
+        where, args = [], []
+        if len(q) >= FTS_MIN_CHARS:
+            mode = "fts"
+            sql = (f"SELECT {_COLUMNS}, snippet(messages_fts, 0, '[', ']', '…', 16) "
+                   "FROM messages_fts f JOIN messages m ON m.seq = f.rowid "
+                   "WHERE messages_fts MATCH ?")
+            args.append(_fts_phrase(q))
+            order = "f.rowid"
+            rid = "f.rowid"
+        else:
+            mode = "like"
+            sql = f"SELECT {_COLUMNS}, NULL FROM messages m WHERE m.text LIKE ? ESCAPE '\\'"
+            args.append(_like_pattern(q))
+            order = "m.seq"
+            rid = "m.seq"
+        if session_id:
+            where.append("m.session_id = ?")
+            args.append(session_id)
+        if before is not None:
+            where.append(f"{rid} < ?")
+            args.append(before)
+        for w in where:
+            sql += f" AND {w}"
+        sql += f" ORDER BY {order} DESC LIMIT ?"
+        args.append(limit + 1)
+        async with self.reader.execute(sql, args) as cur:
+            rows = await cur.fetchall()
+        self.search_ms.add((time.perf_counter() - t0) * 1000.0)
+        more = len(rows) > limit
+        rows = rows[:limit]
+        return {
+            "messages": [_message(r, r[7]) for r in rows],
+            "next_cursor": encode_cursor(rows[-1][0]) if more else None,
+            "mode": mode,
+        }
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "path": self.path,
+            "synchronous": CONV_SYNCHRONOUS,
+            "async_ack": self.async_ack,
+            "queued": self._queue.qsize(),
+            **self.counters,
+            "batch_rows": self.batch_rows.summary(),
+            "commit_ms": self.commit_ms.summary(),
+            "history_ms": self.history_ms.summary(),
+            "search_ms": self.search_ms.summary(),
+            "archive_read_ms": self.archive.read_ms.summary(),
+        }
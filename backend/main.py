@@ -1,63 +1,242 @@
-from fastapi import FastAPI
-from fastapi import FastAPI, UploadFile, Form
-from fastapi.responses import FileResponse, JSONResponse
+"""
+单入口网关：/asr（上传音频 → 文本）、/chat（文本 + 人设 → 回复）、/tts（文本 → 音频）
+
+在仓库根目录：
+  uvicorn backend.main:app --host 0.0.0.0 --port 8000
+
+handler 里不做任何阻塞 I/O，一个慢请求不会卡住别的客户端：
+- 上游（vLLM / llama-server 的 /v1/chat/completions）走进程内共用的 httpx.AsyncClient 连接池；
+- CPU 活放进各自的有界线程池（_Lane）：whisper 转写、Piper 合成；同时跑 workers 个、再排 queue 个，
+  超出直接 503（带 Retry-After），不在事件循环里无限堆积；
+- 上传的音频不落 uploads/ 目录：UploadFile 本身是 SpooledTemporaryFile（小文件在内存，大了才落到临时文件，
+  关闭即删），直接交给 faster-whisper 解码，请求结束关闭；
+- /chat 传 stream=true 时边生成边返回纯文本；/tts 按句切段，首段合成完就发 wav 头 + 音频，
+  后面的段边合成边发（预取一段），不写文件；客户端断开时没合成的段不再合成。
+"""
+import asyncio
 import os
-import uuid
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict
+
+import httpx
+from fastapi import FastAPI, Form, HTTPException, UploadFile
+from fastapi.responses import JSONResponse, StreamingResponse
+
+from backend.common.startup import Startup
+from backend.common.stats import LatencyWindow
+from backend.asr.asr_app import BEAM_SIZE, LANGUAGE, USE_VAD, load_model
+from backend.chat import VLLM_ENDPOINT, achat_with_role, chat_payload, stream_with_role
+from backend.tts.codecs import wav_stream_header
+from backend.tts.piper_pool import PIPER_POOL_SIZE, SynthesisCancelled, default_pool
+from backend.tts.segment import segment_text, silence
+from backend.tts.tts import VOICE_MODEL
+
+STARTUP = Startup("gateway")
+
+# ====== 配置 ======
+GATEWAY_LLM_TIMEOUT = float(os.getenv("GATEWAY_LLM_TIMEOUT", "60"))
+GATEWAY_MAX_CONNECTIONS = int(os.getenv("GATEWAY_MAX_CONNECTIONS", "32"))      # 到上游 LLM 的连接池上限
+GATEWAY_ASR_WORKERS = int(os.getenv("GATEWAY_ASR_WORKERS", "1"))               # 同时转写的请求数
+GATEWAY_TTS_WORKERS = int(os.getenv("GATEWAY_TTS_WORKERS", str(PIPER_POOL_SIZE)))
+GATEWAY_MAX_QUEUE = int(os.getenv("GATEWAY_MAX_QUEUE", "16"))                  # 每个线程池最多排队多少个
+GATEWAY_VOICE_MODEL = os.getenv("GATEWAY_VOICE_MODEL", VOICE_MODEL)
+GATEWAY_VOICE_CONFIG = os.getenv("GATEWAY_VOICE_CONFIG", GATEWAY_VOICE_MODEL + ".json")
+
+
+class _Lane:
+    """一类 CPU 活的有界线程池：占位在线程真正结束时才归还（客户端断开也一样），所以上限是真实的"""
+
+    def __init__(self, name: str, workers: int, queue: int):
+        self.name = name
+        self.workers = max(1, workers)
+        self.limit = self.workers + max(0, queue)
+        self.pool = ThreadPoolExecutor(self.workers, thread_name_prefix=f"gw-{name}")
+        self.inflight = 0
+        self.rejected = 0
+        self.run_ms = LatencyWindow()
+
+    async def run(self, fn: Callable[..., Any], *args) -> Any:
+        if self.inflight >= self.limit:
+            self.rejected += 1
+            raise HTTPException(status_code=503, detail=f"{self.name} busy", headers={"Retry-After": "1"})
+        loop = asyncio.get_running_loop()
+        t0 = time.perf_counter()
+
+        def _done(_f):
+            self.run_ms.add((time.perf_counter() - t0) * 1000.0)
+            loop.call_soon_threadsafe(self._release)
+
+        # 先提交再占位：submit 抛错（如 shutdown 之后）时没有占位要还
+        fut = self.pool.submit(fn, *args)
+        self.inflight += 1
+        fut.add_done_callback(_done)
+        return await asyncio.wrap_future(fut)
+
+    def _release(self):
+        self.inflight -= 1
+
+    def summary(self) -> Dict[str, Any]:
+        return {"workers": self.workers, "limit": self.limit, "inflight": self.inflight,
+                "rejected": self.rejected, "run_ms": self.run_ms.summary()}
+
+
+ASR_LANE = _Lane("asr", GATEWAY_ASR_WORKERS, GATEWAY_MAX_QUEUE)
+TTS_LANE = _Lane("tts", GATEWAY_TTS_WORKERS, GATEWAY_MAX_QUEUE)
+PIPER = default_pool()
+HTTP: httpx.AsyncClient = None      # startup 时建，shutdown 时关
+
+STARTUP.background("whisper", load_model)
+
+app = FastAPI(title="AI Role Chat Backend")
+
+
+@app.on_event("startup")
+async def _startup():
+    global HTTP
+    HTTP = httpx.AsyncClient(
+        timeout=httpx.Timeout(GATEWAY_LLM_TIMEOUT, connect=5.0),
+        limits=httpx.Limits(max_connections=GATEWAY_MAX_CONNECTIONS,
+                            max_keepalive_connections=GATEWAY_MAX_CONNECTIONS),
+    )
 
-from backend.asr.asr import transcribe
-from chat import chat_with_role
-from backend.asr.tts import synthesize
 
-app = FastAPI()
+@app.on_event("shutdown")
+async def _shutdown():
+    await HTTP.aclose()
+    for lane in (ASR_LANE, TTS_LANE):
+        lane.pool.shutdown(wait=False, cancel_futures=True)
+
 
 @app.get("/")
-def root():
-    return {"message": "AI Role Chat Backend is running"}
+async def root():
+    return JSONResponse({"message": "AI Role Chat Backend is running!"})
 
 
+@app.get("/stats")
+def stats():
+    return {"asr": ASR_LANE.summary(), "tts": TTS_LANE.summary(), "piper": PIPER.summary(),
+            "startup": STARTUP.summary()}
 
 
-app = FastAPI(title="AI Role Chat Backend")
+# ====== ASR ======
+def _transcribe_upload(f) -> str:
+    f.seek(0)
+    segments, _ = load_model().transcribe(f, language=LANGUAGE, beam_size=BEAM_SIZE, vad_filter=USE_VAD)
+    return "".join(s.text for s in segments).strip()
 
-# 音频临时保存目录
-UPLOAD_DIR = "uploads"
-os.makedirs(UPLOAD_DIR, exist_ok=True)
 
 @app.post("/asr")
 async def asr_endpoint(file: UploadFile):
     """
     上传音频文件 → 返回识别的文本
     """
-    temp_path = os.path.join(UPLOAD_DIR, f"{uuid.uuid4()}.wav")
-    with open(temp_path, "wb") as f:
-        f.write(await file.read())
-
-    text = transcribe(temp_path)
+    try:
+        await STARTUP.require()
+        text = await ASR_LANE.run(_transcribe_upload, file.file)
+    finally:
+        await file.close()
     return {"text": text}
 
 
+# ====== Chat ======
+def _upstream_error(e: Exception) -> HTTPException:
+    if isinstance(e, httpx.HTTPStatusError):
+        return HTTPException(status_code=502, detail=f"llm upstream {e.response.status_code}")
+    return HTTPException(status_code=502, detail=f"llm upstream {type(e).__name__}")
+
+
 @app.post("/chat")
 async def chat_endpoint(
     user_text: str = Form(...),
-    persona: str = Form("你是一个友好的助手")
+    persona: str = Form("你是一个友好的助手"),
+    stream: bool = Form(False),
 ):
     """
     输入文本 + 人设提示 → 返回模型回复
+    stream=true 时以 text/plain 边生成边返回
     """
-    reply = chat_with_role(user_text, persona)
-    return {"reply": reply}
+    if not stream:
+        try:
+            reply = await achat_with_role(HTTP, user_text, persona)
+        except (httpx.HTTPError, KeyError, IndexError, ValueError) as e:
+            raise _upstream_error(e)
+        return {"reply": reply}
+
+    req = HTTP.build_request("POST", VLLM_ENDPOINT, json=chat_payload(user_text, persona, stream=True))
+    try:
+        r = await HTTP.send(req, stream=True)
+    except httpx.HTTPError as e:
+        raise _upstream_error(e)
+    if r.status_code != 200:
+        await r.aclose()
+        raise HTTPException(status_code=502, detail=f"llm upstream {r.status_code}")
+
+    async def gen():
+        try:
+            async for delta in stream_with_role(r):
+                yield delta
+        except httpx.HTTPError as e:
+            # 响应头已发出，只能提前结束
+            print(f"[gateway] chat stream stopped: {type(e).__name__}: {e}")
+        finally:
+            await r.aclose()
+
+    return StreamingResponse(gen(), media_type="text/plain; charset=utf-8")
+
+
+# ====== TTS ======
+def _synthesize(text: str, cancel: threading.Event):
+    return PIPER.synthesize(GATEWAY_VOICE_MODEL, GATEWAY_VOICE_CONFIG, text, cancel=cancel)
+
+
+async def _synth_segment(text: str, cancel: threading.Event):
+    try:
+        return await TTS_LANE.run(_synthesize, text, cancel)
+    except (HTTPException, SynthesisCancelled):
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"tts failed: {type(e).__name__}: {e}")
 
 
 @app.post("/tts")
 async def tts_endpoint(text: str = Form(...)):
     """
-    输入文本 → 返回音频文件
+    输入文本 → 返回音频（wav，流式）
     """
-    out_path = os.path.join(UPLOAD_DIR, f"{uuid.uuid4()}.wav")
-    synthesize(text, out_path)
-    return FileResponse(out_path, media_type="audio/wav", filename="reply.wav")
-
-
-@app.get("/")
-def root():
-    return JSONResponse({"message": "AI Role Chat Backend is running!"})
+    segments = segment_text(text)
+    if not segments:
+        raise HTTPException(status_code=400, detail="text is empty")
+    cancel = threading.Event()
+    # 首段出错时还没发响应头，可以正常返回错误码
+    pcm0, sr = await _synth_segment(segments[0][0], cancel)
+
+    def start(i: int):
+        return asyncio.ensure_future(_synth_segment(segments[i][0], cancel)) if i < len(segments) else None
+
+    async def gen():
+        nxt = start(1)                    # 首段在发的时候，下一段已经在合成
+        try:
+            yield wav_stream_header(sr) + pcm0
+            for i in range(1, len(segments)):
+                cur, nxt = nxt, start(i + 1)
+                try:
+                    pcm, _ = await cur
+                except Exception as e:
+                    # 响应头已发出，只能提前结束流
+                    print(f"[gateway] tts stream stopped at segment {i}: {type(e).__name__}: {e}")
+                    return
+                yield silence(segments[i - 1][1], sr) + pcm
+        finally:
+            cancel.set()                  # 客户端断开 / 出错：没合成完的段不再合成
+            if nxt is not None and not nxt.done():
+                nxt.cancel()
+
+    return StreamingResponse(gen(), media_type="audio/wav", headers={
+        "Content-Disposition": 'attachment; filename="reply.wav"',
+        "X-Segments": str(len(segments)),
+    })
+
+
+STARTUP.install(app)
@@ -0,0 +1,353 @@
+# uvicorn backend.pipeline.chat_app:app --host 0.0.0.0 --port 8003 --workers 1
+"""
+全双工 /ws_chat：一条 WebSocket 上跑完 ASR → LLM → TTS
+
+- ASR：进程内直接复用 asr_app 的 Session + run_transcriber（同一个 whisper 模型）
+- LLM：进程内直接调用 llm_app._stream_via_llama（共用其到 llama-server 的连接池）
+- TTS：通过 TTSClient 连接池调用 TTS 服务（模型多在另一张卡/另一个进程）
+
+客户端 → 服务端：
+  文本 {"op":"config","persona":"wukong","system":"...可选，覆盖默认人设...","sampleRate":16000}
+  文本 {"op":"text","text":"..."}     直接发文字（不走 ASR）
+  二进制：PCM16 单声道 16kHz，建议 20ms/帧
+  文本 "__stop__"
+
+服务端 → 客户端：
+  {"type":"partial"|"stable"|"final", ...}             与 /ws_asr 相同
+  {"type":"token","turn":n,"text":...}                   LLM 增量
+  {"type":"audio","turn":n,"idx":i,"text":...,"format":"wav","bytes":N}  紧跟一帧二进制 = 该句音频
+      垫话为 idx=-1、"filler":true（带 duration_ms），客户端按到达顺序依次播放即可无缝衔接
+  {"type":"turn_done","turn":n,"text":全文,"timings":{...}}
+  {"type":"barge_in","turn":n,"cancel_ms":...,"reclaimed_ms":...}   用户开口打断：客户端应立即停播
+  {"type":"error","turn":n,"stage":"llm"|"tts",...}
+
+timings 为各阶段的墙钟时间戳（秒）与相对 final 的毫秒差，用来量化端到端延迟。
+
+打断：ASR 检测到说话起点（speech_start）时，若本连接还在回复，立即取消：
+关闭 llama-server 流（释放槽位）、取消未完成的合成请求，并调用 TTS /cancel 终止该会话的 piper 进程。
+"""
+import asyncio
+import json
+import os
+import time
+import uuid
+from typing import Any, Dict, List, Optional
+
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+import uvicorn
+
+from backend.common.startup import Startup
+from backend.common.inflight import CancelStats
+from backend.common.trace import Tracer
+from backend.asr.asr_app import SAMPLE_RATE, Session, load_model, run_transcriber
+from backend.llm.llm_app import ChatReq, Msg, _stream_via_llama
+from backend.pipeline.sentence_pipeline import SentencePipeline
+from backend.tts.filler import FillerPolicy
+from backend.tts.tts_client import TTSClient
+
+STARTUP = Startup("chat")
+
+# ============ 配置 ============
+CHAT_HISTORY_TURNS = int(os.getenv("CHAT_HISTORY_TURNS", "6"))   # 保留最近几轮对话
+CHAT_MAX_TOKENS = int(os.getenv("CHAT_MAX_TOKENS", "256"))
+TTS_PIPELINE_INFLIGHT = int(os.getenv("TTS_PIPELINE_INFLIGHT", "2"))
+
+# 与前端 PERSONAS 保持一致；config 里可传 system 覆盖
+PERSONA_PROMPTS = {
+    "wukong": "你是一个机灵、俏皮、会自称‘俺老孙’的中文角色。风格轻快，爱用比喻，避免学术化长句。",
+    "harry": "你是一位亲切机智的‘哈利·波特’风格中文角色。用温柔的方式解释问题，偶尔用一点魔法世界的比喻。",
+    "ironman": "你是一位托尼·斯塔克风格的中文角色：理性、自信、略带幽默。回答结构清晰，先结论后细节，并给出可执行建议。",
+}
+
+app = FastAPI(title="Full-duplex chat orchestrator", version="0.1.0")
+TTS = TTSClient()
+BARGE = CancelStats()
+FILLER = FillerPolicy()
+TRACER = Tracer("chat")    # 每轮一个 llm span，trace_id 沿用 ASR final 里的（backend/common/trace.py）
+
+@app.on_event("shutdown")
+async def _shutdown():
+    await TTS.aclose()
+
+@app.get("/health")
+async def health():
+    return {"status": "ok"}
+
+@app.get("/stats")
+async def stats():
+    return {"barge_in": BARGE.summary(), "filler": FILLER.summary(), "startup": STARTUP.summary()}
+
+# whisper 与 asr_app 共用一份（合并部署时谁先调谁加载，另一个直接拿到）
+STARTUP.background("whisper", load_model)
+
+
+class ChatSession:
+    """一条 /ws_chat 连接的状态：人设、对话历史、发送锁、当前轮次。"""
+
+    def __init__(self, ws: WebSocket):
+        self.ws = ws
+        self.session_id = "chat-" + uuid.uuid4().hex[:12]
+        self.persona = "wukong"
+        self.system = PERSONA_PROMPTS["wukong"]
+        self.history: List[Msg] = []
+        self.turn = 0
+        self._send_lock = asyncio.Lock()   # 解码端与回复端并发发送，必须串行化
+        self._turn_lock = asyncio.Lock()   # 同一时间只跑一轮回复
+        self._cancel: Optional[asyncio.Event] = None   # 当前轮的打断信号
+        self._cancelled_ev: Optional[Dict[str, Any]] = None
+        self._turn_exit: Optional[asyncio.Event] = None  # 当前轮退出（含被打断）时 set
+
+    def configure(self, cfg: Dict[str, Any]):
+        persona = (cfg.get("persona") or self.persona).strip()
+        if persona != self.persona:
+            self.history.clear()
+        self.persona = persona
+        self.system = cfg.get("system") or PERSONA_PROMPTS.get(persona, self.system)
+
+    async def send_json(self, msg: Dict[str, Any]):
+        async with self._send_lock:
+            await self.ws.send_text(json.dumps(msg, ensure_ascii=False))
+
+    async def send_audio(self, header: Dict[str, Any], audio: bytes):
+        # 头 + 二进制必须相邻，放在同一把锁里
+        async with self._send_lock:
+            await self.ws.send_text(json.dumps(header, ensure_ascii=False))
+            await self.ws.send_bytes(audio)
+
+    def build_request(self, user_text: str) -> ChatReq:
+        keep = self.history[-2 * CHAT_HISTORY_TURNS:] if CHAT_HISTORY_TURNS > 0 else []
+        messages = [Msg(role="system", content=self.system)] + keep + [Msg(role="user", content=user_text)]
+        return ChatReq(messages=messages, max_tokens=CHAT_MAX_TOKENS)
+
+    async def reply(self, user_text: str, final_ts: float, speech_end_ts: Optional[float] = None,
+                    trace_id: Optional[str] = None):
+        async with self._turn_lock:
+            self.turn += 1
+            turn = self.turn
+            span = TRACER.span(trace_id, "llm", start=final_ts, session_id=self.session_id, turn=turn)
+            ts: Dict[str, Optional[float]] = {
+                "speech_end": speech_end_ts,
+                "final": final_ts,
+                "llm_first_token": None,
+                "llm_done": None,
+                "filler": None,
+                "tts_first_audio": None,
+                "tts_done": None,
+            }
+            persona, session_id = self.persona, self.session_id
+            pipe = SentencePipeline(
+                synth=lambda sent, idx: TTS.synthesize_sentence(sent, idx, persona=persona, session_id=session_id,
+                                                                trace_id=span.trace_id),
+                max_inflight=TTS_PIPELINE_INFLIGHT,
+            )
+            tokens: List[str] = []
+            self._cancel = cancel = asyncio.Event()
+            self._turn_exit = turn_exit = asyncio.Event()
+            self._cancelled_ev = None
+            # 预测首句音频会慢 → 与 LLM 并行取一条预合成垫话，保证排在真正回复之前发出
+            filler = None
+            if FILLER.should_fill(persona):
+                filler = asyncio.create_task(self._send_filler(turn, persona, ts))
+            try:
+                reply_text = await self._run_turn(pipe, user_text, turn, ts, cancel, tokens, filler)
+            finally:
+                self._cancel = None
+                turn_exit.set()
+                _end_span(span, ts, cancelled=self._cancelled_ev is not None)
+            if self._cancelled_ev is not None:
+                # 被打断：只记下已经说出口的部分，不发 turn_done
+                spoken = "".join(tokens).strip()
+                self.history.append(Msg(role="user", content=user_text))
+                if spoken:
+                    self.history.append(Msg(role="assistant", content=spoken))
+                return
+            ts["tts_done"] = time.time()
+            if ts["tts_first_audio"] is not None:
+                FILLER.observe(persona, (ts["tts_first_audio"] - ts["final"]) * 1000.0)
+
+            self.history += [Msg(role="user", content=user_text), Msg(role="assistant", content=reply_text)]
+            await self.send_json({
+                "type": "turn_done",
+                "turn": turn,
+                "text": reply_text,
+                "timings": _timings(ts),
+                "trace_id": span.trace_id,
+            })
+
+    async def _send_filler(self, turn: int, persona: str, ts: Dict[str, Optional[float]]):
+        clip = await TTS.filler(persona)
+        if clip is None:
+            return
+        ts["filler"] = time.time()
+        await self.send_audio(
+            {"type": "audio", "turn": turn, "idx": -1, "filler": True, "text": clip["text"],
+             "format": "wav", "bytes": len(clip["audio"]), "duration_ms": clip["duration_ms"]},
+            clip["audio"],
+        )
+
+    async def _run_turn(self, pipe: SentencePipeline, user_text: str, turn: int,
+                        ts: Dict[str, Optional[float]], cancel: asyncio.Event, tokens: List[str],
+                        filler: Optional["asyncio.Task"] = None) -> str:
+        """跑一轮流水线并把事件转发给客户端；返回完整回复文本（被打断时为空）"""
+        reply_text = ""
+        async for ev in pipe.run(_stream_via_llama(self.build_request(user_text)), cancel=cancel):
+            kind = ev["type"]
+            if kind == "token":
+                if ts["llm_first_token"] is None:
+                    ts["llm_first_token"] = time.time()
+                tokens.append(ev["text"])
+                await self.send_json({"type": "token", "turn": turn, "text": ev["text"]})
+            elif kind == "llm_done":
+                ts["llm_done"] = time.time()
+            elif kind == "audio":
+                if filler is not None:
+                    await filler
+                    filler = None
+                if ts["tts_first_audio"] is None:
+                    ts["tts_first_audio"] = time.time()
+                await self.send_audio(
+                    {"type": "audio", "turn": turn, "idx": ev["idx"], "text": ev["text"],
+                     "format": "wav", "bytes": len(ev["audio"])},
+                    ev["audio"],
+                )
+            elif kind == "error":
+                await self.send_json(dict(ev, turn=turn))
+            elif kind == "done":
+                reply_text = ev["text"]
+            elif kind == "cancelled":
+                self._cancelled_ev = ev
+        if filler is not None and not filler.done():
+            filler.cancel()
+        return reply_text
+
+    async def barge_in(self):
+        """用户开口：取消正在进行的回复，测量取消耗时与回收的算力时间。"""
+        cancel = self._cancel
+        if cancel is None or cancel.is_set():
+            return
+        turn = self.turn
+        t0 = time.perf_counter()
+        cancel.set()
+        tts_cancel = asyncio.create_task(TTS.cancel(self.session_id))
+        # 等本轮真正退出（上游流已关闭）
+        if self._turn_exit is not None:
+            try:
+                await asyncio.wait_for(self._turn_exit.wait(), timeout=2.0)
+            except asyncio.TimeoutError:
+                pass
+        cancel_ms = (time.perf_counter() - t0) * 1000.0
+        tts_res: Dict[str, Any] = {}
+        try:
+            tts_res = await tts_cancel
+        except Exception:
+            pass
+        ev = self._cancelled_ev or {}
+        reclaimed = ev.get("reclaimed_llm_ms", 0.0) + max(
+            ev.get("reclaimed_tts_ms", 0.0), tts_res.get("reclaimed_ms", 0.0))
+        BARGE.record(cancel_ms, reclaimed)
+        await self.send_json({
+            "type": "barge_in",
+            "turn": turn,
+            "cancel_ms": round(cancel_ms, 1),
+            "reclaimed_ms": round(reclaimed, 1),
+            "tokens": ev.get("tokens"),
+        })
+
+
+def _end_span(span, ts: Dict[str, Optional[float]], **attrs):
+    """本轮各阶段时间戳记进 llm span（阶段名与 llm_app 的 /llm_tts 一致，report 按同一套算）"""
+    for stage, key in (("first_token", "llm_first_token"), ("llm_done", "llm_done"),
+                       ("filler", "filler"), ("first_audio", "tts_first_audio")):
+        if ts[key] is not None:
+            span.mark(stage, ts[key])
+    span.set(**attrs)
+    span.end()
+
+
+def _timings(ts: Dict[str, Optional[float]]) -> Dict[str, Any]:
+    """墙钟时间戳 + 相对 final 的毫秒差（final_to_first_audio_ms 即用户感知的等待）"""
+    base = ts["final"]
+    rel = {
+        f"final_to_{k}_ms": round((v - base) * 1000.0, 1)
+        for k, v in ts.items() if v is not None and k not in ("final", "speech_end")
+    }
+    if ts["speech_end"] is not None:
+        rel["speech_end_to_final_ms"] = round((base - ts["speech_end"]) * 1000.0, 1)
+    return {"ts": ts, **rel}
+
+
+@app.websocket("/ws_chat")
+async def ws_chat(ws: WebSocket):
+    await ws.accept()
+    if not await STARTUP.wait_ready():
+        await ws.close(code=1013, reason="asr model loading")     # 1013 = Try Again Later
+        return
+    chat = ChatSession(ws)
+    sess = Session()
+    turn_tasks: set = set()
+
+    def start_turn(text: str, speech_end_ts: Optional[float] = None, trace_id: Optional[str] = None):
+        t = asyncio.create_task(chat.reply(text, time.time(), speech_end_ts, trace_id))
+        turn_tasks.add(t)
+        t.add_done_callback(turn_tasks.discard)
+
+    async def emit(msg: Dict[str, Any]):
+        # ASR 消息原样转给客户端；final 直接进入本轮回复；speech_start 触发打断
+        await chat.send_json(msg)
+        kind = msg.get("type")
+        if kind == "speech_start":
+            t = asyncio.create_task(chat.barge_in())
+            turn_tasks.add(t)
+            t.add_done_callback(turn_tasks.discard)
+        elif kind == "final" and msg.get("text"):
+            start_turn(msg["text"], msg.get("speech_end_ts"), msg.get("trace_id"))
+
+    async def receiver():
+        try:
+            while True:
+                message = await ws.receive()
+                if message.get("type") != "websocket.receive":
+                    break
+                if (binary := message.get("bytes")) is not None:
+                    sess.add_pcm_i16(binary)
+                    continue
+                text = message.get("text")
+                if not text:
+                    continue
+                if text == "__stop__":
+                    break
+                try:
+                    cmd = json.loads(text)
+                except ValueError:
+                    continue
+                if not isinstance(cmd, dict):
+                    continue
+                if cmd.get("op") == "config":
+                    chat.configure(cmd)
+                    sr = int(cmd.get("sampleRate", SAMPLE_RATE))
+                    if sr != SAMPLE_RATE:
+                        await chat.send_json({
+                            "type": "warning",
+                            "message": f"sampleRate {sr} != server {SAMPLE_RATE}, using server rate."
+                        })
+                elif cmd.get("op") == "text" and (cmd.get("text") or "").strip():
+                    start_turn(cmd["text"].strip())
+        except WebSocketDisconnect:
+            pass
+        finally:
+            sess.close()
+
+    recv_task = asyncio.create_task(receiver())
+    trans_task = asyncio.create_task(run_transcriber(sess, emit))
+    done, pending = await asyncio.wait(
+        {recv_task, trans_task},
+        return_when=asyncio.FIRST_COMPLETED,
+    )
+    for t in list(pending) + list(turn_tasks):
+        t.cancel()
+
+
+STARTUP.install(app, tracer=TRACER)
+
+if __name__ == "__main__":
+    uvicorn.run(app, host="0.0.0.0", port=8003)
@@ -0,0 +1,213 @@
+"""
+合并部署：ASR / LLM / TTS（以及 /ws_chat、算力仲裁）跑在同一个进程里
+
+小机器上本来要起 4~5 个进程（arbiter、asr_app:8000、llm_app:8001、tts_server:8002、chat_app:8003），
+彼此走 localhost HTTP + JSON。这里在一个事件循环里同时起各服务原来的端口，对外的 HTTP/WS 接口不变
+（前端、curl 示例照旧），进程内部的调用改成直接函数调用：
+
+- LLM → TTS：llm_app / chat_app 的 TTS 客户端换成 LocalTTSClient，直接调 TTS 模块的 render()，
+  wav 字节原样交回，不再走 HTTP、不做 base64 / JSON；打断时的 /cancel、垫话同理；
+- ASR final → LLM：asr_app.FINAL_SINK 换成 llm.ingest（ASR_PUSH_FINAL=1 时生效），直接落库；
+- 共用：一份配置（同一组环境变量只读一次）、一个 whisper 模型（chat_app 与 asr_app 本来各加载一份）、
+  一个到 llama-server 的连接池、一套 TTS 合成池 / 调度器 / 音频缓存；算力仲裁也跑在本进程里；
+- 生命周期：按 arbiter → tts → llm → asr → chat 的顺序启动（前一个 startup 完成才起下一个，
+  任何一个起不来整体退出），SIGINT/SIGTERM 时反序关闭，保证 LLM 的落盘/记忆保存先于 TTS 池关闭。
+
+llm.py（/receive_text、/history、/search、/store/stats）并进 8001，与 llm_app 同端口
+（分进程时两者都默认 8001，只能二选一）。
+
+运行（仓库根目录）：
+  python -m backend.pipeline.combined_app
+  COMBINED_SERVICES=llm,tts python -m backend.pipeline.combined_app     # 本机不跑 whisper 时
+  COMBINED_TTS=xtts python -m backend.pipeline.combined_app             # TTS 用 tts_xtts_server
+  curl -s http://127.0.0.1:8001/combined                                # 进程内存、各服务启动耗时
+
+分进程 vs 合并的内存与每轮开销：python -m backend.test.bench_combined
+"""
+import asyncio
+import importlib
+import os
+import signal
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, List, Tuple
+
+import uvicorn
+
+# ============ 配置 ============
+COMBINED_HOST = os.getenv("COMBINED_HOST", "127.0.0.1")
+COMBINED_SERVICES = [s.strip() for s in os.getenv("COMBINED_SERVICES", "asr,llm,tts,chat").split(",") if s.strip()]
+COMBINED_TTS = os.getenv("COMBINED_TTS", "piper")                # piper | xtts
+COMBINED_ARBITER = os.getenv("COMBINED_ARBITER", "1") == "1"     # 本进程里顺带起算力仲裁
+COMBINED_LOG_LEVEL = os.getenv("COMBINED_LOG_LEVEL", "info")
+PORTS = {
+    "asr": int(os.getenv("ASR_PORT", "8000")),
+    "llm": int(os.getenv("LLM_PORT", "8001")),
+    "tts": int(os.getenv("TTS_PORT", "8002")),
+    "chat": int(os.getenv("CHAT_PORT", "8003")),
+}
+START_ORDER = ["tts", "llm", "asr", "chat"]     # 被调用方先起；关闭反过来
+TTS_MODULES = {"piper": "backend.tts.tts_server", "xtts": "backend.tts.tts_xtts_server"}
+
+
+def rss_mb(pid: str = "self") -> Dict[str, float]:
+    """进程常驻内存（rss）与按比例分摊共享页后的 pss，MB"""
+    out = {}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                k, _, rest = line.partition(":")
+                if k in ("Rss", "Pss"):
+                    out[k.lower() + "_mb"] = round(int(rest.split()[0]) / 1024, 1)
+    except OSError:
+        pass
+    return out
+
+
+class _Server(uvicorn.Server):
+    """信号由 Combined.run() 统一处理（uvicorn 各实例自己装的处理器会互相覆盖）"""
+
+    @contextmanager
+    def capture_signals(self):
+        yield
+
+    def install_signal_handlers(self):      # 旧版 uvicorn
+        pass
+
+
+class Combined:
+    def __init__(self, services: List[str] = COMBINED_SERVICES, host: str = COMBINED_HOST,
+                 ports: Dict[str, int] = PORTS, tts_backend: str = COMBINED_TTS):
+        unknown = set(services) - set(START_ORDER)
+        if unknown:
+            raise ValueError(f"unknown services: {sorted(unknown)}")
+        self.services = [s for s in START_ORDER if s in services]
+        self.host = host
+        self.ports = ports
+        self.tts_backend = tts_backend
+        self.apps: Dict[str, Any] = {}
+        self.modules: Dict[str, Any] = {}
+        self.wiring: Dict[str, str] = {}
+        self.startup_ms: Dict[str, float] = {}
+        self.import_ms: Dict[str, float] = {}
+        self._running: List[Tuple[str, _Server, asyncio.Task]] = []
+        self._discard: List[Any] = []       # 换下来的 HTTP 客户端，启动后关掉
+
+    def _import(self, name: str, module: str):
+        t0 = time.perf_counter()
+        mod = importlib.import_module(module)
+        self.import_ms[name] = round((time.perf_counter() - t0) * 1000.0, 1)
+        self.modules[name] = mod
+        return mod
+
+    # ------------------ 组装：只导入要跑的服务，把跨服务调用接成函数调用 ------------------
+    def build(self):
+        from backend.tts.tts_client import LocalTTSClient
+
+        tts = self._import("tts", TTS_MODULES[self.tts_backend]) if "tts" in self.services else None
+        if tts is not None:
+            self.apps["tts"] = tts.app
+
+        clients = []
+        if "llm" in self.services:
+            llm_app = self._import("llm", "backend.llm.llm_app")
+            store = importlib.import_module("backend.llm.llm")
+            lifespan = llm_app.app.router.lifespan_context
+            llm_app.app.include_router(store.app.router)     # 路由与 startup/shutdown 一并并入
+            # 新版 FastAPI 还会把被并入路由的默认 lifespan 合进来，store 的 startup 会再跑一遍
+            llm_app.app.router.lifespan_context = lifespan
+            # include_router 把 startup 追加在后面；先开库，记忆索引 / 压缩再从库里同步
+            startup = llm_app.app.router.on_startup
+            for h in store.app.router.on_startup:
+                startup.remove(h)
+                startup.insert(0, h)
+            llm_app.app.add_api_route("/combined", self.summary, methods=["GET"])
+            self.apps["llm"] = llm_app.app
+            clients.append(llm_app)
+        if "asr" in self.services:
+            asr_app = self._import("asr", "backend.asr.asr_app")
+            self.apps["asr"] = asr_app.app
+            if "llm" in self.services:
+                asr_app.FINAL_SINK = importlib.import_module("backend.llm.llm").ingest
+                self.wiring["asr->llm"] = "inproc"
+        if "chat" in self.services:
+            chat_app = self._import("chat", "backend.pipeline.chat_app")
+            self.apps["chat"] = chat_app.app
+            clients.append(chat_app)
+
+        # 两边的 TTS 客户端都指向同一个进程内 TTS；TTS 不在本进程时保持 HTTP（TTS_BASE）
+        if tts is not None:
+            local = LocalTTSClient(tts)
+            for mod in clients:
+                old, mod.TTS = mod.TTS, local
+                self._discard.append(old)
+                self.wiring[f"{mod.__name__.rsplit('.', 1)[-1]}->tts"] = "inproc"
+        return self
+
+    # ------------------ 生命周期 ------------------
+    async def _start(self, name: str) -> Tuple[_Server, asyncio.Task]:
+        config = uvicorn.Config(self.apps[name], host=self.host, port=self.ports[name],
+                                log_level=COMBINED_LOG_LEVEL, lifespan="on")
+        server = _Server(config)
+        t0 = time.perf_counter()
+        task = asyncio.create_task(server.serve(), name=f"serve-{name}")
+        while not server.started:
+            if task.done():
+                task.result()           # 端口被占等：uvicorn 在这里 SystemExit
+                raise RuntimeError(f"{name} failed to start")
+            await asyncio.sleep(0.02)
+        self.startup_ms[name] = round((time.perf_counter() - t0) * 1000.0, 1)
+        print(f"[combined] {name} :{self.ports[name]} ready in {self.startup_ms[name]:.0f}ms")
+        return server, task
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+
+        arbiter = None
+        if COMBINED_ARBITER:
+            from backend.common.arbiter import serve as arbiter_serve
+            arbiter = asyncio.create_task(arbiter_serve(), name="arbiter")
+        try:
+            for name in self.services:
+                server, task = await self._start(name)
+                self._running.append((name, server, task))
+            for old in self._discard:
+                await old.aclose()
+            self._discard.clear()
+            print(f"[combined] pid={os.getpid()} {rss_mb()} wiring={self.wiring}")
+            # 任何一个服务自己退出（异常），整体跟着停
+            await asyncio.wait([asyncio.create_task(stop.wait())] + [t for _, _, t in self._running],
+                               return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for name, server, task in reversed(self._running):
+                server.should_exit = True
+                try:
+                    await task
+                except BaseException as e:
+                    print(f"[combined] {name} stopped with {type(e).__name__}: {e}")
+            if arbiter is not None:
+                arbiter.cancel()
+
+    async def summary(self):
+        return {
+            "pid": os.getpid(),
+            "services": {n: self.ports[n] for n in self.services},
+            "tts_backend": self.tts_backend if "tts" in self.services else None,
+            "wiring": self.wiring,
+            "import_ms": self.import_ms,
+            "startup_ms": self.startup_ms,
+            # 各服务的后台加载（模型 / 语音 / 记忆索引）进度与 import → ready 耗时，见 backend/common/startup.py
+            "ready": {n: m.STARTUP.summary() for n, m in self.modules.items()},
+            "memory": rss_mb(),
+        }
+
+
+def main():
+    asyncio.run(Combined().build().run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+"""
+LLM → TTS 句级流水线
+
+LLM 流式 token 按句切开，每凑满一句立刻送 TTS；音频按句序输出。
+第 N 句在合成的同时，LLM 继续生成第 N+1 句，首包音频只需等“第一句生成 + 第一句合成”。
+
+用法：
+    pipe = SentencePipeline(synth=lambda s, idx: tts_client.synthesize_sentence(s, idx, persona="wukong"))
+    async for ev in pipe.run(token_iter, cancel=ev_cancel):
+        ev["type"] in {"token", "sentence", "llm_done", "audio", "error", "done", "cancelled"}
+
+打断：cancel（asyncio.Event）被 set 后立即停止——关闭 LLM 上游流、取消未完成的合成，
+并输出一条 {"type":"cancelled",...}，附带估算的回收算力时间。
+"""
+import asyncio
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Optional
+
+from backend.common.stats import Ewma
+from backend.common.text import SentenceSplitter
+
+_END = object()
+
+
+class SentencePipeline:
+    # 跨实例的经验值，用于估算“打断后省下了多少生成/合成时间”
+    reply_tokens = Ewma(alpha=0.1, initial=120.0)    # 一次完整回复的 token 数
+    tts_ms_per_char = Ewma(alpha=0.1)                # 合成耗时 / 字符
+
+    def __init__(
+        self,
+        synth: Callable[[str, int], Awaitable[bytes]],
+        max_inflight: int = 2,
+        clause_min_chars: int = 24,
+    ):
+        """
+        synth(text, idx)：合成第 idx 句，返回音频字节（wav/pcm，由调用方决定）；
+                          idx 用于让 TTS 端优先调度首句
+        max_inflight：同时在合成中的句子数上限（TTS 后端并发有限，别一次压太多）
+        """
+        self.synth = synth
+        self.max_inflight = max(1, max_inflight)
+        self.clause_min_chars = clause_min_chars
+
+    async def run(
+        self,
+        tokens: AsyncIterator[str],
+        cancel: Optional[asyncio.Event] = None,
+    ) -> AsyncIterator[Dict[str, Any]]:
+        t0 = time.perf_counter()
+        ms = lambda: round((time.perf_counter() - t0) * 1000.0, 1)
+        splitter = SentenceSplitter(self.clause_min_chars)
+        sem = asyncio.Semaphore(self.max_inflight)
+        events: asyncio.Queue = asyncio.Queue()
+        jobs: asyncio.Queue = asyncio.Queue()       # (idx, text, task)，按句序
+        synth_tasks = []                            # (text, task)
+        full_text = []
+        llm = {"tokens": 0, "first": None, "done": False}
+
+        async def synth_one(idx: int, text: str) -> bytes:
+            async with sem:
+                ts = time.perf_counter()
+                audio = await self.synth(text, idx)
+                self.tts_ms_per_char.update((time.perf_counter() - ts) * 1000.0 / max(1, len(text)))
+                return audio
+
+        def submit(idx: int, text: str):
+            t = asyncio.create_task(synth_one(idx, text))
+            synth_tasks.append((text, t))
+            jobs.put_nowait((idx, text, t))
+
+        async def producer():
+            idx = 0
+            try:
+                async for tok in tokens:
+                    if not tok:
+                        continue
+                    llm["tokens"] += 1
+                    if llm["first"] is None:
+                        llm["first"] = time.perf_counter()
+                    full_text.append(tok)
+                    await events.put({"type": "token", "text": tok})
+                    for sent in splitter.feed(tok):
+                        await events.put({"type": "sentence", "idx": idx, "text": sent, "ms": ms()})
+                        submit(idx, sent)
+                        idx += 1
+                for sent in splitter.flush():
+                    await events.put({"type": "sentence", "idx": idx, "text": sent, "ms": ms()})
+                    submit(idx, sent)
+                    idx += 1
+                llm["done"] = True
+                self.reply_tokens.update(llm["tokens"])
+                await events.put({"type": "llm_done", "ms": ms()})
+            except Exception as e:
+                await events.put({"type": "error", "stage": "llm", "message": f"{type(e).__name__}: {e}"})
+            finally:
+                # 关闭上游流（httpx stream 会随之断开，llama-server 停止生成）；连接已坏时 aclose
+                # 本身也可能抛错，结束标记放在 finally 里照发，deliver / 主循环才不会一直等下去
+                try:
+                    if hasattr(tokens, "aclose"):
+                        await tokens.aclose()
+                except Exception as e:
+                    print(f"[pipeline] closing token stream failed: {type(e).__name__}: {e}")
+                finally:
+                    jobs.put_nowait(None)
+                    await events.put(_END)
+
+        async def deliver():
+            # 按句序等待合成结果，保证音频顺序
+            try:
+                while (job := await jobs.get()) is not None:
+                    idx, text, t = job
+                    try:
+                        audio = await t
+                    except Exception as e:
+                        await events.put({"type": "error", "stage": "tts", "idx": idx,
+                                          "message": f"{type(e).__name__}: {e}"})
+                        continue
+                    await events.put({"type": "audio", "idx": idx, "text": text, "audio": audio, "ms": ms()})
+            finally:
+                await events.put(_END)
+
+        def reclaimed() -> Dict[str, Any]:
+            # 估算：LLM 还差 (平均回复长度 - 已生成) 个 token × 当前 token 速率；
+            #       TTS 为尚未完成的句子字符数 × 平均合成速率
+            llm_ms = 0.0
+            n = llm["tokens"]
+            if not llm["done"] and n and llm["first"] is not None:
+                per_tok = (time.perf_counter() - llm["first"]) * 1000.0 / max(1, n - 1)
+                llm_ms = max(0.0, self.reply_tokens.value - n) * per_tok
+            pending_chars = sum(len(text) for text, t in synth_tasks if not t.done())
+            tts_ms = pending_chars * (self.tts_ms_per_char.value or 0.0)
+            return {
+                "tokens": n,
+                "llm_done": llm["done"],
+                "pending_chars": pending_chars,
+                "reclaimed_llm_ms": round(llm_ms, 1),
+                "reclaimed_tts_ms": round(tts_ms, 1),
+            }
+
+        workers = [asyncio.create_task(producer()), asyncio.create_task(deliver())]
+        cancel_wait = asyncio.ensure_future(cancel.wait()) if cancel is not None else None
+        try:
+            ended = 0
+            while ended < len(workers):
+                if cancel_wait is None:
+                    ev = await events.get()
+                else:
+                    getter = asyncio.ensure_future(events.get())
+                    await asyncio.wait({getter, cancel_wait}, return_when=asyncio.FIRST_COMPLETED)
+                    if cancel_wait.done():
+                        getter.cancel()
+                        yield dict(type="cancelled", ms=ms(), **reclaimed())
+                        return
+                    ev = getter.result()
+                if ev is _END:
+                    ended += 1
+                    continue
+                yield ev
+            yield {"type": "done", "text": "".join(full_text).strip(), "ms": ms()}
+        finally:
+            # 消费方提前退出（断开/打断）时，停止生成与合成
+            if cancel_wait is not None and not cancel_wait.done():
+                cancel_wait.cancel()
+            pending = [t for t in workers + [t for _, t in synth_tasks] if not t.done()]
+            for t in pending:
+                t.cancel()
+            if pending:
+                # 等上游连接真正关闭再返回，调用方测到的取消耗时才是真实的
+                await asyncio.wait(pending, timeout=1.0)
@@ -0,0 +1,143 @@
+"""
+ASR tick 延迟：单独跑 / 与 TTS 同时跑（不仲裁）/ 与 TTS 同时跑（经 arbiter）
+
+在仓库根目录：
+  python -m backend.test.bench_arbiter --ticks 80 --tts-procs 2
+
+用 ONNX Runtime 跑合成的 MatMul 链模拟两边的负载（不需要 whisper / piper 模型）：
+- asr：一个进程，每 250ms 一次 tick，会话 intra-op 线程 = --asr-threads；
+- tts：--tts-procs 个进程，各自不停地跑“合成”，会话线程 = --tts-threads（默认整机核数，模拟各自独占的默认配置）。
+真实服务上的数字看 asr_app 的 GET /stats（tick_ms）与 TTS 的 GET /stats（arbiter）。
+需要 `pip install onnx onnxruntime`。
+"""
+import argparse
+import multiprocessing as mp
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+from backend.common.stats import percentiles
+
+TICK_S = 0.25
+
+
+def build_model(path: str, dim: int, layers: int):
+    import onnx
+    from onnx import TensorProto, helper, numpy_helper
+
+    rng = np.random.default_rng(0)
+    nodes, inits, x = [], [], "x"
+    for i in range(layers):
+        w = numpy_helper.from_array((rng.standard_normal((dim, dim)) / np.sqrt(dim)).astype(np.float32), f"w{i}")
+        inits.append(w)
+        nodes.append(helper.make_node("MatMul", [x, f"w{i}"], [f"h{i}"]))
+        x = f"h{i}"
+    g = helper.make_graph(nodes, "load", [helper.make_tensor_value_info("x", TensorProto.FLOAT, ["n", dim])],
+                          [helper.make_tensor_value_info(x, TensorProto.FLOAT, ["n", dim])], inits)
+    m = helper.make_model(g, opset_imports=[helper.make_opsetid("", 17)])
+    m.ir_version = 8
+    onnx.save(m, path)
+
+
+def _session(model: str, threads: int):
+    import onnxruntime
+    o = onnxruntime.SessionOptions()
+    o.intra_op_num_threads = threads
+    o.inter_op_num_threads = 1
+    return onnxruntime.InferenceSession(model, sess_options=o, providers=["CPUExecutionProvider"])
+
+
+def asr_proc(model, threads, ticks, rows, use_arbiter, out):
+    from backend.common.arbiter import ArbiterClient
+    arb = ArbiterClient("asr", enabled=use_arbiter)
+    sess = _session(model, threads)
+    x = np.ones((rows, sess.get_inputs()[0].shape[1]), dtype=np.float32)
+    sess.run(None, {"x": x})
+    samples = []
+    for _ in range(ticks):
+        time.sleep(TICK_S)
+        t0 = time.perf_counter()
+        with arb.lease(threads, min_threads=threads):
+            sess.run(None, {"x": x})
+        samples.append((time.perf_counter() - t0) * 1000.0)
+    out.put(samples)
+
+
+def tts_proc(model, threads, rows, use_arbiter, stop, out):
+    from backend.common.arbiter import ArbiterClient
+    arb = ArbiterClient("tts", enabled=use_arbiter)
+    sess = _session(model, threads)
+    x = np.ones((rows, sess.get_inputs()[0].shape[1]), dtype=np.float32)
+    jobs = 0
+    while not stop.is_set():
+        with arb.lease(threads, min_threads=threads):
+            sess.run(None, {"x": x})
+        jobs += 1
+    out.put(jobs)
+
+
+def scenario(label, args, model, tts_procs, use_arbiter):
+    ctx = mp.get_context("spawn")
+    out, tout, stop = ctx.Queue(), ctx.Queue(), ctx.Event()
+    tts = [ctx.Process(target=tts_proc, args=(model, args.tts_threads, args.rows, use_arbiter, stop, tout))
+           for _ in range(tts_procs)]
+    for p in tts:
+        p.start()
+    t0 = time.perf_counter()
+    asr = ctx.Process(target=asr_proc, args=(model, args.asr_threads, args.ticks, args.rows, use_arbiter, out))
+    asr.start()
+    samples = out.get()
+    asr.join()
+    stop.set()
+    jobs = sum(tout.get() for _ in tts)
+    for p in tts:
+        p.join()
+    elapsed = time.perf_counter() - t0
+    p = percentiles(samples, (50, 95, 99))
+    tput = f"  tts={jobs / elapsed:6.1f} jobs/s" if tts_procs else ""
+    print(f"{label:<22} asr tick p50={p['p50']:7.1f}ms p95={p['p95']:7.1f}ms p99={p['p99']:7.1f}ms{tput}")
+
+
+def main():
+    ncpu = os.cpu_count() or 4
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--ticks", type=int, default=80)
+    ap.add_argument("--tts-procs", type=int, default=2)
+    ap.add_argument("--asr-threads", type=int, default=max(1, ncpu // 2))
+    ap.add_argument("--tts-threads", type=int, default=ncpu)
+    ap.add_argument("--dim", type=int, default=1024)
+    ap.add_argument("--layers", type=int, default=8)
+    ap.add_argument("--rows", type=int, default=64)
+    args = ap.parse_args()
+
+    td = tempfile.mkdtemp(prefix="bench_arbiter_")
+    model = str(Path(td) / "load.onnx")
+    build_model(model, args.dim, args.layers)
+    sock = str(Path(td) / "arbiter.sock")
+    os.environ["ARBITER_SOCKET"] = sock     # 子进程（spawn）继承
+
+    print(f"cpu={ncpu} asr_threads={args.asr_threads} tts_procs={args.tts_procs} tts_threads={args.tts_threads}")
+    scenario("asr alone", args, model, 0, use_arbiter=False)
+    scenario("asr + tts", args, model, args.tts_procs, use_arbiter=False)
+
+    server = subprocess.Popen([sys.executable, "-m", "backend.common.arbiter", "serve",
+                               "--socket", sock, "--cpu", str(ncpu)])
+    try:
+        for _ in range(50):
+            if os.path.exists(sock):
+                break
+            time.sleep(0.1)
+        scenario("asr + tts (arbiter)", args, model, args.tts_procs, use_arbiter=True)
+        subprocess.run([sys.executable, "-m", "backend.common.arbiter", "stats", "--socket", sock])
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+"""
+冷数据归档：归档前 / 归档中 / 归档后的库大小与写入延迟
+
+在仓库根目录：
+  python -m backend.test.bench_archive --messages 1000000 --days 180 --idle-days 30
+
+先灌一个覆盖最近 --days 天的临时库（带索引、FTS 和触发器；每个会话 ~300 条、时间上连续），
+然后依次测：
+- 归档前：文件大小 / 实际占用页、ConversationStore 持久确认写入的 p50 / p99；
+- 归档中：Archiver 在线程里分批搬运的同时照常写入，看写入 p99 和每批持锁时间；
+- 归档后：同样的指标，另加一次读已归档会话历史的延迟；--vacuum 时再 VACUUM 一次看文件能缩多少。
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+
+from backend.common.stats import percentiles
+from backend.llm.archive import Archiver
+from backend.llm.store import FTS_SCHEMA, SCHEMA, ConversationStore
+
+INSERT_ROW = "INSERT INTO messages (id, session_id, role, text, created_at, idem, meta) VALUES (?,?,?,?,?,?,?)"
+
+WORDS = ["今天", "天气", "不错", "我们", "去公园", "散步", "晚饭", "吃什么", "帮我", "查一下",
+         "明天", "的会议", "几点", "开始", "这首歌", "很好听", "讲个", "笑话", "周末", "有空吗"]
+
+
+def build(path: str, n: int, days: float, per_session: int, seed: int = 0):
+    rng = random.Random(seed)
+    db = sqlite3.connect(path)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=OFF")
+    for ddl in SCHEMA + FTS_SCHEMA:
+        db.execute(ddl)
+    step = days * 86400.0 / n
+    t0 = time.time() - days * 86400.0
+    batch = []
+    for i in range(n):
+        sid = f"s{i // per_session}"
+        text = "".join(rng.choice(WORDS) for _ in range(rng.randint(3, 12)))
+        batch.append((str(uuid.uuid4()), sid, "user" if i % 2 else "assistant", text, t0 + i * step,
+                      f"k{i}", json.dumps({"source": "asr", "language": "zh"})))
+        if len(batch) == 50000:
+            db.executemany(INSERT_ROW, batch)
+            batch.clear()
+    if batch:
+        db.executemany(INSERT_ROW, batch)
+    db.executemany("INSERT OR IGNORE INTO sessions (id, created_at) VALUES (?,?)",
+                   [(f"s{j}", t0) for j in range((n + per_session - 1) // per_session)])
+    db.commit()
+    db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    db.close()
+
+
+def sizes(path: str) -> str:
+    db = sqlite3.connect(path)
+    page = db.execute("PRAGMA page_size").fetchone()[0]
+    count = db.execute("PRAGMA page_count").fetchone()[0]
+    free = db.execute("PRAGMA freelist_count").fetchone()[0]
+    rows = db.execute("SELECT count(*) FROM messages").fetchone()[0]
+    db.close()
+    return (f"messages={rows}  文件 {os.path.getsize(path) / 2**20:.0f}MB  "
+            f"实际占用 {(count - free) * page / 2**20:.0f}MB（空闲页 {free * page / 2**20:.0f}MB）")
+
+
+async def insert_latency(store: ConversationStore, n: int, concurrency: int, stop: threading.Event = None):
+    sem = asyncio.Semaphore(concurrency)
+    lat = []
+
+    async def one(i):
+        async with sem:
+            t0 = time.perf_counter()
+            await store.save_message(f"live{i % 50}", "user", f"新消息 {i}", f"live-{uuid.uuid4()}",
+                                     {"source": "asr"})
+            lat.append((time.perf_counter() - t0) * 1000.0)
+
+    if stop is None:
+        await asyncio.gather(*(one(i) for i in range(n)))
+    else:
+        i = 0
+        while not stop.is_set():        # 一直写到归档结束
+            await asyncio.gather(*(one(i + j) for j in range(concurrency)))
+            i += concurrency
+    return percentiles(lat, (50, 99)), len(lat)
+
+
+async def main_async(args):
+    td = tempfile.mkdtemp(prefix="bench_archive_")
+    path = os.path.join(td, "conv.db")
+    t0 = time.perf_counter()
+    build(path, args.messages, args.days, args.per_session)
+    print(f"灌库 {args.messages} 条 / {args.days:.0f} 天: {time.perf_counter() - t0:.0f}s")
+    print("归档前 ", sizes(path))
+
+    store = ConversationStore(path)
+    await store.open()
+    p, _ = await insert_latency(store, args.inserts, args.concurrency)
+    print(f"归档前  写入 p50={p['p50']}ms p99={p['p99']}ms")
+
+    archiver = Archiver(path, idle_days=args.idle_days, batch_rows=args.batch_rows)
+    stop = threading.Event()
+    result = {}
+
+    def run():
+        try:
+            t = time.perf_counter()
+            result.update(archiver.run_once())
+            result["s"] = time.perf_counter() - t
+        finally:
+            stop.set()
+    th = threading.Thread(target=run)
+    th.start()
+    p, n = await insert_latency(store, 0, args.concurrency, stop)
+    th.join()
+    s = archiver.summary()
+    print(f"归档中  写入 p50={p['p50']}ms p99={p['p99']}ms（{n} 条）；归档 {result['sessions']} 个会话 / "
+          f"{result['messages']} 条，{result['batches']} 批，用时 {result['s']:.0f}s，"
+          f"每批持锁 p50={s['lock_ms'].get('p50')}ms p99={s['lock_ms'].get('p99')}ms，压缩比 {s['ratio']}（{archiver.codec}）")
+
+    p, _ = await insert_latency(store, args.inserts, args.concurrency)
+    print(f"归档后  写入 p50={p['p50']}ms p99={p['p99']}ms")
+    print("归档后 ", sizes(path))
+    seg = sum(os.path.getsize(os.path.join(archiver.dir, f)) for f in os.listdir(archiver.dir))
+    print(f"        段文件 {len(os.listdir(archiver.dir))} 个，共 {seg / 2**20:.0f}MB")
+
+    lat = []
+    for i in range(50):
+        sid = f"s{random.Random(i).randrange(result['sessions'] or 1)}"
+        t = time.perf_counter()
+        await store.history(sid, 50)
+        lat.append((time.perf_counter() - t) * 1000.0)
+    p = percentiles(lat, (50, 99))
+    print(f"        读已归档会话 /history 首页 p50={p['p50']}ms p99={p['p99']}ms（含解压，帧缓存未命中为主）")
+    await store.close()
+
+    if args.vacuum:
+        t = time.perf_counter()
+        db = sqlite3.connect(path)
+        db.execute("VACUUM")
+        db.close()
+        print(f"VACUUM {time.perf_counter() - t:.0f}s 后", sizes(path))
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--messages", type=int, default=1_000_000)
+    ap.add_argument("--days", type=float, default=180)
+    ap.add_argument("--per-session", type=int, default=300)
+    ap.add_argument("--idle-days", type=float, default=30)
+    ap.add_argument("--batch-rows", type=int, default=500)
+    ap.add_argument("--inserts", type=int, default=3000)
+    ap.add_argument("--concurrency", type=int, default=16)
+    ap.add_argument("--vacuum", action="store_true")
+    asyncio.run(main_async(ap.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
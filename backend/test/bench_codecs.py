@@ -0,0 +1,72 @@
+"""
+TTS 输出编码对比：每种编码 × 输出采样率的编码耗时与体积（按每秒音频计）
+
+在仓库根目录：
+  python -m backend.test.bench_codecs                      # 合成信号（22.05kHz，10 秒）
+  python -m backend.test.bench_codecs --wav some_reply.wav  # 用真实合成结果
+
+流式一列按 TTS 服务的做法把音频切成约 200ms 的块逐块编码，和整段编码的体积对照。
+opus 需要 `pip install av`。
+"""
+import argparse
+import time
+from pathlib import Path
+
+import numpy as np
+
+from backend.tts.codecs import available, make_encoder, wav_to_pcm
+
+
+def synthetic(sr: int, seconds: float) -> bytes:
+    """带包络的谐波 + 噪声，近似语音的频谱与停顿"""
+    t = np.arange(int(sr * seconds)) / sr
+    f0 = 180 + 40 * np.sin(2 * np.pi * 0.7 * t)
+    x = sum(np.sin(2 * np.pi * k * np.cumsum(f0) / sr) / k for k in range(1, 6))
+    env = np.clip(np.sin(2 * np.pi * 1.5 * t), 0, None)
+    x = x * env + np.random.default_rng(0).normal(0, 0.02, t.shape)
+    return (x / np.abs(x).max() * 20000).astype("<i2").tobytes()
+
+
+def bench(encoding: str, pcm: bytes, sr: int, out_rate, runs: int, chunk_ms: float):
+    audio_s = len(pcm) / 2 / sr
+    cpu = []
+    for _ in range(runs):
+        enc = make_encoder(encoding, sr, out_rate)
+        t0 = time.perf_counter()
+        body = enc.encode_all(pcm)
+        cpu.append((time.perf_counter() - t0) * 1000.0)
+
+    step = int(sr * chunk_ms / 1000.0) * 2
+    enc = make_encoder(encoding, sr, out_rate)
+    streamed = len(enc.header()) + sum(len(enc.encode(pcm[i:i + step])) for i in range(0, len(pcm), step))
+    streamed += len(enc.flush())
+
+    ms = sorted(cpu)[len(cpu) // 2] / audio_s
+    print(f"{encoding:<6} {enc.rate:>6}Hz  encode={ms:7.3f}ms/s  "
+          f"buffered={len(body) / audio_s / 1024:7.1f}KB/s  streamed={streamed / audio_s / 1024:7.1f}KB/s  "
+          f"ratio={len(pcm) / len(body):5.1f}x")
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--wav", default=None, help="16bit 单声道 wav；不给则用合成信号")
+    ap.add_argument("--seconds", type=float, default=10.0)
+    ap.add_argument("--runs", type=int, default=5)
+    ap.add_argument("--chunk-ms", type=float, default=200.0)
+    args = ap.parse_args()
+
+    if args.wav:
+        pcm, sr = wav_to_pcm(Path(args.wav).read_bytes())
+    else:
+        sr = 22050
+        pcm = synthetic(sr, args.seconds)
+    print(f"input {sr}Hz {len(pcm) / 2 / sr:.1f}s, encodings: {', '.join(available())}")
+    for encoding in available():
+        for out_rate in (None, 16000, 8000):
+            if out_rate and out_rate >= sr:
+                continue
+            bench(encoding, pcm, sr, out_rate, args.runs, args.chunk_ms)
+
+
+if __name__ == "__main__":
+    main()
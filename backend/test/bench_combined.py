@@ -0,0 +1,210 @@
+"""
+合并部署 vs 分进程：常驻内存与每轮内部调用开销
+
+在仓库根目录：
+  python -m backend.test.bench_combined --turns 200 --sentences 4
+  python -m backend.test.bench_combined --services asr,llm,tts,chat      # 装了 faster-whisper 时连 ASR 一起比
+
+内存：分别拉起两种布局（子进程），各跑 --warm 轮请求后读 /proc/<pid>/smaps_rollup：
+- 分进程：arbiter + llm_app + llm.py（落库）+ tts_server（+ asr_app + chat_app），各自 uvicorn；
+- 合并：python -m backend.pipeline.combined_app，同样的服务集合。
+rss 按进程相加会把共享库算多遍，pss 按共享比例分摊，两者都列出。
+
+每轮开销：一轮里进程之间的内部调用 = ASR final → /receive_text 一次 + 垫话一次 + 每句一次 TTS。
+- 分进程：对上面的分进程布局走 localhost HTTP（httpx 连接池，已是最好情况）；
+- 合并：本进程内直接调用 llm.ingest / LocalTTSClient（combined_app 里的接法）。
+TTS 句子预先写进盘层缓存（合成的正弦 wav，时长按字数估），两边都命中缓存，差值只剩传输与编解码；
+本机没有 piper 语音也能跑。落库一步两边都要 fsync，单列出来。
+"""
+import argparse
+import asyncio
+import math
+import os
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from backend.common.stats import percentiles
+
+SENTENCES = ["俺老孙来也！", "今天带你去花果山看看。", "那里有水帘洞，还有好多猴子。", "想当年俺在那儿称王称霸，好不快活！",
+             "你要是累了，就歇一歇。", "师父说过，路要一步一步走。", "有啥难题尽管说！", "一个筋斗就是十万八千里。"]
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def fake_wav(text: str, sr: int = 22050) -> bytes:
+    from backend.tts.codecs import pcm_to_wav
+    n = int(sr * 0.22 * len(text))      # 约 0.22s/字
+    pcm = b"".join(struct.pack("<h", int(8000 * math.sin(i * 0.05))) for i in range(n))
+    return pcm_to_wav(pcm, sr)
+
+
+def warm_cache(sentences):
+    from backend.tts.audio_cache import AudioCache, cache_key
+    from backend.tts.tts_server import VOICE_MAP
+    v = VOICE_MAP["wukong"]
+    cache = AudioCache()
+    for s in sentences:
+        cache.put(cache_key("piper", v["model"], s, length_scale=v.get("length_scale"),
+                            speaker_id=v.get("speaker_id")), fake_wav(s))
+
+
+def pss(pids) -> dict:
+    from backend.pipeline.combined_app import rss_mb
+    tot = {"rss_mb": 0.0, "pss_mb": 0.0}
+    for pid in pids:
+        for k, v in rss_mb(str(pid)).items():
+            tot[k] += v
+    return {k: round(v, 1) for k, v in tot.items()}
+
+
+async def wait_http(url: str, timeout: float = 120.0):
+    t0 = time.time()
+    async with httpx.AsyncClient() as c:
+        while time.time() - t0 < timeout:
+            try:
+                await c.get(url)
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} not up")
+
+
+def launch_multi(services, ports, env):
+    mods = {"llm": "backend.llm.llm_app:app", "store": "backend.llm.llm:app", "tts": "backend.tts.tts_server:app",
+            "asr": "backend.asr.asr_app:app", "chat": "backend.pipeline.chat_app:app"}
+    procs = [subprocess.Popen([sys.executable, "-m", "backend.common.arbiter", "serve"], env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)]
+    for name in ["tts", "llm", "store", "asr", "chat"]:
+        if name in services or (name == "store" and "llm" in services):
+            procs.append(subprocess.Popen(
+                [sys.executable, "-m", "uvicorn", mods[name], "--host", "127.0.0.1", "--port", str(ports[name]),
+                 "--log-level", "warning"], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+    return procs
+
+
+def launch_combined(services, ports, env):
+    env = dict(env, COMBINED_SERVICES=",".join(services), COMBINED_LOG_LEVEL="warning",
+               **{f"{k.upper()}_PORT": str(ports[k]) for k in ("asr", "llm", "tts", "chat")})
+    return [subprocess.Popen([sys.executable, "-m", "backend.pipeline.combined_app"], env=env,
+                             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)]
+
+
+def stop(procs):
+    for p in procs:
+        p.terminate()
+    for p in procs:
+        try:
+            p.wait(timeout=20)
+        except subprocess.TimeoutExpired:
+            p.kill()
+
+
+async def run_turns(ingest, tts, n: int, sentences: int, lat: dict):
+    for i in range(n):
+        t0 = time.perf_counter()
+        await ingest({"text": f"第{i}轮：今天天气怎么样", "session_id": "bench"}, f"bench-{time.time_ns()}")
+        t1 = time.perf_counter()
+        await tts.filler("wukong")
+        for j in range(sentences):
+            await tts.synthesize_sentence(SENTENCES[(i + j) % len(SENTENCES)], j, persona="wukong",
+                                          session_id="bench")
+        t2 = time.perf_counter()
+        lat["ingest"].append((t1 - t0) * 1000.0)
+        lat["tts"].append((t2 - t1) * 1000.0)
+        lat["turn"].append((t2 - t0) * 1000.0)
+
+
+async def http_turns(ports, n: int, sentences: int, lat: dict):
+    from backend.tts.tts_client import TTSClient
+    store = httpx.AsyncClient(base_url=f"http://127.0.0.1:{ports['store']}")
+    tts = TTSClient(f"http://127.0.0.1:{ports['tts']}")
+
+    async def ingest(payload, idem):
+        r = await store.post("/receive_text", json=payload, headers={"X-Idempotency-Key": idem})
+        return r.json()
+    try:
+        await run_turns(ingest, tts, n, sentences, lat)
+    finally:
+        await tts.aclose()
+        await store.aclose()
+
+
+async def main_async(args):
+    td = tempfile.mkdtemp(prefix="bench_combined_")
+    os.environ.update(TTS_CACHE_DIR=os.path.join(td, "tts_cache"), ARBITER_SOCKET=os.path.join(td, "arb.sock"),
+                      CONV_DB_PATH=os.path.join(td, "inproc.db"))
+    services = [s for s in args.services.split(",") if s]
+    warm_cache(SENTENCES)
+
+    results = {}
+    for layout in ("multi", "combined"):
+        ports = {k: free_port() for k in ("asr", "llm", "store", "tts", "chat")}
+        env = dict(os.environ, CONV_DB_PATH=os.path.join(td, f"{layout}.db"), PYTHONPATH=os.getcwd())
+        if layout == "combined":
+            ports["store"] = ports["llm"]       # llm.py 并进 llm_app 的端口
+        procs = (launch_multi if layout == "multi" else launch_combined)(services, ports, env)
+        try:
+            t0 = time.perf_counter()
+            for name in services:
+                if name != "chat":
+                    await wait_http(f"http://127.0.0.1:{ports[name]}/")
+            await wait_http(f"http://127.0.0.1:{ports['store']}/")
+            up_s = time.perf_counter() - t0
+
+            lat = {"ingest": [], "tts": [], "turn": []}
+            await http_turns(ports, args.warm, args.sentences, {k: [] for k in lat})
+            if layout == "multi":
+                await http_turns(ports, args.turns, args.sentences, lat)
+            mem = pss([p.pid for p in procs])
+        finally:
+            stop(procs)
+        results[layout] = {"up_s": up_s, "mem": mem, "procs": len(procs), "lat": lat}
+
+    # 合并布局的内部调用发生在它自己的进程里；这里在本进程按 combined_app 的接法直接调用来计时
+    from backend.llm import llm
+    from backend.tts import tts_server
+    from backend.tts.audio_cache import AudioCache
+    from backend.tts.tts_client import LocalTTSClient
+    tts_server.CACHE = AudioCache()     # 与子进程一样：启动时从盘层建索引，命中走 mmap
+    await llm.STORE.open()
+    local = LocalTTSClient(tts_server)
+    lat = {"ingest": [], "tts": [], "turn": []}
+    await run_turns(llm.ingest, local, args.warm, args.sentences, {k: [] for k in lat})
+    await run_turns(llm.ingest, local, args.turns, args.sentences, lat)
+    await llm.STORE.close()
+    results["combined"]["lat"] = lat
+
+    print(f"服务: {','.join(services)}；每轮 = 1 次落库 + 1 次垫话 + {args.sentences} 句 TTS（缓存命中），{args.turns} 轮")
+    print(f"{'布局':<10}{'进程数':>6}{'rss 合计':>12}{'pss 合计':>12}{'就绪':>8}")
+    for layout, r in results.items():
+        print(f"{layout:<10}{r['procs']:>6}{r['mem']['rss_mb']:>10.1f}MB{r['mem']['pss_mb']:>10.1f}MB{r['up_s']:>7.1f}s")
+    print(f"{'内部调用':<14}{'分进程 p50/p99 ms':>22}{'合并 p50/p99 ms':>22}")
+    for k, label in (("ingest", "final→落库"), ("tts", f"垫话+{args.sentences}句TTS"), ("turn", "整轮")):
+        a = percentiles(results["multi"]["lat"][k], (50, 99))
+        b = percentiles(results["combined"]["lat"][k], (50, 99))
+        print(f"{label:<14}{a['p50']:>14}/{a['p99']:<8}{b['p50']:>14}/{b['p99']:<8}")
+    shutil.rmtree(td, ignore_errors=True)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--services", default="llm,tts", help="asr / chat 需要 faster-whisper")
+    ap.add_argument("--turns", type=int, default=200)
+    ap.add_argument("--warm", type=int, default=20)
+    ap.add_argument("--sentences", type=int, default=4)
+    asyncio.run(main_async(ap.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+对话压缩：长会话每轮 prompt token 数（压缩前 / 后）与请求路径上的额外开销
+
+在仓库根目录：
+  python -m backend.test.bench_compaction --turns 120
+  python -m backend.test.bench_compaction --turns 60 --llama-base http://127.0.0.1:8080   # 用真实 llama-server 写摘要
+
+模拟客户端每轮都把完整历史发给 llm_app（人设 system + 全部 user/assistant），每轮之间让后台 worker
+有机会压缩一次；默认用截断拼接充当“摘要”（只看 token 走势，不评价摘要质量）。
+最后再测一次抢占：摘要生成途中来了新请求，worker 应立即放弃。
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+from backend.common.stats import percentiles
+from backend.llm.compaction import Compactor, estimate_tokens
+
+PERSONA = "你是孙悟空，说话豪爽、爱用“俺老孙”自称，喜欢讲西游路上的见闻。"
+USER_LINES = ["今天上班好累啊，老板又让加班", "你说我要不要换个工作", "周末想去爬山，你去过花果山吗",
+              "我女儿最近迷上了你的故事", "晚饭吃什么好呢，想吃火锅", "我下个月要去成都出差",
+              "最近在学吉他，手指好疼", "你和二郎神到底谁厉害", "帮我想个给朋友的生日祝福"]
+
+
+def fake_reply(rng: random.Random) -> str:
+    return "俺老孙" + "".join(rng.choice(["觉得", "这事儿", "好办", "想当年", "在花果山", "一个筋斗",
+                                         "十万八千里", "妖怪", "师父", "莫怕", "且听俺说"])
+                               for _ in range(rng.randint(12, 30))) + "！"
+
+
+async def fake_summarize(messages, max_tokens):
+    await asyncio.sleep(0.01)
+    body = messages[-1]["content"]
+    return body[-240:]
+
+
+def llama_summarizer(base: str):
+    import httpx
+    client = httpx.AsyncClient(timeout=120)
+
+    async def summarize(messages, max_tokens):
+        r = await client.post(f"{base}/v1/chat/completions", json={
+            "messages": messages, "max_tokens": max_tokens, "temperature": 0.3, "stream": False})
+        r.raise_for_status()
+        return r.json()["choices"][0]["message"]["content"]
+    return summarize
+
+
+async def main_async(args):
+    db = os.path.join(tempfile.mkdtemp(prefix="bench_compact_"), "conv.db")
+    summarize = llama_summarizer(args.llama_base) if args.llama_base else fake_summarize
+    c = Compactor(summarize, db_path=db, trigger_tokens=args.trigger, keep_messages=args.keep, idle_ms=0)
+    await c.start()
+    rng = random.Random(0)
+    history = [{"role": "system", "content": PERSONA}]
+    sid = "bench"
+    apply_us, rows = [], []
+    for turn in range(1, args.turns + 1):
+        history.append({"role": "user", "content": rng.choice(USER_LINES) + f"（第{turn}轮）"})
+        t0 = time.perf_counter()
+        c.observe(sid, "wukong", list(history))
+        out = c.apply(sid, list(history))
+        apply_us.append((time.perf_counter() - t0) * 1e6)
+        before = sum(estimate_tokens(m["content"]) + 4 for m in history)
+        after = sum(estimate_tokens(m["content"]) + 4 for m in out)
+        rows.append((turn, before, after))
+        history.append({"role": "assistant", "content": fake_reply(rng)})
+        # 两轮之间用户在听 TTS：worker 此时空闲可以压缩
+        if c._candidate() == sid:
+            await c.compact(sid)
+
+    print(f"{'轮次':>6} {'压缩前':>8} {'压缩后':>8}")
+    for turn, before, after in rows:
+        if turn % args.every == 0 or turn == len(rows):
+            print(f"{turn:>6} {before:>8} {after:>8}")
+    b = [r[1] for r in rows]
+    a = [r[2] for r in rows]
+    print(f"平均 prompt tokens / 轮: 压缩前 {sum(b) / len(b):.0f} → 压缩后 {sum(a) / len(a):.0f}；"
+          f"最后一轮 {b[-1]} → {a[-1]}")
+    s = c.summary()
+    print(f"压缩 {s['compactions']} 次，每次 p50={s['compact_ms'].get('p50')}ms；"
+          f"请求路径 observe+apply p50={percentiles(apply_us, (50,))['p50']}µs p99={percentiles(apply_us, (99,))['p99']}µs")
+
+    # 抢占：摘要写到一半来了新请求
+    async def slow(messages, max_tokens):
+        await asyncio.sleep(5)
+        return "不该出现"
+    c.summarize = slow
+    history += [{"role": "user", "content": "再聊一句"}, {"role": "assistant", "content": fake_reply(rng)}] * args.keep
+    c.observe(sid, "wukong", list(history))
+    task = asyncio.create_task(c.compact(sid))
+    await asyncio.sleep(0.2)
+    t0 = time.perf_counter()
+    c.observe(sid, "wukong", list(history))
+    res = await task
+    print(f"抢占: 结果={res}，新请求到达后 {(time.perf_counter() - t0) * 1000:.0f}ms 内让出，preempted={c.counters['preempted']}")
+    await c.stop()
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--turns", type=int, default=120)
+    ap.add_argument("--trigger", type=int, default=1500)
+    ap.add_argument("--keep", type=int, default=6)
+    ap.add_argument("--every", type=int, default=10)
+    ap.add_argument("--llama-base", default=None)
+    asyncio.run(main_async(ap.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
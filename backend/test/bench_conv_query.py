@@ -0,0 +1,154 @@
+"""
+对话库读路径延迟：百万级消息下，按会话取历史 / 全文检索
+
+在仓库根目录：
+  python -m backend.test.bench_conv_query --messages 1000000 --sessions 2000
+
+先用 sqlite3 批量灌一个临时库（带 store.py 的索引、FTS 表和触发器，灌库本身也就测了触发器的写入开销），
+再对比：
+- 无索引（NOT INDEXED 强制全表扫描，相当于改造前的 schema）：ORDER BY created_at + OFFSET 分页、LIKE 检索；
+- 现在的实现：ConversationStore.history / search（复合索引 + 游标分页、FTS5 trigram）。
+--db 指定已有的库可跳过灌库。
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import time
+import uuid
+
+from backend.common.stats import percentiles
+from backend.llm.store import FTS_SCHEMA, SCHEMA, ConversationStore
+
+INSERT_ROW = "INSERT INTO messages (id, session_id, role, text, created_at, idem, meta) VALUES (?,?,?,?,?,?,?)"
+
+WORDS = ["今天", "天气", "不错", "我们", "去公园", "散步", "晚饭", "吃什么", "帮我", "查一下",
+         "明天", "的会议", "几点", "开始", "这首歌", "很好听", "讲个", "笑话", "周末", "有空吗",
+         "提醒我", "买牛奶", "火车票", "订好了", "孩子", "作业", "写完", "电影", "太长了", "早点睡"]
+RARE = "量子纠缠实验室"
+
+
+def build(path: str, n: int, sessions: int, seed: int = 0):
+    rng = random.Random(seed)
+    db = sqlite3.connect(path)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=OFF")
+    for ddl in SCHEMA + FTS_SCHEMA:
+        db.execute(ddl)
+    t0 = time.time() - n          # 每条消息间隔 ~1s
+    db.executemany("INSERT INTO sessions (id, created_at) VALUES (?,?)",
+                   [(f"s{i}", t0) for i in range(sessions)])
+    batch = []
+    for i in range(n):
+        text = "".join(rng.choice(WORDS) for _ in range(rng.randint(3, 12)))
+        if i % 50000 == 0:
+            text += RARE
+        batch.append((str(uuid.uuid4()), f"s{rng.randrange(sessions)}", "user" if i % 2 else "assistant",
+                      text, t0 + i, f"k{i}", json.dumps({"source": "asr"})))
+        if len(batch) == 50000:
+            db.executemany(INSERT_ROW, batch)
+            batch.clear()
+    if batch:
+        db.executemany(INSERT_ROW, batch)
+    db.commit()
+    db.execute("INSERT INTO messages_fts(messages_fts) VALUES ('optimize')")
+    db.commit()
+    db.close()
+
+
+def timeit(fn, reps: int):
+    lat = []
+    for _ in range(reps):
+        t0 = time.perf_counter()
+        fn()
+        lat.append((time.perf_counter() - t0) * 1000.0)
+    return lat
+
+
+async def atimeit(fn, reps: int):
+    lat = []
+    for _ in range(reps):
+        t0 = time.perf_counter()
+        await fn()
+        lat.append((time.perf_counter() - t0) * 1000.0)
+    return lat
+
+
+def report(label, lat):
+    p = percentiles(lat, (50, 99))
+    print(f"  {label:<44} p50={p['p50']:9.2f}ms p99={p['p99']:9.2f}ms")
+
+
+async def main_async(args):
+    path = args.db
+    if not path:
+        path = os.path.join(tempfile.mkdtemp(prefix="bench_convq_"), "conv.db")
+        t0 = time.perf_counter()
+        build(path, args.messages, args.sessions)
+        dt = time.perf_counter() - t0
+        print(f"灌库 {args.messages} 条（含 FTS 触发器）: {dt:.1f}s，{args.messages / dt:.0f} 条/s，"
+              f"{os.path.getsize(path) / 2**20:.0f}MB")
+
+    rng = random.Random(1)
+    sids = [f"s{rng.randrange(args.sessions)}" for _ in range(args.reps)]
+    raw = sqlite3.connect(path)
+    n = raw.execute("SELECT count(*) FROM messages").fetchone()[0]
+    print(f"messages={n}")
+
+    # ---- 无索引：全表扫描 ----
+    reps = max(3, args.reps // 20)
+    print("无索引（全表扫描）:")
+    it = itertools.cycle(sids)
+    report("history 第 1 页（50 条）", timeit(lambda: raw.execute(
+        "SELECT * FROM messages NOT INDEXED WHERE session_id=? ORDER BY created_at DESC LIMIT 50",
+        (next(it),)).fetchall(), reps))
+    report("history 第 5 页（OFFSET 200）", timeit(lambda: raw.execute(
+        "SELECT * FROM messages NOT INDEXED WHERE session_id=? ORDER BY created_at DESC LIMIT 50 OFFSET 200",
+        (next(it),)).fetchall(), reps))
+    report(f"search LIKE '{RARE}'（全库，20 条）", timeit(lambda: raw.execute(
+        "SELECT * FROM messages NOT INDEXED WHERE text LIKE ? ORDER BY rowid DESC LIMIT 20",
+        (f"%{RARE}%",)).fetchall(), reps))
+    raw.close()
+
+    # ---- 现在的实现 ----
+    store = ConversationStore(path)
+    await store.open()
+    print("索引 + FTS5（ConversationStore）:")
+    it = itertools.cycle(sids)
+    report("history 第 1 页（50 条）", await atimeit(lambda: store.history(next(it), 50), args.reps))
+
+    async def deep():
+        sid, cur = next(it), None
+        for _ in range(5):
+            r = await store.history(sid, 50, cur)
+            cur = r["next_cursor"]
+            if not cur:
+                break
+    lat = await atimeit(deep, args.reps)
+    report("history 翻到第 5 页（游标，5 次查询合计）", lat)
+    report(f"search FTS '{RARE}'（全库）", await atimeit(lambda: store.search(RARE), args.reps))
+    report("search FTS '去公园散步'（高频，20 条）", await atimeit(lambda: store.search("去公园散步"), args.reps))
+    report("search FTS '去公园散步' + session_id", await atimeit(
+        lambda: store.search("去公园散步", session_id=next(it)), args.reps))
+    report("search 两字词 '天气' + session_id（LIKE）", await atimeit(
+        lambda: store.search("天气", session_id=next(it)), args.reps))
+    hits = await store.search(RARE, limit=200)
+    print(f"  '{RARE}' 命中 {len(hits['messages'])} 条（应为 {(n + 49999) // 50000}）")
+    await store.close()
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--messages", type=int, default=1_000_000)
+    ap.add_argument("--sessions", type=int, default=2000)
+    ap.add_argument("--reps", type=int, default=200)
+    ap.add_argument("--db", default=None, help="用已有的库，不灌数据")
+    asyncio.run(main_async(ap.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""
+对话存储写入吞吐：原实现（每条消息新建连接 + 单独提交） vs 常驻连接 + 批量提交
+
+在仓库根目录：
+  python -m backend.test.bench_conv_store --messages 2000 --concurrency 32
+
+每种实现都写进一个新的临时库；--concurrency 模拟同时到达的 /receive_text 请求数。
+另外附带 10% 重复 idem 的消息，核对两边的幂等结果一致。
+"""
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+import uuid
+
+import aiosqlite
+
+from backend.common.stats import percentiles
+from backend.llm.store import SCHEMA, ConversationStore
+
+
+# ====== 原实现（backend/llm/llm.py 改造前）======
+async def legacy_init(path: str):
+    async with aiosqlite.connect(path) as db:
+        for ddl in SCHEMA:
+            await db.execute(ddl)
+        await db.commit()
+
+
+async def legacy_save(path: str, session_id, role, text, idem, meta=None):
+    async with aiosqlite.connect(path) as db:
+        await db.execute("INSERT OR IGNORE INTO sessions (id, created_at) VALUES (?,?)",
+                         (session_id, time.time()))
+        try:
+            await db.execute("""INSERT INTO messages
+                (id, session_id, role, text, created_at, idem, meta)
+                VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                (str(uuid.uuid4()), session_id, role, text, time.time(),
+                 idem, json.dumps(meta or {})))
+            await db.commit()
+            return True
+        except aiosqlite.IntegrityError:
+            return False
+
+
+async def stored_idems(path: str) -> set:
+    async with aiosqlite.connect(path) as db:
+        async with db.execute("SELECT idem FROM messages") as cur:
+            return {r[0] for r in await cur.fetchall()}
+
+
+def workload(n: int):
+    msgs = []
+    for i in range(n):
+        idem = f"s{i % 8}:{i}"
+        if i and i % 10 == 0:
+            idem = f"s{(i - 1) % 8}:{i - 1}"    # 重复上一条
+        msgs.append((f"s{i % 8}", "user", f"第 {i} 句话，测试一下写入吞吐。", idem,
+                     {"source": "asr", "segments": [{"start": 0, "end": 1.2, "text": "x"}]}))
+    return msgs
+
+
+async def drive(save, msgs, concurrency: int):
+    sem = asyncio.Semaphore(concurrency)
+    lat, results = [], [None] * len(msgs)
+
+    async def one(i, m):
+        async with sem:
+            t0 = time.perf_counter()
+            results[i] = await save(*m)
+            lat.append((time.perf_counter() - t0) * 1000.0)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(one(i, m) for i, m in enumerate(msgs)))
+    return time.perf_counter() - t0, lat, results
+
+
+def report(label, elapsed, lat, n):
+    p = percentiles(lat, (50, 99))
+    print(f"{label:<26} {n / elapsed:9.0f} msg/s  p50={p['p50']:7.2f}ms p99={p['p99']:7.2f}ms")
+
+
+async def main_async(args):
+    msgs = workload(args.messages)
+    td = tempfile.mkdtemp(prefix="bench_conv_")
+
+    path = os.path.join(td, "legacy.db")
+    await legacy_init(path)
+    elapsed, lat, legacy_res = await drive(lambda *m: legacy_save(path, *m), msgs, args.concurrency)
+    report("legacy (connect+commit)", elapsed, lat, len(msgs))
+    legacy_idems = await stored_idems(path)
+
+    for label, async_ack in (("store (durable ack)", False), ("store (CONV_ASYNC_ACK=1)", True)):
+        store = ConversationStore(os.path.join(td, f"store_{int(async_ack)}.db"), async_ack=async_ack)
+        await store.open()
+        elapsed, lat, res = await drive(store.save_message, msgs, args.concurrency)
+        t_close = time.perf_counter()
+        await store.close()     # 异步确认模式把落盘时间也算进去
+        elapsed += time.perf_counter() - t_close
+        report(label, elapsed, lat, len(msgs))
+        s = store.summary()
+        print(f"{'':<26} batches={s['batches']} rows/batch p50={s['batch_rows'].get('p50')} "
+              f"commit p99={s['commit_ms'].get('p99')}ms")
+        # 并发下重复对里谁先到不确定，比较重复条数和最终库里的 idem 集合
+        if not async_ack:
+            print(f"{'':<26} 重复: 原实现 {legacy_res.count(False)} 条 / 本实现 {res.count(False)} 条")
+        same = await stored_idems(os.path.join(td, f"store_{int(async_ack)}.db")) == legacy_idems
+        print(f"{'':<26} 库内 idem 集合与原实现一致: {same}")
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--messages", type=int, default=2000)
+    ap.add_argument("--concurrency", type=int, default=32)
+    asyncio.run(main_async(ap.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,298 @@
+"""
+整条对话链路压测：假 llama-server + 假 piper，真 llm_app.py 与 tts_server.py（无 GPU、无模型，CI 上可跑）
+
+在仓库根目录：
+  python -m backend.test.bench_e2e_load --conversations 4 --turns 3
+  python -m backend.test.bench_e2e_load --conversations 16 --llama-slots 4 --llama-tps 20 --piper-rtf 0.5
+  python -m backend.test.bench_e2e_load --legacy                        # 假 llama 不提供 /v1，走 /completion 回退
+  python -m backend.test.bench_e2e_load --llm-url http://127.0.0.1:8001 # 压已经在跑的真服务，不起替身
+
+起的进程（各自 uvicorn，端口随机，数据都在临时目录）：
+- backend.test.fake_llama_server：按 --llama-prefill-tps / --llama-tps / --llama-slots 出字；
+- tts_server：PIPER_BACKEND=cli，PIPER_BIN 指向 backend.test.fake_piper 的包装脚本（按 --piper-rtf 睡够时长），
+  VOICE_MAP 里的语音换成临时目录下的空模型文件；默认关掉音频缓存（台词会重复，开了测的就是缓存）；
+- llm_app：LLAMA_BASE / TTS_BASE 指向上面两个。
+
+每个人设 --conversations 路对话同时进行，每路按脚本说 --turns 句（带上前几轮历史），句间停 --think-ms；
+每轮走 POST /llm_tts（与前端流水线模式相同），客户端计时：
+- TTFT：请求发出 → 第一个 token 事件；TTFA：→ 第一段真回复音频（垫话单列）；整轮：→ done；
+- 错误：HTTP 非 200、流里的 error 事件（按 llm / tts 阶段分）、超时 / 连接错误。
+汇总：吞吐（轮/秒、合成音频秒/秒）、各分位数、错误率；--max-error-rate 超了以非 0 退出，给 CI 用。
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import random
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from backend.common.stats import percentiles
+
+PERSONAS = {
+    "wukong": "你是一个机灵、俏皮、会自称‘俺老孙’的中文角色。风格轻快，爱用比喻，避免学术化长句。",
+    "harry": "你是一位亲切机智的‘哈利·波特’风格中文角色。用温柔的方式解释问题，偶尔用一点魔法世界的比喻。",
+    "ironman": "你是一位托尼·斯塔克风格的中文角色：理性、自信、略带幽默。回答结构清晰，先结论后细节，并给出可执行建议。",
+}
+SCRIPT = ["你好，今天过得怎么样？", "给我讲讲你最得意的一件事。", "我最近总是睡不好，有什么办法吗？",
+          "周末想出去玩，去哪儿好？", "帮我想个生日礼物。", "你觉得学编程难吗？", "讲个笑话吧。", "好的，谢谢你！"]
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wav_seconds(wav: bytes) -> float:
+    if len(wav) < 44:
+        return 0.0
+    sr = struct.unpack("<I", wav[24:28])[0] or 1
+    return (len(wav) - 44) / (2.0 * sr)
+
+
+# ------------------ 替身与服务 ------------------
+def fake_voices(root: str) -> str:
+    """VOICE_MAP 里的每个语音放一份空模型 + 只带采样率的 config"""
+    from backend.tts.tts_server import VOICE_MAP
+    vdir = os.path.join(root, "voices")
+    os.makedirs(vdir, exist_ok=True)
+    for v in VOICE_MAP.values():
+        open(os.path.join(vdir, v["model"]), "wb").close()
+        with open(os.path.join(vdir, v["config"]), "w", encoding="utf-8") as f:
+            json.dump({"audio": {"sample_rate": 22050}}, f)
+    return vdir
+
+
+def piper_wrapper(root: str) -> str:
+    path = os.path.join(root, "piper")
+    with open(path, "w") as f:
+        f.write(f'#!/bin/sh\nexec "{sys.executable}" -m backend.test.fake_piper "$@"\n')
+    os.chmod(path, 0o755)
+    return path
+
+
+def launch(args, root: str):
+    ports = {k: free_port() for k in ("llama", "tts", "llm")}
+    env = dict(
+        os.environ, PYTHONPATH=os.getcwd(),
+        LLAMA_BASE=f"http://127.0.0.1:{ports['llama']}", TTS_BASE=f"http://127.0.0.1:{ports['tts']}",
+        PIPER_BACKEND="cli", PIPER_BIN=piper_wrapper(root), PIPER_VOICE_DIR=fake_voices(root),
+        FAKE_PIPER_RTF=str(args.piper_rtf), FAKE_PIPER_LOAD_MS=str(args.piper_load_ms),
+        FAKE_PIPER_CPU="1" if args.piper_cpu else "0", FAKE_PIPER_FAIL_RATE=str(args.piper_fail_rate),
+        TTS_CACHE="1" if args.cache else "0", TTS_CACHE_DIR=os.path.join(root, "tts_cache"),
+        CONV_DB_PATH=os.path.join(root, "conv.db"), TRACE_DIR=os.path.join(root, "traces"), ARBITER="0",
+    )
+    if args.tts_workers:
+        env["TTS_WORKERS"] = str(args.tts_workers)
+    llama = [sys.executable, "-m", "backend.test.fake_llama_server", "--port", str(ports["llama"]),
+             "--prefill-tps", str(args.llama_prefill_tps), "--tps", str(args.llama_tps),
+             "--slots", str(args.llama_slots), "--tokens", str(args.llama_tokens),
+             "--error-rate", str(args.llama_error_rate)] + (["--no-openai"] if args.legacy else [])
+    cmds = {
+        "llama": llama,
+        "tts": [sys.executable, "-m", "uvicorn", "backend.tts.tts_server:app", "--host", "127.0.0.1",
+                "--port", str(ports["tts"]), "--log-level", "warning"],
+        "llm": [sys.executable, "-m", "uvicorn", "backend.llm.llm_app:app", "--host", "127.0.0.1",
+                "--port", str(ports["llm"]), "--log-level", "warning"],
+    }
+    procs = {}
+    for name, cmd in cmds.items():
+        log = open(os.path.join(root, f"{name}.log"), "wb")
+        procs[name] = subprocess.Popen(cmd, env=env, stdout=log, stderr=subprocess.STDOUT)
+    return ports, procs
+
+
+async def wait_http(url: str, proc: subprocess.Popen = None, timeout: float = 60.0):
+    t0 = time.time()
+    async with httpx.AsyncClient() as c:
+        while time.time() - t0 < timeout:
+            if proc is not None and proc.poll() is not None:
+                raise RuntimeError(f"{url}: process exited with {proc.returncode}")
+            try:
+                if (await c.get(url)).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} not up")
+
+
+def stop(procs):
+    for p in procs.values():
+        p.terminate()
+    for p in procs.values():
+        try:
+            p.wait(timeout=20)
+        except subprocess.TimeoutExpired:
+            p.kill()
+
+
+# ------------------ 对话 ------------------
+async def turn(client: httpx.AsyncClient, persona: str, session_id: str, messages, max_tokens: int) -> dict:
+    """一轮 /llm_tts；返回客户端视角的各阶段毫秒数与错误"""
+    r = {"persona": persona, "errors": [], "audio_s": 0.0, "text": ""}
+    t0 = time.perf_counter()
+    ms = lambda: (time.perf_counter() - t0) * 1000.0
+    body = {"messages": messages, "persona": persona, "session_id": session_id, "max_tokens": max_tokens}
+    try:
+        async with client.stream("POST", "/llm_tts", json=body) as resp:
+            if resp.status_code != 200:
+                r["errors"].append(f"http_{resp.status_code}")
+                return r
+            async for line in resp.aiter_lines():
+                if not line.strip():
+                    continue
+                ev = json.loads(line)
+                kind = ev.get("type")
+                if kind == "token":
+                    r.setdefault("ttft", ms())
+                elif kind == "filler":
+                    r.setdefault("filler", ms())
+                elif kind == "audio":
+                    r.setdefault("ttfa", ms())
+                    r["audio_s"] += wav_seconds(base64.b64decode(ev["audio"]))
+                elif kind == "error":
+                    r["errors"].append(f"{ev.get('stage', 'stream')}_error")
+                elif kind == "done":
+                    r["text"] = ev.get("text", "")
+                    r["turn"] = ms()
+    except httpx.TimeoutException:
+        r["errors"].append("timeout")
+    except httpx.TransportError as e:
+        r["errors"].append(type(e).__name__)
+    if "turn" not in r and not r["errors"]:
+        r["errors"].append("no_done")
+    return r
+
+
+async def conversation(client, persona: str, idx: int, args, results: list, rng: random.Random):
+    await asyncio.sleep(rng.uniform(0, args.ramp_s))
+    session_id = f"load-{persona}-{idx}"
+    messages = [{"role": "system", "content": PERSONAS[persona]}]
+    for t in range(args.turns):
+        messages.append({"role": "user", "content": SCRIPT[(idx + t) % len(SCRIPT)]})
+        r = await turn(client, persona, session_id, messages, args.max_tokens)
+        results.append(r)
+        messages.append({"role": "assistant", "content": r["text"] or "……"})
+        await asyncio.sleep(args.think_ms / 1000.0 * rng.uniform(0.5, 1.5))
+
+
+def row(label: str, rs: list) -> str:
+    n = len(rs)
+    bad = sum(1 for r in rs if r["errors"])
+    cols = [f"{label:<10}{n:>6}{bad / n * 100 if n else 0:>7.1f}%"]
+    for k in ("ttft", "ttfa", "turn"):
+        p = percentiles([r[k] for r in rs if k in r], (50, 90, 99))
+        cols.append(f"{'/'.join(str(p.get(q, '-')) for q in ('p50', 'p90', 'p99')):>24}")
+    return "".join(cols)
+
+
+async def main_async(args) -> int:
+    root = tempfile.mkdtemp(prefix="bench_e2e_")
+    procs = {}
+    llm_url = args.llm_url
+    try:
+        if not llm_url:
+            ports, procs = launch(args, root)
+            await wait_http(f"http://127.0.0.1:{ports['llama']}/health", procs["llama"])
+            await wait_http(f"http://127.0.0.1:{ports['tts']}/ready", procs["tts"])
+            llm_url = f"http://127.0.0.1:{ports['llm']}"
+        await wait_http(f"{llm_url}/ready", procs.get("llm"))
+
+        personas = [p for p in args.personas.split(",") if p]
+        rng = random.Random(args.seed)
+        results: list = []
+        n = len(personas) * args.conversations
+        limits = httpx.Limits(max_connections=n, max_keepalive_connections=n)
+        async with httpx.AsyncClient(base_url=llm_url, timeout=args.timeout, limits=limits) as client:
+            t0 = time.perf_counter()
+            await asyncio.gather(*(conversation(client, p, i, args, results, rng)
+                                   for p in personas for i in range(args.conversations)))
+            wall = time.perf_counter() - t0
+            extra = {}
+            if procs:
+                async with httpx.AsyncClient() as c:
+                    extra["llama"] = (await c.get(f"http://127.0.0.1:{ports['llama']}/stats")).json()
+                    tts = (await c.get(f"http://127.0.0.1:{ports['tts']}/stats")).json()
+                    extra["tts_queue_wait_ms"] = {p: v["queue_wait_ms"] for p, v in tts.get("personas", {}).items()}
+    finally:
+        stop(procs)
+        if args.keep:
+            print(f"日志与数据：{root}")
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+    ok = [r for r in results if not r["errors"]]
+    errors: dict = {}
+    for r in results:
+        for e in r["errors"]:
+            errors[e] = errors.get(e, 0) + 1
+    audio_s = sum(r["audio_s"] for r in results)
+    rate = (len(results) - len(ok)) / max(1, len(results))
+    summary = {
+        "conversations": n, "turns": len(results), "wall_s": round(wall, 2),
+        "turns_per_s": round(len(ok) / wall, 2), "audio_s_per_s": round(audio_s / wall, 2),
+        "error_rate": round(rate, 4), "errors": errors,
+        **{k: percentiles([r[k] for r in results if k in r], (50, 90, 99)) for k in ("ttft", "ttfa", "filler", "turn")},
+        **extra,
+    }
+    if args.json:
+        print(json.dumps(summary, ensure_ascii=False, indent=2))
+    else:
+        print(f"{n} 路对话 × {args.turns} 轮，用时 {wall:.1f}s：成功 {len(ok)} 轮，"
+              f"{summary['turns_per_s']} 轮/s，合成音频 {summary['audio_s_per_s']} s/s，错误率 {rate * 100:.1f}% {errors or ''}")
+        print(f"{'人设':<10}{'轮数':>6}{'错误':>8}{'TTFT p50/90/99 ms':>24}{'TTFA p50/90/99 ms':>24}{'整轮 p50/90/99 ms':>24}")
+        for p in personas:
+            print(row(p, [r for r in results if r["persona"] == p]))
+        print(row("all", results))
+        if summary["filler"]:
+            print(f"垫话 {sum(1 for r in results if 'filler' in r)} 次，到达 p50={summary['filler']['p50']}ms")
+        if "llama" in extra:
+            print(f"llama 替身：{extra['llama']}")
+            print(f"TTS 排队：{extra['tts_queue_wait_ms']}")
+    if args.max_error_rate is not None and rate > args.max_error_rate:
+        print(f"错误率 {rate:.3f} 超过 --max-error-rate {args.max_error_rate}")
+        return 1
+    return 0
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--personas", default=",".join(PERSONAS))
+    ap.add_argument("--conversations", type=int, default=4, help="每个人设同时进行的对话数")
+    ap.add_argument("--turns", type=int, default=3)
+    ap.add_argument("--think-ms", type=float, default=500, help="两轮之间用户停顿（±50%% 抖动）")
+    ap.add_argument("--ramp-s", type=float, default=1.0, help="各路对话在这段时间内错开开始")
+    ap.add_argument("--max-tokens", type=int, default=128)
+    ap.add_argument("--timeout", type=float, default=60)
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--llm-url", default=None, help="压已在跑的 llm_app，不起替身")
+    ap.add_argument("--llama-prefill-tps", type=float, default=400)
+    ap.add_argument("--llama-tps", type=float, default=25)
+    ap.add_argument("--llama-slots", type=int, default=4)
+    ap.add_argument("--llama-tokens", type=int, default=60)
+    ap.add_argument("--llama-error-rate", type=float, default=0)
+    ap.add_argument("--legacy", action="store_true", help="假 llama 的 /v1/chat/completions 回 404")
+    ap.add_argument("--piper-rtf", type=float, default=0.3)
+    ap.add_argument("--piper-load-ms", type=float, default=150)
+    ap.add_argument("--piper-cpu", action="store_true", help="假 piper 空转占核而不是 sleep")
+    ap.add_argument("--piper-fail-rate", type=float, default=0)
+    ap.add_argument("--tts-workers", type=int, default=0, help="0 = tts_server 默认")
+    ap.add_argument("--cache", action="store_true", help="打开 TTS 音频缓存")
+    ap.add_argument("--max-error-rate", type=float, default=None)
+    ap.add_argument("--json", action="store_true")
+    ap.add_argument("--keep", action="store_true", help="保留临时目录（各服务日志）")
+    sys.exit(asyncio.run(main_async(ap.parse_args())))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+"""
+backend/main.py 网关并发压测：原来的阻塞实现 vs 现在的全异步实现（假 llama-server + 假 piper，无 GPU、无模型）
+
+在仓库根目录：
+  python -m backend.test.bench_gateway --clients 8 --requests 6
+  python -m backend.test.bench_gateway --mix chat --clients 16 --llama-slots 8
+  python -m backend.test.bench_gateway --only new --url http://127.0.0.1:8000   # 压已经在跑的网关
+
+两个网关各起一个 uvicorn（端口随机），上游是同一个 backend.test.fake_llama_server，
+Piper 走 cli 后端、PIPER_BIN 指向 backend.test.fake_piper 的包装脚本：
+- old：本文件里按原 main.py 复刻的 handler（async def 里同步 POST 上游、合成写进 uploads/ 再 FileResponse）；
+  原实现用 requests，这里换成同样阻塞的 httpx.Client，免得多装一个包；
+- new：uvicorn backend.main:app（共用连接池、有界线程池、流式响应）。
+
+--clients 个客户端同时跑，每个发 --requests 个请求，按 --mix 在 /chat 与 /tts 之间轮换；
+同时一个探针每 50ms 打一次 GET /，探针延迟就是事件循环被卡住的时间。
+/asr 需要 faster-whisper 模型，这里不压。
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import httpx
+
+from backend.common.stats import percentiles
+from backend.test.bench_e2e_load import free_port, piper_wrapper, stop, wait_http
+
+TEXTS = [
+    "俺老孙来也！今天想聊点什么？",
+    "先说结论：可以做，而且不难。第一步，把需求写清楚。",
+    "记得多喝水，别熬夜。还有什么想问的，尽管说！",
+]
+
+
+# ------------------ 原实现（复刻 main.py 改造前的 handler） ------------------
+def create_legacy_app():
+    from fastapi import FastAPI, Form
+    from fastapi.responses import FileResponse
+    from backend.chat import chat_payload, VLLM_ENDPOINT
+    from backend.tts.piper_pool import default_pool
+
+    app = FastAPI()
+    upload_dir = os.getenv("LEGACY_UPLOAD_DIR", "uploads")
+    os.makedirs(upload_dir, exist_ok=True)
+    model = os.environ["GATEWAY_VOICE_MODEL"]
+
+    @app.get("/")
+    def root():
+        return {"message": "AI Role Chat Backend is running!"}
+
+    @app.post("/chat")
+    async def chat_endpoint(user_text: str = Form(...), persona: str = Form("你是一个友好的助手")):
+        response = httpx.post(VLLM_ENDPOINT, json=chat_payload(user_text, persona), timeout=60)
+        return {"reply": response.json()["choices"][0]["message"]["content"].strip()}
+
+    @app.post("/tts")
+    async def tts_endpoint(text: str = Form(...)):
+        out_path = os.path.join(upload_dir, f"{uuid.uuid4()}.wav")
+        with open(out_path, "wb") as f:
+            f.write(default_pool().synthesize_wav(model, model + ".json", text))
+        return FileResponse(out_path, media_type="audio/wav", filename="reply.wav")
+
+    return app
+
+
+# ------------------ 服务 ------------------
+def launch(args, root: str):
+    ports = {"llama": free_port(), "old": free_port(), "new": free_port()}
+    model = os.path.join(root, "voice.onnx")
+    open(model, "wb").close()
+    with open(model + ".json", "w", encoding="utf-8") as f:
+        json.dump({"audio": {"sample_rate": 22050}}, f)
+    env = dict(
+        os.environ, PYTHONPATH=os.getcwd(), ARBITER="0", TRACE_DIR=os.path.join(root, "traces"),
+        VLLM_ENDPOINT=f"http://127.0.0.1:{ports['llama']}/v1/chat/completions",
+        PIPER_BACKEND="cli", PIPER_BIN=piper_wrapper(root), GATEWAY_VOICE_MODEL=model,
+        FAKE_PIPER_RTF=str(args.piper_rtf), FAKE_PIPER_LOAD_MS=str(args.piper_load_ms),
+        GATEWAY_TTS_WORKERS=str(args.tts_workers), LEGACY_UPLOAD_DIR=os.path.join(root, "uploads"),
+    )
+    cmds = {
+        "llama": [sys.executable, "-m", "backend.test.fake_llama_server", "--port", str(ports["llama"]),
+                  "--slots", str(args.llama_slots), "--tps", str(args.llama_tps),
+                  "--tokens", str(args.llama_tokens)],
+    }
+    if args.only in ("both", "old"):
+        cmds["old"] = [sys.executable, "-m", "backend.test.bench_gateway", "--serve-legacy",
+                       "--port", str(ports["old"])]
+    if args.only in ("both", "new"):
+        cmds["new"] = [sys.executable, "-m", "uvicorn", "backend.main:app", "--host", "127.0.0.1",
+                       "--port", str(ports["new"]), "--log-level", "warning"]
+    procs = {}
+    for name, cmd in cmds.items():
+        log = open(os.path.join(root, f"{name}.log"), "wb")
+        procs[name] = subprocess.Popen(cmd, env=env, stdout=log, stderr=subprocess.STDOUT)
+    return ports, procs
+
+
+# ------------------ 压测 ------------------
+async def one(client: httpx.AsyncClient, kind: str, text: str) -> dict:
+    t0 = time.perf_counter()
+    try:
+        if kind == "chat":
+            r = await client.post("/chat", data={"user_text": text, "persona": "你是孙悟空"})
+        else:
+            r = await client.post("/tts", data={"text": text})
+        ok = r.status_code == 200 and len(r.content) > 0
+        err = None if ok else f"http {r.status_code}"
+    except httpx.HTTPError as e:
+        err = type(e).__name__
+    return {"kind": kind, "ms": (time.perf_counter() - t0) * 1000.0, "error": err}
+
+
+async def probe(client: httpx.AsyncClient, stop_evt: asyncio.Event, out: list):
+    while not stop_evt.is_set():
+        t0 = time.perf_counter()
+        try:
+            await client.get("/")
+            out.append((time.perf_counter() - t0) * 1000.0)
+        except httpx.HTTPError:
+            pass
+        await asyncio.sleep(0.05)
+
+
+async def run_load(base: str, args) -> dict:
+    kinds = {"chat": ["chat"], "tts": ["tts"], "both": ["chat", "tts"]}[args.mix]
+    limits = httpx.Limits(max_connections=args.clients + 2)
+    async with httpx.AsyncClient(base_url=base, timeout=args.timeout, limits=limits) as client:
+        results, probes, stop_evt = [], [], asyncio.Event()
+
+        async def worker(i: int):
+            for j in range(args.requests):
+                kind = kinds[(i + j) % len(kinds)]
+                results.append(await one(client, kind, TEXTS[(i + j) % len(TEXTS)]))
+
+        prober = asyncio.create_task(probe(client, stop_evt, probes))
+        t0 = time.perf_counter()
+        await asyncio.gather(*(worker(i) for i in range(args.clients)))
+        elapsed = time.perf_counter() - t0
+        stop_evt.set()
+        await prober
+    return {"elapsed": elapsed, "results": results, "probe_ms": probes}
+
+
+def report(label: str, res: dict):
+    rs = res["results"]
+    ok = [r for r in rs if not r["error"]]
+    print(f"{label:<5} {len(ok)}/{len(rs)} ok  {len(ok) / res['elapsed']:.2f} req/s  ({res['elapsed']:.1f}s)")
+    for kind in ("chat", "tts"):
+        ms = [r["ms"] for r in ok if r["kind"] == kind]
+        if ms:
+            p = percentiles(ms, (50, 90, 99))
+            print(f"      {kind:<5} p50 {p['p50']:7.0f}  p90 {p['p90']:7.0f}  p99 {p['p99']:7.0f} ms  (n={len(ms)})")
+    if res["probe_ms"]:
+        p = percentiles(res["probe_ms"], (50, 99))
+        print(f"      GET / p50 {p['p50']:7.0f}  p99 {p['p99']:7.0f}  max {max(res['probe_ms']):7.0f} ms  "
+              f"(事件循环卡顿)")
+    errors = {}
+    for r in rs:
+        if r["error"]:
+            errors[r["error"]] = errors.get(r["error"], 0) + 1
+    if errors:
+        print(f"      errors {errors}")
+
+
+async def main_async(args) -> int:
+    root = tempfile.mkdtemp(prefix="bench_gateway_")
+    procs = {}
+    try:
+        if args.url:
+            targets = {args.only if args.only != "both" else "new": args.url}
+        else:
+            ports, procs = launch(args, root)
+            await wait_http(f"http://127.0.0.1:{ports['llama']}/health", procs["llama"])
+            targets = {}
+            for name in ("old", "new"):
+                if name in procs:
+                    await wait_http(f"http://127.0.0.1:{ports[name]}/", procs[name])
+                    targets[name] = f"http://127.0.0.1:{ports[name]}"
+        print(f"clients={args.clients} requests={args.requests} mix={args.mix} "
+              f"llama slots={args.llama_slots} tps={args.llama_tps} piper rtf={args.piper_rtf} "
+              f"tts workers={args.tts_workers}")
+        out = {}
+        for name, base in targets.items():
+            out[name] = await run_load(base, args)
+            report(name, out[name])
+        if len(out) == 2:
+            old, new = (len([r for r in out[k]["results"] if not r["error"]]) / out[k]["elapsed"]
+                        for k in ("old", "new"))
+            print(f"吞吐 {old:.2f} → {new:.2f} req/s（×{new / old:.1f}）" if old else "")
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump({k: {"elapsed": v["elapsed"], "results": v["results"], "probe_ms": v["probe_ms"]}
+                           for k, v in out.items()}, f, ensure_ascii=False)
+        return 0
+    finally:
+        stop(procs)
+        if args.keep:
+            print(f"logs: {root}")
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--clients", type=int, default=8)
+    ap.add_argument("--requests", type=int, default=6, help="每个客户端发的请求数")
+    ap.add_argument("--mix", choices=("both", "chat", "tts"), default="both")
+    ap.add_argument("--only", choices=("both", "old", "new"), default="both")
+    ap.add_argument("--url", default=None, help="压已经在跑的网关（不起替身）")
+    ap.add_argument("--timeout", type=float, default=120.0)
+    ap.add_argument("--llama-slots", type=int, default=4)
+    ap.add_argument("--llama-tps", type=float, default=50.0)
+    ap.add_argument("--llama-tokens", type=int, default=40)
+    ap.add_argument("--piper-rtf", type=float, default=0.3)
+    ap.add_argument("--piper-load-ms", type=float, default=150.0)
+    ap.add_argument("--tts-workers", type=int, default=4)
+    ap.add_argument("--json", default=None, help="原始结果写到这个文件")
+    ap.add_argument("--keep", action="store_true", help="保留临时目录（各服务日志）")
+    ap.add_argument("--serve-legacy", action="store_true", help=argparse.SUPPRESS)
+    ap.add_argument("--port", type=int, default=0, help=argparse.SUPPRESS)
+    args = ap.parse_args()
+    if args.serve_legacy:
+        import uvicorn
+        uvicorn.run(create_legacy_app(), host="127.0.0.1", port=args.port, log_level="warning")
+        return
+    sys.exit(asyncio.run(main_async(args)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""
+长期记忆索引：10 万 / 100 万向量下的召回延迟、索引内存与 IVF 召回率
+
+在仓库根目录：
+  python -m backend.test.bench_memory --sizes 100000 1000000 --dim 256
+
+向量是合成的（簇心 + 噪声，归一化，模拟同一会话里话题扎堆的分布），只测索引本身；
+另外单独测一下哈希向量化的吞吐。对每个规模：
+- flat：同一个分区不建 IVF，整块矩阵乘；
+- ivf：MEMORY_IVF_MIN 以上时的实际路径（簇数 = sqrt(n)，nprobe = --nprobe）；
+- recall@k：ivf 的 top-k 与 flat 精确结果的重合比例；
+- 保存 / mmap 加载耗时。
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+import numpy as np
+
+from backend.common.stats import percentiles
+from backend.llm.memory import HashEmbedder, MemoryIndex, Partition, _normalize
+
+
+def synth(n: int, dim: int, topics: int, seed: int = 0) -> np.ndarray:
+    """每条 = 话题中心 + 噪声（噪声范数约为中心的一半）"""
+    rng = np.random.default_rng(seed)
+    noise = np.float32(0.5 / np.sqrt(dim))
+    centers = _normalize(rng.standard_normal((topics, dim)).astype(np.float32))
+    out = np.empty((n, dim), dtype=np.float32)
+    for i in range(0, n, 100_000):
+        m = min(100_000, n - i)
+        x = centers[rng.integers(0, topics, m)] + noise * rng.standard_normal((m, dim)).astype(np.float32)
+        out[i:i + m] = _normalize(x)
+    return out
+
+
+def lat(fn, reps: int):
+    out = []
+    for _ in range(reps):
+        t0 = time.perf_counter()
+        fn()
+        out.append((time.perf_counter() - t0) * 1000.0)
+    return percentiles(out, (50, 99))
+
+
+def bench_embed(n: int = 20000):
+    words = ["今天", "天气", "不错", "我们", "去公园", "散步", "晚饭", "吃什么", "帮我", "查一下", "明天", "的会议"]
+    rng = random.Random(0)
+    texts = ["".join(rng.choice(words) for _ in range(rng.randint(3, 12))) for _ in range(n)]
+    emb = HashEmbedder()
+    t0 = time.perf_counter()
+    for i in range(0, n, 2000):
+        emb.embed(texts[i:i + 2000])
+    dt = time.perf_counter() - t0
+    p = lat(lambda: emb.embed([texts[0]]), 200)
+    print(f"哈希向量化: {n / dt:.0f} 条/s（批 2000），单条查询 p50={p['p50']}ms")
+
+
+def bench_size(n: int, args):
+    print(f"\n== {n} 向量, dim={args.dim} ==")
+    x = synth(n, args.dim, topics=max(64, n // 500))
+    # 查询 = 某条已有消息的“换个说法”
+    q = x[np.random.default_rng(1).choice(n, args.queries, replace=False)]
+    q = _normalize(q + np.float32(0.3 / np.sqrt(args.dim)) * np.random.default_rng(2).standard_normal(q.shape).astype(np.float32))
+
+    part = Partition(args.dim)
+    part.add(x, np.arange(n, dtype=np.int64))
+    del x
+    flat_p1 = lat(lambda: part.search(q[:1], args.k), args.reps)
+    flat_b = lat(lambda: part.search(q[:args.batch], args.k), max(3, args.reps // 10))
+    exact = [set(r.tolist()) for _, r in part.search(q, args.k)]
+    print(f"flat  内存={part.nbytes() / 2**20:7.1f}MB  单查询 p50={flat_p1['p50']}ms p99={flat_p1['p99']}ms  "
+          f"批 {args.batch} p50={flat_b['p50']}ms（每条 {flat_b['p50'] / args.batch:.2f}ms）")
+
+    t0 = time.perf_counter()
+    part.apply_ivf(part.build_ivf())
+    build = time.perf_counter() - t0
+    ivf_p1 = lat(lambda: part.search(q[:1], args.k, args.nprobe), args.reps)
+    ivf_b = lat(lambda: part.search(q[:args.batch], args.k, args.nprobe), max(3, args.reps // 10))
+    got = [set(r.tolist()) for _, r in part.search(q, args.k, args.nprobe)]
+    recall = np.mean([len(a & b) / len(a) for a, b in zip(exact, got)])
+    print(f"ivf   内存={part.nbytes() / 2**20:7.1f}MB  单查询 p50={ivf_p1['p50']}ms p99={ivf_p1['p99']}ms  "
+          f"批 {args.batch} p50={ivf_b['p50']}ms（每条 {ivf_b['p50'] / args.batch:.2f}ms）  "
+          f"nlist={len(part.centroids)} nprobe={args.nprobe} recall@{args.k}={recall:.3f}  建索引 {build:.1f}s")
+
+    # 存盘 / 加载（加载是 mmap，不读全量数据）
+    idx = MemoryIndex(db_path=os.devnull, directory=tempfile.mkdtemp(prefix="bench_mem_"), embedder=HashEmbedder(args.dim))
+    idx.parts["s"] = part
+    idx.dirty = True
+    t0 = time.perf_counter()
+    idx.save()
+    save = time.perf_counter() - t0
+    idx2 = MemoryIndex(db_path=os.devnull, directory=idx.dir, embedder=HashEmbedder(args.dim))
+    t0 = time.perf_counter()
+    idx2.load()
+    load = time.perf_counter() - t0
+    p2 = idx2.parts["s"]
+    cold = lat(lambda: p2.search(q[:1], args.k, args.nprobe), 1)
+    warm = lat(lambda: p2.search(q[:1], args.k, args.nprobe), args.reps)
+    print(f"持久化 保存 {save:.2f}s  加载（mmap）{load * 1000:.1f}ms  首查询 {cold['p50']}ms  之后 p50={warm['p50']}ms")
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--sizes", type=int, nargs="+", default=[100_000, 1_000_000])
+    ap.add_argument("--dim", type=int, default=256)
+    ap.add_argument("--k", type=int, default=4)
+    ap.add_argument("--nprobe", type=int, default=32)
+    ap.add_argument("--batch", type=int, default=32)
+    ap.add_argument("--queries", type=int, default=200)
+    ap.add_argument("--reps", type=int, default=50)
+    args = ap.parse_args()
+    bench_embed()
+    for n in args.sizes:
+        bench_size(n, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+Piper 合成延迟对比：按请求起进程（原 tts_server 做法：临时目录 + wav 文件） vs 常驻合成池
+
+在仓库根目录：
+  python -m backend.test.bench_piper_pool --model /path/zh_CN-huayan-medium.onnx --runs 10
+
+需要 piper 可执行程序（对比基线）与 `pip install piper-tts`（常驻池）。
+"""
+import argparse
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+from backend.common.stats import percentiles
+from backend.tts.piper_pool import PIPER_BIN, PiperPool
+
+SHORT = "俺老孙来也！"
+LONG = ("话说那花果山上有一块仙石，受天真地秀、日精月华，感之既久，遂有灵通之意。"
+        "一日迸裂，产一石卵，见风化作一个石猴，五官俱备，四肢皆全。"
+        "那猴在山中，却会行走跳跃，食草木，饮涧泉，采山花，觅树果。")
+
+
+def spawn_per_request(model: str, config: str, text: str) -> bytes:
+    with tempfile.TemporaryDirectory() as td:
+        out_wav = Path(td) / "out.wav"
+        cmd = [PIPER_BIN, "--model", model, "--config", config, "--output_file", str(out_wav)]
+        subprocess.run(cmd, input=text.encode("utf-8"), capture_output=True, check=True)
+        return out_wav.read_bytes()
+
+
+def bench(name: str, fn, runs: int):
+    for label, text in (("short", SHORT), ("long", LONG)):
+        samples = []
+        for _ in range(runs):
+            t0 = time.perf_counter()
+            fn(text)
+            samples.append((time.perf_counter() - t0) * 1000.0)
+        p = percentiles(samples)
+        print(f"{name:<10} {label:<6} chars={len(text):<4} "
+              f"p50={p['p50']:.1f}ms p95={p['p95']:.1f}ms p99={p['p99']:.1f}ms")
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--model", required=True)
+    ap.add_argument("--config", default=None, help="默认 <model>.json")
+    ap.add_argument("--runs", type=int, default=10)
+    ap.add_argument("--pool-size", type=int, default=1)
+    ap.add_argument("--threads", type=int, default=0, help="intra-op 线程数，0 = 自动")
+    args = ap.parse_args()
+    config = args.config or args.model + ".json"
+
+    bench("spawn", lambda t: spawn_per_request(args.model, config, t), args.runs)
+
+    cli = PiperPool(backend="cli")
+    bench("cli-raw", lambda t: cli.synthesize_wav(args.model, config, t), args.runs)
+
+    pool = PiperPool(size=args.pool_size, intra_op_threads=args.threads, backend="inproc")
+    t0 = time.perf_counter()
+    pool.warm([(args.model, config)])
+    print(f"inproc 预加载 {(time.perf_counter() - t0) * 1000.0:.0f}ms "
+          f"(size={pool.size}, intra_op_threads={pool.intra_op_threads})")
+    bench("inproc", lambda t: pool.synthesize_wav(args.model, config, t), args.runs)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""
+长回复分段并行合成 vs 串行整段合成：按回复长度（句数）给出耗时与加速比
+
+在仓库根目录：
+  python -m backend.test.bench_tts_segments --model /path/zh_CN-huayan-medium.onnx --workers 4
+"""
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from backend.tts.piper_pool import PiperPool
+from backend.tts.segment import join_pcm, segment_text
+
+SENTENCES = [
+    "话说那花果山上有一块仙石，受天真地秀、日精月华，感之既久，遂有灵通之意。",
+    "一日迸裂，产一石卵，见风化作一个石猴。",
+    "那猴在山中，却会行走跳跃，食草木，饮涧泉，采山花，觅树果。",
+    "与狼虫为伴，虎豹为群，獐鹿为友，猕猿为亲。",
+]
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--model", required=True)
+    ap.add_argument("--config", default=None, help="默认 <model>.json")
+    ap.add_argument("--workers", type=int, default=4)
+    ap.add_argument("--runs", type=int, default=3)
+    ap.add_argument("--lengths", type=int, nargs="+", default=[1, 2, 4, 8, 16], help="回复句数")
+    args = ap.parse_args()
+    config = args.config or args.model + ".json"
+
+    pool = PiperPool(size=args.workers)
+    pool.warm([(args.model, config)])
+    ex = ThreadPoolExecutor(args.workers)
+    print(f"backend={pool.backend} workers={args.workers} intra_op_threads={pool.intra_op_threads}")
+
+    for n in args.lengths:
+        text = "".join(SENTENCES[i % len(SENTENCES)] for i in range(n))
+        segments = segment_text(text)
+        serial, parallel = [], []
+        for _ in range(args.runs):
+            t0 = time.perf_counter()
+            pool.synthesize(args.model, config, text)
+            serial.append(time.perf_counter() - t0)
+
+            t0 = time.perf_counter()
+            results = list(ex.map(lambda seg: pool.synthesize(args.model, config, seg[0]), segments))
+            join_pcm([r[0] for r in results], [p for _, p in segments], results[0][1])
+            parallel.append(time.perf_counter() - t0)
+        s, p = min(serial), min(parallel)
+        print(f"sentences={n:<3} chars={len(text):<5} segments={len(segments):<3} "
+              f"serial={s * 1000:7.0f}ms parallel={p * 1000:7.0f}ms speedup={s / p:4.2f}x")
+
+
+if __name__ == "__main__":
+    main()
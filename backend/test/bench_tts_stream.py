@@ -0,0 +1,58 @@
+"""
+/tts 缓冲模式 vs 流式模式（stream=true）：同一段多句文本的首字节时间（TTFB）与总耗时
+
+在仓库根目录（TTS 服务已启动）：
+  python -m backend.test.bench_tts_stream --url http://127.0.0.1:8002 --runs 5
+"""
+import argparse
+import time
+import uuid
+
+import httpx
+
+from backend.common.stats import percentiles
+
+TEXT = ("话说那花果山上有一块仙石，受天真地秀、日精月华，感之既久，遂有灵通之意。"
+        "一日迸裂，产一石卵，见风化作一个石猴。"
+        "那猴在山中，却会行走跳跃，食草木，饮涧泉，采山花，觅树果。"
+        "与狼虫为伴，虎豹为群，獐鹿为友，猕猿为亲。")
+
+
+def once(client: httpx.Client, text: str, persona: str, stream: bool):
+    # 每次换一个不同的文本后缀，避免命中音频缓存
+    body = {"text": f"{text}{uuid.uuid4().hex[:6]}。", "persona": persona, "stream": stream}
+    t0 = time.perf_counter()
+    ttfb = None
+    n = 0
+    with client.stream("POST", "/tts", json=body) as r:
+        r.raise_for_status()
+        for chunk in r.iter_bytes():
+            if ttfb is None and chunk:
+                ttfb = (time.perf_counter() - t0) * 1000.0
+            n += len(chunk)
+    return ttfb, (time.perf_counter() - t0) * 1000.0, n
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--url", default="http://127.0.0.1:8002")
+    ap.add_argument("--persona", default="wukong")
+    ap.add_argument("--runs", type=int, default=5)
+    ap.add_argument("--text", default=TEXT)
+    args = ap.parse_args()
+
+    with httpx.Client(base_url=args.url, timeout=120) as client:
+        for stream in (False, True):
+            ttfbs, totals, size = [], [], 0
+            for _ in range(args.runs):
+                ttfb, total, size = once(client, args.text, args.persona, stream)
+                ttfbs.append(ttfb)
+                totals.append(total)
+            a, b = percentiles(ttfbs), percentiles(totals)
+            print(f"{'stream' if stream else 'buffered':<9} chars={len(args.text)} bytes={size} "
+                  f"ttfb p50={a['p50']:.0f}ms p95={a['p95']:.0f}ms | "
+                  f"total p50={b['p50']:.0f}ms p95={b['p95']:.0f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+多进程加载同一语音的内存对比：各进程各读一份 .onnx vs voice_store 的 mmap 共享权重
+
+在仓库根目录：
+  python -m backend.test.bench_voice_store --model /path/zh_CN-huayan-medium.onnx --procs 4 --sessions 2
+
+每个子进程建 --sessions 个 ONNX Runtime 会话（相当于 PIPER_POOL_SIZE）后上报自己的 rss / pss；
+pss 把共享页按进程数分摊，各进程 pss 之和就是这组进程实际占的物理内存。
+需要 `pip install onnx onnxruntime`。
+"""
+import argparse
+import multiprocessing as mp
+from pathlib import Path
+
+import numpy as np
+
+from backend.tts.voice_store import mapped_resident, process_memory, session_options, shared_model
+
+
+_DTYPES = {"tensor(float)": np.float32, "tensor(int64)": np.int64, "tensor(int32)": np.int32}
+
+
+def dummy_inputs(sess) -> dict:
+    """跑一次推理让权重页真正驻留（Piper 的输入按其约定构造，其它模型填 0）"""
+    feeds = {}
+    for i in sess.get_inputs():
+        if i.name == "input":
+            feeds[i.name] = np.ones((1, 16), dtype=np.int64)
+        elif i.name == "input_lengths":
+            feeds[i.name] = np.array([16], dtype=np.int64)
+        elif i.name == "scales":
+            feeds[i.name] = np.array([0.667, 1.0, 0.8], dtype=np.float32)
+        else:
+            shape = [d if isinstance(d, int) else 1 for d in i.shape]
+            feeds[i.name] = np.zeros(shape, dtype=_DTYPES.get(i.type, np.float32))
+    return feeds
+
+
+def worker(model: str, sessions: int, shared: bool, ready, go, out):
+    import onnxruntime
+    if shared:
+        opts = lambda: session_options(1)   # noqa: E731
+    else:
+        def opts():
+            o = onnxruntime.SessionOptions()
+            o.intra_op_num_threads = 1
+            return o
+    before = process_memory()
+    keep = [onnxruntime.InferenceSession(model, sess_options=opts(), providers=["CPUExecutionProvider"])
+            for _ in range(sessions)]
+    for sess in keep:
+        sess.run(None, dummy_inputs(sess))
+    ready.set()
+    go.wait()       # 所有进程都加载完再量，pss 才是按最终共享数分摊的
+    after = process_memory()
+    mapped = mapped_resident([model + ".data"])[str(Path(model + ".data").resolve())]
+    out.put({"rss": after["rss"] - before["rss"], "pss": after.get("pss", 0) - before.get("pss", 0),
+             "mapped_pss": mapped["pss"]})
+    del keep
+
+
+def run(label: str, model: str, procs: int, sessions: int, shared: bool):
+    ctx = mp.get_context("spawn")
+    out, go = ctx.Queue(), ctx.Event()
+    readies = [ctx.Event() for _ in range(procs)]
+    ps = [ctx.Process(target=worker, args=(model, sessions, shared, r, go, out)) for r in readies]
+    for p in ps:
+        p.start()
+    for r in readies:
+        r.wait()
+    go.set()
+    res = [out.get() for _ in ps]
+    for p in ps:
+        p.join()
+    mb = 1024 * 1024
+    print(f"{label:<8} procs={procs} sessions={sessions}  "
+          f"rss/proc={sum(r['rss'] for r in res) / procs / mb:7.1f}MB  "
+          f"pss total={sum(r['pss'] for r in res) / mb:7.1f}MB  "
+          f"(mapped weights pss/proc={sum(r['mapped_pss'] for r in res) / procs / mb:.1f}MB)")
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--model", required=True)
+    ap.add_argument("--procs", type=int, default=4)
+    ap.add_argument("--sessions", type=int, default=2)
+    args = ap.parse_args()
+
+    run("private", args.model, args.procs, args.sessions, shared=False)
+    shared = shared_model(args.model)
+    if shared is None:
+        print("shared   跳过：需要 `pip install onnx`（或 VOICE_SHARED_WEIGHTS=0）")
+        return
+    run("shared", shared, args.procs, args.sessions, shared=True)
+
+
+if __name__ == "__main__":
+    main()
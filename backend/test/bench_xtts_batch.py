@@ -0,0 +1,68 @@
+"""
+XTTS 服务吞吐：并发 1 / 4 / 16 下的 句/秒 与单句延迟，以及调度排队等待（来自 /stats）
+
+在仓库根目录（tts_xtts_server 已启动）：
+  python -m backend.test.bench_xtts_batch --url http://127.0.0.1:8002 --sentences 32
+"""
+import argparse
+import asyncio
+import json
+import time
+import uuid
+
+import httpx
+
+from backend.common.stats import percentiles
+
+SENTENCES = [
+    "俺老孙来也！", "这花果山的桃子可甜了。", "师父，前面有妖怪！", "吃俺老孙一棒！",
+    "I solemnly swear that I am up to no good.", "Let me think about that.",
+    "Jarvis, run the diagnostics.", "Sometimes you gotta run before you can walk.",
+]
+
+
+async def run(url: str, persona: str, concurrency: int, n: int):
+    sem = asyncio.Semaphore(concurrency)
+    lat = []
+    failed = 0
+
+    async with httpx.AsyncClient(base_url=url, timeout=300) as client:
+        async def one(i: int):
+            nonlocal failed
+            # 加随机后缀避开音频缓存
+            text = f"{SENTENCES[i % len(SENTENCES)]} {uuid.uuid4().hex[:4]}"
+            async with sem:
+                t0 = time.perf_counter()
+                r = await client.post("/tts", json={"text": text, "persona": persona})
+                if r.status_code != 200:
+                    failed += 1
+                    return
+                lat.append((time.perf_counter() - t0) * 1000.0)
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(n)))
+        wall = time.perf_counter() - t0
+        stats = (await client.get("/stats")).json()
+
+    p = percentiles(lat)
+    print(f"concurrency={concurrency:<3} ok={len(lat)} failed={failed} "
+          f"throughput={len(lat) / wall:.2f} sent/s  latency p50={p.get('p50', 0):.0f}ms p99={p.get('p99', 0):.0f}ms")
+    return stats
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--url", default="http://127.0.0.1:8002")
+    ap.add_argument("--persona", default="wukong")
+    ap.add_argument("--sentences", type=int, default=32)
+    ap.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    args = ap.parse_args()
+
+    stats = {}
+    for c in args.concurrency:
+        stats = asyncio.run(run(args.url, args.persona, c, args.sentences))
+    print("queue:", json.dumps(stats.get("personas", {}).get(args.persona), ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
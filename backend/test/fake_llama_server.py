@@ -0,0 +1,230 @@
+"""
+llama-server 替身：不加载模型，按设定的 prefill / 出字速度回一段固定台词（压测用，纯 CPU、无 GPU）
+
+在仓库根目录：
+  python -m backend.test.fake_llama_server --port 8080 --prefill-tps 400 --tps 25 --slots 4
+  LLAMA_BASE=http://127.0.0.1:8080 uvicorn backend.llm.llm_app:app --port 8001
+
+接口与 llama-server 一致（llm_app 用到的部分）：
+- POST /v1/chat/completions：stream=true 时 SSE（`data: {"choices":[{"delta":{"content":...}}]}` … `data: [DONE]`），
+  否则一次性返回 choices[0].message.content；--no-openai 时返回 404，用来走 llm_app 的 /completion 回退；
+- POST /completion：stream=true 时 SSE（`data: {"content":...,"stop":false}` … `"stop":true`），否则 {"content":...}；
+- GET /health、GET /stats（请求数、排队 / 占用槽位、出字数、断开数）。
+
+耗时模型：
+- 槽位：--slots 个（同 llama-server --parallel），占满后新请求排队；
+- prefill：提示 token 数 / --prefill-tps（中文按字、其余按 4 字符一个 token 估）；
+- decode：每个 token 1 / --tps 秒；同时在出字的槽位每多一个，单步慢 --batch-penalty（批量解码的分摊）；
+- 客户端断开（打断）时立刻释放槽位，与真 llama-server 一致。
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+from contextlib import aclosing
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# ============ 配置（命令行参数优先） ============
+FAKE_LLAMA_PREFILL_TPS = float(os.getenv("FAKE_LLAMA_PREFILL_TPS", "400"))
+FAKE_LLAMA_TPS = float(os.getenv("FAKE_LLAMA_TPS", "25"))
+FAKE_LLAMA_SLOTS = int(os.getenv("FAKE_LLAMA_SLOTS", "4"))
+FAKE_LLAMA_TOKENS = int(os.getenv("FAKE_LLAMA_TOKENS", "60"))            # 每次回复的 token 数（再受 max_tokens 限制）
+FAKE_LLAMA_BATCH_PENALTY = float(os.getenv("FAKE_LLAMA_BATCH_PENALTY", "0.15"))
+FAKE_LLAMA_ERROR_RATE = float(os.getenv("FAKE_LLAMA_ERROR_RATE", "0"))   # 按比例直接回 500
+FAKE_LLAMA_NO_OPENAI = os.getenv("FAKE_LLAMA_NO_OPENAI", "0") == "1"
+MODEL_NAME = "fake-llama"
+
+# 按句号切成句的台词；按最后一条用户消息的哈希选起点，同一输入回同一段
+LINES = [
+    "俺老孙来也！", "这事包在俺身上。", "你先别急，听我慢慢说。", "今天天气不错，适合出门走走。",
+    "要我说，先把最要紧的事办了，剩下的再一件件来。", "这个问题嘛，答案其实很简单。",
+    "想当年在花果山，俺也遇到过差不多的难题，", "后来还是靠一个筋斗云解决的。",
+    "记得多喝水，别熬夜。", "还有什么想问的，尽管说！", "先说结论：可以做，而且不难。",
+    "第一步，把需求写清楚；第二步，挑一个最小的版本先跑起来。", "魔法也好，科技也罢，关键是动手试一试。",
+]
+_CJK = re.compile(r"[　-〿一-鿿＀-￯]")
+
+
+def count_tokens(text: str) -> int:
+    cjk = len(_CJK.findall(text))
+    return cjk + max(0, len(text) - cjk) // 4
+
+
+def split_tokens(text: str):
+    """中文一两个字一个 token，其余按词"""
+    out, i = [], 0
+    while i < len(text):
+        if _CJK.match(text[i]):
+            n = 1 + (ord(text[i]) & 1)
+            out.append(text[i:i + n])
+            i += n
+        else:
+            j = i + 1
+            while j < len(text) and not _CJK.match(text[j]) and not text[j].isspace():
+                j += 1
+            while j < len(text) and text[j].isspace():
+                j += 1
+            out.append(text[i:j])
+            i = j
+    return out
+
+
+def reply_tokens(prompt_key: str, n: int):
+    start = int(hashlib.md5(prompt_key.encode("utf-8")).hexdigest(), 16) % len(LINES)
+    toks = []
+    k = start
+    while len(toks) < n:
+        toks.extend(split_tokens(LINES[k % len(LINES)]))
+        k += 1
+    return toks[:n]
+
+
+class FakeLlama:
+    def __init__(self, prefill_tps: float = FAKE_LLAMA_PREFILL_TPS, tps: float = FAKE_LLAMA_TPS,
+                 slots: int = FAKE_LLAMA_SLOTS, tokens: int = FAKE_LLAMA_TOKENS,
+                 batch_penalty: float = FAKE_LLAMA_BATCH_PENALTY, error_rate: float = FAKE_LLAMA_ERROR_RATE,
+                 no_openai: bool = FAKE_LLAMA_NO_OPENAI):
+        self.prefill_tps = prefill_tps
+        self.tps = tps
+        self.slots = asyncio.Semaphore(slots)
+        self.n_slots = slots
+        self.tokens = tokens
+        self.batch_penalty = batch_penalty
+        self.error_rate = error_rate
+        self.no_openai = no_openai
+        self.decoding = 0
+        self.queued = 0
+        self.counters = {"requests": 0, "completed": 0, "disconnected": 0, "errors": 0,
+                         "prompt_tokens": 0, "tokens": 0}
+
+    async def generate(self, prompt: str, key: str, max_tokens: int):
+        """排队拿槽位 → prefill → 逐 token 产出；生成器被关闭（客户端断开）即释放槽位"""
+        self.counters["requests"] += 1
+        self.queued += 1
+        try:
+            await self.slots.acquire()
+        finally:
+            self.queued -= 1
+        done = False
+        try:
+            n_prompt = count_tokens(prompt)
+            self.counters["prompt_tokens"] += n_prompt
+            await asyncio.sleep(n_prompt / self.prefill_tps)
+            self.decoding += 1
+            try:
+                for tok in reply_tokens(key, min(self.tokens, max_tokens or self.tokens)):
+                    await asyncio.sleep((1.0 + self.batch_penalty * (self.decoding - 1)) / self.tps)
+                    self.counters["tokens"] += 1
+                    yield tok
+            finally:
+                self.decoding -= 1
+            done = True
+        finally:
+            self.slots.release()
+            self.counters["completed" if done else "disconnected"] += 1
+
+    def fail(self) -> bool:
+        if self.error_rate > 0 and random.random() < self.error_rate:
+            self.counters["errors"] += 1
+            return True
+        return False
+
+    def summary(self) -> dict:
+        return {**self.counters, "slots": self.n_slots, "decoding": self.decoding, "queued": self.queued,
+                "prefill_tps": self.prefill_tps, "tps": self.tps}
+
+
+async def _collect(gen) -> str:
+    async with aclosing(gen):   # 请求中途被取消 / 客户端断开时立即还槽位，不等垃圾回收
+        return "".join([t async for t in gen])
+
+
+def _messages_prompt(messages) -> str:
+    return "\n".join(f"{m.get('role')}: {m.get('content')}" for m in messages)
+
+
+def _last_user(messages) -> str:
+    return next((m.get("content") or "" for m in reversed(messages) if m.get("role") == "user"), "")
+
+
+def create_app(llama: FakeLlama) -> FastAPI:
+    app = FastAPI(title="fake llama-server")
+
+    @app.get("/health")
+    async def health():
+        return {"status": "ok"}
+
+    @app.get("/stats")
+    async def stats():
+        return llama.summary()
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        if llama.no_openai:
+            return JSONResponse({"error": "not found"}, status_code=404)
+        body = await request.json()
+        if llama.fail():
+            return JSONResponse({"error": "injected"}, status_code=500)
+        messages = body.get("messages") or []
+        gen = llama.generate(_messages_prompt(messages), _last_user(messages), body.get("max_tokens") or 0)
+        if not body.get("stream"):
+            text = await _collect(gen)
+            return {"model": MODEL_NAME, "choices": [{"index": 0, "message": {"role": "assistant", "content": text},
+                                                      "finish_reason": "stop"}]}
+
+        async def sse():
+            async with aclosing(gen):
+                async for tok in gen:
+                    yield "data: " + json.dumps({"model": MODEL_NAME,
+                                                 "choices": [{"index": 0, "delta": {"content": tok}}]},
+                                                ensure_ascii=False) + "\n\n"
+            yield "data: " + json.dumps({"choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}) + "\n\n"
+            yield "data: [DONE]\n\n"
+        return StreamingResponse(sse(), media_type="text/event-stream")
+
+    @app.post("/completion")
+    async def completion(request: Request):
+        body = await request.json()
+        if llama.fail():
+            return JSONResponse({"error": "injected"}, status_code=500)
+        prompt = body.get("prompt") or ""
+        key = prompt.rsplit("User: ", 1)[-1].split("Assistant:", 1)[0]
+        gen = llama.generate(prompt, key, body.get("n_predict") or 0)
+        if not body.get("stream"):
+            return {"content": await _collect(gen), "stop": True}
+
+        async def sse():
+            async with aclosing(gen):
+                async for tok in gen:
+                    yield "data: " + json.dumps({"content": tok, "stop": False}, ensure_ascii=False) + "\n\n"
+            yield "data: " + json.dumps({"content": "", "stop": True}) + "\n\n"
+        return StreamingResponse(sse(), media_type="text/event-stream")
+
+    return app
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8080)
+    ap.add_argument("--prefill-tps", type=float, default=FAKE_LLAMA_PREFILL_TPS, help="prefill 速度，token/s")
+    ap.add_argument("--tps", type=float, default=FAKE_LLAMA_TPS, help="单槽出字速度，token/s")
+    ap.add_argument("--slots", type=int, default=FAKE_LLAMA_SLOTS)
+    ap.add_argument("--tokens", type=int, default=FAKE_LLAMA_TOKENS)
+    ap.add_argument("--batch-penalty", type=float, default=FAKE_LLAMA_BATCH_PENALTY)
+    ap.add_argument("--error-rate", type=float, default=FAKE_LLAMA_ERROR_RATE)
+    ap.add_argument("--no-openai", action="store_true", default=FAKE_LLAMA_NO_OPENAI)
+    args = ap.parse_args()
+    llama = FakeLlama(args.prefill_tps, args.tps, args.slots, args.tokens, args.batch_penalty, args.error_rate,
+                      args.no_openai)
+    uvicorn.run(create_app(llama), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
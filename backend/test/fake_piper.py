@@ -0,0 +1,91 @@
+"""
+piper 可执行程序替身：不跑 ONNX，按设定的实时率（RTF）睡够时间后输出等长的 PCM（压测用，纯 CPU）
+
+参数与 piper CLI 一致（piper_pool.py 的 cli 后端用到的部分）：
+  echo "俺老孙来也！" | python -m backend.test.fake_piper --model x.onnx --config x.onnx.json --output_raw > out.pcm
+  --output_file out.wav 时写 wav 文件；--length_scale 按比例拉长音频时长；--speaker 忽略。
+
+PIPER_BIN 只能是单个可执行文件，压测脚本会生成一个 `exec python -m backend.test.fake_piper "$@"` 的包装脚本。
+
+耗时模型（环境变量）：
+- FAKE_PIPER_LOAD_MS：进程启动后“加载模型”的时间（真 piper CLI 每次都要加载，默认 150ms）；
+- FAKE_PIPER_RTF：合成耗时 / 音频时长（默认 0.3）；音频时长按中文 0.22s/字、其余 0.06s/字符估；
+- FAKE_PIPER_CPU=1：合成期间空转占满一个核，而不是 sleep（看 CPU 争用时的表现）；
+- FAKE_PIPER_FAIL_RATE：按比例以非 0 退出码失败。
+"""
+import argparse
+import json
+import math
+import os
+import random
+import re
+import struct
+import sys
+import time
+
+FAKE_PIPER_LOAD_MS = float(os.getenv("FAKE_PIPER_LOAD_MS", "150"))
+FAKE_PIPER_RTF = float(os.getenv("FAKE_PIPER_RTF", "0.3"))
+FAKE_PIPER_CPU = os.getenv("FAKE_PIPER_CPU", "0") == "1"
+FAKE_PIPER_FAIL_RATE = float(os.getenv("FAKE_PIPER_FAIL_RATE", "0"))
+_CJK = re.compile(r"[一-鿿]")
+
+
+def audio_seconds(text: str, length_scale: float = 1.0) -> float:
+    cjk = len(_CJK.findall(text))
+    return (0.22 * cjk + 0.06 * (len(text.strip()) - cjk)) * length_scale
+
+
+def spend(seconds: float):
+    if not FAKE_PIPER_CPU:
+        time.sleep(seconds)
+        return
+    end = time.perf_counter() + seconds
+    x = 0
+    while time.perf_counter() < end:
+        x += 1
+
+
+def pcm(seconds: float, sample_rate: int) -> bytes:
+    n = int(seconds * sample_rate)
+    step = 2 * math.pi * 220.0 / sample_rate
+    return struct.pack(f"<{n}h", *(int(3000 * math.sin(i * step)) for i in range(n)))
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--model", "-m", required=True)
+    ap.add_argument("--config", "-c", default=None)
+    ap.add_argument("--output_raw", action="store_true")
+    ap.add_argument("--output_file", "-f", default=None)
+    ap.add_argument("--length_scale", type=float, default=1.0)
+    ap.add_argument("--speaker", default=None)
+    args, _ = ap.parse_known_args()
+
+    sample_rate = 22050
+    try:
+        with open(args.config or args.model + ".json", "r", encoding="utf-8") as f:
+            sample_rate = int(json.load(f).get("audio", {}).get("sample_rate", sample_rate))
+    except (OSError, ValueError) as e:
+        print(f"Unable to load config: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    spend(FAKE_PIPER_LOAD_MS / 1000.0)
+    text = sys.stdin.read()
+    if FAKE_PIPER_FAIL_RATE > 0 and random.random() < FAKE_PIPER_FAIL_RATE:
+        print("injected failure", file=sys.stderr)
+        sys.exit(2)
+    seconds = audio_seconds(text, args.length_scale)
+    spend(seconds * FAKE_PIPER_RTF)
+    data = pcm(seconds, sample_rate)
+
+    if args.output_file:
+        from backend.tts.codecs import pcm_to_wav
+        with open(args.output_file, "wb") as f:
+            f.write(pcm_to_wav(data, sample_rate))
+    else:
+        sys.stdout.buffer.write(data)
+        sys.stdout.buffer.flush()
+
+
+if __name__ == "__main__":
+    main()
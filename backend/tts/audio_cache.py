@@ -0,0 +1,260 @@
+"""
+TTS 音频缓存（内容寻址，所有 TTS 后端共用）
+
+人设开场白、问候语、常见短回复每次都重新合成，白白占用合成算力。这里按
+(后端, 人设/语音模型, length_scale, speaker_id, 语言, 归一化文本) 的哈希缓存合成结果：
+
+- 热层：进程内 LRU，按字节预算淘汰（TTS_CACHE_HOT_MB）；
+- 盘层：TTS_CACHE_DIR 下按哈希存放的原始音频文件（wav/mp3，原样保存），命中时用 mmap
+  映射后按块以 memoryview 输出，不读成 Python bytes；按字节预算淘汰（TTS_CACHE_DISK_MB）。
+
+部署时预热各人设开场白（TTS 服务需已启动，未命中会现场合成并写入缓存）：
+  python -m backend.tts.audio_cache warm --url http://127.0.0.1:8002
+  python -m backend.tts.audio_cache stats --url http://127.0.0.1:8002
+"""
+import hashlib
+import json
+import mmap
+import os
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Iterator, Optional
+
+from fastapi.responses import Response, StreamingResponse
+
+TTS_CACHE_DIR = Path(os.getenv("TTS_CACHE_DIR", str(Path(__file__).resolve().parents[1] / "data" / "tts_cache")))
+TTS_CACHE_HOT_MB = float(os.getenv("TTS_CACHE_HOT_MB", "64"))
+TTS_CACHE_DISK_MB = float(os.getenv("TTS_CACHE_DISK_MB", "512"))
+TTS_CACHE_ENABLED = os.getenv("TTS_CACHE", "1") != "0"
+
+_CHUNK = 64 * 1024
+
+# 各人设开场白与常见短回复（与前端 index_v3.html 的 greeting 保持一致）
+OPENER_TEXTS: Dict[str, list] = {
+    "wukong": ["俺老孙来也！有啥难题尽管说，保你一个跟斗云就到~", "好嘞！", "没问题，包在俺老孙身上！"],
+    "harry": ["你好！魔法世界的大门已经打开，我们从第一个问题开始吧。", "Of course.", "Good question!"],
+    "ironman": ["Jarvis…哦不，是我。说吧，要造点什么？", "Sure.", "Done."],
+}
+
+
+def cache_key(backend: str, voice: str, text: str, **params) -> str:
+    """
+    文本只做 NFKC + 空白折叠（标点会影响韵律，不能去掉）；
+    params 为影响音色/语速的参数（length_scale、speaker_id、language、rate…），None 视为未指定
+    """
+    norm = re.sub(r"\s+", " ", unicodedata.normalize("NFKC", text)).strip()
+    payload = {"b": backend, "v": voice, "t": norm, "p": {k: v for k, v in sorted(params.items()) if v is not None}}
+    return hashlib.sha256(json.dumps(payload, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def _stream_mmap(path: Path) -> Iterator[memoryview]:
+    with open(path, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    mv = memoryview(mm)
+    try:
+        for i in range(0, len(mv), _CHUNK):
+            yield mv[i:i + _CHUNK]
+    finally:
+        mv.release()
+        try:
+            mm.close()
+        except BufferError:
+            pass    # 还有切片被发送端引用，交给 GC 回收
+
+
+class AudioCache:
+    def __init__(
+        self,
+        root: Path = TTS_CACHE_DIR,
+        hot_bytes: int = int(TTS_CACHE_HOT_MB * 1024 * 1024),
+        disk_bytes: int = int(TTS_CACHE_DISK_MB * 1024 * 1024),
+        enabled: bool = TTS_CACHE_ENABLED,
+    ):
+        self.root = Path(root)
+        self.hot_budget = hot_bytes
+        self.disk_budget = disk_bytes
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._hot: "OrderedDict[str, bytes]" = OrderedDict()
+        self._hot_size = 0
+        self._disk: "OrderedDict[str, int]" = OrderedDict()    # key -> 字节数，LRU 顺序
+        self._disk_size = 0
+        self.counters = {"hit_hot": 0, "hit_disk": 0, "miss": 0, "put": 0,
+                         "bytes_hot": 0, "bytes_disk": 0, "evicted_hot": 0, "evicted_disk": 0}
+        if self.enabled:
+            self._load_index()
+
+    # ------------------ 盘层索引 ------------------
+    def _path(self, key: str) -> Path:
+        return self.root / key[:2] / key
+
+    def _load_index(self):
+        """启动时按修改时间重建 LRU 顺序（旧的先淘汰）"""
+        entries = []
+        if self.root.exists():
+            for sub in self.root.iterdir():
+                if not sub.is_dir():
+                    continue
+                for f in sub.iterdir():
+                    if f.is_file() and not f.name.endswith(".tmp"):
+                        st = f.stat()
+                        entries.append((st.st_mtime, f.name, st.st_size))
+        for _, key, size in sorted(entries):
+            self._disk[key] = size
+            self._disk_size += size
+
+    # ------------------ 读写 ------------------
+    def response(self, key: str, media_type: str = "audio/wav") -> Optional[Response]:
+        """命中则返回可直接交给 FastAPI 的响应（热层 bytes / 盘层 mmap 流），否则 None"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            data = self._hot.get(key)
+            if data is not None:
+                self._hot.move_to_end(key)
+                self.counters["hit_hot"] += 1
+                self.counters["bytes_hot"] += len(data)
+            else:
+                size = self._disk.get(key)
+                if size is not None:
+                    self._disk.move_to_end(key)
+        if data is not None:
+            return Response(content=data, media_type=media_type, headers={"X-Cache": "hot"})
+        if size is None:
+            with self._lock:
+                self.counters["miss"] += 1
+            return None
+
+        path = self._path(key)
+        if not path.exists():
+            # 其它进程淘汰了这个文件
+            with self._lock:
+                if self._disk.pop(key, None) is not None:
+                    self._disk_size -= size
+                self.counters["miss"] += 1
+            return None
+        with self._lock:
+            self.counters["hit_disk"] += 1
+            self.counters["bytes_disk"] += size
+        return StreamingResponse(_stream_mmap(path), media_type=media_type,
+                                 headers={"X-Cache": "disk", "Content-Length": str(size)})
+
+    def get(self, key: str) -> Optional[bytes]:
+        """命中则返回原始字节（转码输出用；直接返回原样音频时用 response 更省）"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            data = self._hot.get(key)
+            if data is not None:
+                self._hot.move_to_end(key)
+                self.counters["hit_hot"] += 1
+                self.counters["bytes_hot"] += len(data)
+                return data
+            size = self._disk.get(key)
+            if size is not None:
+                self._disk.move_to_end(key)
+        try:
+            data = self._path(key).read_bytes() if size is not None else None
+        except FileNotFoundError:
+            data = None
+            with self._lock:
+                if self._disk.pop(key, None) is not None:
+                    self._disk_size -= size
+        with self._lock:
+            if data is None:
+                self.counters["miss"] += 1
+            else:
+                self.counters["hit_disk"] += 1
+                self.counters["bytes_disk"] += len(data)
+        return data
+
+    def put(self, key: str, data: bytes):
+        if not self.enabled or not data:
+            return
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f"{key}.{threading.get_ident()}.tmp")
+        tmp.write_bytes(data)
+        os.replace(tmp, path)   # 原子替换，读者不会看到半个文件
+
+        evict = []
+        with self._lock:
+            self.counters["put"] += 1
+            if len(data) <= self.hot_budget // 4:    # 太大的不占热层
+                old = self._hot.pop(key, None)
+                self._hot_size -= len(old) if old is not None else 0
+                self._hot[key] = data
+                self._hot_size += len(data)
+                while self._hot_size > self.hot_budget and self._hot:
+                    _, v = self._hot.popitem(last=False)
+                    self._hot_size -= len(v)
+                    self.counters["evicted_hot"] += 1
+            self._disk_size -= self._disk.pop(key, 0)
+            self._disk[key] = len(data)
+            self._disk_size += len(data)
+            while self._disk_size > self.disk_budget and len(self._disk) > 1:
+                k, size = self._disk.popitem(last=False)
+                self._disk_size -= size
+                self.counters["evicted_disk"] += 1
+                evict.append(k)
+        for k in evict:
+            try:
+                self._path(k).unlink()
+            except FileNotFoundError:
+                pass
+
+    def summary(self) -> Dict[str, object]:
+        with self._lock:
+            c = dict(self.counters)
+            hot_entries, hot_size = len(self._hot), self._hot_size
+            disk_entries, disk_size = len(self._disk), self._disk_size
+        hits = c["hit_hot"] + c["hit_disk"]
+        total = hits + c["miss"]
+        return {
+            "enabled": self.enabled,
+            "hit_ratio": round(hits / total, 3) if total else None,
+            "bytes_served": c["bytes_hot"] + c["bytes_disk"],
+            **c,
+            "hot": {"entries": hot_entries, "bytes": hot_size, "budget": self.hot_budget},
+            "disk": {"entries": disk_entries, "bytes": disk_size, "budget": self.disk_budget, "dir": str(self.root)},
+        }
+
+
+# ====== 预热 CLI ======
+def _warm(url: str, personas: Optional[list]):
+    import time
+    import httpx
+
+    with httpx.Client(base_url=url.rstrip("/"), timeout=120) as client:
+        for persona, texts in OPENER_TEXTS.items():
+            if personas and persona not in personas:
+                continue
+            for text in texts:
+                t0 = time.perf_counter()
+                r = client.post("/tts", json={"text": text, "persona": persona})
+                ms = (time.perf_counter() - t0) * 1000.0
+                print(f"[{persona}] {r.status_code} {r.headers.get('X-Cache', 'miss'):<4} "
+                      f"{len(r.content):>7}B {ms:7.1f}ms  {text}")
+        print(json.dumps(client.get("/cache/stats").json(), ensure_ascii=False, indent=2))
+
+
+def main():
+    import argparse
+
+    ap = argparse.ArgumentParser(description="TTS 音频缓存：预热开场白 / 查看统计")
+    ap.add_argument("cmd", choices=["warm", "stats"])
+    ap.add_argument("--url", default=os.getenv("TTS_BASE", "http://127.0.0.1:8002"))
+    ap.add_argument("--persona", action="append", help="只预热指定人设，可重复")
+    args = ap.parse_args()
+    if args.cmd == "warm":
+        _warm(args.url, args.persona)
+    else:
+        import httpx
+        print(json.dumps(httpx.get(args.url.rstrip("/") + "/cache/stats").json(), ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,345 @@
+"""
+TTS 输出编码（tts_server.py / tts_xtts_server.py 共用）
+
+默认返回未压缩 wav（Piper 22.05kHz / XTTS 24kHz 16bit），一段回复几百 KB，弱网下的移动端吃不消。
+这里按请求字段 encoding（或 Accept 头）协商输出格式，可选服务端降采样（sample_rate）：
+
+  wav    16bit PCM wav（默认，流式时长度字段为 0xFFFFFFFF）
+  pcm    裸 s16le，格式由响应头 X-Sample-Rate / X-Channels 声明
+  mulaw  G.711 µ-law 8bit（查表向量化编码，放在 wav 容器里，格式码 7），体积减半
+  opus   Ogg Opus（需 `pip install av`，没装则不可用）
+
+所有编码器都是增量的：header() 先发，encode(chunk) 逐块编码，flush() 收尾，
+所以和流式响应可以直接组合。IMA ADPCM 的每个样本依赖上一步的预测状态，没法用 numpy 向量化，
+就不提供了；要更小的体积用 opus。
+"""
+import io
+import struct
+import threading
+import time
+import wave
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+try:
+    import av   # 可选：Opus 编码
+except ImportError:
+    av = None
+
+ENCODINGS = ("wav", "pcm", "mulaw", "opus")
+
+_ACCEPT = {
+    "audio/ogg": "opus", "audio/opus": "opus", "audio/webm": "opus",
+    "audio/basic": "mulaw", "audio/x-mulaw": "mulaw", "audio/pcmu": "mulaw",
+    "audio/pcm": "pcm", "audio/l16": "pcm", "application/octet-stream": "pcm",
+    "audio/wav": "wav", "audio/x-wav": "wav", "audio/wave": "wav",
+}
+
+
+def available() -> Tuple[str, ...]:
+    return tuple(e for e in ENCODINGS if e != "opus" or av is not None)
+
+
+def negotiate(encoding: Optional[str], accept: Optional[str]) -> str:
+    """
+    显式字段优先（不支持则 ValueError，由调用方转 400）；
+    否则按 Accept 头的 q 值挑第一个可用的；都没有就 wav
+    """
+    if encoding:
+        enc = encoding.strip().lower()
+        if enc not in available():
+            raise ValueError(f"unsupported encoding {enc!r}, available: {', '.join(available())}")
+        return enc
+    if accept:
+        prefs = []
+        for i, part in enumerate(accept.split(",")):
+            fields = [f.strip() for f in part.split(";")]
+            q = 1.0
+            for f in fields[1:]:
+                if f.startswith("q="):
+                    try:
+                        q = float(f[2:])
+                    except ValueError:
+                        q = 0.0
+            prefs.append((-q, i, fields[0].lower()))
+        for _, _, mime in sorted(prefs):
+            enc = _ACCEPT.get(mime)
+            if enc in available():
+                return enc
+    return "wav"
+
+
+# ====== wav 容器 ======
+def pcm_to_wav(pcm: bytes, sample_rate: int, channels: int = 1, sampwidth: int = 2) -> bytes:
+    """int16 PCM → 内存里的 wav 字节"""
+    buf = io.BytesIO()
+    with wave.open(buf, "wb") as w:
+        w.setnchannels(channels)
+        w.setsampwidth(sampwidth)
+        w.setframerate(sample_rate)
+        w.writeframes(pcm)
+    return buf.getvalue()
+
+
+def wav_to_pcm(data: bytes) -> Tuple[bytes, int]:
+    """16bit 单声道 wav → (PCM, 采样率)"""
+    with wave.open(io.BytesIO(data), "rb") as w:
+        return w.readframes(w.getnframes()), w.getframerate()
+
+
+def _wav_header(sample_rate: int, fmt_tag: int, sampwidth: int, channels: int = 1,
+                data_size: int = 0xFFFFFFFF) -> bytes:
+    block_align = channels * sampwidth
+    fmt = struct.pack("<HHIIHH", fmt_tag, channels, sample_rate, sample_rate * block_align, block_align,
+                      sampwidth * 8)
+    if fmt_tag != 1:
+        # 非 PCM 格式：fmt 带 cbSize，并附 fact 块（样本数，流式时未知）
+        fmt += struct.pack("<H", 0)
+        fact = b"fact" + struct.pack("<II", 4, 0xFFFFFFFF if data_size == 0xFFFFFFFF else data_size // block_align)
+    else:
+        fact = b""
+    riff = 0xFFFFFFFF if data_size == 0xFFFFFFFF else 4 + 8 + len(fmt) + len(fact) + 8 + data_size
+    return (b"RIFF" + struct.pack("<I", riff) + b"WAVE"
+            + b"fmt " + struct.pack("<I", len(fmt)) + fmt + fact
+            + b"data" + struct.pack("<I", data_size))
+
+
+def wav_stream_header(sample_rate: int, channels: int = 1, sampwidth: int = 2) -> bytes:
+    """
+    流式 wav 头：总长度未知，RIFF / data 长度填 0xFFFFFFFF，
+    播放端（浏览器、ffmpeg、sox）按“读到连接结束”处理
+    """
+    return _wav_header(sample_rate, 1, sampwidth, channels)
+
+
+# ====== µ-law（G.711）：65536 项查表，编码就是一次 numpy 索引 ======
+def _build_mulaw_table() -> np.ndarray:
+    # 与 CCITT G.711 参考实现（14bit 幅度、BIAS=33、段上界表）逐值一致
+    x = np.arange(-32768, 32768, dtype=np.int32) >> 2
+    mask = np.where(x < 0, 0x7F, 0xFF)
+    mag = np.minimum(np.abs(x), 8159) + 33
+    seg = np.searchsorted(np.array([0x3F, 0x7F, 0xFF, 0x1FF, 0x3FF, 0x7FF, 0xFFF, 0x1FFF]), mag)
+    uval = np.where(seg >= 8, 0x7F, (seg << 4) | ((mag >> (seg + 1)) & 0x0F))
+    table = (uval ^ mask) & 0xFF
+    # 按 uint16 视图索引：0..32767 为正数，32768..65535 为负数
+    return np.concatenate([table[32768:], table[:32768]]).astype(np.uint8)
+
+
+_MULAW = _build_mulaw_table()
+
+
+def mulaw_encode(pcm: bytes) -> bytes:
+    return _MULAW[np.frombuffer(pcm, dtype="<u2")].tobytes()
+
+
+# ====== 降采样（线性插值，跨块保持相位，流式逐块调用结果与整段一致）======
+class LinearResampler:
+    def __init__(self, src_rate: int, dst_rate: int):
+        self.step = src_rate / float(dst_rate)
+        self._tail: Optional[np.ndarray] = None
+        self._t = 0.0
+
+    def process(self, pcm: bytes) -> bytes:
+        x = np.frombuffer(pcm, dtype="<i2").astype(np.float32)
+        if not len(x):
+            return b""
+        buf = x if self._tail is None else np.concatenate([self._tail, x])
+        n = len(buf)
+        ts = np.arange(self._t, n - 1, self.step)
+        i = ts.astype(np.int64)
+        frac = (ts - i).astype(np.float32)
+        y = buf[i] * (1.0 - frac) + buf[np.minimum(i + 1, n - 1)] * frac
+        self._t = (ts[-1] + self.step if len(ts) else self._t) - (n - 1)
+        self._tail = buf[-1:]
+        return np.clip(np.round(y), -32768, 32767).astype("<i2").tobytes()
+
+
+# ====== 增量编码器 ======
+class Encoder:
+    """
+    header() → encode(chunk)* → flush()（流式），或 encode_all(pcm)（缓冲）；
+    输入均为源采样率的 int16 单声道 PCM。子类实现 _encode / _flush / _encode_all。
+    每个编码器自己记账（编码耗时、音频时长、输出字节），结束时汇总到 STATS。
+    """
+    encoding = "wav"
+    media_type = "audio/wav"
+
+    def __init__(self, src_rate: int, out_rate: Optional[int] = None):
+        self.src_rate = src_rate
+        self.rate = out_rate if out_rate and out_rate < src_rate else src_rate   # 只降不升
+        self._rs = LinearResampler(src_rate, self.rate) if self.rate != src_rate else None
+        self.cpu_ms = 0.0
+        self.audio_ms = 0.0
+        self.out_bytes = 0
+
+    def _pcm(self, pcm: bytes) -> bytes:
+        return self._rs.process(pcm) if self._rs is not None else pcm
+
+    def _timed(self, fn, pcm: bytes) -> bytes:
+        t0 = time.perf_counter()
+        out = fn(pcm) if pcm is not None else fn()
+        self.cpu_ms += (time.perf_counter() - t0) * 1000.0
+        if pcm:
+            self.audio_ms += len(pcm) / 2 * 1000.0 / self.src_rate
+        self.out_bytes += len(out)
+        return out
+
+    def header(self) -> bytes:
+        out = self._header()
+        self.out_bytes += len(out)
+        return out
+
+    def encode(self, pcm: bytes) -> bytes:
+        return self._timed(self._encode, pcm)
+
+    def flush(self) -> bytes:
+        out = self._timed(self._flush, None)
+        STATS.record(self)
+        return out
+
+    def encode_all(self, pcm: bytes) -> bytes:
+        """缓冲模式：一次编码整段（wav 写出准确的长度字段）"""
+        out = self._timed(self._encode_all, pcm)
+        STATS.record(self)
+        return out
+
+    def headers(self) -> Dict[str, str]:
+        return {"X-Audio-Encoding": self.encoding, "X-Sample-Rate": str(self.rate), "X-Channels": "1"}
+
+    # ---- 子类实现 ----
+    def _header(self) -> bytes:
+        return wav_stream_header(self.rate)
+
+    def _encode(self, pcm: bytes) -> bytes:
+        return self._pcm(pcm)
+
+    def _flush(self) -> bytes:
+        return b""
+
+    def _encode_all(self, pcm: bytes) -> bytes:
+        return pcm_to_wav(self._pcm(pcm), self.rate)
+
+
+class PcmEncoder(Encoder):
+    encoding = "pcm"
+    media_type = "application/octet-stream"
+
+    def headers(self) -> Dict[str, str]:
+        return {**super().headers(), "X-Audio-Format": "s16le"}
+
+    def _header(self) -> bytes:
+        return b""
+
+    def _encode_all(self, pcm: bytes) -> bytes:
+        return self._pcm(pcm)
+
+
+class MulawEncoder(Encoder):
+    encoding = "mulaw"
+
+    def _header(self) -> bytes:
+        return _wav_header(self.rate, 7, 1)
+
+    def _encode(self, pcm: bytes) -> bytes:
+        return mulaw_encode(self._pcm(pcm))
+
+    def _encode_all(self, pcm: bytes) -> bytes:
+        body = mulaw_encode(self._pcm(pcm))
+        return _wav_header(self.rate, 7, 1, data_size=len(body)) + body
+
+
+def _opus_rate(rate: int) -> int:
+    for r in (8000, 12000, 16000, 24000, 48000):
+        if rate <= r:
+            return r
+    return 48000
+
+
+class OpusEncoder(Encoder):
+    """Ogg Opus（PyAV/libopus）；Opus 只支持 8/12/16/24/48k，其它采样率由编码器内部重采样"""
+    encoding = "opus"
+    media_type = "audio/ogg"
+    bitrate = 24000
+
+    def __init__(self, src_rate: int, out_rate: Optional[int] = None):
+        super().__init__(src_rate, out_rate)
+        self._buf = io.BytesIO()
+        self._sent = 0
+        self._container = av.open(self._buf, mode="w", format="ogg")
+        self._stream = self._container.add_stream("libopus", rate=_opus_rate(self.rate))
+        self._stream.bit_rate = self.bitrate
+        self._stream.layout = "mono"
+        self._pts = 0
+
+    def _drain(self) -> bytes:
+        view = self._buf.getbuffer()
+        out = bytes(view[self._sent:])
+        view.release()
+        self._sent += len(out)
+        return out
+
+    def _header(self) -> bytes:
+        return b""      # Ogg 头随第一个包一起写出
+
+    def _encode(self, pcm: bytes) -> bytes:
+        pcm = self._pcm(pcm)
+        if not pcm:
+            return b""
+        arr = np.frombuffer(pcm, dtype="<i2").reshape(1, -1)
+        frame = av.AudioFrame.from_ndarray(arr, format="s16", layout="mono")
+        frame.sample_rate = self.rate
+        frame.pts = self._pts
+        self._pts += arr.shape[1]
+        for packet in self._stream.encode(frame):
+            self._container.mux(packet)
+        return self._drain()
+
+    def _flush(self) -> bytes:
+        for packet in self._stream.encode(None):
+            self._container.mux(packet)
+        self._container.close()
+        return self._drain()
+
+    def _encode_all(self, pcm: bytes) -> bytes:
+        return self._encode(pcm) + self._flush()
+
+
+_ENCODERS = {"wav": Encoder, "pcm": PcmEncoder, "mulaw": MulawEncoder, "opus": OpusEncoder}
+
+
+def make_encoder(encoding: str, src_rate: int, out_rate: Optional[int] = None) -> Encoder:
+    return _ENCODERS[encoding](src_rate, out_rate)
+
+
+# ====== 统计：每种编码（含输出采样率）的编码耗时 / 音频秒、输出字节 / 音频秒 ======
+class CodecStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._acc: Dict[str, Dict[str, float]] = {}
+
+    def record(self, enc: Encoder):
+        if enc.audio_ms <= 0:
+            return
+        name = f"{enc.encoding}@{enc.rate}"
+        with self._lock:
+            a = self._acc.setdefault(name, {"responses": 0, "cpu_ms": 0.0, "audio_ms": 0.0, "bytes": 0})
+            a["responses"] += 1
+            a["cpu_ms"] += enc.cpu_ms
+            a["audio_ms"] += enc.audio_ms
+            a["bytes"] += enc.out_bytes
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            return {
+                name: {
+                    "responses": a["responses"],
+                    "audio_s": round(a["audio_ms"] / 1000.0, 1),
+                    "encode_ms_per_audio_s": round(a["cpu_ms"] / (a["audio_ms"] / 1000.0), 3),
+                    "bytes_per_audio_s": round(a["bytes"] / (a["audio_ms"] / 1000.0)),
+                }
+                for name, a in self._acc.items()
+            }
+
+
+STATS = CodecStats()
@@ -1,9 +1,16 @@
 # backend/tts/edge_tts_app.py
+# 在仓库根目录：
+# uvicorn backend.tts.edge_tts_app:app --host 0.0.0.0 --port 8001
+import asyncio
+import os
+
 from fastapi import FastAPI, Body
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse, JSONResponse
 import edge_tts
 
+from backend.tts.audio_cache import TTS_CACHE_ENABLED, AudioCache, cache_key
+
 app = FastAPI(title="Edge TTS Service", version="0.1.0")
 
 
@@ -25,6 +32,11 @@ TTS_PRESETS = {
     "harry_vibe":      {"voice": "en-GB-RyanNeural",     "rate": "+5%", "pitch": "+2Hz"},
 }
 
+# Edge 合成的是任意回复文本，命中率低：缓存默认关闭，EDGE_TTS_CACHE=1 打开
+# （盘层按 TTS_CACHE_DISK_MB 字节预算淘汰，默认 512MB，见 audio_cache.py）
+EDGE_TTS_CACHE = os.getenv("EDGE_TTS_CACHE", "0") == "1"
+CACHE = AudioCache(enabled=EDGE_TTS_CACHE and TTS_CACHE_ENABLED)
+
 @app.get("/health")
 def health():
     return {"ok": True}
@@ -52,11 +64,25 @@ async def tts(
     # 用 SSML 让 rate/pitch/volume 生效
     ssml = f"""{text}""".strip()
 
+    key = cache_key("edge", voice, ssml, rate=rate, pitch=pitch, volume=volume)
+    cached = CACHE.response(key, media_type="audio/mpeg")
+    if cached is not None:
+        return cached
+
     com = edge_tts.Communicate(ssml, voice=voice, volume=volume,pitch=pitch)
 
     async def gen():
+        parts = []
         async for chunk in com.stream():
             if chunk["type"] == "audio":
+                parts.append(chunk["data"])
                 yield chunk["data"]
+        # 完整收完才写缓存（中途断开的不缓存）；落盘放到线程里，不卡事件循环
+        if CACHE.enabled:
+            await asyncio.to_thread(CACHE.put, key, b"".join(parts))
 
     return StreamingResponse(gen(), media_type="audio/mpeg")
+
+@app.get("/cache/stats")
+def cache_stats():
+    return CACHE.summary()
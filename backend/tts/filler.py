@@ -0,0 +1,119 @@
+"""
+人设垫话 / 附和音频（"嗯……"、"让我想想"、"Well…"）
+
+- FillerBank（TTS 服务端）：启动时用各人设自己的音色预合成几条短句，常驻内存，/filler 直接返回；
+- FillerPolicy（编排端）：按人设记录 final → 首句音频 的 EWMA，预测值超过阈值时
+  在回复开始前先下发一条垫话，真正的回复按顺序排在其后播放（客户端顺序播放，不重叠）。
+"""
+import io
+import itertools
+import os
+import threading
+import time
+import wave
+from typing import Callable, Dict, List, Optional
+
+from backend.common.stats import Ewma
+
+# 各人设垫话（按 VOICE_MAP / PERSONA_MAP 的语种：wukong 中文，harry/ironman 英文）
+FILLER_TEXTS: Dict[str, List[str]] = {
+    "wukong": ["嗯……", "让俺老孙想想。", "好嘞！"],
+    "harry": ["Hmm…", "Well…", "Let me think."],
+    "ironman": ["Right.", "Well…", "Let me see."],
+}
+
+FILLER_THRESHOLD_MS = float(os.getenv("FILLER_THRESHOLD_MS", "700"))
+
+
+def wav_duration_ms(wav_bytes: bytes) -> float:
+    try:
+        with wave.open(io.BytesIO(wav_bytes), "rb") as w:
+            return w.getnframes() * 1000.0 / max(1, w.getframerate())
+    except (wave.Error, EOFError):
+        return 0.0
+
+
+class FillerClip:
+    def __init__(self, text: str, audio: bytes):
+        self.text = text
+        self.audio = audio
+        self.duration_ms = wav_duration_ms(audio)
+
+
+class FillerBank:
+    def __init__(self, texts: Dict[str, List[str]] = FILLER_TEXTS):
+        self.texts = texts
+        self._clips: Dict[str, List[FillerClip]] = {}
+        self._rr: Dict[str, "itertools.cycle"] = {}
+        self._lock = threading.Lock()
+        self.warm_ms: Optional[float] = None
+
+    def warm(self, synth: Callable[[str, str], bytes]):
+        """synth(persona, text) -> wav 字节。单条失败只跳过，不影响其它人设。"""
+        t0 = time.perf_counter()
+        for persona, texts in self.texts.items():
+            clips = []
+            for text in texts:
+                try:
+                    clips.append(FillerClip(text, synth(persona, text)))
+                except Exception as e:
+                    print(f"[filler] {persona} {text!r} 预合成失败: {type(e).__name__}: {e}")
+            with self._lock:
+                self._clips[persona] = clips
+                self._rr[persona] = itertools.cycle(range(len(clips))) if clips else None
+        self.warm_ms = (time.perf_counter() - t0) * 1000.0
+
+    def warm_in_background(self, synth: Callable[[str, str], bytes]) -> threading.Thread:
+        t = threading.Thread(target=self.warm, args=(synth,), daemon=True, name="filler-warm")
+        t.start()
+        return t
+
+    def pick(self, persona: str) -> Optional[FillerClip]:
+        """轮流返回该人设的垫话；还没预合成好则返回 None"""
+        with self._lock:
+            clips = self._clips.get(persona)
+            rr = self._rr.get(persona)
+            if not clips or rr is None:
+                return None
+            return clips[next(rr)]
+
+    def summary(self) -> Dict[str, object]:
+        with self._lock:
+            return {
+                "warm_ms": round(self.warm_ms, 1) if self.warm_ms is not None else None,
+                "personas": {
+                    p: [{"text": c.text, "duration_ms": round(c.duration_ms, 1), "bytes": len(c.audio)}
+                        for c in clips]
+                    for p, clips in self._clips.items()
+                },
+            }
+
+
+class FillerPolicy:
+    """预测首句音频时间（按人设 EWMA），超过阈值才垫话。"""
+
+    def __init__(self, threshold_ms: float = FILLER_THRESHOLD_MS):
+        self.threshold_ms = threshold_ms
+        self._ttfa: Dict[str, Ewma] = {}
+        self.counters = {"filled": 0, "skipped": 0}
+
+    def observe(self, persona: str, ttfa_ms: float):
+        self._ttfa.setdefault(persona, Ewma(alpha=0.3)).update(ttfa_ms)
+
+    def predicted_ms(self, persona: str) -> Optional[float]:
+        e = self._ttfa.get(persona)
+        return e.value if e is not None else None
+
+    def should_fill(self, persona: str) -> bool:
+        # 没有历史数据时不垫话，避免每个新人设第一句都“嗯……”
+        pred = self.predicted_ms(persona)
+        fill = pred is not None and pred > self.threshold_ms
+        self.counters["filled" if fill else "skipped"] += 1
+        return fill
+
+    def summary(self) -> Dict[str, object]:
+        return {
+            "threshold_ms": self.threshold_ms,
+            "predicted_ttfa_ms": {p: round(e.value, 1) for p, e in self._ttfa.items() if e.value is not None},
+            **self.counters,
+        }
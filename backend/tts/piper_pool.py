@@ -0,0 +1,320 @@
+"""
+常驻 Piper 合成池（tts_server.py / piper_tts_app.py / tts.py 共用）
+
+原来每个请求都起一个 `piper` 进程：每次重新加载 ONNX 语音模型，再经临时目录 / wav 文件
+落盘读回，短句的耗时基本全花在加载模型上。这里改成：
+
+- inproc（默认，需 `pip install piper-tts`）：每个语音常驻 N 个 PiperVoice（ONNX Runtime
+  会话，intra-op 线程数可调），请求从空闲实例里取一个，PCM 直接在内存里拼成 wav；
+- cli（回退）：没装 piper-tts 时仍按请求起 `piper --output_raw`，但 PCM 走 stdout，不落临时文件。
+
+打断：inproc 在句与句之间检查 cancel；cli 直接 kill 进程。两者都抛 SynthesisCancelled。
+
+inproc 的语音经 voice_store.py 按需加载：权重 mmap 共享（多进程 / 多实例同一份物理页），
+超出 VOICE_STORE_BUDGET_MB 时淘汰最久没用的语音。
+"""
+import json
+import os
+import queue
+import subprocess
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, Optional, Tuple
+
+from backend.common.stats import LatencyWindow
+from backend.tts.codecs import pcm_to_wav
+from backend.tts.voice_store import (
+    VoiceStore, mapped_resident, process_memory, session_options, shared_model, weights_cost,
+)
+
+PIPER_BIN = os.getenv("PIPER_BIN", "piper")
+PIPER_BACKEND = os.getenv("PIPER_BACKEND", "auto")              # auto / inproc / cli
+# 每个语音常驻实例数：长回复分段并行合成时，同一语音能同时跑几段
+PIPER_POOL_SIZE = int(os.getenv("PIPER_POOL_SIZE", str(min(4, max(1, (os.cpu_count() or 2) // 2)))))
+PIPER_INTRA_OP_THREADS = int(os.getenv("PIPER_INTRA_OP_THREADS", "0"))  # 0 = 按核数 / 实例数自动
+
+
+class SynthesisCancelled(Exception):
+    pass
+
+
+def _sample_rate(config: str) -> int:
+    with open(config, "r", encoding="utf-8") as f:
+        return int(json.load(f).get("audio", {}).get("sample_rate", 22050))
+
+
+def _piper_module_available() -> bool:
+    """只查找不导入：import piper 会拖进 onnxruntime，放到首次加载语音时再付"""
+    import importlib.util
+    return importlib.util.find_spec("piper") is not None
+
+
+# ====== inproc：常驻 PiperVoice ======
+class _Voice:
+    """一个常驻的 PiperVoice，兼容 piper-tts 1.2（synthesize_stream_raw）与 1.3（synthesize → AudioChunk）"""
+
+    def __init__(self, model: str, config: str, intra_op_threads: int):
+        """model：原 .onnx，或 voice_store 转出的外部数据格式（权重 mmap 共享）"""
+        from piper import PiperVoice
+        from piper.config import PiperConfig
+        import onnxruntime
+        # 不走 PiperVoice.load：它用默认 SessionOptions（线程数 = 全部核、权重预打包成私有副本）
+        # 先建一个会话，再替换的话每个语音要加载两遍；这里直接建限定线程数、不预打包的会话
+        with open(config, "r", encoding="utf-8") as f:
+            cfg = PiperConfig.from_dict(json.load(f))
+        session = onnxruntime.InferenceSession(
+            model, sess_options=session_options(intra_op_threads), providers=["CPUExecutionProvider"])
+        self.voice = PiperVoice(session=session, config=cfg)
+        self.sample_rate = int(self.voice.config.sample_rate)
+
+    def stream(self, text: str, speaker_id: Optional[int], length_scale: Optional[float]) -> Iterator[bytes]:
+        """逐句产出 int16 PCM"""
+        if hasattr(self.voice, "synthesize_stream_raw"):
+            yield from self.voice.synthesize_stream_raw(text, speaker_id=speaker_id, length_scale=length_scale)
+            return
+        from piper import SynthesisConfig
+        syn = SynthesisConfig(speaker_id=speaker_id, length_scale=length_scale)
+        for chunk in self.voice.synthesize(text, syn_config=syn):
+            yield chunk.audio_int16_bytes
+
+
+class _VoicePool:
+    def __init__(self, model: str, config: str, size: int, intra_op_threads: int):
+        t0 = time.perf_counter()
+        shared = shared_model(model)
+        self.weights = shared + ".data" if shared else model    # 常驻统计看这个文件的映射
+        self.shared = shared is not None
+        self._idle: "queue.Queue[_Voice]" = queue.Queue()
+        for _ in range(max(1, size)):
+            self._idle.put(_Voice(shared or model, config, intra_op_threads))
+        self.sample_rate = _sample_rate(config)
+        self.size = max(1, size)
+        self.load_ms = (time.perf_counter() - t0) * 1000.0
+        self.wait = LatencyWindow()
+
+    def synthesize(
+        self,
+        text: str,
+        speaker_id: Optional[int],
+        length_scale: Optional[float],
+        cancel: Optional[threading.Event],
+    ) -> Tuple[bytes, int]:
+        return b"".join(self.stream(text, speaker_id, length_scale, cancel)), self.sample_rate
+
+    def stream(
+        self,
+        text: str,
+        speaker_id: Optional[int],
+        length_scale: Optional[float],
+        cancel: Optional[threading.Event],
+    ) -> Iterator[bytes]:
+        """逐句产出 PCM；迭代结束（或生成器被关闭）时实例才归还"""
+        t0 = time.perf_counter()
+        v = self._idle.get()
+        self.wait.add((time.perf_counter() - t0) * 1000.0)
+        try:
+            for pcm in v.stream(text, speaker_id, length_scale):
+                if cancel is not None and cancel.is_set():
+                    raise SynthesisCancelled()
+                yield pcm
+        finally:
+            self._idle.put(v)
+
+
+# ====== cli：按请求起进程（回退路径，PCM 走 stdout）======
+def _synthesize_cli(
+    model: str,
+    config: str,
+    text: str,
+    speaker_id: Optional[int],
+    length_scale: Optional[float],
+    cancel: Optional[threading.Event],
+) -> Tuple[bytes, int]:
+    cmd = [PIPER_BIN, "--model", model, "--config", config, "--output_raw"]
+    if length_scale is not None:
+        cmd += ["--length_scale", str(length_scale)]
+    if speaker_id is not None:
+        cmd += ["--speaker", str(speaker_id)]
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    data: Optional[bytes] = text.encode("utf-8")
+    while True:
+        try:
+            out, err = proc.communicate(input=data, timeout=0.05)
+            break
+        except subprocess.TimeoutExpired:
+            data = None     # 输入已写入，重试时不能再传
+            if cancel is not None and cancel.is_set():
+                proc.kill()
+                proc.communicate()
+                raise SynthesisCancelled()
+    if proc.returncode != 0:
+        raise RuntimeError(f"Piper synthesis failed.\nSTDERR:\n{err.decode(errors='ignore')}")
+    return out, _sample_rate(config)
+
+
+def _stream_cli(
+    model: str,
+    config: str,
+    text: str,
+    speaker_id: Optional[int],
+    length_scale: Optional[float],
+    cancel: Optional[threading.Event],
+) -> Iterator[bytes]:
+    """cli 的流式版本：PCM 读到一块发一块；生成器提前关闭时 kill 掉进程"""
+    cmd = [PIPER_BIN, "--model", model, "--config", config, "--output_raw"]
+    if length_scale is not None:
+        cmd += ["--length_scale", str(length_scale)]
+    if speaker_id is not None:
+        cmd += ["--speaker", str(speaker_id)]
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    err = b""
+
+    def _drain_err():
+        nonlocal err
+        err = proc.stderr.read()
+    t = threading.Thread(target=_drain_err, daemon=True)     # stderr 写满管道会卡住进程
+    t.start()
+    try:
+        proc.stdin.write(text.encode("utf-8"))
+        proc.stdin.close()
+        for chunk in iter(lambda: proc.stdout.read(4096), b""):
+            if cancel is not None and cancel.is_set():
+                raise SynthesisCancelled()
+            yield chunk
+        proc.wait()
+        t.join()
+        if proc.returncode != 0:
+            raise RuntimeError(f"Piper synthesis failed.\nSTDERR:\n{err.decode(errors='ignore')}")
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+
+
+class PiperPool:
+    def __init__(
+        self,
+        size: int = PIPER_POOL_SIZE,
+        intra_op_threads: int = PIPER_INTRA_OP_THREADS,
+        backend: str = PIPER_BACKEND,
+    ):
+        if backend == "auto":
+            backend = "inproc" if _piper_module_available() else "cli"
+        self.backend = backend
+        self.size = max(1, size)
+        self.intra_op_threads = intra_op_threads or max(1, (os.cpu_count() or 2) // self.size)
+        # 语音按需加载、按预算淘汰；预算按权重字节计（共享权重每个语音只算一份）
+        self.store = VoiceStore(
+            load=lambda key: _VoicePool(key[0], key[1], self.size, self.intra_op_threads),
+            cost=lambda key: weights_cost(key[0], self.size),
+        )
+        self.synth = LatencyWindow()
+
+    def warm(self, voices: Iterable[Tuple[str, str]]):
+        """预加载到预算装满为止，其余语音首次用到时再加载"""
+        if self.backend != "inproc":
+            return
+        for model, config in voices:
+            try:
+                self.store.warm([(model, config)])
+            except Exception as e:
+                print(f"[piper] 预加载 {model} 失败: {type(e).__name__}: {e}")
+
+    def warm_in_background(self, voices: Iterable[Tuple[str, str]]) -> threading.Thread:
+        t = threading.Thread(target=self.warm, args=(list(voices),), daemon=True, name="piper-warm")
+        t.start()
+        return t
+
+    def synthesize(
+        self,
+        model: str,
+        config: str,
+        text: str,
+        speaker_id: Optional[int] = None,
+        length_scale: Optional[float] = None,
+        cancel: Optional[threading.Event] = None,
+    ) -> Tuple[bytes, int]:
+        """返回 (int16 PCM, 采样率)"""
+        t0 = time.perf_counter()
+        if self.backend == "inproc":
+            with self.store.lease((model, config)) as pool:
+                out = pool.synthesize(text, speaker_id, length_scale, cancel)
+        else:
+            out = _synthesize_cli(model, config, text, speaker_id, length_scale, cancel)
+        self.synth.add((time.perf_counter() - t0) * 1000.0)
+        return out
+
+    def stream(
+        self,
+        model: str,
+        config: str,
+        text: str,
+        speaker_id: Optional[int] = None,
+        length_scale: Optional[float] = None,
+        cancel: Optional[threading.Event] = None,
+    ) -> Iterator[bytes]:
+        """边合成边产出 int16 PCM（采样率见 sample_rate(config)）；inproc 逐句，cli 按读到的块"""
+        t0 = time.perf_counter()
+        if self.backend == "inproc":
+            with self.store.lease((model, config)) as pool:
+                yield from pool.stream(text, speaker_id, length_scale, cancel)
+        else:
+            yield from _stream_cli(model, config, text, speaker_id, length_scale, cancel)
+        self.synth.add((time.perf_counter() - t0) * 1000.0)
+
+    @staticmethod
+    def sample_rate(config: str) -> int:
+        return _sample_rate(config)
+
+    def synthesize_wav(self, model: str, config: str, text: str, **kw) -> bytes:
+        pcm, sr = self.synthesize(model, config, text, **kw)
+        return pcm_to_wav(pcm, sr)
+
+    def voices(self) -> Dict[str, object]:
+        """已加载的语音及其权重映射的常驻字节（/voices 用）"""
+        items = self.store.items()
+        resident = mapped_resident(it["value"].weights for it in items.values())
+        return {
+            "backend": self.backend,
+            "process": process_memory(),
+            **self.store.summary(),
+            "loaded": {
+                Path(m).name: {
+                    "shared": it["value"].shared,
+                    "sessions": it["value"].size,
+                    "cost_bytes": it["cost"],
+                    "busy": it["busy"],
+                    "idle_s": round(it["idle_s"], 1),
+                    # 只有共享权重是文件映射；未共享时权重在堆里，看 process
+                    **(resident.get(str(Path(it["value"].weights).resolve()), {}) if it["value"].shared else {}),
+                }
+                for (m, _), it in items.items()
+            },
+        }
+
+    def summary(self) -> Dict[str, object]:
+        return {
+            "backend": self.backend,
+            "size": self.size,
+            "intra_op_threads": self.intra_op_threads,
+            "synth_ms": self.synth.summary(),
+            "store": self.store.summary(),
+            "voices": {
+                Path(m).name: {"load_ms": round(it["load_ms"], 1), "wait_ms": it["value"].wait.summary()}
+                for (m, _), it in self.store.items().items()
+            },
+        }
+
+
+# 进程内共用一个池（各 app 直接 import）
+_DEFAULT: Optional[PiperPool] = None
+_DEFAULT_LOCK = threading.Lock()
+
+
+def default_pool() -> PiperPool:
+    global _DEFAULT
+    with _DEFAULT_LOCK:
+        if _DEFAULT is None:
+            _DEFAULT = PiperPool()
+        return _DEFAULT
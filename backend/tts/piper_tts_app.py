@@ -1,12 +1,17 @@
+# 在仓库根目录：
+# uvicorn backend.tts.piper_tts_app:app --host 0.0.0.0 --port 8002
 from fastapi import FastAPI, Body, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
-import os, shutil, subprocess, threading
+import os, shutil
 from pathlib import Path
 
+from backend.tts.audio_cache import AudioCache, cache_key
+from backend.tts.codecs import pcm_to_wav, wav_stream_header
+from backend.tts.piper_pool import PIPER_BIN, default_pool
+
 
 import logging
-from fastapi.responses import Response, JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 
 app = FastAPI(title="Piper TTS Service", version="0.1.0")
 app.add_middleware(
@@ -23,20 +28,24 @@ TTS_PRESETS = {
     "cn_male_calm":    {"voice":"zh-CN-YunxiNeural",   "rate":"-5%","pitch":"-1Hz"},
 }
 # --- 配置：可用环境变量覆盖 ---
-PIPER_BIN  = os.getenv("PIPER_BIN", "piper")  # 已加入 PATH 则用命令名
-# 默认模型（按你的实际路径修改为 WSL 路径）
-PIPER_MODEL = os.getenv("PIPER_MODEL", "../../models/sound/voice-zh_CN-huayan-medium/zh_CN-huayan-medium.onnx")
-PIPER_CFG   = os.getenv("PIPER_CFG",   "../../models/sound/voice-zh_CN-huayan-medium/zh_CN-huayan-medium.onnx.json")
+# PIPER_BIN（cli 回退时的命令名）见 piper_pool.py
+# 默认模型（相对仓库根目录，即启动 uvicorn 的目录；按你的实际路径修改为 WSL 路径）
+PIPER_MODEL = os.getenv("PIPER_MODEL", "models/sound/voice-zh_CN-huayan-medium/zh_CN-huayan-medium.onnx")
+PIPER_CFG   = os.getenv("PIPER_CFG",   "models/sound/voice-zh_CN-huayan-medium/zh_CN-huayan-medium.onnx.json")
+
+PIPER = default_pool()
+CACHE = AudioCache()
 
 def _check_ready(model: str, cfg: str):
-    if shutil.which(PIPER_BIN) is None:
+    if PIPER.backend == "cli" and shutil.which(PIPER_BIN) is None:
         raise HTTPException(500, f"Piper binary not found: {PIPER_BIN}")
     if not Path(model).exists() or not Path(cfg).exists():
         raise HTTPException(500, f"Piper model or config not found: {model} / {cfg}")
 
 @app.get("/health")
 def health():
-    ok = shutil.which(PIPER_BIN) is not None and Path(PIPER_MODEL).exists() and Path(PIPER_CFG).exists()
+    ok = (PIPER.backend == "inproc" or shutil.which(PIPER_BIN) is not None) \
+        and Path(PIPER_MODEL).exists() and Path(PIPER_CFG).exists()
     print(ok)
     return {"ok": ok}
 
@@ -53,23 +62,39 @@ def tts_piper_post(
     cfgp = cfg   or PIPER_CFG
     _check_ready(mdl, cfgp)
 
-    cmd = [
-        PIPER_BIN,
-        "--model", mdl,
-        "--config", cfgp,
-        "--output_file", "-",
-        "--text", text,
-    ]
-    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=0)
+    key = cache_key("piper", Path(mdl).name, text)
+    cached = CACHE.response(key)
+    if cached is not None:
+        return cached
 
-    def _pump_err():
-        for line in iter(p.stderr.readline, b""):
-            logger.error("PIPER: %s", line.decode("utf-8", "ignore").rstrip())
-    threading.Thread(target=_pump_err, daemon=True).start()
+    # 常驻合成池：模型只加载一次；仍是边合成边流式输出（流式 wav 头 + PCM），
+    # 完整合成完才写缓存，中途出错 / 客户端断开的不缓存
+    sr = PIPER.sample_rate(cfgp)
+    chunks = PIPER.stream(mdl, cfgp, text)
+    try:
+        first = next(chunks, b"")       # 首块在发响应头之前合成：一开始就失败还能回 500
+    except Exception as e:
+        logger.error("PIPER: %s", e)
+        raise HTTPException(500, str(e))
 
     def gen():
-        for chunk in iter(lambda: p.stdout.read(4096), b""):
-            yield chunk
-        p.wait()
+        parts = [first]
+        yield wav_stream_header(sr) + first
+        try:
+            for pcm in chunks:
+                parts.append(pcm)
+                yield pcm
+        except Exception as e:
+            logger.error("PIPER: %s", e)    # 响应头已发出，只能提前结束
+            return
+        CACHE.put(key, pcm_to_wav(b"".join(parts), sr))
+
+    return StreamingResponse(gen(), media_type="audio/wav")
+
+@app.get("/cache/stats")
+def cache_stats():
+    return CACHE.summary()
 
-    return StreamingResponse(gen(), media_type="audio/wav")
\ No newline at end of file
+@app.on_event("startup")
+def _warm_piper():
+    PIPER.warm_in_background([(PIPER_MODEL, PIPER_CFG)])
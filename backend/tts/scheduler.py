@@ -0,0 +1,252 @@
+"""
+TTS 合成调度器（tts_server.py / tts_xtts_server.py 共用）
+
+同步 handler 直接跑在 FastAPI 默认线程池里时是“先到先得”，A 用户回复的第一句
+可能排在 B 用户第 7 句后面。这里改成固定数量的工作线程 + 优先级队列：
+
+  1) 每轮回复的第一句优先（first=True）；
+  2) 其次按截止时间（deadline）早的先做；
+  3) 同等条件下，当前占用工作线程少的会话先做（按会话公平）。
+
+截止时间默认只用来排序：赶不上也照样合成（尽力而为），完成时超时的记进 late，不丢句子。
+提交时 strict=True 才做准入：按该人设的历史合成速率估算完成时间，赶不上的直接拒绝（DeadlineExceeded），
+出队时再检查一次（排队期间可能已过期）。按人设统计排队等待与首句完成时间分位数。
+"""
+import itertools
+import os
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional
+
+from backend.common.stats import Ewma, LatencyWindow
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class SynthesisDropped(Exception):
+    """会话被打断，排队中的任务被丢弃"""
+
+
+class SchedulerBusy(Exception):
+    """队列已满（max_queue），拒绝新任务以限制内存"""
+
+
+class _Job:
+    __slots__ = ("fn", "future", "persona", "session_id", "first", "deadline", "n_chars", "submitted", "seq",
+                 "strict")
+
+    def __init__(self, fn, future, persona, session_id, first, deadline, n_chars, seq, strict=False):
+        self.fn = fn
+        self.strict = strict
+        self.future = future
+        self.persona = persona
+        self.session_id = session_id
+        self.first = first
+        self.deadline = deadline
+        self.n_chars = n_chars
+        self.submitted = time.perf_counter()
+        self.seq = seq
+
+
+class _PersonaStats:
+    def __init__(self):
+        self.queue_wait = LatencyWindow()
+        self.first_done = LatencyWindow()     # 首句：提交 → 合成完成（服务端视角的首包时间）
+        self.synth = LatencyWindow()
+        self.ms_per_char = Ewma(alpha=0.2)
+        self.rejected = 0
+        self.late = 0         # 尽力而为的任务完成时已过截止时间
+        self.dropped = 0
+
+
+class SynthScheduler:
+    def __init__(
+        self,
+        workers: int,
+        name: str = "tts",
+        default_ms_per_char: float = 30.0,
+        max_queue: int = 0,
+    ):
+        """
+        workers：并发合成数（CPU 版按核数，GPU 版一般为 1）
+        default_ms_per_char：还没有历史数据时的速率估计，用于截止时间准入（strict 任务）
+        max_queue：排队上限，0 为不限；超过直接 SchedulerBusy
+        """
+        self.workers = max(1, workers)
+        self.name = name
+        self.default_ms_per_char = default_ms_per_char
+        self.max_queue = max_queue
+        self._queue: List[_Job] = []
+        self._cond = threading.Condition()
+        self._seq = itertools.count()
+        self._running_by_session: Dict[str, int] = {}
+        self._running = 0
+        self._stats: Dict[str, _PersonaStats] = {}
+        self._threads = [
+            threading.Thread(target=self._worker, daemon=True, name=f"{name}-worker-{i}")
+            for i in range(self.workers)
+        ]
+        for t in self._threads:
+            t.start()
+
+    # ------------------ 估算 ------------------
+    def _st(self, persona: str) -> _PersonaStats:
+        st = self._stats.get(persona)
+        if st is None:
+            st = self._stats.setdefault(persona, _PersonaStats())   # 多线程下 setdefault 原子
+        return st
+
+    def _est_ms(self, persona: str, n_chars: int) -> float:
+        rate = self._st(persona).ms_per_char.value or self.default_ms_per_char
+        return rate * max(1, n_chars)
+
+    def _backlog_ms(self, job: _Job) -> float:
+        """排在 job 前面的任务预计耗时 / 工作线程数（粗略，但足以做准入）"""
+        ahead = [j for j in self._queue if self._key(j) < self._key(job)]
+        total = sum(self._est_ms(j.persona, j.n_chars) for j in ahead)
+        return total / self.workers
+
+    def _key(self, j: _Job):
+        return (
+            0 if j.first else 1,
+            j.deadline,
+            self._running_by_session.get(j.session_id, 0) if j.session_id else 0,
+            j.seq,
+        )
+
+    # ------------------ 提交 ------------------
+    def submit(
+        self,
+        fn: Callable[[], Any],
+        persona: str = "default",
+        session_id: Optional[str] = None,
+        first: bool = False,
+        deadline_ms: float = 15000.0,
+        n_chars: int = 1,
+        strict: bool = False,
+    ) -> Future:
+        """
+        strict：赶不上 deadline_ms 时拒绝（DeadlineExceeded）；默认只按截止时间排序，赶不上也合成
+        """
+        fut: Future = Future()
+        now = time.perf_counter()
+        job = _Job(fn, fut, persona, session_id, first, now + deadline_ms / 1000.0, n_chars, next(self._seq), strict)
+        with self._cond:
+            if self.max_queue and len(self._queue) >= self.max_queue:
+                self._st(persona).rejected += 1
+                fut.set_exception(SchedulerBusy(f"queue full ({self.max_queue})"))
+                return fut
+            eta = now + (self._backlog_ms(job) + self._est_ms(persona, n_chars)) / 1000.0 if strict else now
+            if eta > job.deadline:
+                self._st(persona).rejected += 1
+                fut.set_exception(DeadlineExceeded(
+                    f"estimated {1000 * (eta - now):.0f}ms > deadline {deadline_ms:.0f}ms"))
+                return fut
+            self._queue.append(job)
+            self._cond.notify()
+        return fut
+
+    def drop(self, session_id: str) -> int:
+        """丢弃该会话排队中（未开始）的任务"""
+        with self._cond:
+            keep, dropped = [], []
+            for j in self._queue:
+                (dropped if j.session_id == session_id else keep).append(j)
+            self._queue = keep
+        for j in dropped:
+            self._st(j.persona).dropped += 1
+            if j.future.set_running_or_notify_cancel():
+                j.future.set_exception(SynthesisDropped(session_id))
+        return len(dropped)
+
+    # ------------------ 执行 ------------------
+    def _pop(self) -> _Job:
+        with self._cond:
+            while not self._queue:
+                self._cond.wait()
+            job = min(self._queue, key=self._key)
+            self._queue.remove(job)
+            self._running += 1
+            if job.session_id:
+                self._running_by_session[job.session_id] = self._running_by_session.get(job.session_id, 0) + 1
+            return job
+
+    def _release(self, job: _Job):
+        with self._cond:
+            self._running -= 1
+            if job.session_id:
+                n = self._running_by_session.get(job.session_id, 1) - 1
+                if n > 0:
+                    self._running_by_session[job.session_id] = n
+                else:
+                    self._running_by_session.pop(job.session_id, None)
+
+    def _worker(self):
+        while True:
+            job = self._pop()
+            try:
+                self._run(job)
+            finally:
+                self._release(job)
+
+    def _admit(self, job: _Job, start: float) -> bool:
+        """开始执行前的检查：客户端已断开 / 排队期间已过期的 strict 任务不再执行"""
+        st = self._st(job.persona)
+        if not job.future.set_running_or_notify_cancel():
+            return False      # 客户端已断开
+        st.queue_wait.add((start - job.submitted) * 1000.0)
+        if job.strict and start + self._est_ms(job.persona, job.n_chars) / 1000.0 > job.deadline:
+            st.rejected += 1
+            job.future.set_exception(DeadlineExceeded("deadline passed while queued"))
+            return False
+        return True
+
+    def _done(self, job: _Job, start: float, end: float, n_chars: int):
+        st = self._st(job.persona)
+        st.synth.add((end - start) * 1000.0)
+        st.ms_per_char.update((end - start) * 1000.0 / max(1, n_chars))
+        if job.first:
+            st.first_done.add((end - job.submitted) * 1000.0)
+        if end > job.deadline:
+            st.late += 1
+
+    def _run(self, job: _Job):
+        start = time.perf_counter()
+        if not self._admit(job, start):
+            return
+        try:
+            result = job.fn()
+        except BaseException as e:
+            job.future.set_exception(e)
+            return
+        self._done(job, start, time.perf_counter(), job.n_chars)
+        job.future.set_result(result)
+
+    # ------------------ 统计 ------------------
+    def summary(self) -> Dict[str, Any]:
+        with self._cond:
+            queued, running = len(self._queue), self._running
+        return {
+            "workers": self.workers,
+            "queued": queued,
+            "running": running,
+            "personas": {
+                p: {
+                    "queue_wait_ms": st.queue_wait.summary(),
+                    "first_sentence_ms": st.first_done.summary(),
+                    "synth_ms": st.synth.summary(),
+                    "ms_per_char": round(st.ms_per_char.value, 2) if st.ms_per_char.value else None,
+                    "rejected": st.rejected,
+                    "late": st.late,
+                    "dropped": st.dropped,
+                }
+                for p, st in self._stats.items()
+            },
+        }
+
+
+def default_workers() -> int:
+    return max(1, (os.cpu_count() or 2) // 2)
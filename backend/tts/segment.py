@@ -0,0 +1,96 @@
+"""
+长文本分段合成（TTS 服务共用）
+
+一段多句的长回复整段交给一次合成，只用得上一个核。这里先切成段，再并行送进合成池，
+最后按原顺序拼接 PCM：
+
+- segment_text：归一化空白，按段落 / 句末 / 长分句的逗号切开（中英文标点混排都认），
+  过短的碎段并入前一段，免得并行任务太碎；
+- join_pcm：段间插入统一的停顿（句末长、分句短），或改用短交叉淡化直接衔接。
+
+流式输出时段 0 合成完就能先发，后面的段仍在并行合成（见 tts_server.py 的 stream 模式）。
+"""
+import os
+import re
+from typing import List, Tuple
+
+import numpy as np
+
+from backend.common.text import END_PUNCTS, SentenceSplitter
+
+TTS_SEGMENT_CLAUSE_CHARS = int(os.getenv("TTS_SEGMENT_CLAUSE_CHARS", "40"))  # 分句长到多少才在逗号处切
+TTS_SEGMENT_MIN_CHARS = int(os.getenv("TTS_SEGMENT_MIN_CHARS", "6"))         # 短于此的碎段并入前一段
+TTS_SENTENCE_PAUSE_MS = float(os.getenv("TTS_SENTENCE_PAUSE_MS", "180"))
+TTS_CLAUSE_PAUSE_MS = float(os.getenv("TTS_CLAUSE_PAUSE_MS", "80"))
+TTS_CROSSFADE_MS = float(os.getenv("TTS_CROSSFADE_MS", "0"))                # >0 时用交叉淡化代替停顿
+
+_SPACES = re.compile(r"[ \t　 ]+")
+
+
+def _joiner(a: str, b: str) -> str:
+    # 英文单词之间补空格，中文直接相连
+    return " " if a and b and a[-1].isascii() and b[0].isascii() else ""
+
+
+def segment_text(
+    text: str,
+    clause_min_chars: int = TTS_SEGMENT_CLAUSE_CHARS,
+    min_chars: int = TTS_SEGMENT_MIN_CHARS,
+) -> List[Tuple[str, float]]:
+    """返回 [(段文本, 该段之后的停顿毫秒)]；最后一段停顿为 0"""
+    segs: List[str] = []
+    for para in re.split(r"\s*\n+\s*", text.replace("\r", "")):
+        para = _SPACES.sub(" ", para).strip()
+        if not para:
+            continue
+        sp = SentenceSplitter(clause_min_chars)
+        segs.extend(s for s in sp.feed(para) + sp.flush() if s)
+
+    merged: List[str] = []
+    for s in segs:
+        if merged and len(s) < min_chars:
+            merged[-1] += _joiner(merged[-1], s) + s
+        else:
+            merged.append(s)
+    if len(merged) > 1 and len(merged[0]) < min_chars:
+        merged[1] = merged[0] + _joiner(merged[0], merged[1]) + merged[1]
+        merged.pop(0)
+
+    out = []
+    for i, s in enumerate(merged):
+        if i == len(merged) - 1:
+            pause = 0.0
+        else:
+            pause = TTS_SENTENCE_PAUSE_MS if s.rstrip("\"'”’）)」』】…~～")[-1:] in END_PUNCTS else TTS_CLAUSE_PAUSE_MS
+        out.append((s, pause))
+    return out or [(text.strip(), 0.0)]
+
+
+def silence(ms: float, sample_rate: int) -> bytes:
+    return b"\x00\x00" * int(sample_rate * ms / 1000.0)
+
+
+def join_pcm(
+    parts: List[bytes],
+    pauses_ms: List[float],
+    sample_rate: int,
+    crossfade_ms: float = TTS_CROSSFADE_MS,
+) -> bytes:
+    """按序拼接 int16 PCM：段间插入 pauses_ms[i] 的静音；crossfade_ms > 0 时改为线性交叉淡化"""
+    if crossfade_ms <= 0:
+        out = []
+        for pcm, pause in zip(parts, pauses_ms):
+            out.append(pcm)
+            out.append(silence(pause, sample_rate))
+        return b"".join(out)
+
+    n_fade = int(sample_rate * crossfade_ms / 1000.0)
+    acc = np.frombuffer(parts[0], dtype="<i2").astype(np.float32) if parts else np.zeros(0, np.float32)
+    for pcm in parts[1:]:
+        nxt = np.frombuffer(pcm, dtype="<i2").astype(np.float32)
+        n = min(n_fade, len(acc), len(nxt))
+        if n > 0:
+            ramp = np.linspace(0.0, 1.0, n, dtype=np.float32)
+            acc[-n:] = acc[-n:] * (1.0 - ramp) + nxt[:n] * ramp
+        acc = np.concatenate([acc, nxt[n:]])
+    return np.clip(acc, -32768, 32767).astype("<i2").tobytes()
@@ -3,19 +3,19 @@ TTS 模块：文本转语音
 这里用 Piper/Coqui TTS
 """
 
-import subprocess
-import os
+from backend.tts.piper_pool import default_pool
 
 # 假设你安装了 Piper，并下载了一个模型
-PIPER_BIN = "piper"
 VOICE_MODEL = "voices/zh_cn-voice.onnx"
+VOICE_CONFIG = VOICE_MODEL + ".json"
 
 def synthesize(text: str, out_path: str = "output.wav") -> str:
     """
     输入：文本
     输出：合成后的语音文件路径
+    （走常驻合成池，模型只加载一次）
     """
-    cmd = [PIPER_BIN, "--model", VOICE_MODEL, "--output_file", out_path]
-    process = subprocess.Popen(cmd, stdin=subprocess.PIPE)
-    process.communicate(input=text.encode("utf-8"))
+    wav = default_pool().synthesize_wav(VOICE_MODEL, VOICE_CONFIG, text)
+    with open(out_path, "wb") as f:
+        f.write(wav)
     return out_path
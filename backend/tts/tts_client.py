@@ -0,0 +1,103 @@
+import os
+from typing import Any, Dict, Optional
+
+import httpx
+
+from backend.common.trace import TRACE_HEADER
+
+TTS_BASE = os.getenv("TTS_BASE", "http://127.0.0.1:8002")
+TTS_TIMEOUT = float(os.getenv("TTS_TIMEOUT", "60"))
+# 句级流水线的截止时间：首句要快、后续句子可以宽松；服务端只按它排序，赶不上也照样合成，句子不会丢
+TTS_FIRST_DEADLINE_MS = float(os.getenv("TTS_FIRST_DEADLINE_MS", "3000"))
+TTS_NEXT_DEADLINE_MS = float(os.getenv("TTS_NEXT_DEADLINE_MS", "15000"))
+
+
+class TTSClient:
+    """
+    TTS 服务（tts_server.py / tts_xtts_server.py）的异步客户端。
+    进程内共用一个连接池，避免每句都重新建 TCP 连接。
+    """
+
+    def __init__(self, base_url: str = TTS_BASE, timeout: float = TTS_TIMEOUT, max_connections: int = 8):
+        self.base_url = base_url.rstrip("/")
+        self._client = httpx.AsyncClient(
+            base_url=self.base_url,
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+        )
+
+    async def synthesize(self, text: str, persona: Optional[str] = None, trace_id: Optional[str] = None,
+                         **extra) -> bytes:
+        """
+        POST /tts，返回 wav 字节。extra 原样并入请求体（session_id / length_scale / speaker_id / language 等）；
+        trace_id 放在 X-Trace-Id 头里（backend/common/trace.py）
+        """
+        payload = {"text": text, "persona": persona}
+        payload.update({k: v for k, v in extra.items() if v is not None})
+        r = await self._client.post("/tts", json=payload, headers={TRACE_HEADER: trace_id} if trace_id else None)
+        r.raise_for_status()
+        return r.content
+
+    async def synthesize_sentence(self, text: str, idx: int, persona: Optional[str] = None, **extra) -> bytes:
+        """流水线里的第 idx 句：第一句带 first=True 与更紧的截止时间，服务端调度优先处理（不带 strict_deadline）"""
+        first = idx == 0
+        return await self.synthesize(
+            text, persona=persona, first=first,
+            deadline_ms=TTS_FIRST_DEADLINE_MS if first else TTS_NEXT_DEADLINE_MS,
+            **extra,
+        )
+
+    async def filler(self, persona: Optional[str]) -> Optional[Dict[str, Any]]:
+        """取一条预合成的垫话（TTS 服务内存里现成的，不做合成）；没有就返回 None"""
+        try:
+            r = await self._client.get("/filler", params={"persona": persona or "wukong"})
+        except httpx.HTTPError:
+            return None
+        if r.status_code != 200:
+            return None
+        return {
+            "audio": r.content,
+            "duration_ms": float(r.headers.get("X-Filler-Duration-Ms", "0")),
+            "text": bytes.fromhex(r.headers.get("X-Filler-Text", "")).decode("utf-8", "ignore"),
+        }
+
+    async def cancel(self, session_id: str) -> dict:
+        """打断：让 TTS 服务终止/作废该会话正在合成与排队的任务"""
+        r = await self._client.post("/cancel", json={"session_id": session_id})
+        r.raise_for_status()
+        return r.json()
+
+    async def aclose(self):
+        await self._client.aclose()
+
+
+class LocalTTSClient(TTSClient):
+    """
+    合并部署（backend/pipeline/combined_app.py）时的进程内客户端：接口与 TTSClient 相同，
+    直接调用 TTS 服务模块（tts_server / tts_xtts_server）里的实现，不经 HTTP、不做 JSON 编解码。
+    出错时抛 HTTPException（对应 TTSClient 的 httpx.HTTPStatusError），调用方按异常统一处理即可。
+    """
+
+    def __init__(self, server):
+        self.base_url = "inproc"
+        self.server = server
+
+    async def synthesize(self, text: str, persona: Optional[str] = None, trace_id: Optional[str] = None,
+                         **extra) -> bytes:
+        req = self.server.TTSIn(text=text, persona=persona, **{k: v for k, v in extra.items() if v is not None})
+        resp = await self.server.render(req, trace_id=trace_id)
+        if hasattr(resp, "body_iterator"):       # 盘层缓存命中是 mmap 流
+            return b"".join([chunk async for chunk in resp.body_iterator])
+        return resp.body
+
+    async def filler(self, persona: Optional[str]) -> Optional[Dict[str, Any]]:
+        clip = self.server.FILLERS.pick(persona or "wukong")
+        if clip is None:
+            return None
+        return {"audio": clip.audio, "duration_ms": float(clip.duration_ms), "text": clip.text}
+
+    async def cancel(self, session_id: str) -> dict:
+        return self.server.cancel(self.server.CancelIn(session_id=session_id))
+
+    async def aclose(self):
+        pass
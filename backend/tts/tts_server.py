@@ -1,21 +1,38 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-# cd backend/tts/
-# uvicorn tts_server:app --host 0.0.0.0 --port 8002
+# 在仓库根目录：
+# uvicorn backend.tts.tts_server:app --host 0.0.0.0 --port 8002
 import os
-import tempfile
-import subprocess
+import time
+import asyncio
+import threading
 from pathlib import Path
-from fastapi import FastAPI, Response, HTTPException
+from fastapi import FastAPI, Request, Response, HTTPException
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from fastapi.middleware.cors import CORSMiddleware
 
+from backend.common.startup import Startup
+from backend.common.arbiter import ArbiterClient
+from backend.common.inflight import CancelBoard
+from backend.common.trace import TRACE_HEADER, Tracer, trace_response
+from backend.common.stats import Ewma
+from backend.tts.audio_cache import AudioCache, cache_key
+from backend.tts.codecs import STATS as CODEC_STATS, make_encoder, negotiate, pcm_to_wav, wav_to_pcm
+from backend.tts.filler import FillerBank
+from backend.tts.piper_pool import SynthesisCancelled, default_pool
+from backend.tts.segment import TTS_CROSSFADE_MS, join_pcm, segment_text, silence
+from backend.tts.scheduler import DeadlineExceeded, SynthScheduler, SynthesisDropped, default_workers
+
+STARTUP = Startup("tts")
+
 """
-运行方式：
-  uvicorn tts_server:app --host 0.0.0.0 --port 8002
+运行方式（仓库根目录）：
+  uvicorn backend.tts.tts_server:app --host 0.0.0.0 --port 8002
 
 准备工作：
-1) 安装 piper 可执行程序（确保命令行能运行 `piper --help`）。
+1) `pip install piper-tts`（进程内常驻合成池）；或安装 piper 可执行程序作为回退
+   （确保命令行能运行 `piper --help`，PIPER_BACKEND=cli）。
 2) 下载语音模型到 VOICE_DIR 目录（见下面 VOICE_MAP 注释）。
    Piper 每个语音包含两个文件：xxx.onnx 和 xxx.onnx.json（或 .json）。
 3) 按你的机器路径改 VOICE_DIR 和 VOICE_MAP。
@@ -66,19 +83,80 @@ class TTSIn(BaseModel):
     # 可选参数
     length_scale: float | None = None  # 全局覆盖语速/停连
     speaker_id: int | None = None      # 若模型支持多说话人
+    session_id: str | None = None      # 会话标识，用于打断（POST /cancel）
+    first: bool | None = None          # 是否为本轮回复的第一句（调度优先）
+    deadline_ms: float | None = None   # 期望完成时间（相对提交），用于排序；赶不上也照样合成
+    strict_deadline: bool | None = None  # 为 True 时赶不上 deadline_ms 直接 503
+    stream: bool | None = None         # 流式输出：按句合成，首句好了就开始发（wav 头长度为 0xFFFFFFFF）
+    encoding: str | None = None        # 输出编码 wav/pcm/mulaw/opus，不填按 Accept 头协商（见 codecs.py）
+    sample_rate: int | None = None     # 服务端降采样到该采样率（只降不升）
     # 兼容将来扩展（如：noise_scale、noise_w 等）
     # noise_scale: float | None = None
     # noise_w: float | None = None
 
+# ====== 常驻合成池：每个语音预加载，启动后首个请求不再付模型加载时间 ======
+PIPER = default_pool()
+
+def _voice_files():
+    return [(str(Path(VOICE_DIR) / v["model"]), str(Path(VOICE_DIR) / v["config"])) for v in VOICE_MAP.values()]
+
 def _ensure_file(p: Path):
     if not p.exists():
         raise FileNotFoundError(str(p))
 
-def synthesize_with_piper(text: str, voice_cfg: dict) -> bytes:
+# ====== 打断（barge-in）：按会话终止正在跑的合成任务 ======
+CANCELS = CancelBoard()
+_JOBS_LOCK = threading.Lock()
+_JOBS: dict[str, dict] = {}           # session_id -> {cancel Event: (start_ts, n_chars)}
+PIPER_MS_PER_CHAR = Ewma(alpha=0.1)   # 估算被打断任务省下的合成时间
+
+def _track_job(session_id: str | None, ev: threading.Event, n_chars: int):
+    if session_id:
+        with _JOBS_LOCK:
+            _JOBS.setdefault(session_id, {})[ev] = (time.perf_counter(), n_chars)
+
+def _untrack_job(session_id: str | None, ev: threading.Event):
+    if session_id:
+        with _JOBS_LOCK:
+            jobs = _JOBS.get(session_id)
+            if jobs is not None:
+                jobs.pop(ev, None)
+                if not jobs:
+                    _JOBS.pop(session_id, None)
+
+# ====== 合成调度：首句优先 + 截止时间 + 按会话公平 ======
+TTS_WORKERS = int(os.getenv("TTS_WORKERS", str(default_workers())))
+TTS_DEADLINE_MS = float(os.getenv("TTS_DEADLINE_MS", "15000"))
+SCHED = SynthScheduler(TTS_WORKERS, name="piper")
+
+# ====== 音频缓存（热层 LRU + 盘层 mmap）======
+CACHE = AudioCache()
+
+# ====== 逐轮追踪：每句一个 span，trace_id 来自 X-Trace-Id（backend/common/trace.py）======
+TRACER = Tracer("tts")
+
+# ====== 与 ASR 同机时的算力仲裁：每段合成前按会话线程数借令牌，ASR 说话时少开几路 ======
+ARBITER = ArbiterClient("tts")
+
+def cancel_session(session_id: str) -> dict:
+    """终止该会话所有在跑的合成（常驻实例在句间停下，cli 进程直接 kill）、丢弃排队中的任务；
+    之后到达的旧请求也会被作废"""
+    CANCELS.cancel(session_id)
+    dropped = SCHED.drop(session_id)
+    with _JOBS_LOCK:
+        jobs = dict(_JOBS.get(session_id, {}))
+    reclaimed_ms = 0.0
+    now = time.perf_counter()
+    for ev, (start, n_chars) in jobs.items():
+        ev.set()
+        expected = n_chars * (PIPER_MS_PER_CHAR.value or 0.0)
+        reclaimed_ms += max(0.0, expected - (now - start) * 1000.0)
+    return {"killed": len(jobs), "dropped": dropped, "reclaimed_ms": round(reclaimed_ms, 1)}
+
+def synthesize_pcm_with_piper(text: str, voice_cfg: dict, session_id: str | None = None) -> tuple[bytes, int]:
     """
-    使用 Piper CLI 合成，输出 wav 字节。
-    做法：把 stdout 写入临时 wav 文件，再读取回来。
-    （piper 版本不同，直出 stdout 的行为不一，这里走临时文件最稳。）
+    用常驻 Piper 池合成，返回 (int16 PCM, 采样率)（全程内存，不落临时文件）。
+    没装 piper-tts 时回退为按请求起 piper 进程（见 piper_pool.py）。
     """
     model = Path(VOICE_DIR) / voice_cfg["model"]
     config = Path(VOICE_DIR) / voice_cfg["config"]
@@ -89,44 +167,66 @@ def synthesize_with_piper(text: str, voice_cfg: dict) -> bytes:
     speaker_id = voice_cfg.get("speaker_id")
     length_scale = voice_cfg.get("length_scale", 1.0)
 
-    # 生成临时 wav
-    with tempfile.TemporaryDirectory() as td:
-        out_wav = Path(td) / "out.wav"
-        cmd = [
-            "piper",
-            "--model", str(model),
-            "--config", str(config),
-            "--length_scale", str(length_scale),
-            "--output_file", str(out_wav),
-        ]
-        if speaker_id is not None:
-            cmd += ["--speaker", str(speaker_id)]
-
-        # 通过 stdin 输入文本
-        try:
-            proc = subprocess.run(
-                cmd,
-                input=text.encode("utf-8"),
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                check=True,
-            )
-        except subprocess.CalledProcessError as e:
-            raise RuntimeError(
-                f"Piper synthesis failed.\nSTDERR:\n{e.stderr.decode(errors='ignore')}"
+    # 登记到会话下，打断时置位
+    cancel_ev = threading.Event()
+    t0 = time.perf_counter()
+    _track_job(session_id, cancel_ev, len(text))
+    try:
+        # ONNX 会话线程数固定，按整块借（借不到就等，等于少开一路并发）
+        with ARBITER.lease(PIPER.intra_op_threads, min_threads=PIPER.intra_op_threads):
+            out = PIPER.synthesize(
+                str(model), str(config), text,
+                speaker_id=speaker_id, length_scale=length_scale, cancel=cancel_ev,
             )
+    finally:
+        _untrack_job(session_id, cancel_ev)
+    PIPER_MS_PER_CHAR.update((time.perf_counter() - t0) * 1000.0 / max(1, len(text)))
+    return out
 
-        if not out_wav.exists():
-            raise RuntimeError("Piper did not produce output WAV.")
+def synthesize_with_piper(text: str, voice_cfg: dict, session_id: str | None = None) -> bytes:
+    """同上，输出 wav 字节"""
+    return pcm_to_wav(*synthesize_pcm_with_piper(text, voice_cfg, session_id=session_id))
 
-        data = out_wav.read_bytes()
-        return data
+async def _await_synth(fut: asyncio.Future):
+    """等待调度结果，把合成侧异常映射为 HTTP 状态码"""
+    try:
+        return await fut
+    except DeadlineExceeded as e:
+        raise HTTPException(status_code=503, detail=f"deadline: {e}")
+    except (SynthesisCancelled, SynthesisDropped):
+        raise HTTPException(status_code=409, detail="cancelled")
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=500, detail=f"Voice model missing: {e}")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/tts", response_class=Response)
-def tts(req: TTSIn):
+async def tts(req: TTSIn, request: Request):
+    return await render(req, request.headers.get("accept"), request.headers.get(TRACE_HEADER))
+
+async def render(req: TTSIn, accept: str | None = None, trace_id: str | None = None) -> Response:
+    """/tts 的实现；合并部署（backend/pipeline/combined_app.py）时 LocalTTSClient 直接调用，不走 HTTP"""
+    # 每句一个 tts span：request → first_byte（流式为首块发出，缓冲为整段合成完）→ done
+    span = TRACER.span(trace_id, "tts", chars=len(req.text or ""), first=bool(req.first),
+                       session_id=req.session_id, stream=bool(req.stream))
+    try:
+        resp = await _render(req, accept)
+    except HTTPException as e:
+        span.set(status=e.status_code)
+        span.end()
+        raise
+    span.set(cache=resp.headers.get("X-Cache"))
+    return trace_response(resp, span)
+
+async def _render(req: TTSIn, accept: str | None) -> Response:
+    submitted = time.time()
     text = (req.text or "").strip()
     if not text:
         raise HTTPException(status_code=400, detail="empty text")
+    try:
+        encoding = negotiate(req.encoding, accept)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
     persona = (req.persona or "wukong").strip()
     if persona not in VOICE_MAP:
@@ -140,14 +240,151 @@ def tts(req: TTSIn):
     if req.speaker_id is not None:
         base["speaker_id"] = int(req.speaker_id)
 
+    # 开场白/常见短句直接走缓存，不占合成线程。
+    # 段间衔接方式也进键：流式只能插停顿（crossfade 0），缓冲模式按 TTS_CROSSFADE_MS 淡化，两种拼法的音频不混用
+    crossfade_ms = 0.0 if req.stream else TTS_CROSSFADE_MS
+    key = cache_key("piper", base["model"], text,
+                    length_scale=base.get("length_scale"), speaker_id=base.get("speaker_id"),
+                    crossfade_ms=crossfade_ms or None)
+    # 缓存里存的是原生 wav；要别的编码/采样率时取出来转码
+    if encoding == "wav" and not req.sample_rate:
+        cached = CACHE.response(key)
+        if cached is not None:
+            return cached
+    else:
+        data = await asyncio.to_thread(CACHE.get, key)
+        if data is not None:
+            pcm, sr = wav_to_pcm(data)
+            return _encoded_response(encoding, pcm, sr, req.sample_rate, {"X-Cache": "transcoded"})
+
+    def job(sent: str):
+        def run() -> tuple[bytes, int]:
+            # 排队期间会话已被打断 → 直接作废
+            if CANCELS.is_cancelled(req.session_id, submitted):
+                raise SynthesisCancelled(req.session_id)
+            return synthesize_pcm_with_piper(sent, base, session_id=req.session_id)
+        return run
+
+    def submit(sent: str, first: bool, deadline_ms: float) -> asyncio.Future:
+        return asyncio.wrap_future(SCHED.submit(
+            job(sent),
+            persona=persona,
+            session_id=req.session_id,
+            first=first,
+            deadline_ms=deadline_ms,
+            n_chars=len(sent),
+            strict=bool(req.strict_deadline),
+        ))
+
+    # 分段：长回复切成句/分句，全部入队由多个工作线程并行合成，再按序拼接
+    deadline_ms = req.deadline_ms or TTS_DEADLINE_MS
+    segments = segment_text(text)
+    futs = _submit_segments(segments, submit, bool(req.first), deadline_ms)
+    if req.stream:
+        return await _stream_tts(segments, futs, key, encoding, req.sample_rate)
+
     try:
-        wav_bytes = synthesize_with_piper(text, base)
-    except FileNotFoundError as e:
-        raise HTTPException(status_code=500, detail=f"Voice model missing: {e}")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        results = [await _await_synth(f) for f in futs]
+    finally:
+        _release(futs)
+    sr = results[0][1]
+    pcm = join_pcm([r[0] for r in results], [p for _, p in segments], sr, crossfade_ms=crossfade_ms)
+    await asyncio.to_thread(CACHE.put, key, pcm_to_wav(pcm, sr))
+    return _encoded_response(encoding, pcm, sr, req.sample_rate, {"X-Segments": str(len(segments))})
+
+def _encoded_response(encoding: str, pcm: bytes, sr: int, out_rate: int | None, headers: dict) -> Response:
+    enc = make_encoder(encoding, sr, out_rate)
+    body = enc.encode_all(pcm)
+    return Response(content=body, media_type=enc.media_type, headers={**enc.headers(), **headers})
+
+def _submit_segments(segments, submit, first: bool, deadline_ms: float) -> list[asyncio.Future]:
+    # 只有段 0 受请求的截止时间约束；后面的段在段 0 播放期间合成，放宽到默认值
+    return [submit(seg, first and i == 0, deadline_ms if i == 0 else max(deadline_ms, TTS_DEADLINE_MS))
+            for i, (seg, _) in enumerate(segments)]
+
+def _release(futs: list[asyncio.Future]):
+    for f in futs:
+        if not f.done():
+            f.cancel()                # 排队中的段不再合成
+        elif not f.cancelled():
+            f.exception()             # 标记已取回，避免 "never retrieved" 警告
+
+async def _stream_tts(segments, futs: list[asyncio.Future], key: str, encoding: str, out_rate: int | None):
+    """
+    流式输出：段 0 合成完就先发头（wav 长度字段 0xFFFFFFFF）+ 段 0 音频，
+    后面的段边合成边按序发，段间插入与缓冲模式相同的停顿；每块按协商的编码增量编码。
+    """
+    # 段 0 出错时还没发响应头，可以正常返回错误码
+    try:
+        pcm0, sr = await _await_synth(futs[0])
+    except HTTPException:
+        _release(futs)
+        raise
 
-    return Response(content=wav_bytes, media_type="audio/wav")
+    enc = make_encoder(encoding, sr, out_rate)
+
+    async def gen():
+        parts = [pcm0]
+        try:
+            yield enc.header() + enc.encode(pcm0)
+            for i, f in enumerate(futs[1:], start=1):
+                try:
+                    pcm, _ = await f
+                except Exception as e:
+                    # 响应头已发出，只能提前结束流
+                    print(f"[tts] stream stopped at segment {i}: {type(e).__name__}: {e}")
+                    return
+                parts.append(pcm)
+                yield enc.encode(silence(segments[i - 1][1], sr) + pcm)
+            yield enc.flush()
+            pcm_all = join_pcm(parts, [p for _, p in segments], sr, crossfade_ms=0)
+            await asyncio.to_thread(CACHE.put, key, pcm_to_wav(pcm_all, sr))
+        finally:
+            _release(futs)
+
+    return StreamingResponse(gen(), media_type=enc.media_type, headers={
+        **enc.headers(),
+        "X-Segments": str(len(segments)),
+    })
+
+@app.get("/stats")
+def stats():
+    return {**SCHED.summary(), "piper": PIPER.summary(), "codecs": CODEC_STATS.summary(),
+            "arbiter": ARBITER.summary(), "trace": TRACER.summary(), "startup": STARTUP.summary()}
+
+@app.get("/cache/stats")
+def cache_stats():
+    return CACHE.summary()
+
+# ====== 垫话：启动时用各人设音色预合成，常驻内存 ======
+FILLERS = FillerBank()
+
+# 后台预加载语音并预合成垫话，不拖慢启动：语音预加载完算就绪（之前到的请求照常按需加载）；
+# 垫话不影响就绪，未完成前 /filler 返回 404
+STARTUP.background("voices", lambda: PIPER.warm(_voice_files()))
+STARTUP.background("fillers", lambda: FILLERS.warm(lambda persona, text: synthesize_with_piper(text, VOICE_MAP[persona])),
+                   required=False)
+
+@app.get("/filler", response_class=Response)
+def filler(persona: str = "wukong"):
+    clip = FILLERS.pick(persona)
+    if clip is None:
+        raise HTTPException(status_code=404, detail="filler not ready")
+    return Response(content=clip.audio, media_type="audio/wav", headers={
+        "X-Filler-Duration-Ms": f"{clip.duration_ms:.0f}",
+        "X-Filler-Text": clip.text.encode("utf-8").hex(),   # header 只能 latin-1，文本用 hex 传
+    })
+
+@app.get("/fillers")
+def fillers():
+    return FILLERS.summary()
+
+class CancelIn(BaseModel):
+    session_id: str
+
+@app.post("/cancel")
+def cancel(req: CancelIn):
+    return cancel_session(req.session_id)
 
 @app.get("/voices")
 def list_voices():
@@ -157,5 +394,9 @@ def list_voices():
         "personas": {
             k: {"model": v["model"], "config": v["config"], "speaker_id": v.get("speaker_id")}
             for k, v in VOICE_MAP.items()
-        }
+        },
+        # 已加载的语音、权重映射的常驻大小（rss/pss）与进程整体内存
+        "store": PIPER.voices(),
     }
+
+STARTUP.install(app, tracer=TRACER)
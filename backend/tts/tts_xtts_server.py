@@ -1,15 +1,28 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-# uvicorn tts_xtts_server:app --host 0.0.0.0 --port 8002
+# 在仓库根目录：uvicorn backend.tts.tts_xtts_server:app --host 0.0.0.0 --port 8002
 import os
+import time
+import asyncio
+import threading
+from contextlib import contextmanager
 from pathlib import Path
-from fastapi import FastAPI, Response, HTTPException
+from fastapi import FastAPI, Request, Response, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-import tempfile
 
-# 关键：Coqui XTTS v2（零样本克隆）
-from TTS.api import TTS
+from backend.common.startup import Startup
+from backend.common.arbiter import ArbiterClient
+from backend.common.inflight import CancelBoard
+from backend.common.trace import TRACE_HEADER, Tracer, trace_response
+from backend.tts.audio_cache import AudioCache, cache_key
+from backend.tts.codecs import STATS as CODEC_STATS, make_encoder, negotiate, pcm_to_wav, wav_to_pcm
+from backend.tts.filler import FillerBank
+from backend.tts.scheduler import DeadlineExceeded, SchedulerBusy, SynthScheduler, SynthesisDropped
+from backend.tts.xtts_latents import LatentStore, to_pcm16
+
+STARTUP = Startup("tts")        # torch / Coqui TTS 与 XTTS 模型都在后台加载，/ready 之前 /tts 回 503
 
 # ============ 配置 ============
 from pathlib import Path
@@ -27,7 +40,23 @@ PERSONA_MAP = {
 # 只加载一次模型（首次运行会自动下载权重到 ~/.local/share/tts）
 # 模型名随 TTS 版本可能略有差异；这个是常用别名：
 MODEL_NAME = "tts_models/multilingual/multi-dataset/xtts_v2"
-tts = TTS(MODEL_NAME).to(DEVICE)
+XTTS_STREAM_CHUNK = int(os.getenv("XTTS_STREAM_CHUNK", "20"))   # 流式每块的 GPT token 数，越小首包越快
+
+# 以下由 load_model() 在后台填上（见文件末尾 STARTUP.background）
+tts = None                  # Coqui TTS(MODEL_NAME)
+MODEL = None                # Xtts 本体：直接用缓存的条件调 inference / inference_stream
+SAMPLE_RATE = 24000         # 加载后按模型配置更新
+# 各人设参考音频的条件（GPT latent + speaker embedding）：启动时算好，内存 + 磁盘缓存
+LATENTS: LatentStore | None = None
+
+def load_model():
+    """关键：Coqui XTTS v2（零样本克隆）；torch 与 TTS 在这里才导入"""
+    global tts, MODEL, SAMPLE_RATE, LATENTS
+    from TTS.api import TTS
+    tts = TTS(MODEL_NAME).to(DEVICE)
+    MODEL = tts.synthesizer.tts_model
+    SAMPLE_RATE = int(getattr(MODEL.config.audio, "output_sample_rate", 24000))
+    LATENTS = LatentStore(MODEL, DEVICE)
 
 # ============ FastAPI ============
 app = FastAPI(title="XTTS v2 TTS", version="0.1.0")
@@ -41,17 +70,103 @@ class TTSIn(BaseModel):
     text: str
     persona: str | None = None
     language: str | None = None   # 可覆盖语言，如 "zh"/"en"
+    session_id: str | None = None # 会话标识，用于打断（POST /cancel）
+    first: bool | None = None     # 是否为本轮回复的第一句（调度优先）
+    deadline_ms: float | None = None  # 期望完成时间（相对提交），用于排序；赶不上也照样合成
+    strict_deadline: bool | None = None  # 为 True 时赶不上 deadline_ms 直接 503
+    stream: bool | None = None    # 流式：边生成边返回（wav 头长度为 0xFFFFFFFF）
+    encoding: str | None = None   # 输出编码 wav/pcm/mulaw/opus，不填按 Accept 头协商（见 codecs.py）
+    sample_rate: int | None = None  # 服务端降采样到该采样率（只降不升）
     # 可选：语速/风格等（XTTS 暂不支持 length_scale，但可用 prosody tokens/情绪等进阶玩法）
 
 def _ensure_file(p: Path):
     if not p.exists():
         raise HTTPException(status_code=500, detail=f"reference wav missing: {p}")
 
+# ====== 打断（barge-in）======
+# XTTS 推理无法中途停下：排队中的任务直接丢弃，正在跑的任务跑完后丢弃结果
+CANCELS = CancelBoard()
+ABANDONED = {"queued": 0, "finished": 0, "stopped": 0}   # stopped：流式生成在块之间被打断
+
+# ====== 音频缓存（热层 LRU + 盘层 mmap）======
+CACHE = AudioCache()
+
+# ====== 逐轮追踪：每句一个 span，trace_id 来自 X-Trace-Id（backend/common/trace.py）======
+TRACER = Tracer("tts")
+
+# ====== 与 ASR 同机时的算力仲裁：GPU 上每条/每块借一个槽位，CPU 上按授予数设 torch 线程 ======
+ARBITER = ArbiterClient("tts", resource="gpu" if DEVICE == "cuda" else "cpu")
+XTTS_CPU_THREADS = int(os.getenv("XTTS_CPU_THREADS", str(os.cpu_count() or 4)))
+
+@contextmanager
+def _compute_lease():
+    import torch
+    want = 1 if ARBITER.resource == "gpu" else XTTS_CPU_THREADS
+    with ARBITER.lease(want) as n:
+        if ARBITER.resource == "cpu" and torch.get_num_threads() != n:
+            torch.set_num_threads(n)
+        yield n
+
+def synthesize_pcm(text: str, persona: str, ref_wav: Path, language: str) -> bytes:
+    """用缓存的条件直接推理，返回 int16 PCM（不再每次编码参考音频、不落临时文件）"""
+    gpt_cond_latent, speaker_embedding = LATENTS.get(persona, ref_wav)
+    out = MODEL.inference(text, language, gpt_cond_latent, speaker_embedding)
+    return to_pcm16(out["wav"])
+
+def _synth_job(text: str, persona: str, ref_wav: Path, language: str, check_queued) -> bytes:
+    """缓冲模式的一条合成（在调度线程上跑）；结果的落盘缓存由调用方在线程池里做，不占模型线程"""
+    import torch
+    check_queued()
+    with torch.inference_mode(), _compute_lease():
+        return pcm_to_wav(synthesize_pcm(text, persona, ref_wav, language), SAMPLE_RATE)
+
+# ====== 合成调度：单个工作线程独占模型，首句优先 + 截止时间 + 按会话公平 ======
+# XTTS 的 inference 没有给独立文本用的 batch 维（各条 speaker 条件不同、GPT 自回归长度不一），
+# 凑批只会白等，所以逐条出队：首句随到随插队，最多排在当前这一条后面
+XTTS_WORKERS = int(os.getenv("XTTS_WORKERS", "1"))
+TTS_DEADLINE_MS = float(os.getenv("TTS_DEADLINE_MS", "15000"))
+XTTS_MAX_QUEUE = int(os.getenv("XTTS_MAX_QUEUE", "64"))           # 排队上限，超过 503（限制内存）
+SCHED = SynthScheduler(XTTS_WORKERS, name="xtts", default_ms_per_char=60.0, max_queue=XTTS_MAX_QUEUE)
+
+async def _await_synth(fut: asyncio.Future):
+    try:
+        return await fut
+    except DeadlineExceeded as e:
+        raise HTTPException(status_code=503, detail=f"deadline: {e}")
+    except SchedulerBusy as e:
+        raise HTTPException(status_code=503, detail=f"busy: {e}")
+    except SynthesisDropped:
+        raise HTTPException(status_code=409, detail="cancelled")
+
 @app.post("/tts", response_class=Response)
-def tts_endpoint(req: TTSIn):
+async def tts_endpoint(req: TTSIn, request: Request):
+    return await render(req, request.headers.get("accept"), request.headers.get(TRACE_HEADER))
+
+async def render(req: TTSIn, accept: str | None = None, trace_id: str | None = None) -> Response:
+    """/tts 的实现；合并部署时 LocalTTSClient 直接调用（与 tts_server.render 同签名）"""
+    # 每句一个 tts span：request → first_byte（流式为首块发出，缓冲为整段合成完）→ done
+    span = TRACER.span(trace_id, "tts", chars=len(req.text or ""), first=bool(req.first),
+                       session_id=req.session_id, stream=bool(req.stream))
+    try:
+        await STARTUP.require()
+        resp = await _render(req, accept)
+    except HTTPException as e:
+        span.set(status=e.status_code)
+        span.end()
+        raise
+    span.set(cache=resp.headers.get("X-Cache"))
+    return trace_response(resp, span)
+
+async def _render(req: TTSIn, accept: str | None) -> Response:
+    submitted = time.time()
     text = (req.text or "").strip()
     if not text:
         raise HTTPException(status_code=400, detail="empty text")
+    try:
+        encoding = negotiate(req.encoding, accept)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    native = encoding == "wav" and not req.sample_rate
 
     persona = (req.persona or "wukong").strip()
     cfg = PERSONA_MAP.get(persona) or PERSONA_MAP["wukong"]
@@ -61,18 +176,183 @@ def tts_endpoint(req: TTSIn):
 
     language = (req.language or cfg["lang"] or "zh").lower()
 
-    with tempfile.TemporaryDirectory() as td:
-        out_wav = Path(td) / "out.wav"
-        # 关键：零样本克隆
-        tts.tts_to_file(
-            text=text,
-            file_path=str(out_wav),
-            speaker_wav=str(ref_wav),
-            language=language
-        )
-        data = out_wav.read_bytes()
+    key = cache_key("xtts", str(ref_wav), text, language=language)
+    # 缓存里存的是原生 wav；要别的编码/采样率时取出来转码
+    if native:
+        cached = CACHE.response(key)
+        if cached is not None:
+            return cached
+    else:
+        data = await asyncio.to_thread(CACHE.get, key)
+        if data is not None:
+            return _encoded_response(encoding, data, req.sample_rate, {"X-Cache": "transcoded"})
+
+    def submit(job) -> asyncio.Future:
+        return asyncio.wrap_future(SCHED.submit(
+            job,
+            persona=persona,
+            session_id=req.session_id,
+            first=bool(req.first),
+            deadline_ms=req.deadline_ms or TTS_DEADLINE_MS,
+            n_chars=len(text),
+            strict=bool(req.strict_deadline),
+        ))
+
+    def check_queued():
+        if CANCELS.is_cancelled(req.session_id, submitted):
+            ABANDONED["queued"] += 1
+            raise SynthesisDropped(req.session_id)
+
+    if req.stream:
+        return await _stream_tts(text, persona, ref_wav, language, key, submit, check_queued,
+                                 lambda: CANCELS.is_cancelled(req.session_id, submitted),
+                                 make_encoder(encoding, SAMPLE_RATE, req.sample_rate))
+
+    data = await _await_synth(submit(lambda: _synth_job(text, persona, ref_wav, language, check_queued)))
+    await asyncio.to_thread(CACHE.put, key, data)
+
+    if CANCELS.is_cancelled(req.session_id, submitted):
+        ABANDONED["finished"] += 1
+        raise HTTPException(status_code=409, detail="cancelled")
+
+    if native:
+        return Response(content=data, media_type="audio/wav")
+    return _encoded_response(encoding, data, req.sample_rate, {})
+
+def _encoded_response(encoding: str, wav: bytes, out_rate: int | None, headers: dict) -> Response:
+    pcm, sr = wav_to_pcm(wav)
+    enc = make_encoder(encoding, sr, out_rate)
+    body = enc.encode_all(pcm)
+    return Response(content=body, media_type=enc.media_type, headers={**enc.headers(), **headers})
 
-    return Response(content=data, media_type="audio/wav")
+_END = object()
+
+async def _stream_tts(text, persona, ref_wav, language, key, submit, check_queued, cancelled, enc):
+    """
+    inference_stream 边生成边出块：工作线程把每块 PCM 投进事件循环的队列，响应按块编码后发出。
+    打断 / 客户端断开时在块之间停下（GPU 单路，早停就能早点让给下一个请求）。
+    """
+    loop = asyncio.get_running_loop()
+    q: asyncio.Queue = asyncio.Queue()
+    stop = threading.Event()
+
+    def job():
+        check_queued()
+        gpt_cond_latent, speaker_embedding = LATENTS.get(persona, ref_wav)
+        parts = []
+        chunks = MODEL.inference_stream(
+            text, language, gpt_cond_latent, speaker_embedding, stream_chunk_size=XTTS_STREAM_CHUNK)
+        while True:
+            # 逐块借令牌：ASR 开口时块与块之间让出来
+            with _compute_lease():
+                chunk = next(chunks, None)
+            if chunk is None:
+                break
+            if stop.is_set() or cancelled():
+                ABANDONED["stopped"] += 1
+                return
+            pcm = to_pcm16(chunk)
+            parts.append(pcm)
+            loop.call_soon_threadsafe(q.put_nowait, pcm)
+        return pcm_to_wav(b"".join(parts), SAMPLE_RATE)     # 生成完整的才缓存，落盘在事件循环侧交给线程池
+
+    fut = submit(job)
+    # 块都是 call_soon_threadsafe 投递的，完成回调排在最后一块之后
+    fut.add_done_callback(lambda _: q.put_nowait(_END))
+
+    first = await q.get()
+    if first is _END:
+        # 一块都没出：排队被拒 / 被打断 / 出错，还能正常返回错误码
+        await _await_synth(fut)
+        raise HTTPException(status_code=409, detail="cancelled")
+
+    async def gen():
+        try:
+            yield enc.header() + enc.encode(first)
+            while (pcm := await q.get()) is not _END:
+                yield enc.encode(pcm)
+            if not fut.cancelled() and fut.exception() is not None:
+                e = fut.exception()
+                print(f"[xtts] stream stopped: {type(e).__name__}: {e}")
+            yield enc.flush()
+            if not fut.cancelled() and fut.exception() is None and fut.result() is not None:
+                await asyncio.to_thread(CACHE.put, key, fut.result())
+        finally:
+            stop.set()
+
+    return StreamingResponse(gen(), media_type=enc.media_type, headers=enc.headers())
+
+@app.get("/stats")
+def stats():
+    return {**SCHED.summary(), "codecs": CODEC_STATS.summary(), "arbiter": ARBITER.summary(),
+            "trace": TRACER.summary(), "startup": STARTUP.summary()}
+
+@app.get("/latents")
+def latents():
+    return LATENTS.summary() if LATENTS is not None else {"loaded": False}
+
+@app.post("/latents/{persona}")
+async def recompute_latents(persona: str):
+    """参考音频替换后强制重算该人设的条件"""
+    cfg = PERSONA_MAP.get(persona)
+    if cfg is None:
+        raise HTTPException(status_code=404, detail=f"unknown persona: {persona}")
+    _ensure_file(cfg["ref"])
+    await STARTUP.require()
+    t0 = time.perf_counter()
+    await _await_synth(asyncio.wrap_future(_on_model_thread(lambda: LATENTS.get(persona, cfg["ref"], force=True))))
+    return {"persona": persona, "ms": round((time.perf_counter() - t0) * 1000.0, 1)}
+
+@app.get("/cache/stats")
+def cache_stats():
+    return CACHE.summary()
+
+# ====== 垫话：启动时用各人设参考音色预合成，常驻内存 ======
+FILLERS = FillerBank()
+
+# 预热 / 维护任务也交给调度线程执行，保证模型始终只有一个线程在用
+_MAINT_DEADLINE_MS = 10 * 60 * 1000.0
+
+def _on_model_thread(fn, persona: str = "maintenance"):
+    return SCHED.submit(fn, persona=persona, deadline_ms=_MAINT_DEADLINE_MS)
+
+def _synth_filler(persona: str, text: str) -> bytes:
+    cfg = PERSONA_MAP[persona]
+    return _on_model_thread(
+        lambda: pcm_to_wav(synthesize_pcm(text, persona, cfg["ref"], cfg["lang"]), SAMPLE_RATE),
+        persona=persona,
+    ).result()
+
+def _load_and_warm():
+    # 加载模型、算好各人设条件才算就绪；垫话之后另起线程预合成（未完成前 /filler 返回 404）
+    load_model()
+    _on_model_thread(lambda: LATENTS.warm(PERSONA_MAP)).result()
+    threading.Thread(target=FILLERS.warm, args=(_synth_filler,), daemon=True, name="xtts-fillers").start()
+
+STARTUP.background("xtts", _load_and_warm)
+
+@app.get("/filler", response_class=Response)
+def filler(persona: str = "wukong"):
+    clip = FILLERS.pick(persona)
+    if clip is None:
+        raise HTTPException(status_code=404, detail="filler not ready")
+    return Response(content=clip.audio, media_type="audio/wav", headers={
+        "X-Filler-Duration-Ms": f"{clip.duration_ms:.0f}",
+        "X-Filler-Text": clip.text.encode("utf-8").hex(),
+    })
+
+@app.get("/fillers")
+def fillers():
+    return FILLERS.summary()
+
+class CancelIn(BaseModel):
+    session_id: str
+
+@app.post("/cancel")
+def cancel(req: CancelIn):
+    CANCELS.cancel(req.session_id)
+    dropped = SCHED.drop(req.session_id)
+    return {"dropped": dropped, "abandoned": dict(ABANDONED)}
 
 @app.get("/voices")
 def voices():
@@ -81,3 +361,5 @@ def voices():
         "model": MODEL_NAME,
         "personas": {k: {"ref": str(v["ref"]), "lang": v["lang"]} for k, v in PERSONA_MAP.items()}
     }
+
+STARTUP.install(app, tracer=TRACER)
@@ -0,0 +1,318 @@
+"""
+Piper 语音模型仓库（piper_pool.py 用）
+
+多开 uvicorn worker / 合成进程时，每个进程都把 VOICE_MAP 里每个 .onnx 整个读进自己的堆，
+内存随 进程数 × 语音数 线性涨。这里做两件事：
+
+- 共享权重：首次使用某个语音时把 .onnx 转存一份“外部数据”格式到 VOICE_STORE_DIR
+  （图结构留在小 .onnx 里，权重按 64KB 对齐写进同名 .onnx.data）。ONNX Runtime 对对齐的
+  外部权重直接 mmap 只读映射，再关掉权重预打包（session.disable_prepacking），
+  各进程、同进程的多个会话共用页缓存里的同一份物理页；
+- 按需加载 + 预算淘汰：语音第一次被用到才加载；总占用超过 VOICE_STORE_BUDGET_MB 时
+  淘汰最久没用、当前也没在合成的语音；空闲超过 VOICE_IDLE_EVICT_S 的也会被卸载。
+
+需要 `pip install onnx` 做格式转换；没装时退回直接加载原 .onnx（各进程各一份，仍按预算淘汰）。
+`GET /voices` 里的 store 一节给出已加载语音及其映射权重的常驻大小（rss / pss，来自 /proc/self/smaps）。
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Dict, Hashable, Iterator, Optional
+
+VOICE_STORE_DIR = Path(os.getenv(
+    "VOICE_STORE_DIR", str(Path(__file__).resolve().parents[1] / "data" / "voice_store")))
+VOICE_STORE_BUDGET_MB = float(os.getenv("VOICE_STORE_BUDGET_MB", "0"))   # 0 = 不限
+VOICE_IDLE_EVICT_S = float(os.getenv("VOICE_IDLE_EVICT_S", "0"))         # 0 = 不按空闲时间卸载
+VOICE_SHARED_WEIGHTS = os.getenv("VOICE_SHARED_WEIGHTS", "1") != "0"
+
+_ALIGN = 64 * 1024          # mmap 偏移须按分配粒度对齐（Windows 64KB，Linux 4KB）
+_MIN_EXTERNAL = 1024        # 太小的常量留在图里
+
+
+# ====== 外部数据格式转换 ======
+def _fingerprint(model: Path) -> str:
+    st = model.stat()
+    raw = f"{model.resolve()}|{st.st_mtime_ns}|{st.st_size}"
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:16]
+
+
+def _tensors(graph) -> Iterator[Any]:
+    """图及其子图（If / Loop 分支）里的全部初始值"""
+    yield from graph.initializer
+    for node in graph.node:
+        for attr in node.attribute:
+            if attr.HasField("g"):
+                yield from _tensors(attr.g)
+            for g in attr.graphs:
+                yield from _tensors(g)
+
+
+def _externalize(src: Path, dst: Path):
+    import onnx
+    from onnx import numpy_helper
+
+    model = onnx.load(str(src))
+    data_path = dst.with_name(dst.name + ".data")
+    tag = f".{os.getpid()}.{threading.get_ident()}.tmp"
+    tmp_data, tmp_model = Path(str(data_path) + tag), Path(str(dst) + tag)
+    with open(tmp_data, "wb") as f:
+        for t in _tensors(model.graph):
+            if t.data_location == onnx.TensorProto.EXTERNAL or t.data_type == onnx.TensorProto.STRING:
+                continue
+            if t.raw_data:
+                raw = t.raw_data
+            else:
+                arr = numpy_helper.to_array(t)
+                raw = arr.astype(arr.dtype.newbyteorder("<"), copy=False).tobytes()
+            if len(raw) < _MIN_EXTERNAL:
+                continue
+            f.write(b"\0" * (-f.tell() % _ALIGN))
+            offset = f.tell()
+            f.write(raw)
+            for field in ("raw_data", "float_data", "int32_data", "int64_data", "double_data", "uint64_data"):
+                t.ClearField(field)
+            t.data_location = onnx.TensorProto.EXTERNAL
+            del t.external_data[:]
+            for k, v in (("location", data_path.name), ("offset", str(offset)), ("length", str(len(raw)))):
+                e = t.external_data.add()
+                e.key, e.value = k, v
+    onnx.save(model, str(tmp_model))
+    # 先换数据再换图：图文件存在即代表转换完整；多个进程同时转换时内容相同，谁后换都一样
+    os.replace(tmp_data, data_path)
+    os.replace(tmp_model, dst)
+
+
+def shared_model(model: str, root: Path = VOICE_STORE_DIR) -> Optional[str]:
+    """返回可 mmap 共享的模型路径（外部数据格式）；没装 onnx / 关闭共享时返回 None"""
+    if not VOICE_SHARED_WEIGHTS:
+        return None
+    src = Path(model)
+    dst = Path(root) / f"{src.stem}-{_fingerprint(src)}.onnx"
+    if dst.exists():
+        return str(dst)
+    try:
+        import onnx  # noqa: F401
+    except ImportError:
+        return None
+    t0 = time.perf_counter()
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    _externalize(src, dst)
+    print(f"[voice] {src.name} → {dst.name}(.data) {(time.perf_counter() - t0) * 1000.0:.0f}ms")
+    return str(dst)
+
+
+def _shareable(model: Path, root: Path = VOICE_STORE_DIR) -> bool:
+    if not VOICE_SHARED_WEIGHTS:
+        return False
+    if (Path(root) / f"{model.stem}-{_fingerprint(model)}.onnx").exists():
+        return True
+    try:
+        import onnx  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def weights_cost(model: str, copies: int) -> int:
+    """预算里计的常驻字节：共享权重不论几个会话只算一份，否则每个会话一份"""
+    src = Path(model)
+    return src.stat().st_size * (1 if _shareable(src) else max(1, copies))
+
+
+def session_options(intra_op_threads: int = 0):
+    """共享权重用的 SessionOptions：关掉预打包，否则 MatMul/Conv 权重会被复制成私有的打包格式"""
+    import onnxruntime
+    opts = onnxruntime.SessionOptions()
+    opts.add_session_config_entry("session.disable_prepacking", "1")
+    if intra_op_threads > 0:
+        opts.intra_op_num_threads = intra_op_threads
+        opts.inter_op_num_threads = 1
+    return opts
+
+
+# ====== 常驻大小 ======
+def mapped_resident(paths) -> Dict[str, Dict[str, int]]:
+    """
+    /proc/self/smaps 里这些文件映射的常驻字节：rss（本进程看到的）、
+    pss（按共享进程数分摊后的）、shared（同时被别的进程映射着的部分）
+    """
+    want = {str(Path(p).resolve()): {"rss": 0, "pss": 0, "shared": 0} for p in paths}
+    cur = None
+    try:
+        with open("/proc/self/smaps", "r") as f:
+            for line in f:
+                head = line.split(None, 5)
+                if len(head) >= 5 and "-" in head[0] and not head[0].endswith(":"):
+                    cur = want.get(head[5].strip()) if len(head) == 6 else None
+                elif cur is not None:
+                    if head[0] == "Rss:":
+                        cur["rss"] += int(head[1]) * 1024
+                    elif head[0] == "Pss:":
+                        cur["pss"] += int(head[1]) * 1024
+                    elif head[0] in ("Shared_Clean:", "Shared_Dirty:"):
+                        cur["shared"] += int(head[1]) * 1024
+    except OSError:
+        pass    # 非 Linux
+    return want
+
+
+def process_memory() -> Dict[str, int]:
+    """整个进程的 rss / pss（pss 把共享映射按进程数分摊，多进程部署看这个）"""
+    out = {}
+    for path, fields in (("/proc/self/status", {"VmRSS:": "rss"}), ("/proc/self/smaps_rollup", {"Pss:": "pss"})):
+        try:
+            with open(path, "r") as f:
+                for line in f:
+                    head = line.split()
+                    if head and head[0] in fields:
+                        out[fields[head[0]]] = int(head[1]) * 1024
+        except OSError:
+            pass
+    return out
+
+
+# ====== 按需加载 + LRU 预算淘汰 ======
+class _Slot:
+    def __init__(self, value: Any, cost: int, load_ms: float):
+        self.value = value
+        self.cost = cost
+        self.load_ms = load_ms
+        self.busy = 0
+        self.last_used = time.monotonic()
+
+
+class VoiceStore:
+    """
+    load(key) 加载一个语音（可能很慢，同一 key 只会有一个线程在加载），
+    cost(key) 估算它的常驻字节（共享权重只算一份）。用 lease(key) 借出，借出期间不会被淘汰。
+    """
+
+    def __init__(
+        self,
+        load: Callable[[Hashable], Any],
+        cost: Callable[[Hashable], int],
+        budget_bytes: int = int(VOICE_STORE_BUDGET_MB * 1024 * 1024),
+        idle_evict_s: float = VOICE_IDLE_EVICT_S,
+    ):
+        self._load = load
+        self._cost = cost
+        self.budget = budget_bytes
+        self.idle_evict_s = idle_evict_s
+        self._lock = threading.Lock()
+        self._slots: "OrderedDict[Hashable, _Slot]" = OrderedDict()   # LRU 顺序
+        self._loading: Dict[Hashable, threading.Lock] = {}
+        self.counters = {"loads": 0, "evicted_budget": 0, "evicted_idle": 0, "over_budget": 0}
+
+    def _used(self) -> int:
+        return sum(s.cost for s in self._slots.values())
+
+    def _evict_locked(self, need: int) -> list:
+        """腾出 need 字节；只动空闲的语音。返回被移除的 (key, slot, 计数项)（锁外释放，或加载失败时放回）"""
+        out = []
+        now = time.monotonic()
+        if self.idle_evict_s > 0:
+            for k, s in list(self._slots.items()):
+                if s.busy == 0 and now - s.last_used > self.idle_evict_s:
+                    out.append((k, self._slots.pop(k), "evicted_idle"))
+                    self.counters["evicted_idle"] += 1
+        if self.budget > 0:
+            used = self._used()
+            for k, s in list(self._slots.items()):
+                if used + need <= self.budget:
+                    break
+                if s.busy == 0:
+                    used -= s.cost
+                    out.append((k, self._slots.pop(k), "evicted_budget"))
+                    self.counters["evicted_budget"] += 1
+            if used + need > self.budget:
+                self.counters["over_budget"] += 1   # 都在合成中，先超一会儿
+        return out
+
+    def _acquire(self, key: Hashable) -> _Slot:
+        with self._lock:
+            s = self._slots.get(key)
+            if s is not None:
+                s.busy += 1
+                self._slots.move_to_end(key)
+                return s
+            gate = self._loading.setdefault(key, threading.Lock())
+        with gate:      # 同一语音只加载一次（预热线程与首个请求可能同时到）
+            with self._lock:
+                s = self._slots.get(key)
+                if s is not None:
+                    s.busy += 1
+                    self._slots.move_to_end(key)
+                    return s
+                cost = self._cost(key)
+                dropped = self._evict_locked(cost)
+            # 被淘汰的语音留到加载成功再释放：加载失败（模型文件坏了、内存不够）时原样放回，
+            # 不因为一次失败的加载白白卸掉别的语音。代价是加载期间峰值多占被淘汰的那部分
+            t0 = time.perf_counter()
+            s = None
+            try:
+                value = self._load(key)
+                s = _Slot(value, cost, (time.perf_counter() - t0) * 1000.0)
+                s.busy = 1
+            finally:
+                with self._lock:
+                    if s is not None:
+                        self._slots[key] = s
+                        self.counters["loads"] += 1
+                    else:
+                        for k, old, counter in reversed(dropped):   # 放回 LRU 队头，顺序不变
+                            if k not in self._slots:
+                                self._slots[k] = old
+                                self._slots.move_to_end(k, last=False)
+                            self.counters[counter] -= 1
+                    self._loading.pop(key, None)
+            del dropped     # 卸载的会话在这里释放（mmap 随之解除）
+            return s
+
+    @contextmanager
+    def lease(self, key: Hashable) -> Iterator[Any]:
+        s = self._acquire(key)
+        try:
+            yield s.value
+        finally:
+            with self._lock:
+                s.busy -= 1
+                s.last_used = time.monotonic()
+            if self.idle_evict_s > 0:
+                self.sweep()    # 顺带卸载别的空闲超时语音
+
+    def warm(self, keys):
+        """按顺序预加载，装不下预算的不再加载（首次用到时再按需加载）"""
+        for key in keys:
+            with self._lock:
+                if key in self._slots:
+                    continue
+                if self.budget > 0 and self._used() + self._cost(key) > self.budget:
+                    return
+            with self.lease(key):
+                pass
+
+    def sweep(self):
+        """卸载空闲超时的语音（调用方定期调用，或随 summary 顺带执行）"""
+        with self._lock:
+            dropped = self._evict_locked(0) if self.idle_evict_s > 0 else []
+        del dropped
+
+    def items(self) -> Dict[Hashable, Dict[str, Any]]:
+        now = time.monotonic()
+        with self._lock:
+            return {
+                k: {"value": s.value, "cost": s.cost, "load_ms": s.load_ms,
+                    "busy": s.busy, "idle_s": now - s.last_used}
+                for k, s in self._slots.items()
+            }
+
+    def summary(self) -> Dict[str, Any]:
+        self.sweep()
+        with self._lock:
+            used, n = self._used(), len(self._slots)
+        return {**self.counters, "loaded_voices": n, "cost_bytes": used, "budget_bytes": self.budget,
+                "idle_evict_s": self.idle_evict_s}
@@ -0,0 +1,114 @@
+"""
+XTTS 说话人条件缓存（tts_xtts_server.py 用）
+
+`tts.tts_to_file(speaker_wav=...)` 每次都对参考音频重新跑一遍条件编码
+（GPT conditioning latent + speaker embedding），CPU 上短句的大部分时间都花在这里。
+这里按人设算一次：内存常驻，同时 torch.save 到 XTTS_LATENT_DIR，重启后直接加载；
+参考音频被替换（mtime/大小变化）时自动重算，也可以 POST /latents/{persona} 强制重算。
+"""
+import hashlib
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Tuple
+
+import numpy as np
+
+XTTS_LATENT_DIR = Path(os.getenv(
+    "XTTS_LATENT_DIR", str(Path(__file__).resolve().parents[1] / "data" / "xtts_latents")))
+
+
+def to_pcm16(wav: Any) -> bytes:
+    """XTTS 输出（float tensor / ndarray，[-1, 1]）→ int16 PCM"""
+    if hasattr(wav, "detach"):       # torch.Tensor（不在模块顶层 import torch，导入本模块不拖进 torch）
+        wav = wav.squeeze().detach().cpu().numpy()
+    wav = np.asarray(wav, dtype=np.float32).reshape(-1)
+    return (np.clip(wav, -1.0, 1.0) * 32767.0).astype("<i2").tobytes()
+
+
+class _Entry:
+    def __init__(self, gpt_cond_latent, speaker_embedding, source: str, ms: float):
+        self.gpt_cond_latent = gpt_cond_latent
+        self.speaker_embedding = speaker_embedding
+        self.source = source        # computed / disk
+        self.ms = ms
+
+
+class LatentStore:
+    def __init__(self, model, device: str, root: Path = XTTS_LATENT_DIR):
+        """model：XTTS 模型本体（TTS(...).synthesizer.tts_model）"""
+        self.model = model
+        self.device = device
+        self.root = Path(root)
+        self._mem: Dict[str, _Entry] = {}
+        self._locks: Dict[str, threading.Lock] = {}
+        self._locks_guard = threading.Lock()
+        self.counters = {"hit": 0, "disk": 0, "computed": 0}
+
+    def _lock(self, persona: str) -> threading.Lock:
+        with self._locks_guard:
+            return self._locks.setdefault(persona, threading.Lock())
+
+    def _fingerprint(self, ref_wav: Path) -> str:
+        st = ref_wav.stat()
+        raw = f"{ref_wav.resolve()}|{st.st_mtime_ns}|{st.st_size}"
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:16]
+
+    def _path(self, persona: str, fp: str) -> Path:
+        return self.root / f"{persona}-{fp}.pt"
+
+    def get(self, persona: str, ref_wav: Path, force: bool = False) -> Tuple[Any, Any]:
+        """返回 (gpt_cond_latent, speaker_embedding)，已在模型所在设备上"""
+        fp = self._fingerprint(ref_wav)
+        mem_key = f"{persona}:{fp}"
+        e = self._mem.get(mem_key)
+        if e is not None and not force:
+            self.counters["hit"] += 1
+            return e.gpt_cond_latent, e.speaker_embedding
+
+        with self._lock(persona):   # 同一人设只算一次（预热与首个请求可能同时到）
+            e = self._mem.get(mem_key)
+            if e is not None and not force:
+                self.counters["hit"] += 1
+                return e.gpt_cond_latent, e.speaker_embedding
+
+            import torch
+            t0 = time.perf_counter()
+            path = self._path(persona, fp)
+            if path.exists() and not force:
+                d = torch.load(path, map_location=self.device)
+                gpt, spk = d["gpt_cond_latent"], d["speaker_embedding"]
+                source = "disk"
+            else:
+                gpt, spk = self.model.get_conditioning_latents(audio_path=[str(ref_wav)])
+                self.root.mkdir(parents=True, exist_ok=True)
+                tmp = path.with_suffix(".tmp")
+                torch.save({"gpt_cond_latent": gpt.cpu(), "speaker_embedding": spk.cpu()}, tmp)
+                os.replace(tmp, path)
+                source = "computed"
+            ms = (time.perf_counter() - t0) * 1000.0
+            self.counters[source] += 1
+            # 同一人设的旧条件（参考音频已替换）不再保留
+            for k in [k for k in self._mem if k.startswith(f"{persona}:")]:
+                self._mem.pop(k, None)
+            self._mem[mem_key] = _Entry(gpt, spk, source, ms)
+            print(f"[xtts] {persona} 条件 {source} {ms:.0f}ms")
+            return gpt, spk
+
+    def warm(self, personas: Dict[str, Dict[str, Any]]):
+        for persona, cfg in personas.items():
+            try:
+                self.get(persona, Path(cfg["ref"]))
+            except Exception as e:
+                print(f"[xtts] {persona} 条件预计算失败: {type(e).__name__}: {e}")
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            **self.counters,
+            "dir": str(self.root),
+            "personas": {
+                k.split(":", 1)[0]: {"source": e.source, "ms": round(e.ms, 1)}
+                for k, e in list(self._mem.items())
+            },
+        }
@@ -4,6 +4,9 @@ set -euo pipefail
 
 export CTRANSLATE2_CUDA_ALLOCATOR=cuda_malloc_async
 export CTRANSLATE2_NUM_THREADS=$(nproc)
+# 与 TTS 同机：whisper 只用半数核，其余交给算力仲裁（python -m backend.common.arbiter serve）分配
+ASR_CPU_THREADS=${ASR_CPU_THREADS:-$(( $(nproc) / 2 > 0 ? $(nproc) / 2 : 1 ))}
+ARBITER_SOCKET=${ARBITER_SOCKET:-/tmp/ai-role-chat-arbiter.sock}
 # 只用 WSL 的 12.x 运行时，避免 /usr/local/cuda 污染
 exec env -i \
   PATH=/usr/bin:/bin \
@@ -11,5 +14,7 @@ exec env -i \
   CUDA_VISIBLE_DEVICES=0 \
   CTRANSLATE2_CUDA_ALLOCATOR=cuda_malloc_async \
   CTRANSLATE2_NUM_THREADS=$(nproc) \
+  ASR_CPU_THREADS=$ASR_CPU_THREADS \
+  ARBITER_SOCKET=$ARBITER_SOCKET \
   CT2_CUDA_TRUE_FP16_GEMM=0 \
   python3 backend/asr.py